@@ -34,6 +34,26 @@ def create_app(config_class=DevelopmentConfig):
     app.register_blueprint(passenger.passenger)
     app.register_blueprint(api.api)
 
+    # Motore di ricerca degli itinerari con scalo
+    from app import reference_data, city_index, route_graph, search_cache, concurrent_search, connections, ranking, airport_index, route_filter, booking, booking_writer, seat_map, idempotency, availability
+    reference_data.init_app(app)
+    city_index.init_app(app)
+    route_filter.init_app(app)
+    route_graph.init_app(app)
+    search_cache.init_app(app)
+    concurrent_search.init_app(app)
+    connections.init_app(app)
+    ranking.init_app(app)
+    airport_index.init_app(app)
+
+    # Prenotazioni (anche a commit di gruppo), blocchi temporanei, mappa dei
+    # posti, chiavi di idempotenza e disponibilità di più voli
+    booking.init_app(app)
+    booking_writer.init_app(app)
+    seat_map.init_app(app)
+    idempotency.init_app(app)
+    availability.init_app(app)
+
     # Creazione delle cartelle necessarie
     import os
     if not os.path.exists(app.config['UPLOAD_FOLDER']):
@@ -0,0 +1,176 @@
+"""
+Indice in memoria degli aeroporti per i suggerimenti di completamento.
+
+Ogni aeroporto è indicizzato per codice IATA, nome, città e paese, senza
+distinzione di maiuscole e accenti (`normalizza`):
+
+- un trie dei prefissi, con una voce per ogni inizio di parola di ogni campo
+  ('aeroporto di roma fiumicino', 'roma fiumicino', 'fiumicino', ...). Ogni
+  nodo conserva già ordinati i migliori `MAX_PER_NODO` aeroporti del suo
+  sottoalbero, quindi un prefisso si risolve in O(lunghezza del prefisso);
+- un indice dei trigrammi, usato solo quando i prefissi non bastano a riempire
+  i suggerimenti, per tollerare errori di battitura ('milno' -> Milano).
+
+Come `indice_città`, l'indice viene costruito dagli aeroporti della cache dei
+dati di riferimento e ricostruito quando la cache viene ricaricata.
+"""
+import threading
+from collections import Counter
+
+from sqlalchemy import inspect
+
+from .city_index import normalizza
+from .models import db, Aeroporto
+from .reference_data import riferimenti
+
+# Peso dei campi: a parità di prefisso il codice IATA precede la città, che
+# precede il nome dell'aeroporto e il paese
+CAMPI = (('codice_iata', 0), ('città', 1), ('nome', 2), ('paese', 3))
+MAX_PER_NODO = 20
+SOGLIA_TRIGRAMMI = 0.5
+
+_FINE = ''
+
+
+def trigrammi(testo):
+    """Trigrammi di un testo normalizzato, con i bordi delle parole: 'roma' -> {'  r', ' ro', 'rom', 'oma', 'ma '}."""
+    testo = f'  {testo} '
+    return {testo[i:i + 3] for i in range(len(testo) - 2)}
+
+
+class IndiceAeroporti:
+    """Trie dei prefissi e indice dei trigrammi sugli aeroporti."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._costruito = -1
+        self.aeroporti = {}
+        self.trie = {}
+        self.per_trigramma = {}
+
+    def _aggiorna(self):
+        generazione = riferimenti.generazione()
+        if self._costruito == generazione:
+            return
+        with self._lock:
+            if self._costruito == generazione:
+                return
+            righe = riferimenti.tutti_aeroporti()
+
+            aeroporti = {}
+            voci = {}
+            per_trigramma = {}
+            for riga in righe:
+                aeroporti[riga.id] = riga._asdict()
+                # Chiave di ordinamento: miglior campo, città, codice
+                ordinamento = (normalizza(riga.città), riga.codice_iata)
+                tri = set()
+                for campo, peso in CAMPI:
+                    parole = normalizza(getattr(riga, campo)).split()
+                    for i in range(len(parole)):
+                        chiave = ' '.join(parole[i:])
+                        # Un inizio di parola interno vale meno dell'inizio del campo
+                        voce = (peso * 2 + (i > 0), ordinamento, riga.id)
+                        if voci.get((chiave, riga.id), voce) >= voce:
+                            voci[(chiave, riga.id)] = voce
+                    tri |= trigrammi(' '.join(parole))
+                for t in tri:
+                    per_trigramma.setdefault(t, []).append(riga.id)
+
+            trie = {}
+            for (chiave, _), voce in voci.items():
+                nodo = trie
+                for carattere in chiave:
+                    nodo = nodo.setdefault(carattere, {})
+                nodo.setdefault(_FINE, []).append(voce)
+            self._compatta(trie)
+
+            self.aeroporti = aeroporti
+            self.trie = trie
+            self.per_trigramma = per_trigramma
+            self._costruito = generazione
+
+    @staticmethod
+    def _compatta(nodo):
+        """
+        Sostituisce le voci di ogni nodo con i migliori `MAX_PER_NODO` aeroporti
+        distinti del suo sottoalbero, unendo quelli già calcolati per i figli.
+
+        Returns:
+            list: Voci (peso, ordinamento, id) migliori del sottoalbero
+        """
+        voci = nodo.get(_FINE, [])
+        for carattere, figlio in nodo.items():
+            if carattere != _FINE:
+                voci += IndiceAeroporti._compatta(figlio)
+        voci.sort()
+        visti = set()
+        migliori = []
+        for voce in voci:
+            if voce[2] not in visti:
+                visti.add(voce[2])
+                migliori.append(voce)
+                if len(migliori) == MAX_PER_NODO:
+                    break
+        nodo[_FINE] = tuple(voce[2] for voce in migliori)
+        return migliori
+
+    def _per_prefisso(self, prefisso):
+        nodo = self.trie
+        for carattere in prefisso:
+            nodo = nodo.get(carattere)
+            if nodo is None:
+                return ()
+        return nodo.get(_FINE, ())
+
+    def _per_trigrammi(self, testo, escludi, limite):
+        tri = trigrammi(testo)
+        conteggi = Counter()
+        for t in tri:
+            conteggi.update(self.per_trigramma.get(t, ()))
+        minimo = SOGLIA_TRIGRAMMI * len(tri)
+        candidati = sorted(
+            (-n, self.aeroporti[a]['città'], a)
+            for a, n in conteggi.items() if n >= minimo and a not in escludi
+        )
+        return [a for _, _, a in candidati[:limite]]
+
+    def suggerisci(self, testo, limite=10):
+        """
+        Aeroporti che corrispondono a un testo parziale.
+
+        Args:
+            testo (str): Codice IATA, città, nome o paese, anche incompleti
+            limite (int): Numero massimo di suggerimenti
+
+        Returns:
+            list: Dizionari con id, codice_iata, nome, città e paese
+        """
+        self._aggiorna()
+        testo = normalizza(testo)
+        if not testo:
+            return []
+        risultati = list(self._per_prefisso(testo)[:limite])
+        if len(risultati) < limite and len(testo) >= 3:
+            risultati += self._per_trigrammi(testo, set(risultati), limite - len(risultati))
+        return [self.aeroporti[a] for a in risultati]
+
+
+indice_aeroporti = IndiceAeroporti()
+
+
+def suggerisci(testo, limite=10):
+    return indice_aeroporti.suggerisci(testo, limite)
+
+
+def init_app(app):
+    """Costruisce l'indice se possibile."""
+    with app.app_context():
+        try:
+            if inspect(db.engine).has_table(Aeroporto.__tablename__):
+                indice_aeroporti.suggerisci('')
+        except Exception:
+            # Database non raggiungibile: l'indice verrà costruito al primo utilizzo
+            pass
+        finally:
+            db.session.remove()
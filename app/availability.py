@@ -0,0 +1,170 @@
+"""
+Disponibilità dei posti di molti voli in una volta, per le pagine dei risultati
+e le integrazioni dei partner.
+
+Dal volo si leggono i contatori dei posti liberi, venduti e bloccati di ogni
+classe (app/booking.py), quindi la disponibilità di qualunque numero di voli è
+una sola SELECT per chiave primaria, senza contare biglietti e blocchi.
+
+I valori letti restano per `DISPONIBILITA_CACHE_TTL` secondi in una cache per
+volo, che vengono tolti al commit di una transazione che tocca il volo (posti
+modificati, biglietti venduti o cancellati, posti bloccati o rilasciati, posti
+assegnati nella mappa) e al suo rollback, perché una lettura fatta nel mezzo
+della transazione non resti in cache. Le modifiche fatte da altri processi si
+vedono alla scadenza della voce.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+from .models import db, Volo, Biglietto, BloccoPosti, MappaPosti
+from .search_cache import valori_attributo
+
+CLASSI = ('economy', 'business', 'first')
+
+
+class CacheDisponibilità:
+    """Cache LRU con TTL della disponibilità, una voce per volo."""
+
+    def __init__(self, dimensione_massima=10000, ttl=5):
+        self.dimensione_massima = dimensione_massima
+        self.ttl = ttl
+        self._voci = OrderedDict()
+        self._lock = threading.Lock()
+
+    def leggi(self, voli_ids):
+        """
+        Returns:
+            tuple: (dict volo_id -> disponibilità in cache, lista degli id mancanti o scaduti)
+        """
+        adesso = time.monotonic()
+        trovati, mancanti = {}, []
+        with self._lock:
+            for volo_id in voli_ids:
+                voce = self._voci.get(volo_id)
+                if voce is None or voce[0] <= adesso:
+                    mancanti.append(volo_id)
+                    continue
+                self._voci.move_to_end(volo_id)
+                trovati[volo_id] = voce[1]
+        return trovati, mancanti
+
+    def scrivi(self, disponibilità):
+        scadenza = time.monotonic() + self.ttl
+        with self._lock:
+            for volo_id, valore in disponibilità.items():
+                self._voci[volo_id] = (scadenza, valore)
+                self._voci.move_to_end(volo_id)
+            while len(self._voci) > self.dimensione_massima:
+                self._voci.popitem(last=False)
+
+    def invalida(self, voli_ids):
+        with self._lock:
+            for volo_id in voli_ids:
+                self._voci.pop(volo_id, None)
+
+    def svuota(self):
+        with self._lock:
+            self._voci.clear()
+
+
+cache_disponibilità = CacheDisponibilità()
+
+COLONNE = (Volo.id, Volo.numero_volo) + tuple(
+    getattr(Volo, f'{contatore}_{classe}')
+    for classe in CLASSI for contatore in ('posti', 'venduti', 'bloccati')
+)
+
+
+def _disponibilità_riga(riga):
+    classi = {}
+    for i, classe in enumerate(CLASSI):
+        liberi, venduti, bloccati = riga[2 + i * 3:5 + i * 3]
+        classi[classe] = {
+            'totali': liberi + venduti + bloccati,
+            'occupati': venduti,
+            'bloccati': bloccati,
+            'disponibili': liberi,
+        }
+    return {'volo_id': riga[0], 'numero_volo': riga[1], 'classi': classi}
+
+
+def disponibilità_voli(voli_ids):
+    """
+    Disponibilità per classe di più voli, con una sola query per i voli non in cache.
+
+    Args:
+        voli_ids (list): ID dei voli
+
+    Returns:
+        dict: volo_id -> {'volo_id', 'numero_volo', 'classi': {classe: {'totali',
+            'occupati', 'bloccati', 'disponibili'}}}; i voli inesistenti mancano
+    """
+    trovati, mancanti = cache_disponibilità.leggi(voli_ids)
+    if mancanti:
+        letti = {
+            riga[0]: _disponibilità_riga(riga)
+            for riga in db.session.execute(select(*COLONNE).where(Volo.id.in_(mancanti)))
+        }
+        cache_disponibilità.scrivi(letti)
+        trovati.update(letti)
+    return trovati
+
+
+def _voli_toccati(session):
+    voli = set()
+    for oggetto in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(oggetto, Volo):
+            voli.add(oggetto.id)
+        elif isinstance(oggetto, (Biglietto, BloccoPosti)):
+            voli.update(valori_attributo(oggetto, 'flight_id'))
+        elif isinstance(oggetto, MappaPosti):
+            voli.add(oggetto.volo_id)
+    voli.discard(None)
+    return voli
+
+
+def invalida_voli(session, volo_ids):
+    """
+    Invalida la disponibilità dei voli modificati con un UPDATE fuori
+    dall'ORM, che non genera eventi di flush: subito e di nuovo a fine
+    transazione.
+    """
+    session.info.setdefault('disponibilità_da_invalidare', set()).update(volo_ids)
+    cache_disponibilità.invalida(volo_ids)
+
+
+def _dopo_flush(session, flush_context):
+    voli = _voli_toccati(session)
+    if voli:
+        invalida_voli(session, voli)
+
+
+def _dopo_commit(session):
+    if session.in_nested_transaction():
+        # RELEASE di un SAVEPOINT: i voli si invalidano al commit vero
+        return
+    cache_disponibilità.invalida(session.info.pop('disponibilità_da_invalidare', ()))
+
+
+def _dopo_rollback(session, transazione_precedente):
+    if transazione_precedente.nested:
+        return
+    cache_disponibilità.invalida(session.info.pop('disponibilità_da_invalidare', ()))
+
+
+def init_app(app):
+    """Configura la cache della disponibilità e registra l'invalidazione."""
+    app.config.setdefault('DISPONIBILITA_CACHE_DIMENSIONE', 10000)
+    app.config.setdefault('DISPONIBILITA_CACHE_TTL', 5)
+    app.config.setdefault('DISPONIBILITA_MASSIMO_VOLI', 300)
+    cache_disponibilità.dimensione_massima = app.config['DISPONIBILITA_CACHE_DIMENSIONE']
+    cache_disponibilità.ttl = app.config['DISPONIBILITA_CACHE_TTL']
+    for nome, funzione in (('after_flush', _dopo_flush),
+                           ('after_commit', _dopo_commit),
+                           ('after_soft_rollback', _dopo_rollback)):
+        if not event.contains(Session, nome, funzione):
+            event.listen(Session, nome, funzione)
@@ -0,0 +1,889 @@
+"""
+Servizio di prenotazione: i posti si riservano con un solo UPDATE condizionale.
+
+`posti_<classe>` di un volo è il numero di posti ancora liberi nella classe,
+`venduti_<classe>` e `bloccati_<classe>` quelli dei biglietti emessi e dei
+blocchi temporanei: la somma dei tre è costante e la disponibilità si legge
+dalla riga del volo, senza contare i biglietti. Una prenotazione di n posti li
+sposta con
+
+    UPDATE volo SET posti_x = posti_x - :n, venduti_x = venduti_x + :n
+    WHERE id = :id AND posti_x >= :n
+
+che controlla e decrementa nello stesso passaggio. Se due prenotazioni si
+contendono gli ultimi posti, il database serializza gli UPDATE sulla riga
+(lock di riga su PostgreSQL, lock di scrittura del database su SQLite) e il
+secondo rivaluta la condizione sul valore già decrementato: non trova la riga
+e la prenotazione fallisce con `PostiNonDisponibili`. Non servono una lettura
+preventiva, un COUNT sui biglietti né un trigger per ogni biglietto, quindi il
+comportamento è lo stesso su SQLite e su PostgreSQL.
+
+Dove il dialetto supporta `UPDATE ... RETURNING` lo stesso passaggio
+restituisce il prezzo della classe; altrimenti si controlla il numero di
+righe aggiornate e il prezzo si legge dopo.
+
+I contatori vengono confrontati a lotti con `biglietto` e `blocco_posti` da
+`verifica_contatori` (`flask posti verifica`), che segnala i voli
+disallineati e, con `--correggi`, li riallinea.
+
+Blocchi temporanei: quando un utente apre la pagina di prenotazione,
+`blocca_posti` toglie subito i posti richiesti dai posti liberi e li registra
+in `blocco_posti` per `BLOCCO_POSTI_DURATA` secondi. La conferma (`prenota`)
+usa i posti del blocco invece di contenderli di nuovo, riservando o
+rilasciando solo la differenza se l'utente ha cambiato numero di passeggeri o
+classe. I blocchi scaduti vengono rilasciati da `scadi_blocchi`: al più ogni
+`BLOCCO_POSTI_PULIZIA` secondi alla creazione di un blocco, quando una
+prenotazione non trova posti sul volo e con `flask blocchi scadi`.
+
+I posti a sedere dei biglietti (`numero_posto`) vengono assegnati dalla mappa
+dei posti del volo (app/seat_map.py) nella stessa transazione. I biglietti di
+una prenotazione si inseriscono con un solo INSERT (più righe in VALUES, con
+RETURNING degli id), qualunque sia il numero di passeggeri.
+
+`prenota_itinerario` prenota un itinerario con scalo come un'unica
+prenotazione: i posti di tutti i voli si riservano nella stessa transazione,
+in ordine di id del volo per non creare attese circolari tra prenotazioni con
+voli in comune.
+
+Modifiche dei voli: `versione`, la colonna di lock ottimistico di `Volo`,
+protegge solo i campi che la compagnia modifica (numero, aeroporti, orari,
+prezzi). Gli UPDATE dei contatori non la incrementano: sommano variazioni, e
+variazioni di prenotazioni e modifiche si compongono in qualunque ordine.
+`aggiorna_volo` scrive i campi con `WHERE versione = :letta` e i posti con un
+UPDATE relativo, come le prenotazioni: su un volo molto venduto la modifica
+non deve ripetere per ogni biglietto emesso nel frattempo.
+
+`annulla_prenotazioni` cancella una o molte prenotazioni con istruzioni su
+insiemi di righe (un UPDATE per i posti di tutti i voli, un DELETE per i
+biglietti); `cancella_volo` la usa per le prenotazioni di un volo cancellato
+dalla compagnia.
+"""
+import threading
+import time
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from sqlalchemy import case, delete, func, insert, select, update
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.orm.util import identity_key
+
+from . import availability, connections, route_graph, search_cache
+from .models import db, Volo, Prenotazione, Biglietto, BloccoPosti
+from .seat_map import assegna_posti, libera_posti
+from .city_index import indice_città
+
+CLASSI = ('economy', 'business', 'first')
+
+
+class PostiNonDisponibili(ValueError):
+    """Il volo non esiste o non ha abbastanza posti liberi nella classe richiesta."""
+
+    def __init__(self, messaggio, volo_id=None):
+        super().__init__(messaggio)
+        self.volo_id = volo_id
+
+
+def _colonne(classe):
+    if classe not in CLASSI:
+        raise ValueError(f'Classe non valida: {classe}')
+    return getattr(Volo, f'posti_{classe}'), getattr(Volo, f'prezzo_{classe}')
+
+
+def _contatori(classe):
+    """Colonne dei posti liberi, venduti e bloccati di una classe."""
+    posti, _ = _colonne(classe)
+    return {
+        'liberi': posti,
+        'venduti': getattr(Volo, f'venduti_{classe}'),
+        'bloccati': getattr(Volo, f'bloccati_{classe}'),
+    }
+
+
+def _scadi_posti(volo_id, classe):
+    # L'UPDATE non passa dagli oggetti della sessione: un Volo già caricato
+    # rileggerà i contatori al prossimo accesso
+    volo = db.session.identity_map.get(identity_key(Volo, volo_id))
+    if volo is not None:
+        db.session.expire(volo, [f'posti_{classe}', f'venduti_{classe}', f'bloccati_{classe}'])
+
+
+def _prezzo(volo_id, classe):
+    _, prezzo = _colonne(classe)
+    riga = db.session.execute(select(prezzo).where(Volo.id == volo_id)).first()
+    if riga is None:
+        raise PostiNonDisponibili('Volo non trovato', volo_id)
+    return riga[0]
+
+
+def sposta_posti(volo_id, classe, liberi=0, venduti=0, bloccati=0):
+    """
+    Somma le variazioni ai contatori dei posti di una classe, con un solo UPDATE.
+
+    Le variazioni si compensano (un posto passa da liberi a venduti, da
+    bloccati a liberi, ...). Se i posti liberi diminuiscono, l'UPDATE li
+    controlla e li toglie nello stesso passaggio.
+
+    Args:
+        volo_id (int): ID del volo
+        classe (str): 'economy', 'business' o 'first'
+        liberi (int): Variazione dei posti liberi
+        venduti (int): Variazione dei biglietti emessi
+        bloccati (int): Variazione dei posti bloccati
+
+    Returns:
+        float: Prezzo base della classe
+
+    Raises:
+        PostiNonDisponibili: se i posti liberi non bastano o il volo non esiste
+    """
+    colonne = _contatori(classe)
+    _, prezzo = _colonne(classe)
+    variazioni = {'liberi': liberi, 'venduti': venduti, 'bloccati': bloccati}
+    valori = {colonne[nome]: colonne[nome] + n for nome, n in variazioni.items() if n}
+    if not valori:
+        return _prezzo(volo_id, classe)
+    condizioni = [Volo.id == volo_id]
+    if liberi < 0:
+        condizioni.append(colonne['liberi'] >= -liberi)
+    istruzione = (
+        update(Volo)
+        .where(*condizioni)
+        .values(valori)
+        .execution_options(synchronize_session=False)
+    )
+    if db.session.get_bind().dialect.update_returning:
+        riga = db.session.execute(istruzione.returning(prezzo)).first()
+    else:
+        riga = None
+        if db.session.execute(istruzione).rowcount == 1:
+            riga = db.session.execute(select(prezzo).where(Volo.id == volo_id)).first()
+    if riga is None:
+        if liberi < 0:
+            raise PostiNonDisponibili('Non ci sono abbastanza posti disponibili', volo_id)
+        raise PostiNonDisponibili('Volo non trovato', volo_id)
+    _scadi_posti(volo_id, classe)
+    return riga[0]
+
+
+def riserva_posti(volo_id, classe, n, stato='venduti'):
+    """
+    Toglie n posti liberi di una classe a un volo, se ci sono.
+
+    Args:
+        volo_id (int): ID del volo
+        classe (str): 'economy', 'business' o 'first'
+        n (int): Numero di posti
+        stato (str): Dove contare i posti tolti: 'venduti' o 'bloccati'
+
+    Returns:
+        float: Prezzo base della classe
+
+    Raises:
+        PostiNonDisponibili: se il volo non ha n posti liberi nella classe
+    """
+    if n < 1:
+        raise ValueError('Il numero di posti deve essere almeno 1')
+    return sposta_posti(volo_id, classe, liberi=-n, **{stato: n})
+
+
+def rilascia_posti(volo_id, classe, n, stato='venduti'):
+    """
+    Restituisce n posti di una classe a un volo: biglietti cancellati
+    (`stato='venduti'`) o blocchi rilasciati (`stato='bloccati'`).
+    """
+    sposta_posti(volo_id, classe, liberi=n, **{stato: -n})
+
+
+def _adatta_posti(volo_id, classe, n, blocco, stato='venduti'):
+    """
+    Porta i posti tenuti sul volo dal blocco (già cancellato) a n posti della
+    classe, contati come `stato`: un solo UPDATE se il blocco è della stessa
+    classe o non c'è.
+
+    Returns:
+        float: Prezzo base della classe
+    """
+    tenuti = 0
+    if blocco is not None:
+        if blocco.classe == classe:
+            tenuti = blocco.posti
+        else:
+            rilascia_posti(volo_id, blocco.classe, blocco.posti, 'bloccati')
+    variazioni = {'liberi': tenuti - n, 'venduti': 0, 'bloccati': -tenuti}
+    variazioni[stato] += n
+    return sposta_posti(volo_id, classe, **variazioni)
+
+
+def _togli_blocco(utente_id, volo_id, anche_scaduto=False):
+    """
+    Cancella il blocco dell'utente sul volo, se c'è, e lo restituisce.
+
+    I posti del blocco restano tolti dai posti liberi: tocca al chiamante
+    usarli o rilasciarli nella stessa transazione. Un blocco scaduto viene
+    ignorato se non `anche_scaduto`: i suoi posti spettano a `scadi_blocchi`.
+    """
+    query = BloccoPosti.query.filter_by(flight_id=volo_id, user_id=utente_id)
+    if not anche_scaduto:
+        query = query.filter(BloccoPosti.scadenza > datetime.now())
+    blocco = query.first()
+    if blocco is not None:
+        db.session.delete(blocco)
+        # StaleDataError se un'altra transazione l'ha già cancellato
+        db.session.flush()
+    return blocco
+
+
+def _con_blocchi_scaduti(operazione):
+    """
+    Esegue `operazione`; se un volo non ha posti, rilascia i blocchi scaduti
+    di quel volo e riprova una volta.
+    """
+    try:
+        return operazione()
+    except PostiNonDisponibili as errore:
+        if errore.volo_id is None or not scadi_blocchi(errore.volo_id):
+            raise
+    return operazione()
+
+
+def blocca_posti(utente_id, volo_id, classe, n):
+    """
+    Tiene n posti di una classe per l'utente per `BLOCCO_POSTI_DURATA` secondi.
+
+    Un blocco precedente dello stesso utente sullo stesso volo viene sostituito
+    (i suoi posti sono usati per il nuovo o rilasciati).
+
+    Args:
+        utente_id (int): ID dell'utente
+        volo_id (int): ID del volo
+        classe (str): 'economy', 'business' o 'first'
+        n (int): Numero di posti
+
+    Returns:
+        BloccoPosti: Il blocco creato
+
+    Raises:
+        PostiNonDisponibili: se il volo non ha abbastanza posti liberi
+    """
+    _pulizia_periodica()
+    durata = timedelta(seconds=current_app.config['BLOCCO_POSTI_DURATA'])
+
+    def blocca():
+        try:
+            _adatta_posti(volo_id, classe, n, _togli_blocco(utente_id, volo_id, anche_scaduto=True), 'bloccati')
+            blocco = BloccoPosti(
+                flight_id=volo_id,
+                user_id=utente_id,
+                classe=classe,
+                posti=n,
+                scadenza=datetime.now() + durata
+            )
+            db.session.add(blocco)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return blocco
+
+    return _con_blocchi_scaduti(blocca)
+
+
+def blocco_attivo(utente_id, volo_id):
+    """Blocco non scaduto dell'utente sul volo, o None."""
+    return BloccoPosti.query.filter(
+        BloccoPosti.flight_id == volo_id,
+        BloccoPosti.user_id == utente_id,
+        BloccoPosti.scadenza > datetime.now()
+    ).first()
+
+
+def scadi_blocchi(volo_id=None, limite=1000):
+    """
+    Rilascia i posti dei blocchi scaduti e li cancella, in una transazione.
+
+    Args:
+        volo_id (int): Solo i blocchi di questo volo; None per tutti
+        limite (int): Numero massimo di blocchi rilasciati
+
+    Returns:
+        int: Numero di blocchi rilasciati (0 se un'altra transazione li ha
+            rilasciati per prima)
+    """
+    try:
+        rilasciati = _rilascia_scaduti(volo_id, limite)
+        db.session.commit()
+    except StaleDataError:
+        db.session.rollback()
+        return 0
+    except Exception:
+        db.session.rollback()
+        raise
+    return rilasciati
+
+
+def _rilascia_scaduti(volo_id=None, limite=1000):
+    """
+    `scadi_blocchi` senza commit.
+
+    Raises:
+        StaleDataError: se un'altra transazione ha cancellato un blocco per prima
+    """
+    query = BloccoPosti.query.filter(BloccoPosti.scadenza <= datetime.now())
+    if volo_id is not None:
+        query = query.filter(BloccoPosti.flight_id == volo_id)
+    blocchi = query.order_by(BloccoPosti.scadenza).limit(limite).all()
+    if not blocchi:
+        return 0
+    posti = defaultdict(int)
+    for blocco in blocchi:
+        posti[(blocco.flight_id, blocco.classe)] += blocco.posti
+    for (volo, classe), n in posti.items():
+        rilascia_posti(volo, classe, n, 'bloccati')
+    # I blocchi si cancellano dopo aver rilasciato i posti, così il flush
+    # notifica coincidenze e cache con i posti già aggiornati; se un'altra
+    # transazione li ha cancellati per prima, il rollback annulla il rilascio
+    for blocco in blocchi:
+        db.session.delete(blocco)
+    db.session.flush()
+    return len(blocchi)
+
+
+_ultima_pulizia = 0.0
+_lock_pulizia = threading.Lock()
+
+
+def _pulizia_periodica():
+    """Rilascia i blocchi scaduti di tutti i voli, al più ogni `BLOCCO_POSTI_PULIZIA` secondi."""
+    global _ultima_pulizia
+    if time.monotonic() - _ultima_pulizia < current_app.config['BLOCCO_POSTI_PULIZIA']:
+        return
+    if not _lock_pulizia.acquire(blocking=False):
+        return
+    try:
+        _ultima_pulizia = time.monotonic()
+        scadi_blocchi()
+    finally:
+        _lock_pulizia.release()
+
+
+def _conferma(utente_id, tratte, classe, passeggeri, supplemento, bagaglio_extra, servizi_extra, esito=None):
+    """
+    Riserva i posti e scrive prenotazione e biglietti, in una transazione.
+
+    Args:
+        tratte (list): Coppie (volo_id, numeri_posto) nell'ordine dell'itinerario
+        esito (callable): Chiamata con la prenotazione prima del commit
+
+    Returns:
+        Prenotazione: La prenotazione confermata
+    """
+    try:
+        prenotazione = _registra(
+            utente_id, tratte, classe, passeggeri, supplemento, bagaglio_extra, servizi_extra, esito
+        )
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return prenotazione
+
+
+def _registra(utente_id, tratte, classe, passeggeri, supplemento, bagaglio_extra, servizi_extra, esito=None):
+    """`_conferma` senza commit: la transazione resta al chiamante."""
+    ordine = {volo_id: i for i, (volo_id, _) in enumerate(tratte)}
+    prezzi, posti = {}, {}
+    # Lock delle righe dei voli (blocco, volo, mappa dei posti) sempre in
+    # ordine di id, qualunque sia l'ordine dell'itinerario
+    for volo_id, numeri_posto in sorted(tratte, key=lambda tratta: tratta[0]):
+        blocco = _togli_blocco(utente_id, volo_id)
+        prezzi[volo_id] = _adatta_posti(volo_id, classe, passeggeri, blocco)
+        posti[volo_id] = assegna_posti(volo_id, classe, passeggeri, numeri_posto)
+    # Il supplemento si paga una volta per passeggero, non per tratta: va sul
+    # biglietto del primo volo dell'itinerario
+    prezzi[tratte[0][0]] += supplemento
+    prenotazione = Prenotazione(
+        user_id=utente_id,
+        stato='confermata',
+        prezzo_totale=sum(prezzi.values()) * passeggeri
+    )
+    db.session.add(prenotazione)
+    db.session.flush()
+    # Un solo INSERT con i biglietti di tutti i voli; l'ordine delle righe
+    # di RETURNING non serve (chiederlo su SQLite fa un INSERT per riga)
+    biglietti = db.session.scalars(
+        insert(Biglietto).returning(Biglietto),
+        [
+            {
+                'booking_id': prenotazione.id,
+                'flight_id': volo_id,
+                'passeggero_id': utente_id,
+                'classe': classe,
+                'numero_posto': numero_posto,
+                'prezzo': prezzi[volo_id],
+                'bagaglio_extra': bagaglio_extra,
+                'servizi_extra': servizi_extra
+            }
+            for volo_id, _ in tratte
+            for numero_posto in posti[volo_id]
+        ]
+    ).all()
+    biglietti.sort(key=lambda biglietto: (ordine[biglietto.flight_id], biglietto.id))
+    set_committed_value(prenotazione, 'biglietti', biglietti)
+    if esito is not None:
+        esito(prenotazione)
+    return prenotazione
+
+
+def prenota(utente_id, volo_id, classe, passeggeri, supplemento=0, bagaglio_extra=False,
+            servizi_extra='', numeri_posto=None, esito=None):
+    """
+    Prenota dei posti di una classe su un volo, in una sola transazione.
+
+    Se l'utente ha un blocco attivo sul volo, i posti bloccati vengono usati
+    per la prenotazione e il blocco cancellato.
+
+    Args:
+        utente_id (int): ID dell'utente che prenota (e passeggero dei biglietti)
+        volo_id (int): ID del volo
+        classe (str): 'economy', 'business' o 'first'
+        passeggeri (int): Numero di biglietti
+        supplemento (float): Costo aggiunto al prezzo base di ogni biglietto
+        bagaglio_extra (bool): Bagaglio extra sui biglietti
+        servizi_extra (str): Servizi extra sui biglietti
+        numeri_posto (list): Posti scelti, uno per biglietto; se None
+            vengono assegnati dalla mappa dei posti (app/seat_map.py),
+            vicini nella stessa fila quando possibile
+        esito (callable): Chiamata con la prenotazione nella stessa
+            transazione, prima del commit (per esempio per salvare la
+            risposta di una Idempotency-Key, app/idempotency.py)
+
+    Returns:
+        Prenotazione: La prenotazione confermata
+
+    Raises:
+        PostiNonDisponibili: se il volo non ha abbastanza posti liberi; la
+            transazione viene annullata
+        PostoNonDisponibile: se un posto scelto è già assegnato
+    """
+    return _con_blocchi_scaduti(lambda: _conferma(
+        utente_id, [(volo_id, numeri_posto)], classe, passeggeri, supplemento, bagaglio_extra, servizi_extra, esito
+    ))
+
+
+def _verifica_itinerario(voli_ids):
+    """
+    Controlla che i voli formino un itinerario: ogni volo parte dalla città
+    in cui arriva il precedente, almeno `RICERCA_TEMPO_MIN_SCALO` dopo.
+
+    Raises:
+        ValueError: se i voli non formano un itinerario
+        PostiNonDisponibili: se un volo non esiste
+    """
+    max_voli = current_app.config.get('RICERCA_MAX_SCALI', 2) + 1
+    if not 1 <= len(voli_ids) <= max_voli:
+        raise ValueError(f'Un itinerario ha da 1 a {max_voli} voli')
+    if len(set(voli_ids)) != len(voli_ids):
+        raise ValueError('Lo stesso volo compare più volte nell\'itinerario')
+    voli = {
+        v.id: v for v in db.session.execute(
+            select(Volo.id, Volo.aeroporto_partenza_id, Volo.aeroporto_arrivo_id,
+                   Volo.data_partenza, Volo.data_arrivo)
+            .where(Volo.id.in_(voli_ids))
+        )
+    }
+    for volo_id in voli_ids:
+        if volo_id not in voli:
+            raise PostiNonDisponibili('Volo non trovato', volo_id)
+    tempo_min_scalo = current_app.config.get('RICERCA_TEMPO_MIN_SCALO', timedelta(hours=2))
+    for precedente, successivo in zip(voli_ids, voli_ids[1:]):
+        arrivo, partenza = voli[precedente], voli[successivo]
+        if partenza.aeroporto_partenza_id not in indice_città.stessa_città(arrivo.aeroporto_arrivo_id):
+            raise ValueError(f'Il volo {successivo} non parte dalla città di arrivo del volo {precedente}')
+        if partenza.data_partenza < arrivo.data_arrivo + tempo_min_scalo:
+            raise ValueError(f'Tempo di coincidenza insufficiente tra i voli {precedente} e {successivo}')
+
+
+def prenota_itinerario(utente_id, voli_ids, classe, passeggeri, supplemento=0, bagaglio_extra=False,
+                       servizi_extra='', esito=None):
+    """
+    Prenota un itinerario con scalo in una sola transazione: una
+    `Prenotazione` con i biglietti di tutti i voli, o niente.
+
+    Se un volo non ha posti la transazione viene annullata per intero, senza
+    prenotazioni a metà. I posti si riservano in ordine di id del volo (non
+    di itinerario), così due prenotazioni con voli in comune prendono i lock
+    delle righe nello stesso ordine e non possono bloccarsi a vicenda.
+    I blocchi attivi dell'utente sui voli vengono usati come in `prenota`.
+
+    Args:
+        utente_id (int): ID dell'utente che prenota (e passeggero dei biglietti)
+        voli_ids (list): ID dei voli nell'ordine dell'itinerario
+        classe (str): 'economy', 'business' o 'first'
+        passeggeri (int): Numero di passeggeri (un biglietto per volo ciascuno)
+        supplemento (float): Costo aggiunto una volta per passeggero, al
+            biglietto del primo volo
+        bagaglio_extra (bool): Bagaglio extra sui biglietti
+        servizi_extra (str): Servizi extra sui biglietti
+        esito (callable): Come in `prenota`
+
+    Returns:
+        Prenotazione: La prenotazione confermata
+
+    Raises:
+        ValueError: se i voli non formano un itinerario
+        PostiNonDisponibili: se un volo non ha abbastanza posti liberi
+            (`volo_id` dell'eccezione); la transazione viene annullata
+    """
+    _verifica_itinerario(voli_ids)
+    return _con_blocchi_scaduti(lambda: _conferma(
+        utente_id, [(volo_id, None) for volo_id in voli_ids], classe, passeggeri,
+        supplemento, bagaglio_extra, servizi_extra, esito
+    ))
+
+
+def aggiorna_volo(volo_id, valori, variazioni_posti, tentativi=5):
+    """
+    Modifica un volo con il lock ottimistico sulla versione.
+
+    Gli altri campi prendono i valori dati e si scrivono solo se la versione
+    letta è ancora quella del volo: se un'altra modifica l'ha preceduta, il
+    volo viene riletto e la modifica ripetuta. I posti si modificano per
+    differenza, con un UPDATE che li somma ai posti liberi attuali nella
+    stessa istruzione (come le prenotazioni, che non cambiano la versione):
+    i posti venduti nel frattempo non si perdono e non fanno ripetere.
+    L'UPDATE non genera eventi di flush: le coincidenze del volo e le cache
+    di ricerca, grafi e disponibilità si aggiornano subito dopo.
+
+    Args:
+        volo_id (int): ID del volo
+        valori (dict): Nuovi valori dei campi del volo (numero, aeroporti,
+            orari, prezzi)
+        variazioni_posti (dict): Per classe, posti liberi da aggiungere
+            (negativi per toglierli)
+        tentativi (int): Scritture tentate prima di rinunciare
+
+    Returns:
+        Volo: Il volo modificato
+
+    Raises:
+        ValueError: se una classe resterebbe con meno di zero posti liberi o
+            il volo non esiste
+        StaleDataError: se il volo è cambiato a ogni tentativo
+    """
+    for tentativo in range(tentativi):
+        try:
+            volo = db.session.get(Volo, volo_id, populate_existing=True)
+            if volo is None:
+                raise ValueError('Volo non trovato')
+            for campo, valore in valori.items():
+                setattr(volo, campo, valore)
+            # UPDATE dei campi con il controllo della versione
+            db.session.flush()
+            _aggiungi_posti(volo, variazioni_posti)
+            db.session.commit()
+            return volo
+        except StaleDataError:
+            db.session.rollback()
+            if tentativo == tentativi - 1:
+                raise
+        except Exception:
+            db.session.rollback()
+            raise
+
+
+def _aggiungi_posti(volo, variazioni_posti):
+    """Somma le variazioni ai posti liberi e totali del volo, con un solo UPDATE."""
+    variazioni = {classe: n for classe, n in variazioni_posti.items() if n}
+    if not variazioni:
+        return
+    colonne = {classe: _colonne(classe)[0] for classe in variazioni}
+    valori = {colonne[classe]: colonne[classe] + n for classe, n in variazioni.items()}
+    valori[Volo.posti_totali] = Volo.posti_totali + sum(variazioni.values())
+    condizioni = [Volo.id == volo.id]
+    condizioni += [colonne[classe] >= -n for classe, n in variazioni.items() if n < 0]
+    istruzione = (
+        update(Volo)
+        .where(*condizioni)
+        .values(valori)
+        .execution_options(synchronize_session=False)
+    )
+    if db.session.execute(istruzione).rowcount != 1:
+        liberi = db.session.execute(select(*colonne.values()).where(Volo.id == volo.id)).first()
+        if liberi is None:
+            raise ValueError('Volo non trovato')
+        for (classe, n), rimasti in zip(variazioni.items(), liberi):
+            if rimasti + n < 0:
+                raise ValueError(f'Non si possono togliere {-n} posti {classe}: ne restano liberi {rimasti}')
+    db.session.expire(volo, [colonna.key for colonna in colonne.values()] + ['posti_totali'])
+    _posti_modificati({volo.id})
+
+
+def _posti_modificati(volo_ids):
+    """
+    Riporta un UPDATE dei posti liberi, che non passa dagli eventi di flush,
+    sulle coincidenze dei voli e sulle cache di ricerca, grafi e disponibilità.
+    """
+    session = db.session()
+    if current_app.config.get('RICERCA_USA_COINCIDENZE', True):
+        connections.aggiorna_posti(session.connection(), volo_ids)
+    for modulo in (search_cache, route_graph, availability):
+        modulo.invalida_voli(session, volo_ids)
+
+
+def _annulla(prenotazioni_ids):
+    """
+    Cancella le prenotazioni (già bloccate) e rimette in vendita i loro posti,
+    senza caricare biglietti e voli nella sessione.
+
+    Returns:
+        int: Numero di prenotazioni cancellate
+    """
+    biglietti = Biglietto.booking_id.in_(prenotazioni_ids)
+    # Lock dei voli in ordine di id, come le prenotazioni
+    voli_ids = db.session.execute(
+        select(Volo.id)
+        .where(Volo.id.in_(select(Biglietto.flight_id).where(biglietti)))
+        .order_by(Volo.id)
+        .with_for_update()
+    ).scalars().all()
+
+    # Un solo UPDATE ... FROM per i posti di tutti i voli e le classi
+    per_volo = (
+        select(
+            Biglietto.flight_id,
+            *[func.sum(case((Biglietto.classe == classe, 1), else_=0)).label(classe) for classe in CLASSI]
+        )
+        .where(biglietti)
+        .group_by(Biglietto.flight_id)
+        .subquery()
+    )
+    valori = {}
+    for classe in CLASSI:
+        colonne = _contatori(classe)
+        valori[colonne['liberi']] = colonne['liberi'] + per_volo.c[classe]
+        valori[colonne['venduti']] = colonne['venduti'] - per_volo.c[classe]
+    db.session.execute(
+        update(Volo)
+        .where(Volo.id == per_volo.c.flight_id)
+        .values(valori)
+        .execution_options(synchronize_session=False)
+    )
+
+    # Un solo DELETE per i biglietti, che restituisce i posti da liberare nella mappa
+    cancella = delete(Biglietto).where(biglietti).execution_options(synchronize_session=False)
+    colonne_posto = (Biglietto.flight_id, Biglietto.classe, Biglietto.numero_posto)
+    if db.session.get_bind().dialect.delete_returning:
+        righe = db.session.execute(cancella.returning(*colonne_posto)).all()
+    else:
+        righe = db.session.execute(select(*colonne_posto).where(biglietti)).all()
+        db.session.execute(cancella)
+    posti = defaultdict(list)
+    for volo_id, classe, numero_posto in righe:
+        posti[(volo_id, classe)].append(numero_posto)
+    for (volo_id, classe), etichette in sorted(posti.items()):
+        libera_posti(volo_id, classe, etichette)
+
+    cancellate = db.session.execute(
+        delete(Prenotazione)
+        .where(Prenotazione.id.in_(prenotazioni_ids))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    for volo_id in voli_ids:
+        for classe in CLASSI:
+            _scadi_posti(volo_id, classe)
+    return cancellate
+
+
+def annulla_prenotazioni(prenotazioni_ids, utente_id=None):
+    """
+    Cancella delle prenotazioni e rimette in vendita i loro posti, in una transazione.
+
+    Il numero di istruzioni non dipende dal numero di biglietti: i contatori
+    dei posti di tutti i voli si aggiornano con un solo `UPDATE ... FROM`
+    sui biglietti raggruppati per volo, biglietti e prenotazioni si cancellano
+    con un DELETE ciascuno e i posti si liberano nella mappa una volta per
+    volo e classe. Le prenotazioni sono bloccate (`SELECT ... FOR UPDATE`)
+    prima di contare i biglietti, quindi due cancellazioni della stessa
+    prenotazione non restituiscono i posti due volte (su SQLite il lock di
+    scrittura del database serializza UPDATE e DELETE: la seconda non trova
+    più biglietti).
+
+    Args:
+        prenotazioni_ids (list): ID delle prenotazioni
+        utente_id (int): Se indicato, solo le prenotazioni di questo utente
+
+    Returns:
+        int: Numero di prenotazioni cancellate
+    """
+    condizioni = [Prenotazione.id.in_(prenotazioni_ids)]
+    if utente_id is not None:
+        condizioni.append(Prenotazione.user_id == utente_id)
+    try:
+        ids = db.session.execute(
+            select(Prenotazione.id).where(*condizioni).order_by(Prenotazione.id).with_for_update()
+        ).scalars().all()
+        cancellate = _annulla(ids) if ids else 0
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return cancellate
+
+
+def cancella_volo(volo_id):
+    """
+    Cancella un volo e tutte le prenotazioni con biglietti sul volo, in una
+    transazione: i posti delle altre tratte degli itinerari tornano liberi.
+
+    Returns:
+        int: Numero di prenotazioni cancellate
+    """
+    try:
+        ids = db.session.execute(
+            select(Prenotazione.id)
+            .where(Prenotazione.id.in_(select(Biglietto.booking_id).where(Biglietto.flight_id == volo_id)))
+            .order_by(Prenotazione.id)
+            .with_for_update()
+        ).scalars().all()
+        cancellate = _annulla(ids) if ids else 0
+        # Lock della riga: nessuna prenotazione o modifica tra la lettura e
+        # il DELETE, che controlla la versione appena riletta
+        volo = db.session.get(Volo, volo_id, with_for_update=True, populate_existing=True)
+        if volo is not None:
+            db.session.delete(volo)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return cancellate
+
+
+Disallineamento = namedtuple('Disallineamento', ['volo_id', 'classe', 'contatore', 'valore', 'atteso'])
+
+
+def _disallineati(volo_ids):
+    """Contatori dei voli diversi dai biglietti emessi e dai posti bloccati."""
+    attesi = defaultdict(int)
+    for volo_id, classe, n in db.session.execute(
+        select(Biglietto.flight_id, Biglietto.classe, func.count(Biglietto.id))
+        .where(Biglietto.flight_id.in_(volo_ids))
+        .group_by(Biglietto.flight_id, Biglietto.classe)
+    ):
+        attesi[(volo_id, classe, 'venduti')] = n
+    for volo_id, classe, n in db.session.execute(
+        select(BloccoPosti.flight_id, BloccoPosti.classe, func.sum(BloccoPosti.posti))
+        .where(BloccoPosti.flight_id.in_(volo_ids))
+        .group_by(BloccoPosti.flight_id, BloccoPosti.classe)
+    ):
+        attesi[(volo_id, classe, 'bloccati')] = n
+    colonne = [_contatori(classe)[contatore] for classe in CLASSI for contatore in ('venduti', 'bloccati')]
+    disallineati = []
+    for volo_id, *valori in db.session.execute(select(Volo.id, *colonne).where(Volo.id.in_(volo_ids))):
+        for colonna, valore in zip(colonne, valori):
+            contatore, classe = colonna.key.split('_', 1)
+            atteso = attesi[(volo_id, classe, contatore)]
+            if valore != atteso:
+                disallineati.append(Disallineamento(volo_id, classe, contatore, valore, atteso))
+    return disallineati
+
+
+def verifica_contatori(correggi=False, lotto=500):
+    """
+    Confronta i contatori dei posti venduti e bloccati con `biglietto` e
+    `blocco_posti`, a lotti di voli in ordine di id.
+
+    I voli che risultano disallineati vengono ricontrollati con la riga del
+    volo bloccata (`SELECT ... FOR UPDATE`): prenotazioni e cancellazioni
+    aggiornano il volo prima di scrivere i biglietti, quindi con il lock non
+    ce ne sono in corso e un conteggio fatto a metà di una prenotazione non
+    viene segnalato. Ogni lotto è una transazione a sé.
+
+    Args:
+        correggi (bool): Riallinea i contatori dei voli disallineati (i posti
+            liberi restano come sono)
+        lotto (int): Voli per transazione
+
+    Returns:
+        list: `Disallineamento` (volo_id, classe, contatore, valore, atteso)
+    """
+    risultato = []
+    ultimo = 0
+    while True:
+        volo_ids = db.session.execute(
+            select(Volo.id).where(Volo.id > ultimo).order_by(Volo.id).limit(lotto)
+        ).scalars().all()
+        if not volo_ids:
+            break
+        ultimo = volo_ids[-1]
+        try:
+            sospetti = sorted({d.volo_id for d in _disallineati(volo_ids)})
+            if sospetti:
+                db.session.execute(select(Volo.id).where(Volo.id.in_(sospetti)).order_by(Volo.id).with_for_update())
+                disallineati = _disallineati(sospetti)
+                for d in disallineati:
+                    current_app.logger.warning(
+                        'Contatore %s_%s del volo %s: %s invece di %s',
+                        d.contatore, d.classe, d.volo_id, d.valore, d.atteso
+                    )
+                    if correggi:
+                        colonna = _contatori(d.classe)[d.contatore]
+                        db.session.execute(
+                            update(Volo)
+                            .where(Volo.id == d.volo_id)
+                            .values({colonna: d.atteso})
+                            .execution_options(synchronize_session=False)
+                        )
+                        _scadi_posti(d.volo_id, d.classe)
+                risultato.extend(disallineati)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    return risultato
+
+
+@click.group('posti')
+def comandi_posti():
+    """Contatori dei posti dei voli."""
+
+
+@comandi_posti.command('verifica')
+@click.option('--correggi', is_flag=True, help='Riallinea i contatori disallineati')
+@click.option('--lotto', default=500, show_default=True, help='Voli per transazione')
+def comando_verifica(correggi, lotto):
+    """Confronta i contatori dei posti venduti e bloccati con biglietti e blocchi."""
+    disallineati = verifica_contatori(correggi=correggi, lotto=lotto)
+    for d in disallineati[:20]:
+        click.echo(f'  volo {d.volo_id} {d.contatore}_{d.classe}: {d.valore} invece di {d.atteso}')
+    if disallineati and not correggi:
+        click.echo(f'Contatori disallineati: {len(disallineati)}; eseguire "flask posti verifica --correggi"')
+        raise SystemExit(1)
+    click.echo(f'Contatori corretti: {len(disallineati)}' if disallineati else 'Contatori allineati')
+
+
+@click.group('blocchi')
+def comandi():
+    """Gestione dei blocchi temporanei dei posti."""
+
+
+@comandi.command('scadi')
+def comando_scadi():
+    """Rilascia i posti dei blocchi scaduti."""
+    totale = 0
+    while True:
+        rilasciati = scadi_blocchi()
+        if not rilasciati:
+            break
+        totale += rilasciati
+    click.echo(f'Blocchi rilasciati: {totale}')
+
+
+def init_app(app):
+    """Durata dei blocchi dei posti e comandi `flask blocchi` e `flask posti`."""
+    app.config.setdefault('BLOCCO_POSTI_DURATA', 600)
+    app.config.setdefault('BLOCCO_POSTI_PULIZIA', 60)
+    app.cli.add_command(comandi)
+    app.cli.add_command(comandi_posti)
@@ -0,0 +1,238 @@
+"""
+Scrittore delle prenotazioni a commit di gruppo, per i picchi di vendita.
+
+Normalmente ogni prenotazione è una transazione con il suo commit, e durante
+una vendita lampo il flush del log del database a ogni commit diventa il
+limite. Con `PRENOTAZIONI_COMMIT_DI_GRUPPO` attivo, `prenota` e
+`prenota_itinerario` di questo modulo controllano la richiesta nel thread
+della richiesta e la mettono in coda; un thread scrittore prende le richieste
+in coda a lotti (al più `PRENOTAZIONI_LOTTO_MASSIMO`, aspettando le successive
+al più `PRENOTAZIONI_LOTTO_ATTESA` secondi dopo la prima) e le scrive tutte in
+una transazione, con un solo commit.
+
+Ogni richiesta del lotto è eseguita in un SAVEPOINT con lo stesso codice di
+`app.booking.prenota`: i posti contesi nel lotto vanno alle richieste in ordine
+di arrivo (l'UPDATE condizionale vede i posti già tolti dalle precedenti) e una
+richiesta rifiutata annulla solo il suo SAVEPOINT. All'inizio del lotto si
+bloccano le righe di tutti i voli coinvolti, in ordine di id, così il lotto
+non accumula lock in un ordine diverso da quello delle altre transazioni.
+
+Ogni richiesta in attesa riceve il proprio risultato: la sua prenotazione
+dopo il commit, o la propria eccezione (`PostiNonDisponibili`,
+`PostoNonDisponibile`, ...). Se il commit del lotto fallisce, tutte le
+richieste confermate nel lotto ricevono l'errore e nessuna è stata scritta.
+
+Una richiesta aspetta al più `PRENOTAZIONI_LOTTO_TIMEOUT` secondi in coda
+(poi esce dalla coda con `TimeoutError`, senza essere scritta) e altrettanti
+il commit del suo lotto, se era già in scrittura: allo scadere della seconda
+attesa riceve `EsitoIncerto`, perché il lotto può ancora fare il commit. La
+callback `esito` della richiesta (come in `app.booking.prenota`) viene
+eseguita nel SAVEPOINT della richiesta, quindi fa parte del commit del lotto.
+
+Senza `PRENOTAZIONI_COMMIT_DI_GRUPPO` le funzioni chiamano direttamente
+quelle di `app.booking`.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as AttesaScaduta
+
+from flask import current_app
+from sqlalchemy import select, text
+from sqlalchemy.orm.exc import StaleDataError
+
+from . import booking
+from .models import db, Volo, Prenotazione
+
+
+class EsitoIncerto(AttesaScaduta):
+    """Il lotto della richiesta non ha finito il commit in tempo: la prenotazione può essere ancora scritta."""
+
+
+class Richiesta:
+    """Una prenotazione in coda e il `Future` con cui la richiesta aspetta il risultato."""
+
+    __slots__ = ('utente_id', 'tratte', 'classe', 'passeggeri', 'supplemento', 'bagaglio_extra',
+                 'servizi_extra', 'esito', 'futuro')
+
+    def __init__(self, utente_id, tratte, classe, passeggeri, supplemento, bagaglio_extra, servizi_extra,
+                 esito=None):
+        self.utente_id = utente_id
+        self.tratte = tratte
+        self.classe = classe
+        self.passeggeri = passeggeri
+        self.supplemento = supplemento
+        self.bagaglio_extra = bagaglio_extra
+        self.servizi_extra = servizi_extra
+        self.esito = esito
+        self.futuro = Future()
+
+    def registra(self):
+        return booking._registra(
+            self.utente_id, self.tratte, self.classe, self.passeggeri,
+            self.supplemento, self.bagaglio_extra, self.servizi_extra, self.esito
+        )
+
+
+class ScrittorePrenotazioni:
+    """Coda delle prenotazioni e thread che le scrive a lotti; uno per applicazione."""
+
+    def __init__(self, app):
+        self.app = app
+        self._coda = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.lotti = 0
+        self.prenotazioni = 0
+
+    def accoda(self, richiesta):
+        """Mette in coda la richiesta, avviando lo scrittore alla prima."""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._ciclo, name='scrittore-prenotazioni', daemon=True)
+                self._thread.start()
+        self._coda.put(richiesta)
+        return richiesta.futuro
+
+    def _ciclo(self):
+        with self.app.app_context():
+            while True:
+                lotto = self._prossimo_lotto()
+                try:
+                    self._scrivi(lotto)
+                finally:
+                    db.session.remove()
+
+    def _prossimo_lotto(self):
+        lotto = [self._coda.get()]
+        massimo = self.app.config['PRENOTAZIONI_LOTTO_MASSIMO']
+        scadenza = time.monotonic() + self.app.config['PRENOTAZIONI_LOTTO_ATTESA']
+        while len(lotto) < massimo:
+            resto = scadenza - time.monotonic()
+            try:
+                lotto.append(self._coda.get(timeout=resto) if resto > 0 else self._coda.get_nowait())
+            except queue.Empty:
+                break
+        # Le richieste abbandonate per timeout non vengono scritte
+        return [richiesta for richiesta in lotto if richiesta.futuro.set_running_or_notify_cancel()]
+
+    def _scrivi(self, lotto):
+        if not lotto:
+            return
+        confermate = []
+        try:
+            if db.session.get_bind().dialect.name == 'sqlite':
+                # pysqlite apre la transazione solo al primo INSERT/UPDATE: il
+                # primo SAVEPOINT diventerebbe la transazione e il suo RELEASE
+                # la committerebbe
+                db.session.execute(text('BEGIN IMMEDIATE'))
+            voli_ids = sorted({volo_id for richiesta in lotto for volo_id, _ in richiesta.tratte})
+            db.session.execute(select(Volo.id).where(Volo.id.in_(voli_ids)).order_by(Volo.id).with_for_update())
+
+            for richiesta in lotto:
+                try:
+                    prenotazione = self._in_savepoint(richiesta)
+                except Exception as errore:
+                    richiesta.futuro.set_exception(errore)
+                else:
+                    confermate.append((richiesta, prenotazione.id))
+            db.session.commit()
+        except Exception as errore:
+            db.session.rollback()
+            # Le confermate nel lotto (le rifiutate hanno già il loro errore)
+            for richiesta in lotto:
+                if not richiesta.futuro.done():
+                    richiesta.futuro.set_exception(errore)
+            return
+        self.lotti += 1
+        self.prenotazioni += len(confermate)
+        for richiesta, prenotazione_id in confermate:
+            richiesta.futuro.set_result(prenotazione_id)
+
+    @staticmethod
+    def _in_savepoint(richiesta):
+        """Come `app.booking._con_blocchi_scaduti`, con SAVEPOINT al posto dei commit."""
+        try:
+            with db.session.begin_nested():
+                return richiesta.registra()
+        except booking.PostiNonDisponibili as errore:
+            if errore.volo_id is None:
+                raise
+            try:
+                with db.session.begin_nested():
+                    rilasciati = booking._rilascia_scaduti(errore.volo_id)
+            except StaleDataError:
+                rilasciati = 0
+            if not rilasciati:
+                raise
+        with db.session.begin_nested():
+            return richiesta.registra()
+
+
+def _attendi(richiesta):
+    """Accoda la richiesta e restituisce la prenotazione, caricata nella sessione del chiamante."""
+    futuro = current_app.extensions['scrittore_prenotazioni'].accoda(richiesta)
+    timeout = current_app.config['PRENOTAZIONI_LOTTO_TIMEOUT']
+    try:
+        prenotazione_id = futuro.result(timeout=timeout)
+    except AttesaScaduta:
+        if futuro.cancel():
+            raise
+        # Già nel lotto in scrittura: il risultato arriva con il suo commit
+        try:
+            prenotazione_id = futuro.result(timeout=timeout)
+        except AttesaScaduta:
+            raise EsitoIncerto('Il lotto della prenotazione non ha ancora fatto il commit') from None
+    return db.session.get(Prenotazione, prenotazione_id)
+
+
+def _controlla(classe, passeggeri):
+    booking._colonne(classe)
+    if passeggeri < 1:
+        raise ValueError('Il numero di posti deve essere almeno 1')
+
+
+def prenota(utente_id, volo_id, classe, passeggeri, supplemento=0, bagaglio_extra=False,
+            servizi_extra='', numeri_posto=None, esito=None):
+    """
+    `app.booking.prenota`, attraverso lo scrittore se `PRENOTAZIONI_COMMIT_DI_GRUPPO`.
+
+    Raises:
+        PostiNonDisponibili, PostoNonDisponibile, ValueError: come `app.booking.prenota`
+        concurrent.futures.TimeoutError: se la richiesta è rimasta in coda oltre
+            `PRENOTAZIONI_LOTTO_TIMEOUT` secondi (e non è stata scritta)
+        EsitoIncerto: se il commit del lotto non è arrivato entro altri
+            `PRENOTAZIONI_LOTTO_TIMEOUT` secondi
+    """
+    if not current_app.config['PRENOTAZIONI_COMMIT_DI_GRUPPO']:
+        return booking.prenota(
+            utente_id, volo_id, classe, passeggeri, supplemento, bagaglio_extra, servizi_extra, numeri_posto, esito
+        )
+    _controlla(classe, passeggeri)
+    return _attendi(Richiesta(
+        utente_id, [(volo_id, numeri_posto)], classe, passeggeri, supplemento, bagaglio_extra, servizi_extra, esito
+    ))
+
+
+def prenota_itinerario(utente_id, voli_ids, classe, passeggeri, supplemento=0, bagaglio_extra=False,
+                       servizi_extra='', esito=None):
+    """`app.booking.prenota_itinerario`, attraverso lo scrittore se `PRENOTAZIONI_COMMIT_DI_GRUPPO`."""
+    if not current_app.config['PRENOTAZIONI_COMMIT_DI_GRUPPO']:
+        return booking.prenota_itinerario(
+            utente_id, voli_ids, classe, passeggeri, supplemento, bagaglio_extra, servizi_extra, esito
+        )
+    _controlla(classe, passeggeri)
+    booking._verifica_itinerario(voli_ids)
+    return _attendi(Richiesta(
+        utente_id, [(volo_id, None) for volo_id in voli_ids], classe, passeggeri,
+        supplemento, bagaglio_extra, servizi_extra, esito
+    ))
+
+
+def init_app(app):
+    """Parametri del commit di gruppo e scrittore delle prenotazioni dell'applicazione."""
+    app.config.setdefault('PRENOTAZIONI_COMMIT_DI_GRUPPO', False)
+    app.config.setdefault('PRENOTAZIONI_LOTTO_MASSIMO', 100)
+    app.config.setdefault('PRENOTAZIONI_LOTTO_ATTESA', 0.005)
+    app.config.setdefault('PRENOTAZIONI_LOTTO_TIMEOUT', 30)
+    app.extensions['scrittore_prenotazioni'] = ScrittorePrenotazioni(app)
@@ -0,0 +1,133 @@
+"""
+Indice città → aeroporti per la ricerca su più aeroporti della stessa città.
+
+Un luogo di ricerca può essere un codice IATA (`MXP`) o il nome di una città
+(`Milano`, `milano`, `Parigi`): `risolvi` lo espande nell'insieme degli id
+degli aeroporti corrispondenti, da usare in un `IN (...)`.
+
+Una città è la coppia (nome, paese): Santiago del Cile e Santiago de
+Compostela, o Portland nell'Oregon e nel Maine se il paese li distingue, sono
+città diverse e uno scalo non passa dall'una all'altra. Il solo nome di una
+città si espande negli aeroporti di tutte le città con quel nome.
+
+Ogni città riceve un id intero (il più piccolo id tra i suoi aeroporti), così
+le coincidenze si confrontano tra interi invece che tra nomi di città.
+
+L'indice viene costruito dagli aeroporti della cache dei dati di riferimento,
+all'avvio (se le tabelle esistono) o al primo utilizzo, e ricostruito quando
+la cache viene ricaricata.
+"""
+import threading
+import unicodedata
+
+from sqlalchemy import inspect
+
+from .models import db, Aeroporto
+from .reference_data import riferimenti
+
+
+def normalizza(testo):
+    """Minuscolo, senza accenti e spazi superflui: 'Città ' -> 'citta'."""
+    testo = unicodedata.normalize('NFKD', testo or '')
+    testo = ''.join(c for c in testo if not unicodedata.combining(c))
+    return ' '.join(testo.casefold().split())
+
+
+class IndiceCittà:
+    """Mappe tra codici IATA, aeroporti e città."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._costruito = -1
+        self.per_codice = {}
+        self.per_città = {}
+        self.città_di = {}
+        self.aeroporti_di = {}
+
+    def _aggiorna(self):
+        generazione = riferimenti.generazione()
+        if self._costruito == generazione:
+            return
+        with self._lock:
+            if self._costruito == generazione:
+                return
+            righe = [(a.id, a.codice_iata, a.città, a.paese) for a in riferimenti.tutti_aeroporti()]
+
+            per_nome_e_paese = {}
+            for aeroporto_id, codice, città, paese in righe:
+                per_nome_e_paese.setdefault((normalizza(città), normalizza(paese)), []).append(aeroporto_id)
+
+            per_nome = {}
+            città_di = {}
+            aeroporti_di = {}
+            for (nome, _), aeroporti in per_nome_e_paese.items():
+                città_id = min(aeroporti)
+                per_nome.setdefault(nome, set()).update(aeroporti)
+                aeroporti_di[città_id] = frozenset(aeroporti)
+                for aeroporto_id in aeroporti:
+                    città_di[aeroporto_id] = città_id
+
+            self.per_codice = {codice.upper(): aeroporto_id for aeroporto_id, codice, _, _ in righe}
+            self.per_città = {nome: frozenset(aeroporti) for nome, aeroporti in per_nome.items()}
+            self.città_di = città_di
+            self.aeroporti_di = aeroporti_di
+            self._costruito = generazione
+
+    def risolvi(self, luogo):
+        """
+        Espande un codice IATA o un nome di città negli id degli aeroporti.
+
+        Returns:
+            frozenset: Id degli aeroporti (vuoto se il luogo è sconosciuto)
+        """
+        self._aggiorna()
+        if luogo is None:
+            return frozenset()
+        codice = luogo.strip().upper()
+        if codice in self.per_codice:
+            return frozenset((self.per_codice[codice],))
+        return self.per_città.get(normalizza(luogo), frozenset())
+
+    def città(self, aeroporto_id):
+        """Id della città di un aeroporto."""
+        self._aggiorna()
+        return self.città_di.get(aeroporto_id, aeroporto_id)
+
+    def aeroporti(self, città_id):
+        """Aeroporti di una città dato il suo id."""
+        self._aggiorna()
+        return self.aeroporti_di.get(città_id, frozenset((città_id,)))
+
+    def stessa_città(self, aeroporto_id):
+        """Aeroporti della stessa città di `aeroporto_id` (incluso)."""
+        self._aggiorna()
+        return self.aeroporti_di.get(self.città_di.get(aeroporto_id), frozenset((aeroporto_id,)))
+
+    def città_multi_aeroporto(self):
+        """{aeroporto_id: città_id} per gli aeroporti di città con più scali."""
+        self._aggiorna()
+        return {
+            aeroporto_id: città_id
+            for città_id, aeroporti in self.aeroporti_di.items() if len(aeroporti) > 1
+            for aeroporto_id in aeroporti
+        }
+
+
+indice_città = IndiceCittà()
+
+
+def risolvi(luogo):
+    return indice_città.risolvi(luogo)
+
+
+def init_app(app):
+    """Costruisce l'indice se possibile."""
+    with app.app_context():
+        try:
+            if inspect(db.engine).has_table(Aeroporto.__tablename__):
+                indice_città.risolvi(None)
+        except Exception:
+            # Database non raggiungibile: l'indice verrà costruito al primo utilizzo
+            pass
+        finally:
+            db.session.remove()
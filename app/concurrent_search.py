@@ -0,0 +1,135 @@
+"""
+Ricerca voli diretti e con scalo eseguite in parallelo.
+
+La ricerca dei voli diretti gira nel thread della richiesta, quella con scalo
+in un pool di thread: ogni worker apre un proprio contesto applicativo, quindi
+una propria sessione e una propria connessione presa dal pool di SQLAlchemy.
+
+Ogni ricerca ha una scadenza (`RICERCA_SCADENZA`, in secondi). Se la ricerca
+con scalo non termina in tempo si restituiscono solo i voli diretti, con
+`completa=False`. Anche il worker si ferma alla scadenza, così una ricerca
+lenta non lo tiene occupato (con pochi worker il pool resterebbe senza
+thread liberi):
+
+- la visita del grafo orario (app/route_graph.py) controlla la scadenza,
+  letta da `g.scadenza_ricerca`, a ogni percorso estratto dalla coda e si
+  interrompe con `RicercaScaduta`;
+- le query SQL vengono interrotte dal database: su PostgreSQL con uno
+  `statement_timeout` pari al tempo rimasto, su SQLite con un progress
+  handler della connessione che interrompe la query quando la scadenza è
+  passata. La query interrotta fallisce.
+
+Una ricerca interrotta non finisce nella cache.
+"""
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from flask import current_app, g
+from sqlalchemy import text
+
+from . import db
+from .search_cache import cerca_diretti, cerca_con_scalo
+
+RisultatiRicerca = namedtuple('RisultatiRicerca', ['diretti', 'scalo', 'completa'])
+
+_pool = None
+
+
+# Istruzioni della VM di SQLite tra due controlli della scadenza
+ISTRUZIONI_TRA_CONTROLLI = 10000
+
+
+def _esegui_nel_contesto(app, scadenza, funzione, *args):
+    with app.app_context():
+        g.scadenza_ricerca = scadenza
+        dialetto = db.engine.dialect.name
+        if dialetto == 'postgresql':
+            rimanenti = max(1, int((scadenza - time.monotonic()) * 1000))
+            db.session.execute(text(f'SET LOCAL statement_timeout = {rimanenti}'))
+            return funzione(*args)
+        if dialetto != 'sqlite':
+            return funzione(*args)
+
+        connessione = db.session.connection().connection.driver_connection
+        # Un valore diverso da zero interrompe la query in corso (OperationalError)
+        connessione.set_progress_handler(lambda: time.monotonic() > scadenza, ISTRUZIONI_TRA_CONTROLLI)
+        try:
+            return funzione(*args)
+        finally:
+            # La connessione torna al pool senza la scadenza di questa ricerca
+            connessione.set_progress_handler(None, 0)
+
+
+def _parallela_possibile(app):
+    """Un database SQLite in memoria ha una sola connessione condivisa."""
+    if not app.config['RICERCA_PARALLELA'] or _pool is None:
+        return False
+    url = db.engine.url
+    return not (url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'))
+
+
+def cerca_voli(aeroporto_partenza, aeroporto_arrivo, data, passeggeri=1, classe='economy', ordina_per='prezzo',
+               limite=None, cursore_diretti=None, cursore_scalo=None):
+    """
+    Cerca voli diretti e con scalo, in parallelo se configurato.
+
+    Args:
+        aeroporto_partenza (str): Codice IATA o città di partenza
+        aeroporto_arrivo (str): Codice IATA o città di arrivo
+        data (datetime): Data del volo
+        passeggeri (int): Numero di passeggeri
+        classe (str): Classe di viaggio
+        ordina_per (str): Ordinamento dei risultati ('prezzo' o 'tempo')
+        limite (int): Numero massimo di risultati per tipo
+        cursore_diretti (tuple): Chiave dell'ultimo volo diretto già restituito
+        cursore_scalo (tuple): Chiave dell'ultimo itinerario con scalo già restituito
+
+    Returns:
+        RisultatiRicerca: Voli diretti, itinerari con scalo e se la ricerca
+        con scalo è terminata entro la scadenza
+    """
+    app = current_app._get_current_object()
+    if not _parallela_possibile(app):
+        return RisultatiRicerca(
+            cerca_diretti(aeroporto_partenza, aeroporto_arrivo, data, passeggeri, classe, ordina_per,
+                          cursore_diretti, limite),
+            cerca_con_scalo(aeroporto_partenza, aeroporto_arrivo, data, passeggeri, classe, ordina_per,
+                            cursore_scalo, limite),
+            True
+        )
+
+    scadenza = time.monotonic() + app.config['RICERCA_SCADENZA']
+    futuro = _pool.submit(
+        _esegui_nel_contesto, app, scadenza, cerca_con_scalo,
+        aeroporto_partenza, aeroporto_arrivo, data, passeggeri, classe, ordina_per, cursore_scalo, limite
+    )
+    try:
+        diretti = cerca_diretti(aeroporto_partenza, aeroporto_arrivo, data, passeggeri, classe, ordina_per,
+                                cursore_diretti, limite)
+    except Exception:
+        futuro.cancel()
+        raise
+
+    try:
+        scalo = futuro.result(timeout=max(0, scadenza - time.monotonic()))
+    except TimeoutError:
+        app.logger.warning('Ricerca con scalo oltre la scadenza, restituisco solo i voli diretti')
+        return RisultatiRicerca(diretti, [], False)
+    except Exception as e:
+        app.logger.warning(f'Ricerca con scalo fallita, restituisco solo i voli diretti: {e}')
+        return RisultatiRicerca(diretti, [], False)
+    return RisultatiRicerca(diretti, scalo, True)
+
+
+def init_app(app):
+    """Crea il pool di thread per le ricerche con scalo."""
+    global _pool
+    app.config.setdefault('RICERCA_PARALLELA', True)
+    app.config.setdefault('RICERCA_SCADENZA', 2.0)
+    app.config.setdefault('RICERCA_WORKER', 4)
+    if app.config['RICERCA_PARALLELA'] and _pool is None:
+        _pool = ThreadPoolExecutor(
+            max_workers=app.config['RICERCA_WORKER'],
+            thread_name_prefix='ricerca-scalo'
+        )
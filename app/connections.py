@@ -0,0 +1,360 @@
+"""
+Tabella materializzata delle coincidenze (coppie di voli con uno scalo valido).
+
+Una coppia (volo1, volo2) è valida se volo2 parte da un aeroporto della città
+in cui arriva volo1, tra `RICERCA_TEMPO_MIN_SCALO` e `RICERCA_TEMPO_MAX_SCALO`
+dopo il suo arrivo, e non riporta alla città di partenza. Per ogni coppia la
+tabella `coincidenza` tiene tempo di scalo, prezzi complessivi e posti
+disponibili su entrambe le tratte, così `cerca_voli_scalo` diventa una lettura
+sull'indice (partenza, arrivo, giorno).
+
+La tabella viene aggiornata dagli eventi di sessione SQLAlchemy, nella stessa
+transazione della modifica:
+
+- un `Volo` inserito, cancellato o con tratta, orari o prezzi modificati
+  viene tolto dalla tabella e le sue coincidenze vengono ricalcolate, sia come
+  prima sia come seconda tratta (due ricerche per intervallo sugli indici);
+- quando cambiano i posti di un volo (biglietti venduti o cancellati, posti
+  bloccati o rilasciati, posti assegnati nella mappa dei posti, posti
+  modificati) si aggiornano solo i posti delle sue coincidenze.
+
+Le modifiche fatte fuori dall'ORM (script SQL, import massivi) non generano
+eventi: `flask coincidenze verifica` le trova e `flask coincidenze
+ricostruisci` rigenera l'intera tabella.
+"""
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from sqlalchemy import bindparam, delete, event, func, inspect, insert, or_, select, update
+from sqlalchemy.orm import Session
+
+from .models import db, Volo, Biglietto, BloccoPosti, MappaPosti, Coincidenza
+from .city_index import indice_città
+from .queries import intervallo_giorno
+from .search_cache import valori_attributo
+
+CLASSI = ('economy', 'business', 'first')
+
+# Colonne di un volo che definiscono le sue coincidenze
+CAMPI_TRATTA = (
+    'aeroporto_partenza_id', 'aeroporto_arrivo_id', 'data_partenza', 'data_arrivo',
+    'prezzo_economy', 'prezzo_business', 'prezzo_first'
+)
+CAMPI_POSTI = ('posti_economy', 'posti_business', 'posti_first')
+
+COLONNE_VOLO = (
+    Volo.id, Volo.aeroporto_partenza_id, Volo.aeroporto_arrivo_id, Volo.data_partenza, Volo.data_arrivo,
+    Volo.posti_economy, Volo.posti_business, Volo.posti_first,
+    Volo.prezzo_economy, Volo.prezzo_business, Volo.prezzo_first
+)
+
+tabella = Coincidenza.__table__
+
+
+def _tempi_scalo():
+    config = current_app.config
+    return (config.get('RICERCA_TEMPO_MIN_SCALO', timedelta(hours=2)),
+            config.get('RICERCA_TEMPO_MAX_SCALO', timedelta(hours=24)))
+
+
+def _riga(volo1, volo2):
+    riga = {
+        'volo1_id': volo1.id,
+        'volo2_id': volo2.id,
+        'aeroporto_partenza_id': volo1.aeroporto_partenza_id,
+        'aeroporto_arrivo_id': volo2.aeroporto_arrivo_id,
+        'data_partenza': volo1.data_partenza,
+        'data_arrivo': volo2.data_arrivo,
+        'tempo_scalo': int((volo2.data_partenza - volo1.data_arrivo).total_seconds()),
+    }
+    for classe in CLASSI:
+        riga[f'prezzo_{classe}'] = getattr(volo1, f'prezzo_{classe}') + getattr(volo2, f'prezzo_{classe}')
+        riga[f'posti_{classe}'] = min(getattr(volo1, f'posti_{classe}'), getattr(volo2, f'posti_{classe}'))
+    return riga
+
+
+def calcola_coincidenze(primi, secondi, tempo_min_scalo, tempo_max_scalo):
+    """
+    Coincidenze valide tra i voli `primi` (prima tratta) e `secondi` (seconda tratta).
+
+    Returns:
+        dict: {(volo1_id, volo2_id): riga della tabella `coincidenza`}
+    """
+    città_di = indice_città.città
+    partenze = defaultdict(list)
+    for volo in secondi:
+        partenze[città_di(volo.aeroporto_partenza_id)].append(volo)
+    orari = {}
+    for città, voli in partenze.items():
+        voli.sort(key=lambda v: (v.data_partenza, v.id))
+        orari[città] = [v.data_partenza for v in voli]
+
+    coincidenze = {}
+    for volo1 in primi:
+        città_scalo = città_di(volo1.aeroporto_arrivo_id)
+        voli = partenze.get(città_scalo)
+        if not voli:
+            continue
+        inizio = bisect_left(orari[città_scalo], volo1.data_arrivo + tempo_min_scalo)
+        fine = bisect_right(orari[città_scalo], volo1.data_arrivo + tempo_max_scalo)
+        città_origine = città_di(volo1.aeroporto_partenza_id)
+        for volo2 in voli[inizio:fine]:
+            if volo2.id != volo1.id and città_di(volo2.aeroporto_arrivo_id) != città_origine:
+                coincidenze[(volo1.id, volo2.id)] = _riga(volo1, volo2)
+    return coincidenze
+
+
+def ricalcola_voli(connessione, volo_ids):
+    """
+    Sostituisce le coincidenze dei voli indicati con quelle calcolate sui dati attuali.
+
+    I voli che non esistono più vengono solo tolti dalla tabella.
+
+    Args:
+        connessione: Connessione (o sessione) su cui eseguire le query
+        volo_ids (set): Id dei voli da ricalcolare
+    """
+    tempo_min, tempo_max = _tempi_scalo()
+    connessione.execute(delete(tabella).where(or_(
+        tabella.c.volo1_id.in_(volo_ids), tabella.c.volo2_id.in_(volo_ids)
+    )))
+
+    coincidenze = {}
+    for volo in connessione.execute(select(*COLONNE_VOLO).where(Volo.id.in_(volo_ids))):
+        successivi = connessione.execute(select(*COLONNE_VOLO).where(
+            Volo.aeroporto_partenza_id.in_(indice_città.stessa_città(volo.aeroporto_arrivo_id)),
+            Volo.data_partenza >= volo.data_arrivo + tempo_min,
+            Volo.data_partenza <= volo.data_arrivo + tempo_max
+        )).all()
+        precedenti = connessione.execute(select(*COLONNE_VOLO).where(
+            Volo.aeroporto_arrivo_id.in_(indice_città.stessa_città(volo.aeroporto_partenza_id)),
+            Volo.data_arrivo >= volo.data_partenza - tempo_max,
+            Volo.data_arrivo <= volo.data_partenza - tempo_min
+        )).all()
+        coincidenze.update(calcola_coincidenze([volo], successivi, tempo_min, tempo_max))
+        coincidenze.update(calcola_coincidenze(precedenti, [volo], tempo_min, tempo_max))
+
+    if coincidenze:
+        connessione.execute(insert(tabella), list(coincidenze.values()))
+
+
+def aggiorna_posti(connessione, volo_ids):
+    """
+    Riallinea i posti delle coincidenze dei voli indicati ai posti attuali dei voli.
+
+    Args:
+        connessione: Connessione (o sessione) su cui eseguire le query
+        volo_ids (set): Id dei voli i cui posti sono cambiati
+    """
+    righe = connessione.execute(
+        select(tabella.c.volo1_id, tabella.c.volo2_id, *(tabella.c[c] for c in CAMPI_POSTI))
+        .where(or_(tabella.c.volo1_id.in_(volo_ids), tabella.c.volo2_id.in_(volo_ids)))
+    ).all()
+    if not righe:
+        return
+    coinvolti = {r.volo1_id for r in righe} | {r.volo2_id for r in righe}
+    posti = {
+        v.id: v for v in connessione.execute(
+            select(Volo.id, *(getattr(Volo, c) for c in CAMPI_POSTI)).where(Volo.id.in_(coinvolti))
+        )
+    }
+
+    modifiche = []
+    for riga in righe:
+        volo1, volo2 = posti.get(riga.volo1_id), posti.get(riga.volo2_id)
+        if volo1 is None or volo2 is None:
+            continue
+        nuovi = {c: min(getattr(volo1, c), getattr(volo2, c)) for c in CAMPI_POSTI}
+        if any(nuovi[c] != getattr(riga, c) for c in CAMPI_POSTI):
+            modifiche.append({'v1': riga.volo1_id, 'v2': riga.volo2_id,
+                              **{f'nuovi_{c}': n for c, n in nuovi.items()}})
+    if modifiche:
+        connessione.execute(
+            update(tabella)
+            .where(tabella.c.volo1_id == bindparam('v1'), tabella.c.volo2_id == bindparam('v2'))
+            .values({c: bindparam(f'nuovi_{c}') for c in CAMPI_POSTI}),
+            modifiche
+        )
+
+
+def _giorni_con_voli(dal):
+    prima, ultima = db.session.execute(
+        select(func.min(Volo.data_partenza), func.max(Volo.data_partenza)).where(Volo.data_partenza >= dal)
+    ).one()
+    if prima is None:
+        return
+    giorno = prima.date()
+    while giorno <= ultima.date():
+        yield giorno
+        giorno += timedelta(days=1)
+
+
+def _coincidenze_del_giorno(giorno, tempo_min, tempo_max):
+    """Coincidenze attese per le prime tratte in partenza in `giorno`."""
+    inizio, fine = intervallo_giorno(giorno)
+    primi = db.session.execute(select(*COLONNE_VOLO).where(
+        Volo.data_partenza >= inizio, Volo.data_partenza < fine
+    )).all()
+    if not primi:
+        return {}
+    secondi = db.session.execute(select(*COLONNE_VOLO).where(
+        Volo.data_partenza >= inizio + tempo_min, Volo.data_partenza <= fine + tempo_max
+    )).all()
+    return calcola_coincidenze(primi, secondi, tempo_min, tempo_max)
+
+
+def ricostruisci(dal=None):
+    """
+    Rigenera la tabella delle coincidenze a partire da una data.
+
+    Il calcolo procede un giorno alla volta, tenendo in memoria solo i voli
+    del giorno e quelli in partenza entro l'attesa massima. La tabella viene
+    sostituita in un'unica transazione.
+
+    Args:
+        dal (date): Primo giorno di partenza considerato (default: oggi)
+
+    Returns:
+        int: Numero di coincidenze scritte
+    """
+    dal = dal or datetime.now().date()
+    inizio, _ = intervallo_giorno(dal)
+    tempo_min, tempo_max = _tempi_scalo()
+    totale = 0
+    try:
+        db.session.execute(delete(tabella).where(tabella.c.data_partenza >= inizio))
+        for giorno in _giorni_con_voli(inizio):
+            coincidenze = _coincidenze_del_giorno(giorno, tempo_min, tempo_max)
+            if coincidenze:
+                db.session.execute(insert(tabella), list(coincidenze.values()))
+                totale += len(coincidenze)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return totale
+
+
+def verifica(dal=None):
+    """
+    Confronta la tabella delle coincidenze con quella ricalcolata dai voli.
+
+    Args:
+        dal (date): Primo giorno di partenza considerato (default: oggi)
+
+    Returns:
+        dict: Coppie (volo1_id, volo2_id) 'mancanti' nella tabella,
+        'superflue' (non più valide) e 'diverse' (prezzi, orari o posti
+        non aggiornati)
+    """
+    dal = dal or datetime.now().date()
+    inizio, _ = intervallo_giorno(dal)
+    tempo_min, tempo_max = _tempi_scalo()
+    risultato = {'mancanti': [], 'superflue': [], 'diverse': []}
+    colonne = [c.name for c in tabella.columns]
+
+    giorni = set(_giorni_con_voli(inizio))
+    ultima = db.session.execute(
+        select(func.max(tabella.c.data_partenza)).where(tabella.c.data_partenza >= inizio)
+    ).scalar()
+    if ultima is not None:
+        giorno = dal
+        while giorno <= ultima.date():
+            giorni.add(giorno)
+            giorno += timedelta(days=1)
+
+    for giorno in sorted(giorni):
+        attese = _coincidenze_del_giorno(giorno, tempo_min, tempo_max)
+        inizio_giorno, fine_giorno = intervallo_giorno(giorno)
+        presenti = {
+            (r.volo1_id, r.volo2_id): r._asdict()
+            for r in db.session.execute(select(tabella).where(
+                tabella.c.data_partenza >= inizio_giorno, tabella.c.data_partenza < fine_giorno
+            ))
+        }
+        risultato['mancanti'].extend(sorted(attese.keys() - presenti.keys()))
+        risultato['superflue'].extend(sorted(presenti.keys() - attese.keys()))
+        for coppia in sorted(attese.keys() & presenti.keys()):
+            attesa, presente = attese[coppia], presenti[coppia]
+            if any(_diversi(attesa[c], presente[c]) for c in colonne):
+                risultato['diverse'].append(coppia)
+    return risultato
+
+
+def _diversi(a, b):
+    if isinstance(a, float) or isinstance(b, float):
+        return abs(float(a) - float(b)) > 0.005
+    return a != b
+
+
+def _dopo_flush(session, flush_context):
+    if not current_app.config.get('RICERCA_USA_COINCIDENZE', True):
+        return
+    da_ricalcolare = set()
+    da_aggiornare = set()
+    for oggetto in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(oggetto, Volo):
+            if oggetto in session.new or oggetto in session.deleted:
+                da_ricalcolare.add(oggetto.id)
+                continue
+            attributi = inspect(oggetto).attrs
+            if any(attributi[c].history.has_changes() for c in CAMPI_TRATTA):
+                da_ricalcolare.add(oggetto.id)
+            elif any(attributi[c].history.has_changes() for c in CAMPI_POSTI):
+                da_aggiornare.add(oggetto.id)
+        elif isinstance(oggetto, (Biglietto, BloccoPosti)):
+            da_aggiornare.update(valori_attributo(oggetto, 'flight_id'))
+        elif isinstance(oggetto, MappaPosti):
+            da_aggiornare.add(oggetto.volo_id)
+
+    if not da_ricalcolare and not da_aggiornare:
+        return
+    connessione = session.connection()
+    if da_ricalcolare:
+        ricalcola_voli(connessione, da_ricalcolare)
+    da_aggiornare -= da_ricalcolare
+    if da_aggiornare:
+        aggiorna_posti(connessione, da_aggiornare)
+
+
+@click.group('coincidenze')
+def comandi():
+    """Gestione della tabella delle coincidenze."""
+
+
+@comandi.command('ricostruisci')
+@click.option('--dal', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='Primo giorno di partenza (default: oggi)')
+def comando_ricostruisci(dal):
+    """Rigenera la tabella delle coincidenze."""
+    totale = ricostruisci(dal.date() if dal else None)
+    click.echo(f'Coincidenze ricostruite: {totale}')
+
+
+@comandi.command('verifica')
+@click.option('--dal', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='Primo giorno di partenza (default: oggi)')
+def comando_verifica(dal):
+    """Controlla che la tabella delle coincidenze sia allineata ai voli."""
+    risultato = verifica(dal.date() if dal else None)
+    errori = 0
+    for tipo, coppie in risultato.items():
+        errori += len(coppie)
+        click.echo(f'{tipo}: {len(coppie)}')
+        for volo1_id, volo2_id in coppie[:20]:
+            click.echo(f'  {volo1_id} -> {volo2_id}')
+    if errori:
+        click.echo('Tabella non allineata: eseguire "flask coincidenze ricostruisci"')
+        raise SystemExit(1)
+    click.echo('Tabella allineata')
+
+
+def init_app(app):
+    """Registra l'aggiornamento incrementale e i comandi `flask coincidenze`."""
+    app.config.setdefault('RICERCA_USA_COINCIDENZE', True)
+    if not event.contains(Session, 'after_flush', _dopo_flush):
+        event.listen(Session, 'after_flush', _dopo_flush)
+    app.cli.add_command(comandi)
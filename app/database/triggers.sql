@@ -1,8 +1,11 @@
--- Funzione per calcolare i posti totali
+-- Funzione per calcolare i posti totali: `posti_*` sono i posti liberi, a cui
+-- si aggiungono i venduti e i bloccati (come nel vincolo check_posti)
 CREATE OR REPLACE FUNCTION calcola_posti_totali()
 RETURNS TRIGGER AS $$
 BEGIN
-    NEW.posti_totali := NEW.posti_economy + NEW.posti_business + NEW.posti_first;
+    NEW.posti_totali := NEW.posti_economy + NEW.posti_business + NEW.posti_first
+        + NEW.venduti_economy + NEW.venduti_business + NEW.venduti_first
+        + NEW.bloccati_economy + NEW.bloccati_business + NEW.bloccati_first;
     RETURN NEW;
 END;
 $$ LANGUAGE plpgsql;
@@ -42,65 +45,8 @@ CREATE TRIGGER trigger_valida_date_volo
     FOR EACH ROW
     EXECUTE FUNCTION valida_date_volo();
 
--- Funzione per aggiornare i posti disponibili
-CREATE OR REPLACE FUNCTION aggiorna_posti_disponibili()
-RETURNS TRIGGER AS $$
-DECLARE
-    posti_disponibili INTEGER;
-BEGIN
-    -- Verifica la disponibilità dei posti per la classe selezionata
-    IF NEW.classe = 'economy' THEN
-        SELECT posti_economy INTO posti_disponibili
-        FROM volo
-        WHERE id = NEW.flight_id
-        FOR UPDATE;
-        
-        IF posti_disponibili <= 0 THEN
-            RAISE EXCEPTION 'Non ci sono più posti disponibili in classe economy';
-        END IF;
-        
-        UPDATE volo
-        SET posti_economy = posti_economy - 1
-        WHERE id = NEW.flight_id;
-        
-    ELSIF NEW.classe = 'business' THEN
-        SELECT posti_business INTO posti_disponibili
-        FROM volo
-        WHERE id = NEW.flight_id
-        FOR UPDATE;
-        
-        IF posti_disponibili <= 0 THEN
-            RAISE EXCEPTION 'Non ci sono più posti disponibili in classe business';
-        END IF;
-        
-        UPDATE volo
-        SET posti_business = posti_business - 1
-        WHERE id = NEW.flight_id;
-        
-    ELSIF NEW.classe = 'first' THEN
-        SELECT posti_first INTO posti_disponibili
-        FROM volo
-        WHERE id = NEW.flight_id
-        FOR UPDATE;
-        
-        IF posti_disponibili <= 0 THEN
-            RAISE EXCEPTION 'Non ci sono più posti disponibili in classe first';
-        END IF;
-        
-        UPDATE volo
-        SET posti_first = posti_first - 1
-        WHERE id = NEW.flight_id;
-    END IF;
-    
-    RETURN NEW;
-END;
-$$ LANGUAGE plpgsql;
-
--- Trigger per aggiornare i posti disponibili
-CREATE TRIGGER trigger_aggiorna_posti_disponibili
-    BEFORE INSERT ON biglietto
-    FOR EACH ROW
-    EXECUTE FUNCTION aggiorna_posti_disponibili();
+-- I posti disponibili non sono gestiti da trigger: ogni prenotazione li
+-- decrementa con un solo UPDATE condizionale (app/booking.py)
 
 -- Funzione per il logging delle modifiche
 CREATE OR REPLACE FUNCTION log_modifiche_volo()
@@ -0,0 +1,356 @@
+"""
+Chiavi di idempotenza per le richieste API che creano prenotazioni.
+
+Un client che ripete una richiesta dopo un timeout manda lo stesso header
+`Idempotency-Key`. La prima esecuzione salva la risposta in
+`richiesta_idempotente`; le ripetizioni entro `IDEMPOTENZA_DURATA` secondi
+ricevono la stessa risposta (con `Idempotent-Replayed: true`) senza eseguire
+di nuovo la vista, quindi senza un'altra verifica dei posti né un'altra
+prenotazione. Le chiavi sono per utente; la stessa chiave con un'altra
+richiesta (metodo, percorso o corpo diversi) viene rifiutata con 422.
+
+Duplicati concorrenti (single flight):
+
+- nello stesso processo un lock per chiave fa aspettare le copie arrivate
+  mentre la prima è in corso: quando entrano trovano la risposta salvata;
+- tra processi diversi la riga della chiave viene inserita e committata prima
+  di eseguire la vista, e l'indice unico fa fallire l'inserimento delle copie,
+  che aspettano la risposta.
+
+In entrambi i casi l'attesa dura al più `IDEMPOTENZA_ATTESA` secondi, poi la
+copia riceve 409 e il client può riprovare.
+
+Si salvano solo gli esiti definitivi. Le eccezioni e le risposte 5xx, 409 e
+429 (`TRANSITORIE`) sono errori transitori, come un database occupato o un
+conflitto con un'altra scrittura: la riga si cancella e la richiesta si può
+ripetere. Una risposta 202 (la scrittura potrebbe ancora concludersi) lascia
+la riga in corso fino alla fine del lease. Le altre risposte si salvano.
+
+Una vista che scrive può salvare la risposta nella propria transazione con
+`risposta_nella_transazione`: la risposta fa parte dello stesso commit dei
+dati, e un processo che muore tra il commit e la fine della richiesta non fa
+eseguire di nuovo la scrittura alle ripetizioni.
+
+La riga di una richiesta in corso scade dopo `IDEMPOTENZA_IN_CORSO` secondi
+(un lease) e la scadenza si porta a `IDEMPOTENZA_DURATA` quando si salva la
+risposta: se il processo muore mentre esegue la vista, le ripetizioni
+ricevono 409 solo fino alla fine del lease, poi la richiesta viene eseguita
+di nuovo. Il lease deve quindi durare più della vista: di default è il tempo
+massimo di una prenotazione con il commit di gruppo (due volte
+`PRENOTAZIONI_LOTTO_TIMEOUT`, app/booking_writer.py) più `IDEMPOTENZA_ATTESA`.
+
+Le chiavi scadute si cancellano al più ogni `IDEMPOTENZA_PULIZIA` secondi
+all'arrivo di una richiesta con chiave e con `flask idempotenza scadi`.
+"""
+import hashlib
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import wraps
+
+import click
+from flask import current_app, g, jsonify, make_response, request
+from flask_jwt_extended import get_jwt_identity
+from sqlalchemy import delete, select, update
+from sqlalchemy.exc import IntegrityError
+
+from .models import db, RichiestaIdempotente
+
+INTESTAZIONE = 'Idempotency-Key'
+RIPETUTA = 'Idempotent-Replayed'
+# Risposte 4xx che una ripetizione può cambiare: non si salvano
+TRANSITORIE = frozenset({408, 409, 425, 429})
+
+
+class LockPerChiave:
+    """Un lock per chiave, tenuto in memoria solo finché qualcuno lo usa."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._voci = {}  # chiave -> [lock, utilizzatori]
+
+    @contextmanager
+    def __call__(self, chiave, timeout):
+        """Acquisisce il lock della chiave; restituisce False se scade il timeout."""
+        with self._lock:
+            voce = self._voci.setdefault(chiave, [threading.Lock(), 0])
+            voce[1] += 1
+        acquisito = voce[0].acquire(timeout=max(timeout, 0))
+        try:
+            yield acquisito
+        finally:
+            if acquisito:
+                voce[0].release()
+            with self._lock:
+                voce[1] -= 1
+                if not voce[1]:
+                    del self._voci[chiave]
+
+
+_in_corso = LockPerChiave()
+
+
+def _impronta():
+    corpo = f'{request.method} {request.path}\n'.encode() + request.get_data()
+    return hashlib.sha256(corpo).hexdigest()
+
+
+def _filtro(utente_id, chiave):
+    return (RichiestaIdempotente.user_id == utente_id, RichiestaIdempotente.chiave == chiave)
+
+
+def _leggi(utente_id, chiave):
+    return db.session.execute(
+        select(RichiestaIdempotente)
+        .where(*_filtro(utente_id, chiave))
+        .execution_options(populate_existing=True)
+    ).scalar_one_or_none()
+
+
+def _cancella(riga_id):
+    db.session.execute(delete(RichiestaIdempotente).where(RichiestaIdempotente.id == riga_id))
+    db.session.commit()
+
+
+def _risposta_salvata(riga, ripetuta=True):
+    risposta = current_app.response_class(riga.risposta, status=riga.stato_http, content_type=riga.tipo_risposta)
+    if ripetuta:
+        risposta.headers[RIPETUTA] = 'true'
+    return risposta
+
+
+def _salva(riga_id, risposta):
+    """Salva la risposta nella riga della chiave, nella transazione corrente."""
+    # Per id: se il lease è scaduto e un'altra copia ha preso la chiave, la
+    # sua riga non viene sovrascritta
+    db.session.execute(
+        update(RichiestaIdempotente)
+        .where(RichiestaIdempotente.id == riga_id)
+        .values(
+            stato_http=risposta.status_code,
+            risposta=risposta.get_data(as_text=True),
+            tipo_risposta=risposta.content_type,
+            scadenza=datetime.now() + timedelta(seconds=current_app.config['IDEMPOTENZA_DURATA'])
+        )
+    )
+
+
+def _in_corso_409():
+    return jsonify({'error': 'Una richiesta con la stessa Idempotency-Key è ancora in corso'}), 409
+
+
+def _registra_chiave(utente_id, chiave, impronta, scadenza_attesa):
+    """
+    Inserisce la riga della chiave, se non c'è già.
+
+    Returns:
+        tuple: (risposta da restituire al posto della vista, None) per una
+            ripetizione, una chiave riusata o una richiesta ancora in corso;
+            (None, id della riga inserita) se la vista va eseguita
+    """
+    while True:
+        riga = _leggi(utente_id, chiave)
+        if riga is not None and riga.scadenza <= datetime.now():
+            db.session.execute(
+                delete(RichiestaIdempotente)
+                .where(RichiestaIdempotente.id == riga.id, RichiestaIdempotente.scadenza <= datetime.now())
+            )
+            db.session.commit()
+            riga = None
+        if riga is None:
+            riga = RichiestaIdempotente(
+                user_id=utente_id,
+                chiave=chiave,
+                impronta=impronta,
+                # Lease della richiesta in corso, allungato al salvataggio della risposta
+                scadenza=datetime.now() + timedelta(seconds=current_app.config['IDEMPOTENZA_IN_CORSO'])
+            )
+            try:
+                db.session.add(riga)
+                db.session.flush()
+                riga_id = riga.id
+                db.session.commit()
+                return None, riga_id
+            except IntegrityError:
+                # Un'altra copia della richiesta l'ha inserita per prima
+                db.session.rollback()
+                continue
+        if riga.impronta != impronta:
+            return (jsonify({'error': 'Idempotency-Key già usata per una richiesta diversa'}), 422), None
+        if riga.stato_http is not None:
+            return _risposta_salvata(riga), None
+        if time.monotonic() >= scadenza_attesa:
+            return _in_corso_409(), None
+        # Non tiene aperta la transazione mentre aspetta l'altra copia
+        db.session.rollback()
+        time.sleep(0.05)
+
+
+def _esegui(vista, args, kwargs, riga_id):
+    g.idempotenza_riga_id = riga_id
+    try:
+        risposta = make_response(vista(*args, **kwargs))
+    except Exception:
+        db.session.rollback()
+        _cancella(riga_id)
+        raise
+    finally:
+        g.pop('idempotenza_riga_id', None)
+    if risposta.status_code == 202:
+        # Esito non ancora noto: le ripetizioni aspettano il salvataggio
+        # nella transazione della vista o la fine del lease
+        db.session.rollback()
+        return risposta
+    if risposta.status_code >= 500 or risposta.status_code in TRANSITORIE or risposta.is_streamed:
+        db.session.rollback()
+        _cancella(riga_id)
+        return risposta
+    riga = db.session.execute(
+        select(RichiestaIdempotente)
+        .where(RichiestaIdempotente.id == riga_id)
+        .execution_options(populate_existing=True)
+    ).scalar_one_or_none()
+    if riga is not None and riga.stato_http is not None:
+        # Salvata dalla vista con il commit dei dati: la stessa risposta
+        # delle ripetizioni
+        db.session.commit()
+        return _risposta_salvata(riga, ripetuta=False)
+    _salva(riga_id, risposta)
+    db.session.commit()
+    return risposta
+
+
+def risposta_nella_transazione(costruisci):
+    """
+    Callback che salva la risposta della richiesta con chiave nella
+    transazione della scrittura, prima del commit.
+
+    La vista la passa alla funzione che scrive (per esempio l'argomento
+    `esito` di `app.booking.prenota`), che la chiama con il risultato; la
+    risposta `costruisci(risultato)` fa parte dello stesso commit dei dati.
+
+    Args:
+        costruisci (callable): Dal risultato alla risposta della vista
+
+    Returns:
+        callable: La callback, o None per una richiesta senza Idempotency-Key
+    """
+    riga_id = g.get('idempotenza_riga_id')
+    if riga_id is None:
+        return None
+
+    def salva(risultato):
+        # Può essere chiamata da un altro thread (lo scrittore a lotti):
+        # usa solo il contesto dell'applicazione
+        _salva(riga_id, make_response(costruisci(risultato)))
+    return salva
+
+
+def idempotente(vista):
+    """
+    Rende una vista API idempotente per le richieste con `Idempotency-Key`.
+
+    Va applicato sotto `@jwt_required()`: la chiave vale per l'utente del
+    token. Le richieste senza header eseguono la vista come prima.
+    """
+    @wraps(vista)
+    def avvolta(*args, **kwargs):
+        chiave = request.headers.get(INTESTAZIONE)
+        if chiave is None:
+            return vista(*args, **kwargs)
+        chiave = chiave.strip()
+        if not 1 <= len(chiave) <= 255:
+            return jsonify({'error': f'{INTESTAZIONE} deve avere da 1 a 255 caratteri'}), 400
+        utente_id = int(get_jwt_identity())
+        impronta = _impronta()
+        _pulizia_periodica()
+
+        attesa = current_app.config['IDEMPOTENZA_ATTESA']
+        scadenza_attesa = time.monotonic() + attesa
+        with _in_corso((utente_id, chiave), attesa) as acquisito:
+            if not acquisito:
+                return _in_corso_409()
+            risposta, riga_id = _registra_chiave(utente_id, chiave, impronta, scadenza_attesa)
+            if risposta is not None:
+                return risposta
+            return _esegui(vista, args, kwargs, riga_id)
+
+    return avvolta
+
+
+def scadi_richieste(limite=1000):
+    """
+    Cancella le chiavi scadute.
+
+    Args:
+        limite (int): Numero massimo di chiavi cancellate
+
+    Returns:
+        int: Numero di chiavi cancellate
+    """
+    scadute = (
+        select(RichiestaIdempotente.id)
+        .where(RichiestaIdempotente.scadenza <= datetime.now())
+        .limit(limite)
+    )
+    cancellate = db.session.execute(
+        delete(RichiestaIdempotente)
+        .where(RichiestaIdempotente.id.in_(scadute))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    return cancellate
+
+
+_ultima_pulizia = 0.0
+_lock_pulizia = threading.Lock()
+
+
+def _pulizia_periodica():
+    """Cancella le chiavi scadute, al più ogni `IDEMPOTENZA_PULIZIA` secondi."""
+    global _ultima_pulizia
+    if time.monotonic() - _ultima_pulizia < current_app.config['IDEMPOTENZA_PULIZIA']:
+        return
+    if not _lock_pulizia.acquire(blocking=False):
+        return
+    try:
+        _ultima_pulizia = time.monotonic()
+        scadi_richieste()
+    finally:
+        _lock_pulizia.release()
+
+
+@click.group('idempotenza')
+def comandi():
+    """Gestione delle chiavi di idempotenza."""
+
+
+@comandi.command('scadi')
+def comando_scadi():
+    """Cancella le chiavi di idempotenza scadute."""
+    totale = 0
+    while True:
+        cancellate = scadi_richieste()
+        if not cancellate:
+            break
+        totale += cancellate
+    click.echo(f'Chiavi cancellate: {totale}')
+
+
+def init_app(app):
+    """Durata, lease e attesa delle chiavi di idempotenza e comandi `flask idempotenza`."""
+    app.config.setdefault('IDEMPOTENZA_DURATA', 86400)
+    app.config.setdefault('IDEMPOTENZA_ATTESA', 10)
+    # Più di una prenotazione: in coda e poi nel lotto per al più
+    # PRENOTAZIONI_LOTTO_TIMEOUT secondi ciascuno
+    durata_massima = 2 * app.config.get('PRENOTAZIONI_LOTTO_TIMEOUT', 30)
+    app.config.setdefault('IDEMPOTENZA_IN_CORSO', durata_massima + app.config['IDEMPOTENZA_ATTESA'])
+    if app.config['IDEMPOTENZA_IN_CORSO'] <= durata_massima:
+        app.logger.warning(
+            'IDEMPOTENZA_IN_CORSO (%s s) non supera la durata massima di una prenotazione (%s s): '
+            'una prenotazione lenta potrebbe essere eseguita due volte',
+            app.config['IDEMPOTENZA_IN_CORSO'], durata_massima
+        )
+    app.config.setdefault('IDEMPOTENZA_PULIZIA', 300)
+    app.cli.add_command(comandi)
@@ -66,6 +66,25 @@ class Aeroporto(db.Model):
 
 class Volo(db.Model):
     __tablename__ = 'volo'
+    __table_args__ = (
+        # Ricerca per tratta e giorno (cerca_voli_diretti); le colonne incluse
+        # permettono a PostgreSQL di rispondere con un index-only scan
+        db.Index(
+            'idx_volo_tratta_data',
+            'aeroporto_partenza_id', 'aeroporto_arrivo_id', 'data_partenza',
+            postgresql_include=[
+                'compagnia_id', 'numero_volo', 'data_arrivo',
+                'posti_economy', 'posti_business', 'posti_first',
+                'prezzo_economy', 'prezzo_business', 'prezzo_first'
+            ]
+        ),
+        # Voli di una compagnia in un periodo (dashboard, statistiche)
+        db.Index('idx_volo_compagnia_data', 'compagnia_id', 'data_partenza'),
+        # Voli di un giorno (ricerca con scalo, grafo orario)
+        db.Index('idx_volo_data_partenza', 'data_partenza'),
+        # Voli in arrivo in un aeroporto in un periodo (coincidenze di un volo)
+        db.Index('idx_volo_arrivo_data', 'aeroporto_arrivo_id', 'data_arrivo'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     numero_volo = db.Column(db.String(10), nullable=False)
@@ -78,9 +97,26 @@ class Volo(db.Model):
     posti_business = db.Column(db.Integer, nullable=False, default=0)
     posti_first = db.Column(db.Integer, nullable=False, default=0)
     posti_totali = db.Column(db.Integer, nullable=False)
+    # Biglietti emessi e posti bloccati per classe, aggiornati con lo stesso
+    # UPDATE dei posti liberi (app/booking.py): posti liberi + venduti +
+    # bloccati = posti della classe. `flask posti verifica` li confronta con
+    # biglietto e blocco_posti
+    venduti_economy = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    venduti_business = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    venduti_first = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    bloccati_economy = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    bloccati_business = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    bloccati_first = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     prezzo_economy = db.Column(db.Float, nullable=False)
     prezzo_business = db.Column(db.Float, nullable=False)
     prezzo_first = db.Column(db.Float, nullable=False)
+    # Lock ottimistico sui campi modificati dalla compagnia: una modifica fatta
+    # con l'ORM su una versione superata fallisce con StaleDataError invece di
+    # sovrascriverla. Gli UPDATE relativi dei posti (app/booking.py) non la
+    # incrementano: si sommano a qualunque versione
+    versione = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    
+    __mapper_args__ = {'version_id_col': versione}
     
     # Relazioni
     compagnia = db.relationship('CompagniaAerea', back_populates='voli')
@@ -96,10 +132,40 @@ class Volo(db.Model):
         return f'<Volo {self.numero_volo}>'
     
     # La validazione delle date è ora gestita dal trigger
-    # La gestione dei posti disponibili è ora gestita dal trigger
+    # I posti disponibili sono decrementati dalle prenotazioni (app/booking.py)
+
+class Coincidenza(db.Model):
+    """Coppia di voli con uno scalo valido, mantenuta da app/connections.py."""
+    __tablename__ = 'coincidenza'
+    __table_args__ = (
+        # Ricerca con scalo per tratta e giorno (cerca_voli_scalo)
+        db.Index('idx_coincidenza_tratta_data', 'aeroporto_partenza_id', 'aeroporto_arrivo_id', 'data_partenza'),
+        # Coincidenze in cui un volo è la seconda tratta
+        db.Index('idx_coincidenza_volo2', 'volo2_id'),
+    )
+    
+    volo1_id = db.Column(db.Integer, db.ForeignKey('volo.id', ondelete='CASCADE'), primary_key=True)
+    volo2_id = db.Column(db.Integer, db.ForeignKey('volo.id', ondelete='CASCADE'), primary_key=True)
+    aeroporto_partenza_id = db.Column(db.Integer, db.ForeignKey('aeroporto.id'), nullable=False)
+    aeroporto_arrivo_id = db.Column(db.Integer, db.ForeignKey('aeroporto.id'), nullable=False)
+    data_partenza = db.Column(db.DateTime, nullable=False)
+    data_arrivo = db.Column(db.DateTime, nullable=False)
+    tempo_scalo = db.Column(db.Integer, nullable=False)  # secondi
+    # Prezzi complessivi delle due tratte
+    prezzo_economy = db.Column(db.Float, nullable=False)
+    prezzo_business = db.Column(db.Float, nullable=False)
+    prezzo_first = db.Column(db.Float, nullable=False)
+    # Posti disponibili su entrambe le tratte (il minimo tra le due)
+    posti_economy = db.Column(db.Integer, nullable=False)
+    posti_business = db.Column(db.Integer, nullable=False)
+    posti_first = db.Column(db.Integer, nullable=False)
+    
+    def __repr__(self):
+        return f'<Coincidenza {self.volo1_id} -> {self.volo2_id}>'
 
 class Prenotazione(db.Model):
     __tablename__ = 'prenotazione'
+    __table_args__ = {'sqlite_autoincrement': True}
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('utente.id'), nullable=False)
@@ -135,6 +201,78 @@ class Biglietto(db.Model):
     def __repr__(self):
         return f'<Biglietto {self.id} - Volo {self.flight_id}>'
 
+class BloccoPosti(db.Model):
+    """Posti tenuti da un utente durante la prenotazione, fino a `scadenza` (app/booking.py)."""
+    __tablename__ = 'blocco_posti'
+    __table_args__ = (
+        # Un blocco per utente e volo: riaprire la pagina lo sostituisce
+        db.UniqueConstraint('flight_id', 'user_id', name='uq_blocco_posti_volo_utente'),
+        # Blocchi scaduti da rilasciare
+        db.Index('idx_blocco_posti_scadenza', 'scadenza'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    flight_id = db.Column(db.Integer, db.ForeignKey('volo.id', ondelete='CASCADE'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('utente.id', ondelete='CASCADE'), nullable=False)
+    classe = db.Column(db.String(20), nullable=False)
+    posti = db.Column(db.Integer, nullable=False)
+    scadenza = db.Column(db.DateTime, nullable=False)
+    # Chi cancella il blocco ne rilascia o ne usa i posti: con la versione, una
+    # seconda cancellazione concorrente fallisce (StaleDataError) invece di
+    # rilasciarli due volte
+    versione = db.Column(db.Integer, nullable=False)
+    
+    __mapper_args__ = {'version_id_col': versione}
+    
+    def __repr__(self):
+        return f'<BloccoPosti {self.posti} {self.classe} - Volo {self.flight_id}>'
+
+class MappaPosti(db.Model):
+    """Disposizione della cabina e posti assegnati di una classe di un volo (app/seat_map.py)."""
+    __tablename__ = 'mappa_posti'
+    
+    volo_id = db.Column(db.Integer, db.ForeignKey('volo.id', ondelete='CASCADE'), primary_key=True)
+    classe = db.Column(db.String(20), primary_key=True)
+    # Posti numerati per fila a partire da `prima_fila`, con le lettere
+    # della fila ('12A', '12B', ...); `capacità` posti in tutto
+    prima_fila = db.Column(db.Integer, nullable=False)
+    lettere = db.Column(db.String(10), nullable=False)
+    capacità = db.Column(db.Integer, nullable=False)
+    # File aggiunte dopo la fine della cabina: segmenti 'prima_fila:file'
+    # separati da virgola; None se le file sono tutte da `prima_fila`
+    segmenti = db.Column(db.String(200))
+    # Bitset dei posti assegnati, little-endian: il bit i è il posto i
+    # contando per fila e, nella fila, per lettera
+    occupati = db.Column(db.LargeBinary, nullable=False)
+    
+    def __repr__(self):
+        return f'<MappaPosti {self.classe} - Volo {self.volo_id}>'
+
+class RichiestaIdempotente(db.Model):
+    """Risposta di una richiesta API con `Idempotency-Key`, fino a `scadenza` (app/idempotency.py)."""
+    __tablename__ = 'richiesta_idempotente'
+    __table_args__ = (
+        # Una sola esecuzione per chiave e utente: il secondo inserimento fallisce
+        db.UniqueConstraint('user_id', 'chiave', name='uq_richiesta_idempotente_utente_chiave'),
+        # Chiavi scadute da cancellare
+        db.Index('idx_richiesta_idempotente_scadenza', 'scadenza'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('utente.id', ondelete='CASCADE'), nullable=False)
+    chiave = db.Column(db.String(255), nullable=False)
+    # SHA-256 di metodo, percorso e corpo: la stessa chiave con un'altra
+    # richiesta viene rifiutata
+    impronta = db.Column(db.String(64), nullable=False)
+    # NULL finché la richiesta è in corso
+    stato_http = db.Column(db.Integer)
+    risposta = db.Column(db.Text)
+    tipo_risposta = db.Column(db.String(100))
+    scadenza = db.Column(db.DateTime, nullable=False)
+    
+    def __repr__(self):
+        return f'<RichiestaIdempotente {self.chiave} - Utente {self.user_id}>'
+
 @login_manager.user_loader
 def load_user(user_id):
     return Utente.query.get(int(user_id)) 
\ No newline at end of file
@@ -1,30 +1,142 @@
+import base64
+import json
 from datetime import datetime, timedelta
-from sqlalchemy import func, case, and_, or_, desc, extract, text
-from sqlalchemy.sql import expression
-from sqlalchemy.dialects.postgresql import JSON
-from .models import db, Volo, CompagniaAerea, Aeroporto, Prenotazione, Biglietto, Utente
+from decimal import Decimal
+from sqlalchemy import func, case, and_, desc, tuple_, values, column, literal, select, union_all
+from sqlalchemy import Integer, String, DateTime
+from .models import db, Volo, CompagniaAerea, Aeroporto, Prenotazione, Biglietto, BloccoPosti, Coincidenza
+from .city_index import indice_città
+from .route_filter import filtro_tratte
 from sqlalchemy.orm import aliased
 
-def cerca_voli_diretti(aeroporto_partenza, aeroporto_arrivo, data, passeggeri=1, classe='economy', ordina_per='prezzo'):
+def intervallo_giorno(data):
     """
-    Cerca voli diretti tra due aeroporti in una data specifica.
+    Restituisce l'intervallo semiaperto [inizio, fine) del giorno di `data`.
+    
+    Filtrare `Volo.data_partenza` con due confronti su questo intervallo,
+    invece che con `func.date(Volo.data_partenza) == giorno`, lascia la colonna
+    libera da funzioni e permette al database di usare gli indici.
+    
+    Args:
+        data (datetime/date): Giorno di riferimento
+    
+    Returns:
+        tuple: (inizio, fine) come datetime
+    """
+    giorno = data.date() if isinstance(data, datetime) else data
+    inizio = datetime.combine(giorno, datetime.min.time())
+    return inizio, inizio + timedelta(days=1)
+
+def durata_secondi(arrivo, partenza):
+    """Espressione SQL con la durata in secondi tra due colonne datetime."""
+    if db.engine.dialect.name == 'sqlite':
+        return func.round((func.julianday(arrivo) - func.julianday(partenza)) * 86400)
+    return func.extract('epoch', arrivo - partenza)
+
+def chiave_ordinamento(risultato, ordina_per='prezzo', classe='economy'):
+    """
+    Chiave (valore, ids) con cui un risultato di ricerca viene ordinato e paginato.
     
     Args:
-        aeroporto_partenza (str): Codice IATA dell'aeroporto di partenza
-        aeroporto_arrivo (str): Codice IATA dell'aeroporto di arrivo
+        risultato: Riga di `cerca_voli_diretti` o `Itinerario`
+        ordina_per (str): 'prezzo' o 'tempo' (durata in secondi)
+        classe (str): Classe del volo, per il prezzo degli itinerari
+    
+    Returns:
+        tuple: (prezzo o durata, tupla degli id dei voli)
+    """
+    tratte = getattr(risultato, 'tratte', None)
+    if tratte is None:
+        ids = (risultato.id,)
+        prezzo = risultato.prezzo
+    else:
+        ids = tuple(t.id for t in tratte)
+        prezzo = risultato.prezzo(classe)
+    if ordina_per == 'prezzo':
+        return Decimal(str(prezzo)), ids
+    return (risultato.data_arrivo - risultato.data_partenza).total_seconds(), ids
+
+def codifica_cursore(chiave, ordina_per='prezzo'):
+    """Cursore opaco che riprende la ricerca dopo il risultato con questa chiave."""
+    valore, ids = chiave
+    dati = json.dumps([ordina_per, str(valore), list(ids)], separators=(',', ':'))
+    return base64.urlsafe_b64encode(dati.encode()).decode().rstrip('=')
+
+def decodifica_cursore(cursore, ordina_per='prezzo'):
+    """
+    Riporta un cursore di `codifica_cursore` alla chiave (valore, ids).
+    
+    Raises:
+        ValueError: Se il cursore non è valido o è stato creato con un altro ordinamento
+    """
+    try:
+        dati = base64.urlsafe_b64decode(cursore + '=' * (-len(cursore) % 4))
+        criterio, valore, ids = json.loads(dati)
+        valore = Decimal(valore) if criterio == 'prezzo' else float(valore)
+        ids = tuple(int(i) for i in ids)
+    except (ValueError, TypeError, ArithmeticError) as e:
+        raise ValueError('Cursore non valido') from e
+    if criterio != ordina_per or not ids:
+        raise ValueError('Cursore non valido per questo ordinamento')
+    return valore, ids
+
+def cerca_voli_diretti(aeroporto_partenza, aeroporto_arrivo, data, passeggeri=1, classe='economy', ordina_per='prezzo',
+                       cursore=None, limite=None):
+    """
+    Cerca voli diretti tra due aeroporti (o città) in una data specifica.
+    
+    La paginazione è per chiave: `cursore` è la chiave (valore, ids)
+    dell'ultimo volo già restituito e la query riparte da lì con un confronto
+    su (prezzo o durata, id) e un `LIMIT`, senza leggere le pagine precedenti.
+    
+    Args:
+        aeroporto_partenza (str): Codice IATA o città di partenza
+        aeroporto_arrivo (str): Codice IATA o città di arrivo
         data (datetime/date): Data del volo
         passeggeri (int): Numero di passeggeri
         classe (str): Classe del volo ('economy', 'business', 'first')
         ordina_per (str): Criterio di ordinamento ('prezzo' o 'tempo')
+        cursore (tuple): Chiave dell'ultimo volo della pagina precedente
+        limite (int): Numero massimo di voli restituiti
     
     Returns:
         list: Lista di voli disponibili
     """
-    # Normaliser la data
-    if hasattr(data, 'date'):
-        search_date = data.date()
-    else:
-        search_date = data
+    query = _query_voli_diretti(aeroporto_partenza, aeroporto_arrivo, data, passeggeri, classe, ordina_per, cursore)
+    if query is None:
+        return []
+    if limite is not None:
+        query = query.limit(limite)
+    return query.all()
+
+def scorri_voli_diretti(aeroporto_partenza, aeroporto_arrivo, data, passeggeri=1, classe='economy', ordina_per='prezzo',
+                        cursore=None, blocco=500):
+    """
+    Come `cerca_voli_diretti`, ma senza limite e leggendo le righe a blocchi.
+    
+    La query usa un cursore lato server (`yield_per`): le righe arrivano man
+    mano che il database le produce e in memoria ce n'è al più un blocco.
+    
+    Yields:
+        Row: Voli diretti nell'ordine di `cerca_voli_diretti`
+    """
+    query = _query_voli_diretti(aeroporto_partenza, aeroporto_arrivo, data, passeggeri, classe, ordina_per, cursore)
+    if query is None:
+        return
+    yield from query.yield_per(blocco)
+
+def _query_voli_diretti(aeroporto_partenza, aeroporto_arrivo, data, passeggeri, classe, ordina_per, cursore):
+    """
+    Query ordinata dei voli diretti, None se uno dei due luoghi è sconosciuto o
+    se il filtro delle tratte esclude voli in quel giorno.
+    """
+    inizio, fine = intervallo_giorno(data)
+    partenze = indice_città.risolvi(aeroporto_partenza)
+    arrivi = indice_città.risolvi(aeroporto_arrivo)
+    if not partenze or not arrivi:
+        return None
+    if not filtro_tratte.possibili_diretti(partenze, arrivi, data):
+        return None
     
     posti_map = {
         'economy': Volo.posti_economy,
@@ -38,10 +150,31 @@ def cerca_voli_diretti(aeroporto_partenza, aeroporto_arrivo, data, passeggeri=1,
         'first': Volo.prezzo_first
     }
     
+    query = _query_base_voli_diretti(posti_map[classe], prezzo_map[classe]).filter(
+        Volo.aeroporto_partenza_id.in_(partenze),
+        Volo.aeroporto_arrivo_id.in_(arrivi),
+        Volo.data_partenza >= inizio,
+        Volo.data_partenza < fine,
+        posti_map[classe] >= passeggeri
+    )
+    
+    if ordina_per == 'prezzo':
+        chiave = prezzo_map[classe]
+    else:
+        chiave = durata_secondi(Volo.data_arrivo, Volo.data_partenza)
+    
+    if cursore is not None:
+        valore, ids = cursore
+        query = query.filter(tuple_(chiave, Volo.id) > tuple_(valore, ids[0]))
+    return query.order_by(chiave, Volo.id)
+
+def _query_base_voli_diretti(posti, prezzo, *colonne):
+    """Voli con compagnia e città, nel formato delle righe di `cerca_voli_diretti`."""
     AeroportoPartenza = aliased(Aeroporto, name='aeroporto_partenza')
     AeroportoArrivo = aliased(Aeroporto, name='aeroporto_arrivo')
     
-    query = db.session.query(
+    return db.session.query(
+        *colonne,
         Volo.id,
         Volo.numero_volo,
         CompagniaAerea.nome_compagnia,
@@ -49,38 +182,229 @@ def cerca_voli_diretti(aeroporto_partenza, aeroporto_arrivo, data, passeggeri=1,
         AeroportoArrivo.città.label('città_arrivo'),
         Volo.data_partenza,
         Volo.data_arrivo,
-        posti_map[classe].label('posti_disponibili'),
-        prezzo_map[classe].label('prezzo')
+        posti.label('posti_disponibili'),
+        prezzo.label('prezzo')
     ).join(
         CompagniaAerea, Volo.compagnia_id == CompagniaAerea.id
     ).join(
         AeroportoPartenza, Volo.aeroporto_partenza_id == AeroportoPartenza.id
     ).join(
         AeroportoArrivo, Volo.aeroporto_arrivo_id == AeroportoArrivo.id
-    ).filter(
-        AeroportoPartenza.codice_iata == aeroporto_partenza,
-        AeroportoArrivo.codice_iata == aeroporto_arrivo,
-        func.date(Volo.data_partenza) == search_date,
-        posti_map[classe] >= passeggeri
     )
+
+def tariffe_minime_per_giorno(aeroporto_partenza, aeroporto_arrivo, data_inizio, data_fine, classe='economy', passeggeri=1):
+    """
+    Calcola la tariffa minima disponibile per ogni giorno di un periodo.
     
-    if ordina_per == 'prezzo':
-        query = query.order_by(prezzo_map[classe])
-    else:
-        query = query.order_by(Volo.data_arrivo - Volo.data_partenza)
+    Una sola query raggruppata per giorno: il filtro sulla data resta un
+    intervallo sulla colonna, così la ricerca usa `idx_volo_tratta_data`.
+    
+    Args:
+        aeroporto_partenza (str): Codice IATA o città di partenza
+        aeroporto_arrivo (str): Codice IATA o città di arrivo
+        data_inizio (date): Primo giorno del periodo (incluso)
+        data_fine (date): Ultimo giorno del periodo (escluso)
+        classe (str): Classe del volo ('economy', 'business', 'first')
+        passeggeri (int): Posti richiesti
+    
+    Returns:
+        dict: {date: (prezzo_minimo, numero_voli)} per i soli giorni con voli
+    """
+    partenze = indice_città.risolvi(aeroporto_partenza)
+    arrivi = indice_città.risolvi(aeroporto_arrivo)
+    if not partenze or not arrivi:
+        return {}
+    
+    posti = getattr(Volo, f'posti_{classe}')
+    prezzo = getattr(Volo, f'prezzo_{classe}')
+    giorno = func.date(Volo.data_partenza)
+    
+    righe = db.session.query(
+        giorno.label('giorno'),
+        func.min(prezzo).label('prezzo_minimo'),
+        func.count(Volo.id).label('numero_voli')
+    ).filter(
+        Volo.aeroporto_partenza_id.in_(partenze),
+        Volo.aeroporto_arrivo_id.in_(arrivi),
+        Volo.data_partenza >= intervallo_giorno(data_inizio)[0],
+        Volo.data_partenza < intervallo_giorno(data_fine)[0],
+        posti >= passeggeri
+    ).group_by(
+        giorno
+    ).all()
+    
+    # SQLite restituisce il giorno come stringa, PostgreSQL come date
+    return {
+        (datetime.strptime(r.giorno, '%Y-%m-%d').date() if isinstance(r.giorno, str) else r.giorno):
+            (float(r.prezzo_minimo), r.numero_voli)
+        for r in righe
+    }
+
+def _id_città(colonna):
+    """Espressione che converte l'id di un aeroporto nell'id della sua città."""
+    città_multi_aeroporto = indice_città.città_multi_aeroporto()
+    if not città_multi_aeroporto:
+        return colonna
+    return case(città_multi_aeroporto, value=colonna, else_=colonna)
+
+def cerca_voli_scalo(città_partenza, città_arrivo, data, tempo_min_scalo=timedelta(hours=2),
+                     classe='economy', ordina_per='prezzo', cursore=None, limite=None, passeggeri=1,
+                     usa_coincidenze=True):
+    """
+    Cerca voli con uno scalo tra due città (o aeroporti) in una data specifica.
+    
+    Partenza e arrivo sono espansi negli aeroporti della città; lo scalo può
+    avvenire tra due aeroporti della stessa città e viene riconosciuto
+    confrontando gli id interi delle città.
     
+    Con `usa_coincidenze` (default; il chiamante passa `RICERCA_USA_COINCIDENZE`)
+    le coppie si leggono dalla tabella precalcolata `coincidenza` tramite
+    l'indice (partenza, arrivo, giorno); altrimenti vengono calcolate con una
+    join dei voli del giorno.
+    
+    Le coppie sono ordinate per prezzo totale (o durata complessiva) e id dei
+    due voli; la paginazione per chiave funziona come in `cerca_voli_diretti`.
+    
+    Args:
+        città_partenza (str): Città o codice IATA di partenza
+        città_arrivo (str): Città o codice IATA di arrivo
+        data (datetime/date): Data del primo volo
+        tempo_min_scalo (timedelta): Tempo minimo di coincidenza
+        classe (str): Classe del volo, per l'ordinamento per prezzo
+        ordina_per (str): Criterio di ordinamento ('prezzo' o 'tempo')
+        cursore (tuple): Chiave dell'ultima coppia della pagina precedente
+        limite (int): Numero massimo di coppie restituite
+        passeggeri (int): Posti richiesti su entrambi i voli
+        usa_coincidenze (bool): Legge le coppie dalla tabella `coincidenza`
+    
+    Returns:
+        list: Coppie di voli con i dettagli dello scalo
+    """
+    query = _query_voli_scalo(città_partenza, città_arrivo, data, tempo_min_scalo, classe, ordina_per, cursore,
+                              passeggeri, usa_coincidenze)
+    if query is None:
+        return []
+    if limite is not None:
+        query = query.limit(limite)
     return query.all()
 
-def cerca_voli_scalo(città_partenza, città_arrivo, data, tempo_min_scalo=timedelta(hours=2)):
+def scorri_voli_scalo(città_partenza, città_arrivo, data, tempo_min_scalo=timedelta(hours=2),
+                      classe='economy', ordina_per='prezzo', cursore=None, blocco=500, passeggeri=1,
+                      usa_coincidenze=True):
+    """
+    Come `cerca_voli_scalo`, ma senza limite e leggendo le righe a blocchi
+    da un cursore lato server.
+    
+    Yields:
+        Row: Coppie di voli nell'ordine di `cerca_voli_scalo`
+    """
+    query = _query_voli_scalo(città_partenza, città_arrivo, data, tempo_min_scalo, classe, ordina_per, cursore,
+                              passeggeri, usa_coincidenze)
+    if query is None:
+        return
+    yield from query.yield_per(blocco)
+
+def _query_voli_scalo(città_partenza, città_arrivo, data, tempo_min_scalo, classe, ordina_per, cursore, passeggeri,
+                      usa_coincidenze):
     """
-    Cerca voli con uno scalo tra due città in una data specifica.
+    Query ordinata delle coppie di voli, None se uno dei due luoghi è sconosciuto
+    o se il filtro delle tratte esclude itinerari in quel giorno.
     """
-    # Normaliser la data
-    if hasattr(data, 'date'):
-        search_date = data.date()
+    inizio, fine = intervallo_giorno(data)
+    partenze = indice_città.risolvi(città_partenza)
+    arrivi = indice_città.risolvi(città_arrivo)
+    if not partenze or not arrivi:
+        return None
+    if not filtro_tratte.possibili_scalo(partenze, arrivi, data):
+        return None
+    
+    if usa_coincidenze:
+        query, prezzo_totale, id1, id2, partenza, arrivo = _query_coincidenze(
+            partenze, arrivi, inizio, fine, tempo_min_scalo, classe, passeggeri
+        )
     else:
-        search_date = data
+        query, prezzo_totale, id1, id2, partenza, arrivo = _query_coppie_voli(
+            partenze, arrivi, inizio, fine, tempo_min_scalo, classe, passeggeri
+        )
     
+    if ordina_per == 'prezzo':
+        chiave = prezzo_totale
+    else:
+        chiave = durata_secondi(arrivo, partenza)
+    
+    if cursore is not None:
+        valore, ids = cursore
+        ids = (tuple(ids) + (0, 0))[:2]
+        query = query.filter(tuple_(chiave, id1, id2) > tuple_(valore, *ids))
+    return query.order_by(chiave, id1, id2)
+
+def _query_coincidenze(partenze, arrivi, inizio, fine, tempo_min_scalo, classe, passeggeri):
+    """Coppie di voli lette dalla tabella `coincidenza`."""
+    query = _query_base_coincidenze().filter(
+        Coincidenza.aeroporto_partenza_id.in_(partenze),
+        Coincidenza.aeroporto_arrivo_id.in_(arrivi),
+        Coincidenza.data_partenza >= inizio,
+        Coincidenza.data_partenza < fine,
+        Coincidenza.tempo_scalo >= int(tempo_min_scalo.total_seconds()),
+        getattr(Coincidenza, 'posti_' + classe) >= passeggeri
+    )
+    return (query, getattr(Coincidenza, 'prezzo_' + classe), Coincidenza.volo1_id, Coincidenza.volo2_id,
+            Coincidenza.data_partenza, Coincidenza.data_arrivo)
+
+def _query_base_coincidenze(*colonne):
+    """Coincidenze con i dettagli dei due voli, nel formato delle righe di `cerca_voli_scalo`."""
+    Volo1 = aliased(Volo, name='volo1')
+    Volo2 = aliased(Volo, name='volo2')
+    compagnia1 = aliased(CompagniaAerea, name='compagnia1')
+    compagnia2 = aliased(CompagniaAerea, name='compagnia2')
+    AeroportoP = aliased(Aeroporto, name='aeroporto_p')
+    AeroportoS = aliased(Aeroporto, name='aeroporto_s')
+    AeroportoA = aliased(Aeroporto, name='aeroporto_a')
+
+    return db.session.query(
+        *colonne,
+        Coincidenza.volo1_id.label('volo1_id'),
+        Volo1.numero_volo.label('volo1_numero'),
+        compagnia1.nome_compagnia.label('compagnia1'),
+        AeroportoP.città.label('città_partenza'),
+        AeroportoS.città.label('città_scalo'),
+        Coincidenza.data_partenza.label('data_partenza'),
+        Volo1.data_arrivo.label('scalo_arrivo'),
+        Volo1.prezzo_economy.label('volo1_prezzo_economy'),
+        Volo1.prezzo_business.label('volo1_prezzo_business'),
+        Volo1.prezzo_first.label('volo1_prezzo_first'),
+
+        Coincidenza.volo2_id.label('volo2_id'),
+        Volo2.numero_volo.label('volo2_numero'),
+        compagnia2.nome_compagnia.label('compagnia2'),
+        AeroportoA.città.label('città_arrivo'),
+        Volo2.data_partenza.label('scalo_partenza'),
+        Coincidenza.data_arrivo.label('data_arrivo'),
+        Volo2.prezzo_economy.label('volo2_prezzo_economy'),
+        Volo2.prezzo_business.label('volo2_prezzo_business'),
+        Volo2.prezzo_first.label('volo2_prezzo_first'),
+
+        Coincidenza.prezzo_economy.label('prezzo_totale_economy'),
+        Coincidenza.prezzo_business.label('prezzo_totale_business'),
+        Coincidenza.prezzo_first.label('prezzo_totale_first')
+    ).join(
+        Volo1, Coincidenza.volo1_id == Volo1.id
+    ).join(
+        Volo2, Coincidenza.volo2_id == Volo2.id
+    ).join(
+        compagnia1, Volo1.compagnia_id == compagnia1.id
+    ).join(
+        compagnia2, Volo2.compagnia_id == compagnia2.id
+    ).join(
+        AeroportoP, Coincidenza.aeroporto_partenza_id == AeroportoP.id
+    ).join(
+        AeroportoS, Volo1.aeroporto_arrivo_id == AeroportoS.id
+    ).join(
+        AeroportoA, Coincidenza.aeroporto_arrivo_id == AeroportoA.id
+    )
+
+def _query_coppie_voli(partenze, arrivi, inizio, fine, tempo_min_scalo, classe, passeggeri):
+    """Coppie di voli calcolate con una join dei voli del giorno."""
     AeroportoP = aliased(Aeroporto, name='aeroporto_p')
     AeroportoA = aliased(Aeroporto, name='aeroporto_a')
 
@@ -88,13 +412,16 @@ def cerca_voli_scalo(città_partenza, città_arrivo, data, tempo_min_scalo=timed
     voli_disponibili = db.session.query(
         Volo,
         AeroportoP.città.label('città_partenza'),
-        AeroportoA.città.label('città_arrivo')
+        AeroportoA.città.label('città_arrivo'),
+        _id_città(Volo.aeroporto_partenza_id).label('città_partenza_id'),
+        _id_città(Volo.aeroporto_arrivo_id).label('città_arrivo_id')
     ).join(
         AeroportoP, Volo.aeroporto_partenza_id == AeroportoP.id
     ).join(
         AeroportoA, Volo.aeroporto_arrivo_id == AeroportoA.id
     ).filter(
-        func.date(Volo.data_partenza) == search_date
+        Volo.data_partenza >= inizio,
+        Volo.data_partenza < fine
     ).subquery()
 
     volo1 = aliased(voli_disponibili, name='volo1')
@@ -108,29 +435,199 @@ def cerca_voli_scalo(città_partenza, città_arrivo, data, tempo_min_scalo=timed
         compagnia1.nome_compagnia.label('compagnia1'),
         volo1.c.città_partenza.label('città_partenza'),
         volo1.c.città_arrivo.label('città_scalo'),
-        volo1.c.data_partenza.label('volo1_data_partenza'),
-        volo1.c.data_arrivo.label('volo1_data_arrivo'),
+        volo1.c.data_partenza.label('data_partenza'),
+        volo1.c.data_arrivo.label('scalo_arrivo'),
+        volo1.c.prezzo_economy.label('volo1_prezzo_economy'),
+        volo1.c.prezzo_business.label('volo1_prezzo_business'),
+        volo1.c.prezzo_first.label('volo1_prezzo_first'),
 
         volo2.c.id.label('volo2_id'),
         volo2.c.numero_volo.label('volo2_numero'),
         compagnia2.nome_compagnia.label('compagnia2'),
         volo2.c.città_arrivo.label('città_arrivo'),
-        volo2.c.data_partenza.label('volo2_data_partenza'),
-        volo2.c.data_arrivo.label('volo2_data_arrivo'),
+        volo2.c.data_partenza.label('scalo_partenza'),
+        volo2.c.data_arrivo.label('data_arrivo'),
+        volo2.c.prezzo_economy.label('volo2_prezzo_economy'),
+        volo2.c.prezzo_business.label('volo2_prezzo_business'),
+        volo2.c.prezzo_first.label('volo2_prezzo_first'),
 
-        (volo1.c.prezzo_economy + volo2.c.prezzo_economy).label('prezzo_totale')
+        (volo1.c.prezzo_economy + volo2.c.prezzo_economy).label('prezzo_totale_economy'),
+        (volo1.c.prezzo_business + volo2.c.prezzo_business).label('prezzo_totale_business'),
+        (volo1.c.prezzo_first + volo2.c.prezzo_first).label('prezzo_totale_first')
     ).select_from(volo1).join(
         volo2, and_(
-            volo1.c.città_arrivo == volo2.c.città_partenza,
-            volo1.c.città_partenza == città_partenza,
-            volo2.c.città_arrivo == città_arrivo,
+            volo1.c.città_arrivo_id == volo2.c.città_partenza_id,
+            volo1.c.aeroporto_partenza_id.in_(partenze),
+            volo2.c.aeroporto_arrivo_id.in_(arrivi),
             volo2.c.data_partenza > volo1.c.data_arrivo,
-            (volo2.c.data_partenza - volo1.c.data_arrivo) >= tempo_min_scalo
+            (volo2.c.data_partenza - volo1.c.data_arrivo) >= tempo_min_scalo,
+            volo1.c['posti_' + classe] >= passeggeri,
+            volo2.c['posti_' + classe] >= passeggeri
         )
     ).join(compagnia1, volo1.c.compagnia_id == compagnia1.id
     ).join(compagnia2, volo2.c.compagnia_id == compagnia2.id)
 
-    return query.all()
+    return (query, volo1.c['prezzo_' + classe] + volo2.c['prezzo_' + classe], volo1.c.id, volo2.c.id,
+            volo1.c.data_partenza, volo2.c.data_arrivo)
+
+# Colonne della tabella derivata con le ricerche di una richiesta multipla
+COLONNE_RICERCA = (
+    ('indice', Integer),
+    ('partenza_id', Integer),
+    ('arrivo_id', Integer),
+    ('inizio', DateTime),
+    ('fine', DateTime),
+    ('passeggeri', Integer),
+    ('classe', String),
+    ('ordina_per', String),
+    ('limite', Integer)
+)
+
+def tabella_valori(nome, colonne, righe):
+    """
+    Tabella derivata da una lista di tuple, da usare in una join.
+    
+    Su PostgreSQL è una lista `VALUES`; gli altri database (SQLite) non
+    accettano nomi di colonna su `VALUES` e ricevono una `UNION ALL` di
+    `SELECT` di costanti.
+    
+    Args:
+        nome (str): Nome della tabella derivata
+        colonne (tuple): Coppie (nome, tipo) delle colonne
+        righe (list): Tuple di valori, nell'ordine delle colonne
+    """
+    if db.engine.dialect.name == 'postgresql':
+        return values(*(column(n, t) for n, t in colonne), name=nome).data(righe)
+    selezioni = [
+        select(*(literal(valore, tipo).label(n) for valore, (n, tipo) in zip(riga, colonne)))
+        for riga in righe
+    ]
+    if len(selezioni) == 1:
+        return selezioni[0].subquery(nome)
+    return union_all(*selezioni).subquery(nome)
+
+def _righe_ricerche(ricerche, possibile):
+    """
+    Una riga per ricerca e coppia di aeroporti in cui si espandono partenza e
+    arrivo, escluse le coppie per cui `possibile(partenze, arrivi, data)` del
+    filtro delle tratte esclude voli.
+    """
+    righe = []
+    for ricerca in ricerche:
+        inizio, fine = intervallo_giorno(ricerca['data'])
+        for partenza in sorted(indice_città.risolvi(ricerca['aeroporto_partenza'])):
+            for arrivo in sorted(indice_città.risolvi(ricerca['aeroporto_arrivo'])):
+                if not possibile((partenza,), (arrivo,), ricerca['data']):
+                    continue
+                righe.append((
+                    ricerca['indice'], partenza, arrivo, inizio, fine,
+                    ricerca.get('passeggeri', 1),
+                    ricerca.get('classe', 'economy'),
+                    ricerca.get('ordina_per', 'prezzo'),
+                    ricerca['limite']
+                ))
+    return righe
+
+def _per_classe(classe, economy, business, first):
+    return case((classe == 'economy', economy), (classe == 'business', business), else_=first)
+
+def cerca_voli_diretti_multipla(ricerche):
+    """
+    Esegue più ricerche di voli diretti con una sola query.
+    
+    Le ricerche diventano una tabella derivata in join con `volo`; per ogni
+    ricerca si tengono i primi `limite` voli nell'ordine di
+    `cerca_voli_diretti` (`row_number()` partizionato per ricerca).
+    
+    Args:
+        ricerche (list): Dizionari con indice, aeroporto_partenza,
+            aeroporto_arrivo, data, passeggeri, classe, ordina_per e limite
+    
+    Returns:
+        dict: {indice: righe nel formato di `cerca_voli_diretti`}
+    """
+    risultati = {ricerca['indice']: [] for ricerca in ricerche}
+    righe = _righe_ricerche(ricerche, filtro_tratte.possibili_diretti)
+    if not righe:
+        return risultati
+    
+    ricerca = tabella_valori('ricerca', COLONNE_RICERCA, righe)
+    posti = _per_classe(ricerca.c.classe, Volo.posti_economy, Volo.posti_business, Volo.posti_first)
+    prezzo = _per_classe(ricerca.c.classe, Volo.prezzo_economy, Volo.prezzo_business, Volo.prezzo_first)
+    chiave = case(
+        (ricerca.c.ordina_per == 'prezzo', prezzo),
+        else_=durata_secondi(Volo.data_arrivo, Volo.data_partenza)
+    )
+    
+    voli = _query_base_voli_diretti(
+        posti,
+        prezzo,
+        ricerca.c.indice,
+        ricerca.c.limite,
+        func.row_number().over(partition_by=ricerca.c.indice, order_by=(chiave, Volo.id)).label('posizione')
+    ).filter(
+        Volo.aeroporto_partenza_id == ricerca.c.partenza_id,
+        Volo.aeroporto_arrivo_id == ricerca.c.arrivo_id,
+        Volo.data_partenza >= ricerca.c.inizio,
+        Volo.data_partenza < ricerca.c.fine,
+        posti >= ricerca.c.passeggeri
+    ).subquery()
+    
+    query = select(voli).where(
+        voli.c.posizione <= voli.c.limite
+    ).order_by(voli.c.indice, voli.c.posizione)
+    for riga in db.session.execute(query):
+        risultati[riga.indice].append(riga)
+    return risultati
+
+def cerca_voli_scalo_multipla(ricerche, tempo_min_scalo=timedelta(hours=2)):
+    """
+    Esegue più ricerche con uno scalo con una sola query sulla tabella `coincidenza`.
+    
+    Args:
+        ricerche (list): Dizionari come in `cerca_voli_diretti_multipla`
+        tempo_min_scalo (timedelta): Tempo minimo di coincidenza
+    
+    Returns:
+        dict: {indice: righe nel formato di `cerca_voli_scalo`}
+    """
+    risultati = {ricerca['indice']: [] for ricerca in ricerche}
+    righe = _righe_ricerche(ricerche, filtro_tratte.possibili_scalo)
+    if not righe:
+        return risultati
+    
+    ricerca = tabella_valori('ricerca', COLONNE_RICERCA, righe)
+    posti = _per_classe(ricerca.c.classe, Coincidenza.posti_economy, Coincidenza.posti_business,
+                        Coincidenza.posti_first)
+    prezzo = _per_classe(ricerca.c.classe, Coincidenza.prezzo_economy, Coincidenza.prezzo_business,
+                         Coincidenza.prezzo_first)
+    chiave = case(
+        (ricerca.c.ordina_per == 'prezzo', prezzo),
+        else_=durata_secondi(Coincidenza.data_arrivo, Coincidenza.data_partenza)
+    )
+    
+    coppie = _query_base_coincidenze(
+        ricerca.c.indice,
+        ricerca.c.limite,
+        func.row_number().over(
+            partition_by=ricerca.c.indice,
+            order_by=(chiave, Coincidenza.volo1_id, Coincidenza.volo2_id)
+        ).label('posizione')
+    ).filter(
+        Coincidenza.aeroporto_partenza_id == ricerca.c.partenza_id,
+        Coincidenza.aeroporto_arrivo_id == ricerca.c.arrivo_id,
+        Coincidenza.data_partenza >= ricerca.c.inizio,
+        Coincidenza.data_partenza < ricerca.c.fine,
+        Coincidenza.tempo_scalo >= int(tempo_min_scalo.total_seconds()),
+        posti >= ricerca.c.passeggeri
+    ).subquery()
+    
+    query = select(coppie).where(
+        coppie.c.posizione <= coppie.c.limite
+    ).order_by(coppie.c.indice, coppie.c.posizione)
+    for riga in db.session.execute(query):
+        risultati[riga.indice].append(riga)
+    return risultati
 
 def statistiche_compagnia(compagnia_id, data_inizio, data_fine):
     """
@@ -262,32 +759,108 @@ def prenotazioni_utente(user_id):
     
     return prenotazioni
 
-def verifica_disponibilità_posti(volo_id):
+def scorri_prenotazioni_utente(user_id, blocco=500):
+    """
+    Prenotazioni di un utente con i biglietti, lette con una sola query a blocchi.
+    
+    Prenotazioni e biglietti arrivano da un'unica join ordinata per
+    prenotazione, letta da un cursore lato server: ogni prenotazione viene
+    restituita appena le sue righe sono complete, senza caricare le altre.
+    
+    Args:
+        user_id (int): ID dell'utente
+        blocco (int): Righe lette dal database per volta
+    
+    Yields:
+        tuple: (prenotazione, biglietti), dove prenotazione è la prima riga
+        della join e biglietti la lista delle righe dei suoi biglietti
+    """
+    AeroportoPartenza = aliased(Aeroporto)
+    AeroportoArrivo = aliased(Aeroporto)
+    
+    righe = db.session.query(
+        Prenotazione.id.label('prenotazione_id'),
+        Prenotazione.data_prenotazione,
+        Prenotazione.stato,
+        Prenotazione.prezzo_totale,
+        Biglietto.id.label('biglietto_id'),
+        Biglietto.classe,
+        Biglietto.numero_posto.label('posto'),
+        Biglietto.prezzo,
+        Biglietto.bagaglio_extra,
+        Biglietto.servizi_extra,
+        Volo.numero_volo.label('volo'),
+        CompagniaAerea.nome_compagnia.label('compagnia'),
+        AeroportoPartenza.città.label('partenza'),
+        AeroportoArrivo.città.label('arrivo'),
+        Volo.data_partenza,
+        Volo.data_arrivo
+    ).outerjoin(
+        Biglietto, Biglietto.booking_id == Prenotazione.id
+    ).outerjoin(
+        Volo, Biglietto.flight_id == Volo.id
+    ).outerjoin(
+        CompagniaAerea, Volo.compagnia_id == CompagniaAerea.id
+    ).outerjoin(
+        AeroportoPartenza, Volo.aeroporto_partenza_id == AeroportoPartenza.id
+    ).outerjoin(
+        AeroportoArrivo, Volo.aeroporto_arrivo_id == AeroportoArrivo.id
+    ).filter(
+        Prenotazione.user_id == user_id
+    ).order_by(
+        desc(Prenotazione.data_prenotazione), desc(Prenotazione.id), Biglietto.id
+    ).yield_per(blocco)
+    
+    prenotazione, biglietti = None, []
+    for riga in righe:
+        if prenotazione is None or riga.prenotazione_id != prenotazione.prenotazione_id:
+            if prenotazione is not None:
+                yield prenotazione, biglietti
+            prenotazione, biglietti = riga, []
+        if riga.biglietto_id is not None:
+            biglietti.append(riga)
+    if prenotazione is not None:
+        yield prenotazione, biglietti
+
+def verifica_disponibilità_posti(volo_id, utente_id=None):
     """
     Verifica la disponibilità dei posti per un volo specifico.
     
+    I posti di un volo sono già quelli liberi: ogni prenotazione e ogni blocco
+    temporaneo li decrementa (app/booking.py), quindi non serve contare i
+    biglietti e i posti bloccati da altri utenti non risultano disponibili.
+    
     Args:
         volo_id (int): ID del volo
+        utente_id (int): Se indicato, i posti bloccati da questo utente sul
+            volo sono contati come disponibili per lui
     
     Returns:
         dict: Disponibilità posti per ogni classe
     """
+    if utente_id is None:
+        posti = {classe: getattr(Volo, f'posti_{classe}') for classe in ('economy', 'business', 'first')}
+    else:
+        posti = {
+            classe: getattr(Volo, f'posti_{classe}') + case(
+                (BloccoPosti.classe == classe, BloccoPosti.posti), else_=0
+            )
+            for classe in ('economy', 'business', 'first')
+        }
     query = db.session.query(
         Volo.id,
         Volo.numero_volo,
-        (Volo.posti_economy - func.count(case((Biglietto.classe == 'economy', 1)))).label('posti_economy_disponibili'),
-        (Volo.posti_business - func.count(case((Biglietto.classe == 'business', 1)))).label('posti_business_disponibili'),
-        (Volo.posti_first - func.count(case((Biglietto.classe == 'first', 1)))).label('posti_first_disponibili')
-    ).outerjoin(
-        Biglietto, Volo.id == Biglietto.flight_id
+        posti['economy'].label('posti_economy_disponibili'),
+        posti['business'].label('posti_business_disponibili'),
+        posti['first'].label('posti_first_disponibili')
     ).filter(
         Volo.id == volo_id
-    ).group_by(
-        Volo.id,
-        Volo.numero_volo,
-        Volo.posti_economy,
-        Volo.posti_business,
-        Volo.posti_first
     )
+    if utente_id is not None:
+        query = query.outerjoin(BloccoPosti, and_(
+            BloccoPosti.flight_id == Volo.id,
+            BloccoPosti.user_id == utente_id,
+            BloccoPosti.scadenza > datetime.now()
+        ))
     
     return query.first() 
\ No newline at end of file
@@ -0,0 +1,170 @@
+"""
+Classifica unica di voli diretti e itinerari con scalo.
+
+I candidati vengono caricati in tre array NumPy (prezzo, durata, scali) e
+tutta la classifica è calcolata su array, senza cicli per riga:
+
+- fronte di Pareto: un candidato è dominato se un altro non è peggiore in
+  nessun criterio e migliore in almeno uno. Ordinati i candidati per
+  (prezzo, durata, scali), per ogni numero di scali basta confrontare la
+  durata con il minimo progressivo delle durate precedenti con scali non
+  superiori: O(n log n) invece del confronto a coppie;
+- punteggio pesato: somma dei tre criteri normalizzati in [0, 1] con i pesi
+  di `RICERCA_PESI` (più basso è meglio);
+- ordine finale: prima il fronte di Pareto, poi gli altri, ciascuno per
+  punteggio. Il migliore, il più economico e il più veloce sono sempre
+  inclusi nei primi k ed etichettati 'best', 'cheapest' e 'fastest'.
+"""
+import numpy as np
+
+MIGLIORE = 'best'
+PIÙ_ECONOMICO = 'cheapest'
+PIÙ_VELOCE = 'fastest'
+
+PESI_PREDEFINITI = {'prezzo': 0.5, 'durata': 0.35, 'scali': 0.15}
+
+
+class Proposta:
+    """Un risultato della classifica: volo diretto o itinerario con scalo."""
+
+    __slots__ = ('risultato', 'diretto', 'prezzo', 'durata', 'scali', 'punteggio', 'pareto', 'etichette')
+
+    def __init__(self, risultato, diretto, prezzo, durata, scali, punteggio, pareto, etichette):
+        self.risultato = risultato
+        self.diretto = diretto
+        self.prezzo = prezzo
+        self.durata = durata
+        self.scali = scali
+        self.punteggio = punteggio
+        self.pareto = pareto
+        self.etichette = etichette
+
+    def __repr__(self):
+        return f'<Proposta {self.prezzo} {self.durata}s {self.scali} scali {self.etichette}>'
+
+
+def fronte_pareto(prezzo, durata, scali):
+    """
+    Maschera dei candidati non dominati.
+
+    Args:
+        prezzo, durata, scali (ndarray): Criteri da minimizzare, uno per candidato
+
+    Returns:
+        ndarray: Array booleano, True per i candidati sul fronte di Pareto
+    """
+    n = len(prezzo)
+    if n == 0:
+        return np.zeros(0, dtype=bool)
+    # I candidati con criteri identici non si dominano a vicenda: si lavora
+    # sui punti distinti e si riporta il risultato ai candidati
+    punti, inversa = np.unique(np.column_stack((prezzo, durata, scali)), axis=0, return_inverse=True)
+    inversa = inversa.reshape(-1)
+    # np.unique ordina i punti per (prezzo, durata, scali)
+    durate, livelli = punti[:, 1], punti[:, 2]
+    dominato = np.zeros(len(punti), dtype=bool)
+    for livello in np.unique(livelli):
+        ammessi = np.where(livelli <= livello, durate, np.inf)
+        minimo_precedente = np.concatenate(([np.inf], np.minimum.accumulate(ammessi)[:-1]))
+        dominato |= (livelli == livello) & (minimo_precedente <= durate)
+    return ~dominato[inversa]
+
+
+def _normalizza(valori):
+    minimo, massimo = valori.min(), valori.max()
+    if massimo == minimo:
+        return np.zeros_like(valori)
+    return (valori - minimo) / (massimo - minimo)
+
+
+def punteggi(prezzo, durata, scali, pesi=None):
+    """Somma pesata dei criteri normalizzati in [0, 1]: più basso è meglio."""
+    pesi = pesi or PESI_PREDEFINITI
+    return (pesi.get('prezzo', 0) * _normalizza(prezzo)
+            + pesi.get('durata', 0) * _normalizza(durata)
+            + pesi.get('scali', 0) * _normalizza(scali))
+
+
+def classifica(diretti, itinerari, classe='economy', k=20, pesi=None):
+    """
+    Unisce voli diretti e itinerari con scalo in una classifica dei primi k.
+
+    Args:
+        diretti (list): Righe di `cerca_voli_diretti` (prezzo già della classe)
+        itinerari (list): `Itinerario` della ricerca con scalo
+        classe (str): Classe del volo per il prezzo degli itinerari
+        k (int): Numero di proposte restituite
+        pesi (dict): Pesi di 'prezzo', 'durata' e 'scali' nel punteggio
+
+    Returns:
+        list: `Proposta` in ordine di classifica
+    """
+    candidati = list(diretti) + list(itinerari)
+    n = len(candidati)
+    if n == 0 or k <= 0:
+        return []
+    n_diretti = len(diretti)
+
+    # Caricamento dei criteri: l'unico passaggio sulle singole righe
+    prezzo = np.fromiter(
+        (float(v.prezzo) for v in diretti),
+        dtype=np.float64, count=n_diretti
+    )
+    prezzo = np.concatenate((prezzo, np.fromiter(
+        (float(i.prezzo(classe)) for i in itinerari),
+        dtype=np.float64, count=n - n_diretti
+    )))
+    durata = np.fromiter(
+        ((c.data_arrivo - c.data_partenza).total_seconds() for c in candidati),
+        dtype=np.float64, count=n
+    )
+    scali = np.concatenate((
+        np.zeros(n_diretti),
+        np.fromiter((i.scali for i in itinerari), dtype=np.float64, count=n - n_diretti)
+    ))
+
+    pareto = fronte_pareto(prezzo, durata, scali)
+    punteggio = punteggi(prezzo, durata, scali, pesi)
+
+    # Ordine: fronte di Pareto, punteggio, prezzo, posizione
+    ordine = np.lexsort((np.arange(n), prezzo, punteggio, ~pareto))
+    rango = np.empty(n, dtype=np.int64)
+    rango[ordine] = np.arange(n)
+
+    migliore = ordine[0]
+    più_economico = np.lexsort((durata, prezzo))[0]
+    più_veloce = np.lexsort((prezzo, durata))[0]
+    evidenziati = np.unique([migliore, più_economico, più_veloce])
+
+    # Primi k, garantendo la presenza dei candidati etichettati
+    primi = ordine[:k]
+    mancanti = np.setdiff1d(evidenziati, primi)
+    if len(mancanti):
+        primi = primi[~np.isin(primi, evidenziati)][:max(k - len(evidenziati), 0)]
+        primi = np.concatenate((primi, evidenziati))
+        primi = primi[np.argsort(rango[primi])]
+
+    etichette = {
+        migliore: [MIGLIORE],
+    }
+    etichette.setdefault(più_economico, []).append(PIÙ_ECONOMICO)
+    etichette.setdefault(più_veloce, []).append(PIÙ_VELOCE)
+
+    return [
+        Proposta(
+            risultato=candidati[i],
+            diretto=i < n_diretti,
+            prezzo=float(prezzo[i]),
+            durata=int(durata[i]),
+            scali=int(scali[i]),
+            punteggio=float(punteggio[i]),
+            pareto=bool(pareto[i]),
+            etichette=etichette.get(i, [])
+        )
+        for i in primi.tolist()
+    ]
+
+
+def init_app(app):
+    """Pesi predefiniti del punteggio."""
+    app.config.setdefault('RICERCA_PESI', dict(PESI_PREDEFINITI))
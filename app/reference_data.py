@@ -0,0 +1,182 @@
+"""
+Cache di processo dei dati di riferimento: aeroporti e compagnie aeree.
+
+Le due tabelle cambiano raramente ma servono in quasi ogni pagina e ricerca.
+Vengono lette una volta per processo e conservate come record immutabili
+(`AeroportoRif`, `CompagniaRif`: namedtuple, quindi senza `__dict__`), da
+consultare per id o per codice senza query:
+
+    aeroporto(volo.aeroporto_partenza_id).città
+    compagnia_di_utente(current_user.id).id
+
+Ogni scrittura su `Aeroporto` o `CompagniaAerea` incrementa il contatore di
+versione (al flush e di nuovo al commit o al rollback, così una lettura fatta
+nel mezzo della transazione non resta in cache); la lettura successiva
+ricarica le tabelle. Le modifiche fatte da altri processi si vedono dopo
+`RIFERIMENTI_TTL` secondi.
+
+`generazione()` identifica i dati caricati: gli indici costruiti sopra questi
+dati (`indice_città`, `indice_aeroporti`) la confrontano per sapere quando
+ricostruirsi.
+"""
+import threading
+import time
+from collections import namedtuple
+
+from flask import current_app
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from .models import db, Aeroporto, CompagniaAerea
+
+AeroportoRif = namedtuple('AeroportoRif', ['id', 'codice_iata', 'nome', 'città', 'paese'])
+CompagniaRif = namedtuple('CompagniaRif', ['id', 'utente_id', 'nome_compagnia', 'codice_iata', 'sede_legale'])
+
+_MODIFICATI = 'riferimenti_modificati'
+
+
+class DatiRiferimento:
+    """Aeroporti e compagnie aeree indicizzati per id e per codice."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.versione = 0
+        self._caricato = -1
+        self._caricato_il = 0.0
+        self.aeroporti = {}
+        self.aeroporti_per_codice = {}
+        self.compagnie = {}
+        self.compagnie_per_codice = {}
+        self.compagnie_per_utente = {}
+
+    def invalida(self):
+        with self._lock:
+            self.versione += 1
+
+    def _scaduto(self):
+        try:
+            ttl = current_app.config['RIFERIMENTI_TTL']
+        except (RuntimeError, KeyError):
+            return False
+        return ttl is not None and time.monotonic() - self._caricato_il > ttl
+
+    def _aggiorna(self):
+        if self._caricato == self.versione and not self._scaduto():
+            return
+        with self._lock:
+            if self._caricato == self.versione and not self._scaduto():
+                return
+            if self._caricato == self.versione:
+                # Scaduto: i dati ricaricati hanno una nuova generazione
+                self.versione += 1
+            versione = self.versione
+            aeroporti = {
+                r.id: AeroportoRif(*r)
+                for r in db.session.query(
+                    Aeroporto.id, Aeroporto.codice_iata, Aeroporto.nome, Aeroporto.città, Aeroporto.paese
+                )
+            }
+            compagnie = {
+                r.id: CompagniaRif(*r)
+                for r in db.session.query(
+                    CompagniaAerea.id, CompagniaAerea.utente_id, CompagniaAerea.nome_compagnia,
+                    CompagniaAerea.codice_iata, CompagniaAerea.sede_legale
+                )
+            }
+
+            self.aeroporti = aeroporti
+            self.aeroporti_per_codice = {a.codice_iata.upper(): a for a in aeroporti.values()}
+            self.compagnie = compagnie
+            self.compagnie_per_codice = {c.codice_iata.upper(): c for c in compagnie.values() if c.codice_iata}
+            self.compagnie_per_utente = {c.utente_id: c for c in compagnie.values()}
+            self._caricato_il = time.monotonic()
+            self._caricato = versione
+
+    def generazione(self):
+        """Versione dei dati attualmente caricati (li carica se necessario)."""
+        self._aggiorna()
+        return self._caricato
+
+    def aeroporto(self, aeroporto_id):
+        self._aggiorna()
+        return self.aeroporti.get(aeroporto_id)
+
+    def aeroporto_per_codice(self, codice):
+        self._aggiorna()
+        return self.aeroporti_per_codice.get((codice or '').strip().upper())
+
+    def tutti_aeroporti(self):
+        self._aggiorna()
+        return list(self.aeroporti.values())
+
+    def compagnia(self, compagnia_id):
+        self._aggiorna()
+        return self.compagnie.get(compagnia_id)
+
+    def compagnia_per_codice(self, codice):
+        self._aggiorna()
+        return self.compagnie_per_codice.get((codice or '').strip().upper())
+
+    def compagnia_di_utente(self, utente_id):
+        self._aggiorna()
+        return self.compagnie_per_utente.get(int(utente_id))
+
+    def tutte_compagnie(self):
+        self._aggiorna()
+        return sorted(self.compagnie.values(), key=lambda c: c.nome_compagnia.casefold())
+
+
+riferimenti = DatiRiferimento()
+
+
+def aeroporto(aeroporto_id):
+    """`AeroportoRif` con questo id, o None."""
+    return riferimenti.aeroporto(aeroporto_id)
+
+
+def compagnia(compagnia_id):
+    """`CompagniaRif` con questo id, o None."""
+    return riferimenti.compagnia(compagnia_id)
+
+
+def compagnia_di_utente(utente_id):
+    """`CompagniaRif` dell'utente compagnia aerea, o None."""
+    return riferimenti.compagnia_di_utente(utente_id)
+
+
+def _dopo_flush(session, flush_context):
+    for oggetto in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(oggetto, (Aeroporto, CompagniaAerea)):
+            session.info[_MODIFICATI] = True
+            riferimenti.invalida()
+            return
+
+
+def _fine_transazione(session, transazione_precedente=None):
+    # Commit e rollback di un SAVEPOINT non chiudono la transazione
+    if session.in_nested_transaction() or getattr(transazione_precedente, 'nested', False):
+        return
+    if session.info.pop(_MODIFICATI, False):
+        riferimenti.invalida()
+
+
+def init_app(app):
+    """Registra l'invalidazione, espone i record ai template e carica la cache se possibile."""
+    app.config.setdefault('RIFERIMENTI_TTL', 300)
+    for nome, funzione in (('after_flush', _dopo_flush),
+                           ('after_commit', _fine_transazione),
+                           ('after_soft_rollback', _fine_transazione)):
+        if not event.contains(Session, nome, funzione):
+            event.listen(Session, nome, funzione)
+    app.add_template_global(aeroporto)
+    app.add_template_global(compagnia)
+    app.add_template_global(compagnia_di_utente)
+    with app.app_context():
+        try:
+            if inspect(db.engine).has_table(Aeroporto.__tablename__):
+                riferimenti.generazione()
+        except Exception:
+            # Database non raggiungibile: la cache verrà caricata al primo utilizzo
+            pass
+        finally:
+            db.session.remove()
@@ -0,0 +1,237 @@
+"""
+Filtro in memoria delle tratte esistenti, per scartare le ricerche impossibili.
+
+Per i prossimi `FILTRO_TRATTE_GIORNI` giorni il filtro conserva delle bitmap
+(interi Python, un bit per giorno a partire da `base`):
+
+- `tratte[(partenza_id, arrivo_id)]`: giorni con almeno un volo diretto;
+- `partenze[aeroporto_id]` e `arrivi[aeroporto_id]`: giorni con almeno un volo
+  in partenza da / in arrivo a ogni aeroporto.
+
+Una ricerca diretta è possibile solo se una coppia di aeroporti ha il bit del
+giorno; una con scalo solo se un'origine ha partenze quel giorno e una
+destinazione ha arrivi nei giorni in cui l'itinerario può terminare. Se il
+filtro risponde no, la ricerca restituisce subito "nessun volo" senza query.
+
+Il filtro può solo sbagliare per eccesso: i bit vengono accesi a ogni flush e
+commit di un `Volo` ma non spenti alla cancellazione o alla modifica (un bit
+acceso in più costa solo una query). La ricostruzione completa, ogni
+`FILTRO_TRATTE_TTL` secondi, spegne i bit superati, sposta la finestra dei
+giorni e recepisce i voli inseriti da altri processi. Per i giorni fuori dalla
+finestra il filtro non sa nulla e lascia passare la ricerca.
+"""
+import math
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+
+from .models import db, Volo
+
+_DA_ACCENDERE = 'filtro_tratte_da_accendere'
+
+
+def _giorno(data):
+    return data.date() if isinstance(data, datetime) else data
+
+
+class FiltroTratte:
+    """Bitmap dei giorni con voli per tratta e per aeroporto."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._lock_ricostruzione = threading.Lock()
+        self.base = None
+        self.giorni = 0
+        self.costruito_il = 0.0
+        self.tratte = {}
+        self.partenze = {}
+        self.arrivi = {}
+        # Voli scritti durante una ricostruzione, da riportare sulle nuove bitmap
+        self._ricostruzione = None
+        self.evitate = 0
+        self.ricostruzioni = 0
+
+    def _accendi(self, tratte, partenze, arrivi, base, voli):
+        for partenza, arrivo, data_partenza, data_arrivo in voli:
+            scarto = (_giorno(data_partenza) - base).days
+            if scarto < 0:
+                continue
+            bit_partenza = 1 << scarto
+            bit_arrivo = 1 << max((_giorno(data_arrivo) - base).days, 0)
+            tratte[(partenza, arrivo)] = tratte.get((partenza, arrivo), 0) | bit_partenza
+            partenze[partenza] = partenze.get(partenza, 0) | bit_partenza
+            arrivi[arrivo] = arrivi.get(arrivo, 0) | bit_arrivo
+
+    def accendi(self, voli):
+        """Registra dei voli (partenza_id, arrivo_id, data_partenza, data_arrivo) appena scritti."""
+        with self._lock:
+            if self._ricostruzione is not None:
+                self._ricostruzione.extend(voli)
+            if self.base is not None:
+                self._accendi(self.tratte, self.partenze, self.arrivi, self.base, voli)
+
+    def ricostruisci(self, giorni):
+        """Ricarica le bitmap dai voli in partenza da oggi ai prossimi `giorni` giorni."""
+        with self._lock:
+            self._ricostruzione = []
+        try:
+            base = date.today()
+            fine = base + timedelta(days=giorni)
+            tratte, partenze, arrivi = {}, {}, {}
+            righe = db.session.execute(
+                select(Volo.aeroporto_partenza_id, Volo.aeroporto_arrivo_id, Volo.data_partenza, Volo.data_arrivo)
+                .where(Volo.data_partenza >= datetime.combine(base, datetime.min.time()),
+                       Volo.data_partenza < datetime.combine(fine, datetime.min.time()))
+                .execution_options(yield_per=5000)
+            )
+            self._accendi(tratte, partenze, arrivi, base, righe)
+            with self._lock:
+                self._accendi(tratte, partenze, arrivi, base, self._ricostruzione)
+                self.tratte, self.partenze, self.arrivi = tratte, partenze, arrivi
+                self.base = base
+                self.giorni = giorni
+                self.costruito_il = time.monotonic()
+                self.ricostruzioni += 1
+        finally:
+            with self._lock:
+                self._ricostruzione = None
+
+    def _da_ricostruire(self):
+        return (self.base is None or self.base != date.today()
+                or time.monotonic() - self.costruito_il > current_app.config['FILTRO_TRATTE_TTL'])
+
+    def _aggiorna(self):
+        if not self._da_ricostruire():
+            return
+        # Una sola ricostruzione alla volta: nel frattempo le altre ricerche
+        # usano le bitmap precedenti, se ci sono
+        if not self._lock_ricostruzione.acquire(blocking=self.base is None):
+            return
+        try:
+            if self._da_ricostruire():
+                self.ricostruisci(current_app.config['FILTRO_TRATTE_GIORNI'])
+        finally:
+            self._lock_ricostruzione.release()
+
+    def _bit(self, data):
+        """Posizione del giorno nelle bitmap, None se fuori dalla finestra."""
+        scarto = (_giorno(data) - self.base).days
+        if 0 <= scarto < self.giorni:
+            return scarto
+        return None
+
+    def possibili_diretti(self, partenze, arrivi, data):
+        """
+        False solo se di certo non ci sono voli diretti tra i due insiemi di aeroporti nel giorno.
+
+        Args:
+            partenze (Iterable[int]): Id degli aeroporti di partenza
+            arrivi (Iterable[int]): Id degli aeroporti di arrivo
+            data (datetime/date): Giorno della ricerca
+        """
+        if not current_app.config['FILTRO_TRATTE']:
+            return True
+        self._aggiorna()
+        bit = self._bit(data)
+        if bit is None:
+            return True
+        tratte = self.tratte
+        if any(tratte.get((p, a), 0) >> bit & 1 for p in partenze for a in arrivi):
+            return True
+        self.evitate += 1
+        return False
+
+    def possibili_scalo(self, partenze, arrivi, data, max_scali=1):
+        """
+        False solo se di certo nessun itinerario parte da `partenze` nel giorno e
+        arriva ad `arrivi` entro la durata massima di un itinerario con
+        `max_scali` scali (un giorno di volo e una attesa massima per scalo).
+        """
+        config = current_app.config
+        if not config['FILTRO_TRATTE']:
+            return True
+        self._aggiorna()
+        bit = self._bit(data)
+        if bit is None:
+            return True
+        if not any(self.partenze.get(p, 0) >> bit & 1 for p in partenze):
+            self.evitate += 1
+            return False
+        attesa = config.get('RICERCA_TEMPO_MAX_SCALO', timedelta(hours=24))
+        ampiezza = 2 + max_scali * (1 + math.ceil(attesa / timedelta(days=1)))
+        finestra = ((1 << ampiezza) - 1) << bit
+        if any(self.arrivi.get(a, 0) & finestra for a in arrivi):
+            return True
+        self.evitate += 1
+        return False
+
+
+filtro_tratte = FiltroTratte()
+
+
+def _dopo_flush(session, flush_context):
+    voli = [
+        (oggetto.aeroporto_partenza_id, oggetto.aeroporto_arrivo_id, oggetto.data_partenza, oggetto.data_arrivo)
+        for oggetto in list(session.new) + list(session.dirty)
+        if isinstance(oggetto, Volo) and oggetto.data_partenza is not None and oggetto.data_arrivo is not None
+    ]
+    if voli:
+        session.info.setdefault(_DA_ACCENDERE, []).extend(voli)
+        filtro_tratte.accendi(voli)
+
+
+def _dopo_commit(session):
+    if session.in_nested_transaction():
+        return
+    # Una ricostruzione iniziata prima del commit non ha visto questi voli
+    voli = session.info.pop(_DA_ACCENDERE, None)
+    if voli:
+        filtro_tratte.accendi(voli)
+
+
+def _dopo_rollback(session, transazione_precedente):
+    # Solo la transazione esterna: i voli di un SAVEPOINT annullato restano
+    # accesi come bit in più
+    if not transazione_precedente.nested:
+        session.info.pop(_DA_ACCENDERE, None)
+
+
+def metriche_prometheus():
+    """Contatori del filtro nel formato testuale di Prometheus."""
+    righe = []
+    for nome, descrizione, valore in (
+        ('evitate', 'Ricerche risolte dal filtro senza query', filtro_tratte.evitate),
+        ('ricostruzioni', 'Ricostruzioni complete del filtro', filtro_tratte.ricostruzioni),
+    ):
+        metrica = f'filtro_tratte_{nome}_total'
+        righe.append(f'# HELP {metrica} {descrizione}')
+        righe.append(f'# TYPE {metrica} counter')
+        righe.append(f'{metrica} {valore}')
+    return '\n'.join(righe) + '\n'
+
+
+def init_app(app):
+    """Registra l'aggiornamento sugli eventi di sessione e costruisce il filtro se possibile."""
+    app.config.setdefault('FILTRO_TRATTE', True)
+    app.config.setdefault('FILTRO_TRATTE_GIORNI', 365)
+    app.config.setdefault('FILTRO_TRATTE_TTL', 600)
+    for nome, funzione in (('after_flush', _dopo_flush),
+                           ('after_commit', _dopo_commit),
+                           ('after_soft_rollback', _dopo_rollback)):
+        if not event.contains(Session, nome, funzione):
+            event.listen(Session, nome, funzione)
+    if not app.config['FILTRO_TRATTE']:
+        return
+    with app.app_context():
+        try:
+            if inspect(db.engine).has_table(Volo.__tablename__):
+                filtro_tratte.ricostruisci(app.config['FILTRO_TRATTE_GIORNI'])
+        except Exception:
+            # Database non raggiungibile: il filtro verrà costruito al primo utilizzo
+            pass
+        finally:
+            db.session.remove()
@@ -0,0 +1,670 @@
+"""
+Grafo orario in memoria per la ricerca di itinerari con scalo.
+
+Per ogni giorno viene costruito (una sola volta, poi riusato) un grafo delle
+partenze dei voli indicizzato per aeroporto, con le partenze ordinate per
+orario. La ricerca degli itinerari a 1 o 2 scali è una visita best-first
+dipendente dal tempo, nell'ordine di prezzo o durata dei risultati: da ogni
+aeroporto si considerano solo le partenze che rispettano il tempo minimo di
+coincidenza (ricerca binaria sugli orari) e solo verso aeroporti da cui la
+destinazione è ancora raggiungibile con gli scali rimasti. Una ricerca
+restituisce al più `RICERCA_MAX_ITINERARI` itinerari, i migliori.
+
+I grafi vengono invalidati dagli eventi di sessione SQLAlchemy quando un
+`Volo`, un `Biglietto`, un `BloccoPosti` o la `MappaPosti` di un volo
+(modificata da ogni prenotazione) cambiano, e comunque scadono dopo
+`RICERCA_GRAFO_TTL` secondi (le modifiche fatte da altri processi o dai trigger
+non sono visibili agli eventi della sessione). L'invalidazione avviene dopo il
+flush e di nuovo dopo il commit o il rollback: un grafo ricostruito tra il
+flush e la fine della transazione (da un'altra sessione con i dati vecchi, o
+dalla stessa con dati poi annullati) non resta in memoria.
+"""
+import heapq
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, deque
+from datetime import datetime, timedelta
+from itertools import count, islice
+
+from flask import current_app, g
+from sqlalchemy import event, inspect, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from .models import db, Volo, Biglietto, BloccoPosti, MappaPosti
+from .city_index import indice_città
+from .reference_data import riferimenti
+from .route_filter import filtro_tratte
+from .queries import (
+    intervallo_giorno, cerca_voli_scalo, scorri_voli_scalo, cerca_voli_scalo_multipla, chiave_ordinamento
+)
+
+
+class RicercaScaduta(TimeoutError):
+    """La visita del grafo ha superato la scadenza della ricerca."""
+
+
+class Tratta:
+    """Un singolo volo all'interno di un itinerario."""
+
+    __slots__ = (
+        'id', 'numero_volo', 'compagnia',
+        'aeroporto_partenza_id', 'aeroporto_arrivo_id',
+        'codice_partenza', 'codice_arrivo',
+        'città_partenza', 'città_arrivo',
+        'data_partenza', 'data_arrivo',
+        'posti_economy', 'posti_business', 'posti_first',
+        'prezzo_economy', 'prezzo_business', 'prezzo_first',
+    )
+
+    def __init__(self, **kwargs):
+        for campo in self.__slots__:
+            setattr(self, campo, kwargs.get(campo))
+
+    def posti(self, classe):
+        return getattr(self, f'posti_{classe}')
+
+    def prezzo(self, classe):
+        return getattr(self, f'prezzo_{classe}')
+
+    def __repr__(self):
+        return f'<Tratta {self.numero_volo} {self.codice_partenza}-{self.codice_arrivo}>'
+
+
+class Itinerario:
+    """
+    Sequenza di tratte con coincidenze valide.
+
+    Espone gli stessi attributi delle righe restituite da `cerca_voli_scalo`
+    (primo e ultimo volo, città di scalo, prezzi totali per classe) così da
+    poter essere usato indifferentemente nei template e nelle API.
+    """
+
+    __slots__ = ('tratte',)
+
+    def __init__(self, tratte):
+        self.tratte = tuple(tratte)
+
+    @property
+    def scali(self):
+        return len(self.tratte) - 1
+
+    @property
+    def data_partenza(self):
+        return self.tratte[0].data_partenza
+
+    @property
+    def data_arrivo(self):
+        return self.tratte[-1].data_arrivo
+
+    @property
+    def durata(self):
+        return self.data_arrivo - self.data_partenza
+
+    @property
+    def città_partenza(self):
+        return self.tratte[0].città_partenza
+
+    @property
+    def città_arrivo(self):
+        return self.tratte[-1].città_arrivo
+
+    @property
+    def città_scalo(self):
+        return ', '.join(t.città_arrivo for t in self.tratte[:-1])
+
+    def prezzo(self, classe):
+        return sum(t.prezzo(classe) for t in self.tratte)
+
+    def posti_disponibili(self, classe):
+        return min(t.posti(classe) for t in self.tratte)
+
+    @property
+    def prezzo_totale_economy(self):
+        return self.prezzo('economy')
+
+    @property
+    def prezzo_totale_business(self):
+        return self.prezzo('business')
+
+    @property
+    def prezzo_totale_first(self):
+        return self.prezzo('first')
+
+    def __repr__(self):
+        return f"<Itinerario {' / '.join(t.numero_volo for t in self.tratte)}>"
+
+
+class GrafoGiornaliero:
+    """Partenze di un giorno indicizzate per aeroporto e ordinate per orario."""
+
+    def __init__(self, giorno, tratte):
+        self.giorno = giorno
+        self.creato_il = time.monotonic()
+        self.partenze = defaultdict(list)
+        self.predecessori = defaultdict(set)
+
+        for tratta in sorted(tratte, key=lambda t: t.data_partenza):
+            self.partenze[tratta.aeroporto_partenza_id].append(tratta)
+            self.predecessori[tratta.aeroporto_arrivo_id].add(tratta.aeroporto_partenza_id)
+
+        self.orari = {
+            aeroporto_id: [t.data_partenza for t in lista]
+            for aeroporto_id, lista in self.partenze.items()
+        }
+        self.voli = {t.id for lista in self.partenze.values() for t in lista}
+
+    def partenze_tra(self, aeroporto_id, dopo, entro):
+        """Partenze da un aeroporto nell'intervallo [dopo, entro]."""
+        orari = self.orari.get(aeroporto_id)
+        if not orari:
+            return []
+        inizio = bisect_left(orari, dopo)
+        fine = bisect_right(orari, entro)
+        return self.partenze[aeroporto_id][inizio:fine]
+
+
+def _carica_tratte(giorno):
+    """
+    Carica con una sola query tutti i voli in partenza in un giorno.
+
+    Compagnie e aeroporti vengono dalla cache dei dati di riferimento, senza join.
+    La query è in un SAVEPOINT della connessione (senza eventi di sessione):
+    se fallisce si annulla solo il SAVEPOINT e la transazione del chiamante
+    resta utilizzabile per la ricerca SQL. Un volo la cui compagnia o i cui
+    aeroporti mancano anche dalla cache ricaricata resta fuori dal grafo.
+    """
+    inizio, fine = intervallo_giorno(giorno)
+
+    query = select(
+        Volo.id,
+        Volo.numero_volo,
+        Volo.compagnia_id,
+        Volo.aeroporto_partenza_id,
+        Volo.aeroporto_arrivo_id,
+        Volo.data_partenza,
+        Volo.data_arrivo,
+        Volo.posti_economy,
+        Volo.posti_business,
+        Volo.posti_first,
+        Volo.prezzo_economy,
+        Volo.prezzo_business,
+        Volo.prezzo_first
+    ).where(
+        Volo.data_partenza >= inizio,
+        Volo.data_partenza < fine
+    )
+    db.session.flush()
+    connessione = db.session.connection()
+    with connessione.begin_nested():
+        righe = connessione.execute(query).all()
+
+    tratte = []
+    for r in righe:
+        compagnia = riferimenti.compagnia(r[2])
+        partenza = riferimenti.aeroporto(r[3])
+        arrivo = riferimenti.aeroporto(r[4])
+        if compagnia is None or partenza is None or arrivo is None:
+            # Riferimento appena creato da un'altra istanza: si rilegge la cache
+            riferimenti.invalida()
+            compagnia = riferimenti.compagnia(r[2])
+            partenza = riferimenti.aeroporto(r[3])
+            arrivo = riferimenti.aeroporto(r[4])
+            if compagnia is None or partenza is None or arrivo is None:
+                current_app.logger.warning(f'Volo {r[0]} senza compagnia o aeroporti nei dati di riferimento')
+                continue
+        tratte.append(Tratta(
+            id=r[0], numero_volo=r[1], compagnia=compagnia.nome_compagnia,
+            aeroporto_partenza_id=r[3], aeroporto_arrivo_id=r[4],
+            codice_partenza=partenza.codice_iata, codice_arrivo=arrivo.codice_iata,
+            città_partenza=partenza.città, città_arrivo=arrivo.città,
+            data_partenza=r[5], data_arrivo=r[6],
+            posti_economy=r[7], posti_business=r[8], posti_first=r[9],
+            prezzo_economy=r[10], prezzo_business=r[11], prezzo_first=r[12]
+        ))
+    return tratte
+
+
+class MotoreRicerca:
+    """Cache dei grafi giornalieri e ricerca degli itinerari."""
+
+    def __init__(self, ttl=300, max_itinerari=1000):
+        self.ttl = ttl
+        self.max_itinerari = max_itinerari
+        self._grafi = {}
+        self._giorno_per_volo = {}
+        self._lock = threading.Lock()
+
+    def grafo(self, giorno):
+        """Restituisce il grafo del giorno, costruendolo se assente o scaduto."""
+        with self._lock:
+            grafo = self._grafi.get(giorno)
+        if grafo is not None and time.monotonic() - grafo.creato_il < self.ttl:
+            return grafo
+
+        grafo = GrafoGiornaliero(giorno, _carica_tratte(giorno))
+        with self._lock:
+            self._grafi[giorno] = grafo
+            for volo_id in grafo.voli:
+                self._giorno_per_volo[volo_id] = giorno
+        return grafo
+
+    def invalida_giorni(self, giorni):
+        with self._lock:
+            for giorno in giorni:
+                grafo = self._grafi.pop(giorno, None)
+                if grafo is not None:
+                    for volo_id in grafo.voli:
+                        self._giorno_per_volo.pop(volo_id, None)
+
+    def invalida_voli(self, volo_ids):
+        with self._lock:
+            giorni = {self._giorno_per_volo.get(v) for v in volo_ids}
+        giorni.discard(None)
+        self.invalida_giorni(giorni)
+
+    def svuota(self):
+        with self._lock:
+            self._grafi.clear()
+            self._giorno_per_volo.clear()
+
+    def cerca(self, aeroporto_partenza, aeroporto_arrivo, data, passeggeri=1,
+              classe='economy', min_scali=1, max_scali=2,
+              tempo_min_scalo=timedelta(hours=2), tempo_max_scalo=timedelta(hours=24),
+              ordina_per='prezzo', cursore=None, limite=None, scadenza=None):
+        """
+        Cerca gli itinerari tra due aeroporti (o città) con partenza in una data.
+
+        Il primo volo parte nel giorno richiesto; le tratte successive possono
+        partire anche il giorno dopo, purché entro `tempo_max_scalo`, e da un
+        altro aeroporto della città di scalo.
+
+        La ricerca è una visita best-first dipendente dal tempo: una coda con
+        priorità contiene i percorsi parziali ordinati per `chiave_ordinamento`
+        (prezzo o durata, poi id dei voli). Prolungare un percorso non fa mai
+        diminuire la sua chiave, quindi gli itinerari completi escono dalla
+        coda già nell'ordine finale: gli itinerari fino a `cursore` si
+        saltano e la ricerca si ferma dopo `limite` itinerari (al più
+        `max_itinerari`) invece di enumerare tutti i percorsi.
+
+        Args:
+            aeroporto_partenza (str): Codice IATA o città di partenza
+            aeroporto_arrivo (str): Codice IATA o città di arrivo
+            data (datetime/date): Data di partenza
+            passeggeri (int): Posti richiesti su ogni tratta
+            classe (str): Classe del volo ('economy', 'business', 'first')
+            min_scali (int): Numero minimo di scali (0 include i voli diretti)
+            max_scali (int): Numero massimo di scali
+            tempo_min_scalo (timedelta): Tempo minimo di coincidenza
+            tempo_max_scalo (timedelta): Attesa massima in aeroporto
+            ordina_per (str): Criterio di ordinamento ('prezzo' o 'tempo')
+            cursore (tuple): Chiave dell'ultimo itinerario della pagina precedente
+            limite (int): Numero massimo di itinerari restituiti
+            scadenza (float): Istante (`time.monotonic()`) oltre il quale la
+                visita si interrompe
+
+        Returns:
+            list: Itinerari nell'ordine di `chiave_ordinamento`
+
+        Raises:
+            RicercaScaduta: se la visita supera `scadenza`
+        """
+        return list(islice(self.scorri(
+            aeroporto_partenza, aeroporto_arrivo, data, passeggeri, classe, min_scali, max_scali,
+            tempo_min_scalo, tempo_max_scalo, ordina_per, cursore, scadenza
+        ), limite))
+
+    def scorri(self, aeroporto_partenza, aeroporto_arrivo, data, passeggeri=1,
+               classe='economy', min_scali=1, max_scali=2,
+               tempo_min_scalo=timedelta(hours=2), tempo_max_scalo=timedelta(hours=24),
+               ordina_per='prezzo', cursore=None, scadenza=None):
+        """
+        Come `cerca`, ma senza limite e restituendo gli itinerari uno alla volta,
+        man mano che la visita li trova.
+
+        I grafi vengono caricati subito (un errore del database arriva al
+        chiamante qui), la visita procede solo quando si leggono gli itinerari.
+
+        Returns:
+            iterator: Itinerari nell'ordine di `chiave_ordinamento`
+        """
+        giorno = data.date() if isinstance(data, datetime) else data
+        origini = indice_città.risolvi(aeroporto_partenza)
+        destinazioni = indice_città.risolvi(aeroporto_arrivo)
+        città_di = indice_città.città
+        if not origini or not destinazioni or origini & destinazioni:
+            return iter(())
+        if not filtro_tratte.possibili_scalo(origini, destinazioni, giorno, max_scali):
+            return iter(())
+
+        grafi = [self.grafo(giorno)]
+        if max_scali > 0:
+            grafi.append(self.grafo(giorno + timedelta(days=1)))
+
+        # Distanza (in numero di voli) di ogni città dalla destinazione, usata
+        # per scartare subito i rami che non possono arrivarci. Si ragiona per
+        # città perché lo scalo può cambiare aeroporto nella stessa città.
+        distanze = {città_di(a): 0 for a in destinazioni}
+        coda = deque(distanze)
+        while coda:
+            città = coda.popleft()
+            if distanze[città] >= max_scali:
+                continue
+            for aeroporto in indice_città.aeroporti(città):
+                for grafo in grafi:
+                    for precedente in grafo.predecessori.get(aeroporto, ()):
+                        città_precedente = città_di(precedente)
+                        if città_precedente not in distanze:
+                            distanze[città_precedente] = distanze[città] + 1
+                            coda.append(città_precedente)
+
+        def chiave(percorso):
+            return chiave_ordinamento(Itinerario(percorso), ordina_per, classe)
+
+        # (chiave, contatore, percorso, città visitate): il contatore evita
+        # di confrontare i percorsi a parità di chiave
+        contatore = count()
+        frontiera = []
+        for origine in origini:
+            for tratta in grafi[0].partenze.get(origine, ()):
+                città_arrivo = città_di(tratta.aeroporto_arrivo_id)
+                if (tratta.posti(classe) < passeggeri
+                        or distanze.get(città_arrivo, max_scali + 1) > max_scali):
+                    continue
+                frontiera.append((chiave((tratta,)), next(contatore), (tratta,),
+                                  frozenset((città_di(origine), città_arrivo))))
+        heapq.heapify(frontiera)
+
+        def itinerari():
+            trovati = 0
+            while frontiera and trovati < self.max_itinerari:
+                if scadenza is not None and time.monotonic() > scadenza:
+                    raise RicercaScaduta('Ricerca sul grafo oltre la scadenza')
+                chiave_percorso, _, percorso, visitati = heapq.heappop(frontiera)
+                ultima = percorso[-1]
+                if ultima.aeroporto_arrivo_id in destinazioni:
+                    if len(percorso) - 1 >= min_scali and (cursore is None or chiave_percorso > cursore):
+                        trovati += 1
+                        yield Itinerario(percorso)
+                    continue
+                voli_rimasti = max_scali + 1 - len(percorso)
+                if voli_rimasti <= 0:
+                    continue
+                dopo = ultima.data_arrivo + tempo_min_scalo
+                entro = ultima.data_arrivo + tempo_max_scalo
+                for aeroporto in indice_città.stessa_città(ultima.aeroporto_arrivo_id):
+                    for grafo in grafi:
+                        for tratta in grafo.partenze_tra(aeroporto, dopo, entro):
+                            città_arrivo = città_di(tratta.aeroporto_arrivo_id)
+                            if (città_arrivo in visitati
+                                    or distanze.get(città_arrivo, voli_rimasti) >= voli_rimasti
+                                    or tratta.posti(classe) < passeggeri):
+                                continue
+                            prolungato = percorso + (tratta,)
+                            heapq.heappush(frontiera, (chiave(prolungato), next(contatore), prolungato,
+                                                       visitati | {città_arrivo}))
+
+        return itinerari()
+
+
+motore = MotoreRicerca()
+
+
+def _giorno(valore):
+    return valore.date() if isinstance(valore, datetime) else None
+
+
+def _invalida(giorni, voli):
+    if giorni:
+        motore.invalida_giorni(giorni)
+    if voli:
+        motore.invalida_voli(voli)
+
+
+def _invalida_dopo_flush(session, flush_context):
+    """Invalida i grafi dei giorni toccati da voli, biglietti o blocchi di posti modificati."""
+    giorni = set()
+    voli = set()
+    for oggetto in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(oggetto, Volo):
+            giorni.add(_giorno(oggetto.data_partenza))
+            storia = inspect(oggetto).attrs.data_partenza.history
+            giorni.update(_giorno(v) for v in storia.deleted or ())
+        elif isinstance(oggetto, (Biglietto, BloccoPosti)):
+            voli.add(oggetto.flight_id)
+        elif isinstance(oggetto, MappaPosti):
+            voli.add(oggetto.volo_id)
+    giorni.discard(None)
+    voli.discard(None)
+    if giorni or voli:
+        _registra(session, giorni, voli)
+
+
+def _registra(session, giorni, voli):
+    da_invalidare = session.info.setdefault('grafo_da_invalidare', (set(), set()))
+    da_invalidare[0].update(giorni)
+    da_invalidare[1].update(voli)
+    _invalida(giorni, voli)
+
+
+def invalida_voli(session, volo_ids):
+    """
+    Invalida i grafi che contengono voli modificati con un UPDATE fuori
+    dall'ORM, che non genera eventi di flush: subito e di nuovo a fine
+    transazione.
+    """
+    _registra(session, set(), set(volo_ids))
+
+
+def _invalida_a_fine_transazione(session, transazione_precedente=None):
+    """
+    Invalida di nuovo i grafi toccati nella transazione, al commit o al
+    rollback; non a quelli di un SAVEPOINT, che la lasciano aperta.
+    """
+    if session.in_nested_transaction() or getattr(transazione_precedente, 'nested', False):
+        return
+    da_invalidare = session.info.pop('grafo_da_invalidare', None)
+    if da_invalidare is not None:
+        _invalida(*da_invalidare)
+
+
+def init_app(app):
+    """Configura il motore di ricerca e registra l'invalidazione automatica."""
+    app.config.setdefault('RICERCA_USA_GRAFO', True)
+    app.config.setdefault('RICERCA_GRAFO_TTL', 300)
+    app.config.setdefault('RICERCA_MAX_SCALI', 2)
+    app.config.setdefault('RICERCA_TEMPO_MIN_SCALO', timedelta(hours=2))
+    app.config.setdefault('RICERCA_TEMPO_MAX_SCALO', timedelta(hours=24))
+    app.config.setdefault('RICERCA_MAX_ITINERARI', 1000)
+    motore.ttl = app.config['RICERCA_GRAFO_TTL']
+    motore.max_itinerari = app.config['RICERCA_MAX_ITINERARI']
+    for nome, funzione in (('after_flush', _invalida_dopo_flush),
+                           ('after_commit', _invalida_a_fine_transazione),
+                           ('after_soft_rollback', _invalida_a_fine_transazione)):
+        if not event.contains(Session, nome, funzione):
+            event.listen(Session, nome, funzione)
+
+
+def _itinerario_da_riga(riga):
+    """Converte una riga di `cerca_voli_scalo` in un `Itinerario`."""
+    return Itinerario([
+        Tratta(
+            id=riga.volo1_id, numero_volo=riga.volo1_numero, compagnia=riga.compagnia1,
+            città_partenza=riga.città_partenza, città_arrivo=riga.città_scalo,
+            data_partenza=riga.data_partenza, data_arrivo=riga.scalo_arrivo,
+            prezzo_economy=riga.volo1_prezzo_economy,
+            prezzo_business=riga.volo1_prezzo_business,
+            prezzo_first=riga.volo1_prezzo_first
+        ),
+        Tratta(
+            id=riga.volo2_id, numero_volo=riga.volo2_numero, compagnia=riga.compagnia2,
+            città_partenza=riga.città_scalo, città_arrivo=riga.città_arrivo,
+            data_partenza=riga.scalo_partenza, data_arrivo=riga.data_arrivo,
+            prezzo_economy=riga.volo2_prezzo_economy,
+            prezzo_business=riga.volo2_prezzo_business,
+            prezzo_first=riga.volo2_prezzo_first
+        )
+    ])
+
+
+def _cerca_su_grafo(aeroporto_partenza, aeroporto_arrivo, data, passeggeri, classe, ordina_per, cursore):
+    """
+    Iteratore degli itinerari trovati sul grafo dopo `cursore`, nell'ordine
+    di `ordina_per`; None se il grafo è disabilitato o il caricamento del
+    grafo fallisce per un errore del database.
+
+    Nei worker della ricerca parallela (app/concurrent_search.py) la visita
+    si interrompe alla scadenza della ricerca, `g.scadenza_ricerca`.
+    """
+    config = current_app.config
+    if not config.get('RICERCA_USA_GRAFO', True):
+        return None
+    try:
+        return motore.scorri(
+            aeroporto_partenza,
+            aeroporto_arrivo,
+            data,
+            passeggeri=passeggeri,
+            classe=classe,
+            max_scali=config.get('RICERCA_MAX_SCALI', 2),
+            tempo_min_scalo=config.get('RICERCA_TEMPO_MIN_SCALO', timedelta(hours=2)),
+            tempo_max_scalo=config.get('RICERCA_TEMPO_MAX_SCALO', timedelta(hours=24)),
+            ordina_per=ordina_per,
+            cursore=cursore,
+            scadenza=g.get('scadenza_ricerca')
+        )
+    except SQLAlchemyError as e:
+        current_app.logger.warning(f'Ricerca su grafo fallita, uso la query SQL: {e}')
+        return None
+
+
+def cerca_itinerari(aeroporto_partenza, aeroporto_arrivo, data, passeggeri=1, classe='economy',
+                    ordina_per='prezzo', cursore=None, limite=None):
+    """
+    Cerca gli itinerari con scalo usando il grafo orario.
+
+    Sul grafo la visita parte dal cursore e si ferma dopo `limite`
+    itinerari. Se il grafo è disabilitato (`RICERCA_USA_GRAFO = False`) o la
+    ricerca fallisce, ricade sulla query SQL di `cerca_voli_scalo` (un solo
+    scalo, letto dalla tabella delle coincidenze), che applica cursore e
+    limite direttamente in SQL.
+
+    Args:
+        ordina_per (str): Criterio di ordinamento ('prezzo' o 'tempo')
+        cursore (tuple): Chiave dell'ultimo itinerario della pagina precedente
+        limite (int): Numero massimo di itinerari restituiti
+
+    Returns:
+        list: Lista di `Itinerario`
+    """
+    config = current_app.config
+    itinerari = _cerca_su_grafo(aeroporto_partenza, aeroporto_arrivo, data, passeggeri, classe, ordina_per, cursore)
+    if itinerari is not None:
+        return list(islice(itinerari, limite))
+
+    righe = cerca_voli_scalo(
+        aeroporto_partenza,
+        aeroporto_arrivo,
+        data,
+        tempo_min_scalo=config.get('RICERCA_TEMPO_MIN_SCALO', timedelta(hours=2)),
+        classe=classe,
+        ordina_per=ordina_per,
+        cursore=cursore,
+        limite=limite,
+        passeggeri=passeggeri,
+        usa_coincidenze=config.get('RICERCA_USA_COINCIDENZE', True)
+    )
+    return [_itinerario_da_riga(r) for r in righe]
+
+
+def scorri_itinerari(aeroporto_partenza, aeroporto_arrivo, data, passeggeri=1, classe='economy',
+                     ordina_per='prezzo', cursore=None):
+    """
+    Come `cerca_itinerari`, ma senza limite e restituendo gli itinerari uno alla volta.
+
+    Sul grafo gli itinerari escono man mano che la visita li trova; con la
+    query SQL le coppie di voli vengono lette a blocchi da un cursore lato
+    server.
+
+    Yields:
+        Itinerario: Itinerari nell'ordine di `cerca_itinerari`
+    """
+    itinerari = _cerca_su_grafo(aeroporto_partenza, aeroporto_arrivo, data, passeggeri, classe, ordina_per, cursore)
+    if itinerari is not None:
+        yield from itinerari
+        return
+
+    config = current_app.config
+    righe = scorri_voli_scalo(
+        aeroporto_partenza,
+        aeroporto_arrivo,
+        data,
+        tempo_min_scalo=config.get('RICERCA_TEMPO_MIN_SCALO', timedelta(hours=2)),
+        classe=classe,
+        ordina_per=ordina_per,
+        cursore=cursore,
+        passeggeri=passeggeri,
+        usa_coincidenze=config.get('RICERCA_USA_COINCIDENZE', True)
+    )
+    for riga in righe:
+        yield _itinerario_da_riga(riga)
+
+
+def cerca_itinerari_multipla(ricerche):
+    """
+    Esegue più ricerche con scalo, come `cerca_itinerari` con cursore assente.
+
+    Sul grafo le ricerche non sono eseguite insieme: ognuna è una visita a
+    sé, in memoria. Condividono però i grafi dei giorni, per cui le query sono
+    al più una per giorno non ancora in memoria, qualunque sia il numero delle
+    ricerche. Senza grafo le ricerche vengono eseguite insieme con una sola
+    query sulla tabella delle coincidenze (`cerca_voli_scalo_multipla`).
+
+    Args:
+        ricerche (list): Dizionari con indice, aeroporto_partenza,
+            aeroporto_arrivo, data, passeggeri, classe, ordina_per e limite
+
+    Returns:
+        dict: {indice: lista di `Itinerario`}
+    """
+    config = current_app.config
+    risultati = {}
+    da_cercare_in_sql = []
+    for ricerca in ricerche:
+        classe = ricerca.get('classe', 'economy')
+        itinerari = _cerca_su_grafo(
+            ricerca['aeroporto_partenza'],
+            ricerca['aeroporto_arrivo'],
+            ricerca['data'],
+            ricerca.get('passeggeri', 1),
+            classe,
+            ricerca.get('ordina_per', 'prezzo'),
+            None
+        )
+        if itinerari is None:
+            da_cercare_in_sql.append(ricerca)
+        else:
+            risultati[ricerca['indice']] = list(islice(itinerari, ricerca['limite']))
+
+    if not da_cercare_in_sql:
+        return risultati
+    tempo_min_scalo = config.get('RICERCA_TEMPO_MIN_SCALO', timedelta(hours=2))
+    if config.get('RICERCA_USA_COINCIDENZE', True):
+        righe = cerca_voli_scalo_multipla(da_cercare_in_sql, tempo_min_scalo)
+        for indice, coppie in righe.items():
+            risultati[indice] = [_itinerario_da_riga(r) for r in coppie]
+    else:
+        for ricerca in da_cercare_in_sql:
+            risultati[ricerca['indice']] = [_itinerario_da_riga(r) for r in cerca_voli_scalo(
+                ricerca['aeroporto_partenza'],
+                ricerca['aeroporto_arrivo'],
+                ricerca['data'],
+                tempo_min_scalo=tempo_min_scalo,
+                classe=ricerca.get('classe', 'economy'),
+                ordina_per=ricerca.get('ordina_per', 'prezzo'),
+                limite=ricerca['limite'],
+                passeggeri=ricerca.get('passeggeri', 1),
+                usa_coincidenze=False
+            )]
+    return risultati
@@ -1,9 +1,12 @@
 from flask import Blueprint, render_template, request, flash, redirect, url_for
 from flask_login import login_required, current_user
 from app.models import Volo, Aeroporto, CompagniaAerea, Biglietto
+from app.reference_data import compagnia_di_utente
+from app.booking import cancella_volo, aggiorna_volo
 from app import db
 from datetime import datetime
 from sqlalchemy import func
+from sqlalchemy.orm.exc import StaleDataError
 
 airline = Blueprint('airline', __name__, url_prefix='/airline')
 
@@ -15,15 +18,15 @@ def dashboard():
         return redirect(url_for('main.index'))
     
     # Recupera i voli della compagnia
-    voli = Volo.query.filter_by(compagnia_id=current_user.compagnia.id).all()
+    voli = Volo.query.filter_by(compagnia_id=compagnia_di_utente(current_user.id).id).all()
     
     # Calcola statistiche
     totale_passeggeri = Biglietto.query.join(Volo).filter(
-        Volo.compagnia_id == current_user.compagnia.id
+        Volo.compagnia_id == compagnia_di_utente(current_user.id).id
     ).count()
     
     guadagno_totale = db.session.query(func.sum(Biglietto.prezzo)).join(Volo).filter(
-        Volo.compagnia_id == current_user.compagnia.id
+        Volo.compagnia_id == compagnia_di_utente(current_user.id).id
     ).scalar() or 0
     
     return render_template('airline/dashboard.html',
@@ -63,7 +66,7 @@ def nuovo_volo():
             # Crea il nuovo volo
             nuovo_volo = Volo(
                 numero_volo=numero_volo,
-                compagnia_id=current_user.compagnia.id,
+                compagnia_id=compagnia_di_utente(current_user.id).id,
                 aeroporto_partenza_id=aeroporto_partenza_id,
                 aeroporto_arrivo_id=aeroporto_arrivo_id,
                 data_partenza=data_partenza,
@@ -90,9 +93,8 @@ def nuovo_volo():
             db.session.rollback()
             flash(f'Errore durante l\'aggiunta del volo: {str(e)}', 'danger')
     
-    # GET request: mostra il form
-    aeroporti = Aeroporto.query.all()
-    return render_template('airline/nuovo_volo.html', aeroporti=aeroporti)
+    # GET request: mostra il form (gli aeroporti si cercano con /api/v1/airports/suggest)
+    return render_template('airline/nuovo_volo.html')
 
 @airline.route('/statistiche')
 @login_required
@@ -112,7 +114,7 @@ def statistiche():
     ).join(
         Biglietto, Biglietto.flight_id == Volo.id
     ).filter(
-        Volo.compagnia_id == current_user.compagnia.id
+        Volo.compagnia_id == compagnia_di_utente(current_user.id).id
     ).group_by(
         Aeroporto.città
     ).all()
@@ -128,7 +130,7 @@ def lista_voli():
         return redirect(url_for('main.index'))
     
     # Recupera i voli della compagnia
-    voli = Volo.query.filter_by(compagnia_id=current_user.compagnia.id).order_by(Volo.data_partenza.desc()).all()
+    voli = Volo.query.filter_by(compagnia_id=compagnia_di_utente(current_user.id).id).order_by(Volo.data_partenza.desc()).all()
     
     return render_template('airline/lista_voli.html', voli=voli, now=datetime.now())
 
@@ -140,30 +142,35 @@ def modifica_volo(volo_id):
         return redirect(url_for('main.index'))
 
     volo = Volo.query.get_or_404(volo_id)
-    aeroporti = Aeroporto.query.all()
 
     if request.method == 'POST':
         try:
-            volo.numero_volo = request.form.get('numero_volo')
-            volo.aeroporto_partenza_id = request.form.get('aeroporto_partenza_id')
-            volo.aeroporto_arrivo_id = request.form.get('aeroporto_arrivo_id')
-            volo.data_partenza = datetime.strptime(request.form.get('data_partenza'), '%Y-%m-%dT%H:%M')
-            volo.data_arrivo = datetime.strptime(request.form.get('data_arrivo'), '%Y-%m-%dT%H:%M')
-            volo.posti_economy = int(request.form.get('posti_economy', 0) or 0)
-            volo.posti_business = int(request.form.get('posti_business', 0) or 0)
-            volo.posti_first = int(request.form.get('posti_first', 0) or 0)
-            volo.prezzo_economy = float(request.form.get('prezzo_economy', 0) or 0)
-            volo.prezzo_business = float(request.form.get('prezzo_business', 0) or 0)
-            volo.prezzo_first = float(request.form.get('prezzo_first', 0) or 0)
-            # Il calcolo dei posti_totali è gestito dal trigger
-            db.session.commit()
+            valori = {
+                'numero_volo': request.form.get('numero_volo'),
+                'aeroporto_partenza_id': int(request.form.get('aeroporto_partenza_id')),
+                'aeroporto_arrivo_id': int(request.form.get('aeroporto_arrivo_id')),
+                'data_partenza': datetime.strptime(request.form.get('data_partenza'), '%Y-%m-%dT%H:%M'),
+                'data_arrivo': datetime.strptime(request.form.get('data_arrivo'), '%Y-%m-%dT%H:%M'),
+                'prezzo_economy': float(request.form.get('prezzo_economy', 0) or 0),
+                'prezzo_business': float(request.form.get('prezzo_business', 0) or 0),
+                'prezzo_first': float(request.form.get('prezzo_first', 0) or 0),
+            }
+            # I posti liberi si modificano per differenza da quelli mostrati
+            # nel modulo: i posti venduti nel frattempo restano venduti
+            variazioni_posti = {}
+            for classe in ('economy', 'business', 'first'):
+                richiesti = int(request.form.get(f'posti_{classe}', 0) or 0)
+                mostrati = request.form.get(f'posti_{classe}_mostrati', type=int)
+                variazioni_posti[classe] = richiesti - (getattr(volo, f'posti_{classe}') if mostrati is None else mostrati)
+            aggiorna_volo(volo_id, valori, variazioni_posti)
             flash('Volo modificato con successo!', 'success')
             return redirect(url_for('airline.lista_voli'))
+        except StaleDataError:
+            flash('Il volo è stato modificato nel frattempo da un altro utente, riprova.', 'danger')
         except Exception as e:
-            db.session.rollback()
             flash(f'Errore durante la modifica del volo: {str(e)}', 'danger')
     # GET: mostra il form precompilato
-    return render_template('airline/modifica_volo.html', volo=volo, aeroporti=aeroporti)
+    return render_template('airline/modifica_volo.html', volo=volo)
 
 @airline.route('/elimina_volo/<int:volo_id>', methods=['POST'])
 @login_required
@@ -172,14 +179,14 @@ def elimina_volo(volo_id):
         flash('Accesso non autorizzato.', 'danger')
         return redirect(url_for('main.index'))
     volo = Volo.query.get_or_404(volo_id)
-    if volo.compagnia_id != current_user.compagnia.id:
+    if volo.compagnia_id != compagnia_di_utente(current_user.id).id:
         flash('Non puoi eliminare un volo che non appartiene alla tua compagnia.', 'danger')
         return redirect(url_for('airline.lista_voli'))
     try:
-        db.session.delete(volo)
-        db.session.commit()
-        flash('Volo eliminato con successo!', 'success')
+        # Le prenotazioni sul volo vengono cancellate e i posti delle loro
+        # altre tratte tornano liberi
+        cancellate = cancella_volo(volo_id)
+        flash(f'Volo eliminato con successo! Prenotazioni cancellate: {cancellate}', 'success')
     except Exception as e:
-        db.session.rollback()
         flash(f'Errore durante l\'eliminazione del volo: {str(e)}', 'danger')
     return redirect(url_for('airline.lista_voli')) 
\ No newline at end of file
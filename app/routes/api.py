@@ -1,16 +1,32 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, jsonify, request, Response, current_app, json, stream_with_context
 from flask_jwt_extended import jwt_required, create_access_token, get_jwt_identity
 from marshmallow import Schema, fields, validate, ValidationError
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm.exc import StaleDataError
+from werkzeug.exceptions import HTTPException
 from datetime import datetime, timedelta
 from .. import db
-from ..models import Utente, Volo, CompagniaAerea, Aeroporto, Prenotazione, Biglietto
+from ..models import Utente
 from ..queries import (
-    cerca_voli_diretti,
-    cerca_voli_scalo,
+    scorri_voli_diretti,
+    cerca_voli_diretti_multipla,
     statistiche_compagnia,
-    prenotazioni_utente,
-    verifica_disponibilità_posti
+    scorri_prenotazioni_utente,
+    chiave_ordinamento,
+    codifica_cursore,
+    decodifica_cursore
 )
+from ..search_cache import calendario_tariffe, metriche_prometheus
+from ..concurrent_search import cerca_voli
+from ..route_graph import scorri_itinerari, cerca_itinerari_multipla
+from ..ranking import classifica
+from ..airport_index import suggerisci
+from ..route_filter import metriche_prometheus as metriche_filtro
+from ..booking import PostiNonDisponibili
+from ..booking_writer import prenota, prenota_itinerario, EsitoIncerto, AttesaScaduta
+from ..seat_map import mappa_volo
+from ..idempotency import idempotente, risposta_nella_transazione
+from ..availability import disponibilità_voli
 
 api = Blueprint('api', __name__, url_prefix='/api/v1')
 
@@ -26,13 +42,40 @@ class LoginSchema(Schema):
     email = fields.Email(required=True)
     password = fields.Str(required=True)
 
+# aeroporto_partenza/aeroporto_arrivo accettano un codice IATA o il nome di una città
 class FlightSearchSchema(Schema):
-    aeroporto_partenza = fields.Str(required=True, validate=validate.Length(equal=3))
-    aeroporto_arrivo = fields.Str(required=True, validate=validate.Length(equal=3))
+    aeroporto_partenza = fields.Str(required=True, validate=validate.Length(min=3, max=100))
+    aeroporto_arrivo = fields.Str(required=True, validate=validate.Length(min=3, max=100))
     data = fields.Date(required=True)
     passeggeri = fields.Int(required=True, validate=validate.Range(min=1, max=9))
     classe = fields.Str(validate=validate.OneOf(['economy', 'business', 'first']))
     ordina_per = fields.Str(validate=validate.OneOf(['prezzo', 'tempo']))
+    # Paginazione per chiave: i cursori arrivano dalla risposta precedente
+    limite = fields.Int(load_default=20, validate=validate.Range(min=1, max=100))
+    cursore_diretti = fields.Str()
+    cursore_scalo = fields.Str()
+
+# Classifica unica di diretti e scali: `limite` è il numero di proposte
+class RankedSearchSchema(Schema):
+    aeroporto_partenza = fields.Str(required=True, validate=validate.Length(min=3, max=100))
+    aeroporto_arrivo = fields.Str(required=True, validate=validate.Length(min=3, max=100))
+    data = fields.Date(required=True)
+    passeggeri = fields.Int(required=True, validate=validate.Range(min=1, max=9))
+    classe = fields.Str(load_default='economy', validate=validate.OneOf(['economy', 'business', 'first']))
+    limite = fields.Int(load_default=20, validate=validate.Range(min=1, max=100))
+    pesi = fields.Dict(
+        keys=fields.Str(validate=validate.OneOf(['prezzo', 'durata', 'scali'])),
+        values=fields.Float(validate=validate.Range(min=0))
+    )
+
+class FareCalendarSchema(Schema):
+    aeroporto_partenza = fields.Str(required=True, validate=validate.Length(min=3, max=100))
+    aeroporto_arrivo = fields.Str(required=True, validate=validate.Length(min=3, max=100))
+    data = fields.Date(required=True)
+    # Giorni prima e dopo la data: al più 2 * 29 + 1 = 59 giorni, entro i 60 del calendario
+    giorni = fields.Int(load_default=7, validate=validate.Range(min=0, max=29))
+    passeggeri = fields.Int(load_default=1, validate=validate.Range(min=1, max=9))
+    classe = fields.Str(load_default='economy', validate=validate.OneOf(['economy', 'business', 'first']))
 
 class BookingSchema(Schema):
     volo_id = fields.Int(required=True)
@@ -41,11 +84,133 @@ class BookingSchema(Schema):
     bagaglio_extra = fields.Bool()
     servizi_extra = fields.Str()
 
+# Voli di un itinerario con scalo (gli id delle `tratte` della ricerca), in ordine
+class ItineraryBookingSchema(Schema):
+    voli = fields.List(fields.Int(), required=True, validate=validate.Length(min=1))
+    classe = fields.Str(required=True, validate=validate.OneOf(['economy', 'business', 'first']))
+    passeggeri = fields.Int(required=True, validate=validate.Range(min=1, max=9))
+    bagaglio_extra = fields.Bool()
+    servizi_extra = fields.Str()
+
+# Disponibilità di più voli: `ids` nel corpo o nella query string (separati da virgole)
+class AvailabilitySchema(Schema):
+    ids = fields.List(fields.Int(validate=validate.Range(min=1)), required=True, validate=validate.Length(min=1))
+
 # Inizializzazione degli schemi
 user_schema = UserSchema()
 login_schema = LoginSchema()
 flight_search_schema = FlightSearchSchema()
+ranked_search_schema = RankedSearchSchema()
+fare_calendar_schema = FareCalendarSchema()
 booking_schema = BookingSchema()
+itinerary_booking_schema = ItineraryBookingSchema()
+availability_schema = AvailabilitySchema()
+
+# Risposte NDJSON (una riga JSON per risultato)
+NDJSON = 'application/x-ndjson'
+
+def _richiede_ndjson():
+    """True se il client preferisce `application/x-ndjson` a `application/json`."""
+    return request.accept_mimetypes.best_match(['application/json', NDJSON]) == NDJSON
+
+def _risposta_ndjson(righe):
+    """
+    Risposta in streaming con un oggetto JSON per riga.
+    
+    Il contesto della richiesta (e la sessione del database) resta aperto
+    finché il generatore non è esaurito. Un errore durante lo streaming, quando
+    lo stato HTTP è già stato inviato, diventa un'ultima riga con `error`.
+    """
+    def genera():
+        try:
+            for riga in righe:
+                yield json.dumps(riga) + '\n'
+        except Exception as e:
+            db.session.rollback()
+            yield json.dumps({'error': str(e)}) + '\n'
+    return Response(stream_with_context(genera()), mimetype=NDJSON)
+
+def _volo_diretto_json(v):
+    return {
+        'id': v.id,
+        'numero_volo': v.numero_volo,
+        'compagnia': v.nome_compagnia,
+        'partenza': v.città_partenza,
+        'arrivo': v.città_arrivo,
+        'data_partenza': v.data_partenza.isoformat(),
+        'data_arrivo': v.data_arrivo.isoformat(),
+        'posti_disponibili': v.posti_disponibili,
+        'prezzo': float(v.prezzo)
+    }
+
+def _itinerario_json(v):
+    tratte = [
+        {
+            'id': t.id,
+            'numero': t.numero_volo,
+            'compagnia': t.compagnia,
+            'partenza': t.città_partenza,
+            'arrivo': t.città_arrivo,
+            'data_partenza': t.data_partenza.isoformat(),
+            'data_arrivo': t.data_arrivo.isoformat()
+        } for t in v.tratte
+    ]
+    itinerario = {
+        'scali': v.scali,
+        'tratte': tratte,
+        'prezzi': {
+            'economy': float(v.prezzo_totale_economy),
+            'business': float(v.prezzo_totale_business),
+            'first': float(v.prezzo_totale_first)
+        }
+    }
+    if len(tratte) == 2:
+        # Un solo scalo: anche le chiavi volo1/volo2 delle risposte precedenti
+        itinerario['volo1'], itinerario['volo2'] = tratte
+    return itinerario
+
+def _pagina_json(voli_diretti, voli_scalo, limite, ordina_per, classe):
+    """
+    Prima pagina dei risultati di una ricerca eseguita con `limite + 1`
+    risultati per tipo: il risultato in più dice se esiste una pagina successiva.
+    """
+    def prossimo_cursore(risultati):
+        if len(risultati) <= limite:
+            return None
+        return codifica_cursore(chiave_ordinamento(risultati[limite - 1], ordina_per, classe), ordina_per)
+    
+    return {
+        'paginazione': {
+            'limite': limite,
+            'cursore_diretti': prossimo_cursore(voli_diretti),
+            'cursore_scalo': prossimo_cursore(voli_scalo)
+        },
+        'voli_diretti': [_volo_diretto_json(v) for v in voli_diretti[:limite]],
+        'voli_scalo': [_itinerario_json(v) for v in voli_scalo[:limite]]
+    }
+
+def _prenotazione_json(p, biglietti):
+    return {
+        'id': p.prenotazione_id,
+        'data': p.data_prenotazione.isoformat(),
+        'stato': p.stato,
+        'prezzo_totale': float(p.prezzo_totale),
+        'biglietti': [
+            {
+                'volo': b.volo,
+                'compagnia': b.compagnia,
+                'partenza': b.partenza,
+                'arrivo': b.arrivo,
+                'data_partenza': b.data_partenza.isoformat(),
+                'data_arrivo': b.data_arrivo.isoformat(),
+                'classe': b.classe,
+                'posto': b.posto,
+                'prezzo': float(b.prezzo),
+                'bagaglio_extra': b.bagaglio_extra,
+                'servizi_extra': b.servizi_extra
+            } for b in biglietti
+        ]
+    }
 
 # Gestione errori
 @api.errorhandler(ValidationError)
@@ -124,142 +289,381 @@ def search_flights():
             # Si c'est un objet date, le convertir en datetime
             data['data'] = datetime.combine(data['data'], datetime.min.time())
         
-        # Cerca voli diretti
-        voli_diretti = cerca_voli_diretti(
+        classe = data.get('classe', 'economy')
+        ordina_per = data.get('ordina_per', 'prezzo')
+        limite = data['limite']
+        cursore_diretti = cursore_scalo = None
+        if 'cursore_diretti' in data:
+            cursore_diretti = decodifica_cursore(data['cursore_diretti'], ordina_per)
+        if 'cursore_scalo' in data:
+            cursore_scalo = decodifica_cursore(data['cursore_scalo'], ordina_per)
+        
+        if _richiede_ndjson():
+            # Tutti i risultati dai cursori in poi, senza limite: prima i voli
+            # diretti letti a blocchi dal database, poi quelli con scalo
+            parametri = (data['aeroporto_partenza'], data['aeroporto_arrivo'], data['data'],
+                         data.get('passeggeri', 1), classe, ordina_per)
+            def righe():
+                for v in scorri_voli_diretti(*parametri, cursore=cursore_diretti):
+                    yield {'tipo': 'diretto', **_volo_diretto_json(v)}
+                for v in scorri_itinerari(*parametri, cursore=cursore_scalo):
+                    yield {'tipo': 'scalo', **_itinerario_json(v)}
+            return _risposta_ndjson(righe())
+        
+        # Cerca voli diretti e con scalo in parallelo; un risultato in più
+        # del limite dice se esiste una pagina successiva
+        voli_diretti, voli_scalo, completa = cerca_voli(
             data['aeroporto_partenza'],
             data['aeroporto_arrivo'],
             data['data'],
             data.get('passeggeri', 1),
-            data.get('classe', 'economy'),
-            data.get('ordina_per', 'prezzo')
+            classe,
+            ordina_per,
+            limite + 1,
+            cursore_diretti,
+            cursore_scalo
         )
         
-        # Cerca voli con scalo
-        voli_scalo = cerca_voli_scalo(
+        return jsonify({
+            # False se la ricerca con scalo ha superato la scadenza
+            'completa': completa,
+            **_pagina_json(voli_diretti, voli_scalo, limite, ordina_per, classe)
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+@api.route('/flights/search/batch', methods=['POST'])
+@jwt_required()
+def search_flights_batch():
+    """
+    Più ricerche di voli in una sola richiesta.
+    
+    Il corpo è `{"ricerche": [...]}` con elementi nel formato di
+    `/flights/search`. I voli diretti di tutte le ricerche vengono cercati con
+    una sola query, così come quelli con scalo quando non si usa il grafo; sul
+    grafo le ricerche con scalo sono visite in memoria, una alla volta, con al
+    più una query per giorno non ancora caricato.
+    I risultati (prima pagina di ogni ricerca, o l'errore di validazione)
+    sono nell'ordine delle ricerche, con il loro indice.
+    """
+    try:
+        ricerche = (request.get_json(silent=True) or {}).get('ricerche')
+        if not isinstance(ricerche, list) or not ricerche:
+            return jsonify({'error': 'ricerche deve essere una lista non vuota'}), 400
+        massimo = current_app.config.get('RICERCA_BATCH_MASSIMO', 50)
+        if len(ricerche) > massimo:
+            return jsonify({'error': f'Al massimo {massimo} ricerche per richiesta'}), 400
+        
+        risultati = [{'indice': indice} for indice in range(len(ricerche))]
+        valide = []
+        for indice, ricerca in enumerate(ricerche):
+            try:
+                dati = flight_search_schema.load(ricerca)
+            except ValidationError as e:
+                risultati[indice]['error'] = e.messages
+                continue
+            if 'cursore_diretti' in dati or 'cursore_scalo' in dati:
+                risultati[indice]['error'] = 'Le pagine successive si richiedono a /flights/search'
+                continue
+            dati['indice'] = indice
+            dati['limite'] += 1
+            valide.append(dati)
+        
+        diretti = cerca_voli_diretti_multipla(valide)
+        con_scalo = cerca_itinerari_multipla(valide)
+        for dati in valide:
+            indice = dati['indice']
+            risultati[indice].update(_pagina_json(
+                diretti[indice],
+                con_scalo[indice],
+                dati['limite'] - 1,
+                dati.get('ordina_per', 'prezzo'),
+                dati.get('classe', 'economy')
+            ))
+        
+        return jsonify({'risultati': risultati})
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+
+@api.route('/flights/search/ranked', methods=['POST'])
+@jwt_required()
+def search_flights_ranked():
+    """
+    Voli diretti e con scalo in un'unica classifica per prezzo, durata e scali.
+    
+    Tutti i candidati della ricerca vengono classificati: prima il fronte di
+    Pareto, poi gli altri, per punteggio pesato (pesi dal corpo della
+    richiesta o da `RICERCA_PESI`). Il migliore, il più economico e il più
+    veloce sono etichettati 'best', 'cheapest' e 'fastest'.
+    """
+    try:
+        data = ranked_search_schema.load(request.json)
+        giorno = datetime.combine(data['data'], datetime.min.time())
+        classe = data['classe']
+        
+        voli_diretti, voli_scalo, completa = cerca_voli(
             data['aeroporto_partenza'],
             data['aeroporto_arrivo'],
-            data['data']
+            giorno,
+            data['passeggeri'],
+            classe
+        )
+        proposte = classifica(
+            voli_diretti,
+            voli_scalo,
+            classe,
+            k=data['limite'],
+            pesi=data.get('pesi') or current_app.config['RICERCA_PESI']
         )
         
         return jsonify({
-            'voli_diretti': [
+            'completa': completa,
+            'candidati': len(voli_diretti) + len(voli_scalo),
+            'risultati': [
                 {
-                    'id': v.id,
-                    'numero_volo': v.numero_volo,
-                    'compagnia': v.nome_compagnia,
-                    'partenza': v.città_partenza,
-                    'arrivo': v.città_arrivo,
-                    'data_partenza': v.data_partenza.isoformat(),
-                    'data_arrivo': v.data_arrivo.isoformat(),
-                    'posti_disponibili': v.posti_disponibili,
-                    'prezzo': float(v.prezzo)
-                } for v in voli_diretti
-            ],
-            'voli_scalo': [
+                    'tipo': 'diretto' if p.diretto else 'scalo',
+                    'etichette': p.etichette,
+                    'pareto': p.pareto,
+                    'punteggio': round(p.punteggio, 4),
+                    'durata_minuti': p.durata // 60,
+                    'prezzo_classe': p.prezzo,
+                    **(_volo_diretto_json(p.risultato) if p.diretto else _itinerario_json(p.risultato))
+                } for p in proposte
+            ]
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+@api.route('/flights/calendar', methods=['GET'])
+@jwt_required()
+def fare_calendar():
+    """Tariffa minima per giorno nei ±N giorni attorno a una data (max 59 giorni)."""
+    try:
+        data = fare_calendar_schema.load(request.args)
+        inizio = data['data'] - timedelta(days=data['giorni'])
+        fine = data['data'] + timedelta(days=data['giorni'] + 1)
+        
+        calendario = calendario_tariffe(
+            data['aeroporto_partenza'],
+            data['aeroporto_arrivo'],
+            inizio,
+            fine,
+            data['classe'],
+            data['passeggeri']
+        )
+        
+        response = jsonify({
+            'aeroporto_partenza': data['aeroporto_partenza'],
+            'aeroporto_arrivo': data['aeroporto_arrivo'],
+            'classe': data['classe'],
+            'calendario': [
                 {
-                    'volo1': {
-                        'id': v.volo1_id,
-                        'numero': v.volo1_numero,
-                        'compagnia': v.compagnia1,
-                        'partenza': v.città_partenza,
-                        'arrivo': v.città_scalo,
-                        'data_partenza': v.data_partenza.isoformat(),
-                        'data_arrivo': v.scalo_arrivo.isoformat()
-                    },
-                    'volo2': {
-                        'id': v.volo2_id,
-                        'numero': v.volo2_numero,
-                        'compagnia': v.compagnia2,
-                        'partenza': v.città_scalo,
-                        'arrivo': v.città_arrivo,
-                        'data_partenza': v.scalo_partenza.isoformat(),
-                        'data_arrivo': v.data_arrivo.isoformat()
-                    },
-                    'prezzi': {
-                        'economy': float(v.prezzo_totale_economy),
-                        'business': float(v.prezzo_totale_business),
-                        'first': float(v.prezzo_totale_first)
-                    }
-                } for v in voli_scalo
+                    'data': giorno.isoformat(),
+                    'prezzo_minimo': tariffa[0] if tariffa else None,
+                    'voli': tariffa[1] if tariffa else 0
+                } for giorno, tariffa in calendario
             ]
         })
+        response.cache_control.private = True
+        response.cache_control.max_age = current_app.config.get('RICERCA_CACHE_TTL', 60)
+        return response
         
+    except ValidationError as e:
+        return jsonify({'error': e.messages}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
+@api.route('/flights/<int:flight_id>/seatmap', methods=['GET'])
+def flight_seat_map(flight_id):
+    """
+    Mappa dei posti del volo per classe: disposizione della cabina e posti
+    assegnati come bitset in base64 (bit i = posto i contando per fila).
+    """
+    mappa = mappa_volo(flight_id)
+    if mappa is None:
+        return jsonify({'error': 'Volo non trovato'}), 404
+    response = jsonify({'volo_id': flight_id, 'classi': mappa})
+    response.cache_control.no_cache = True
+    return response
+
+@api.route('/availability', methods=['GET', 'POST'])
+def flights_availability():
+    """
+    Disponibilità per classe di più voli in una richiesta.
+    
+    Gli id arrivano come `?ids=1,2,3` (GET) o `{"ids": [1, 2, 3]}` (POST),
+    al più `DISPONIBILITA_MASSIMO_VOLI`. I voli sono nell'ordine richiesto;
+    quelli inesistenti sono in `non_trovati`. La risposta ha un ETag: con
+    `If-None-Match` uguale si riceve 304 senza corpo.
+    """
+    try:
+        if request.method == 'POST':
+            dati = availability_schema.load(request.get_json(silent=True) or {})
+        else:
+            ids = [i.strip() for valore in request.args.getlist('ids') for i in valore.split(',') if i.strip()]
+            dati = availability_schema.load({'ids': ids} if ids else {})
+    except ValidationError as e:
+        return jsonify({'error': e.messages}), 400
+    
+    voli_ids = list(dict.fromkeys(dati['ids']))
+    massimo = current_app.config['DISPONIBILITA_MASSIMO_VOLI']
+    if len(voli_ids) > massimo:
+        return jsonify({'error': f'Al massimo {massimo} voli per richiesta'}), 400
+    
+    disponibilità = disponibilità_voli(voli_ids)
+    response = jsonify({
+        'voli': [disponibilità[volo_id] for volo_id in voli_ids if volo_id in disponibilità],
+        'non_trovati': [volo_id for volo_id in voli_ids if volo_id not in disponibilità]
+    })
+    response.add_etag()
+    if response.get_etag()[0] in request.if_none_match:
+        # Anche per POST: make_conditional risponde 304 solo a GET e HEAD
+        response.status_code = 304
+        response.set_data(b'')
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['DISPONIBILITA_CACHE_TTL']
+    return response
+
+# Aeroporti
+@api.route('/airports/suggest', methods=['GET'])
+def suggest_airports():
+    """
+    Aeroporti il cui codice IATA, nome, città o paese inizia con `q` (o gli
+    somiglia), per il completamento dei campi aeroporto nei form.
+    """
+    limite = request.args.get('limite', 10, type=int)
+    limite = min(max(limite, 1), 20)
+    response = jsonify(suggerisci(request.args.get('q', ''), limite))
+    response.cache_control.public = True
+    response.cache_control.max_age = 300
+    return response
+
+# Metriche
+@api.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(metriche_prometheus() + metriche_filtro(), mimetype='text/plain; version=0.0.4')
+
 # Prenotazioni
+def _prenotazione_creata(prenotazione):
+    return jsonify({
+        'message': 'Prenotazione creata con successo',
+        'prenotazione_id': prenotazione.id,
+        'prezzo_totale': prenotazione.prezzo_totale
+    }), 201
+
+def _itinerario_creato(prenotazione):
+    return jsonify({
+        'message': 'Prenotazione creata con successo',
+        'prenotazione_id': prenotazione.id,
+        'prezzo_totale': prenotazione.prezzo_totale,
+        'biglietti': [
+            {'volo_id': b.flight_id, 'posto': b.numero_posto, 'prezzo': b.prezzo}
+            for b in prenotazione.biglietti
+        ]
+    }), 201
+
+# Errori transitori di una prenotazione: la stessa richiesta può riuscire
+# ripetendola, quindi la Idempotency-Key non ne conserva la risposta
+def _errore_transitorio(errore):
+    db.session.rollback()
+    if isinstance(errore, EsitoIncerto):
+        # Il lotto può ancora fare il commit: la chiave resta in corso
+        return jsonify({
+            'message': 'Prenotazione in corso: ripetere la richiesta con la stessa Idempotency-Key '
+                       'o controllare le prenotazioni'
+        }), 202
+    if isinstance(errore, StaleDataError):
+        return jsonify({'error': 'Il volo è stato modificato durante la prenotazione, riprovare'}), 409
+    # OperationalError (database occupato, deadlock, timeout dei lock) o coda
+    # dello scrittore piena (AttesaScaduta)
+    return jsonify({'error': 'Servizio momentaneamente non disponibile, riprovare'}), 503, {'Retry-After': '1'}
+
 @api.route('/bookings', methods=['POST'])
 @jwt_required()
+@idempotente
 def create_booking():
     try:
         data = booking_schema.load(request.json)
         user_id = int(get_jwt_identity())
         
-        # Verifica disponibilità
-        disponibilità = verifica_disponibilità_posti(data['volo_id'])
-        posti_disponibili = getattr(disponibilità, f'posti_{data["classe"]}_disponibili')
-        
-        if posti_disponibili < data['passeggeri']:
-            return jsonify({'error': 'Posti non disponibili'}), 400
-            
-        # Crea prenotazione
-        with db.session.begin():
-            prenotazione = Prenotazione(
-                user_id=user_id,
-                stato='confermata',
-                prezzo_totale=0
-            )
-            db.session.add(prenotazione)
-            db.session.flush()
-            
-            # Crea biglietti
-            volo = Volo.query.get_or_404(data['volo_id'])
-            prezzo_base = getattr(volo, f'prezzo_{data["classe"]}')
-            prezzo_totale = 0
-            
-            for i in range(data['passeggeri']):
-                biglietto = Biglietto(
-                    booking_id=prenotazione.id,
-                    flight_id=data['volo_id'],
-                    classe=data['classe'],
-                    numero_posto=f"{data['classe'][0].upper()}{i+1}",
-                    prezzo=prezzo_base,
-                    bagaglio_extra=data.get('bagaglio_extra', False),
-                    servizi_extra=data.get('servizi_extra', '')
-                )
-                db.session.add(biglietto)
-                prezzo_totale += prezzo_base
-                
-            prenotazione.prezzo_totale = prezzo_totale
+        # Riserva i posti e crea prenotazione e biglietti in una transazione,
+        # insieme alla risposta della Idempotency-Key
+        prenotazione = prenota(
+            user_id,
+            data['volo_id'],
+            data['classe'],
+            data['passeggeri'],
+            bagaglio_extra=data.get('bagaglio_extra', False),
+            servizi_extra=data.get('servizi_extra', ''),
+            esito=risposta_nella_transazione(_prenotazione_creata)
+        )
             
-        return jsonify({
-            'message': 'Prenotazione creata con successo',
-            'prenotazione_id': prenotazione.id,
-            'prezzo_totale': prezzo_totale
-        }), 201
+        return _prenotazione_creata(prenotazione)
         
-    except Exception as e:
+    except ValidationError as e:
+        return jsonify({'error': e.messages}), 400
+    except PostiNonDisponibili:
+        return jsonify({'error': 'Posti non disponibili'}), 400
+    except ValueError as e:
+        # Posto scelto già assegnato, classe o numero di posti non validi
         db.session.rollback()
         return jsonify({'error': str(e)}), 400
+    except HTTPException as e:
+        return jsonify({'error': e.description}), e.code
+    except (AttesaScaduta, OperationalError, StaleDataError) as e:
+        return _errore_transitorio(e)
+
+@api.route('/bookings/itinerary', methods=['POST'])
+@jwt_required()
+@idempotente
+def create_itinerary_booking():
+    """Prenota tutti i voli di un itinerario con scalo in una prenotazione, o nessuno."""
+    try:
+        data = itinerary_booking_schema.load(request.json)
+        user_id = int(get_jwt_identity())
+        
+        prenotazione = prenota_itinerario(
+            user_id,
+            data['voli'],
+            data['classe'],
+            data['passeggeri'],
+            bagaglio_extra=data.get('bagaglio_extra', False),
+            servizi_extra=data.get('servizi_extra', ''),
+            esito=risposta_nella_transazione(_itinerario_creato)
+        )
+        
+        return _itinerario_creato(prenotazione)
+        
+    except ValidationError as e:
+        return jsonify({'error': e.messages}), 400
+    except PostiNonDisponibili as e:
+        return jsonify({'error': 'Posti non disponibili', 'volo_id': e.volo_id}), 400
+    except ValueError as e:
+        # Voli che non formano un itinerario, classe o numero di posti non validi
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    except HTTPException as e:
+        return jsonify({'error': e.description}), e.code
+    except (AttesaScaduta, OperationalError, StaleDataError) as e:
+        return _errore_transitorio(e)
 
 @api.route('/bookings', methods=['GET'])
 @jwt_required()
 def get_bookings():
     try:
         user_id = int(get_jwt_identity())
-        prenotazioni = prenotazioni_utente(user_id)
+        prenotazioni = (
+            _prenotazione_json(p, biglietti)
+            for p, biglietti in scorri_prenotazioni_utente(user_id)
+        )
         
-        return jsonify({
-            'prenotazioni': [
-                {
-                    'id': p.prenotazione_id,
-                    'data': p.data_prenotazione.isoformat(),
-                    'stato': p.stato,
-                    'prezzo_totale': float(p.prezzo_totale),
-                    'biglietti': p.dettagli_biglietti
-                } for p in prenotazioni
-            ]
-        })
+        if _richiede_ndjson():
+            return _risposta_ndjson(prenotazioni)
+        return jsonify({'prenotazioni': list(prenotazioni)})
         
     except Exception as e:
         return jsonify({'error': str(e)}), 400
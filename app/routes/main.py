@@ -1,4 +1,4 @@
-from flask import Blueprint, render_template, request, jsonify, flash, redirect, url_for, make_response
+from flask import Blueprint, render_template, request, jsonify, flash, redirect, url_for, make_response, abort
 from flask_login import login_required, current_user
 from datetime import datetime, timedelta
 from sqlalchemy.exc import SQLAlchemyError
@@ -9,29 +9,27 @@ from reportlab.lib.units import inch
 from reportlab.lib import colors
 from io import BytesIO
 from .. import db
-from ..models import Volo, Prenotazione, Biglietto, CompagniaAerea, Aeroporto
+from ..models import Volo, Prenotazione
 from ..queries import (
-    cerca_voli_diretti,
-    cerca_voli_scalo,
     statistiche_compagnia,
     prenotazioni_utente,
-    verifica_disponibilità_posti
+    verifica_disponibilità_posti
 )
+from ..concurrent_search import cerca_voli as cerca_voli_parallela
+from ..reference_data import riferimenti, compagnia_di_utente
+from ..booking import blocca_posti, blocco_attivo
+from ..booking_writer import prenota
 
 main = Blueprint('main', __name__)
 
 @main.route('/')
 def index():
     """Homepage dell'applicazione"""
-    aeroporti = Aeroporto.query.all()
-    return render_template('index.html', aeroporti=aeroporti)
+    return render_template('index.html')
 
 @main.route('/cerca_voli', methods=['GET', 'POST'])
 def cerca_voli():
     """Pagina di ricerca voli"""
-    # Recupera la lista degli aeroporti
-    aeroporti = Aeroporto.query.all()
-    
     if request.method == 'POST':
         try:
             # Recupera i parametri dal form
@@ -42,8 +40,8 @@ def cerca_voli():
             classe = request.form.get('classe', 'economy')
             ordina_per = request.form.get('ordina_per', 'prezzo')
             
-            # Cerca voli diretti
-            voli_diretti = cerca_voli_diretti(
+            # Cerca voli diretti e con scalo in parallelo
+            risultati = cerca_voli_parallela(
                 aeroporto_partenza,
                 aeroporto_arrivo,
                 data,
@@ -51,21 +49,18 @@ def cerca_voli():
                 classe,
                 ordina_per
             )
-            
-            # Cerca voli con scalo
-            voli_scalo = cerca_voli_scalo(
-                aeroporto_partenza,
-                aeroporto_arrivo,
-                data
-            )
+            if not risultati.completa:
+                flash('La ricerca dei voli con scalo non è terminata in tempo: sono mostrati solo i voli diretti.', 'warning')
             
             return render_template(
                 'risultati_ricerca.html',
-                voli_diretti=voli_diretti,
-                voli_scalo=voli_scalo,
+                voli_diretti=risultati.diretti,
+                voli_scalo=risultati.scalo,
                 aeroporto_partenza=aeroporto_partenza,
                 aeroporto_arrivo=aeroporto_arrivo,
-                data=data
+                data=data,
+                passeggeri=passeggeri,
+                classe=classe
             )
             
         except ValueError as e:
@@ -74,7 +69,7 @@ def cerca_voli():
             db.session.rollback()
             flash('Errore durante la ricerca dei voli.', 'error')
             
-    return render_template('cerca_voli.html', aeroporti=aeroporti)
+    return render_template('cerca_voli.html')
 
 @main.route('/prenota/<int:volo_id>', methods=['GET', 'POST'])
 @login_required
@@ -82,53 +77,30 @@ def prenota_volo(volo_id):
     """Pagina di prenotazione di un volo"""
     if request.method == 'POST':
         try:
-            disponibilità = verifica_disponibilità_posti(volo_id)
             classe = request.form.get('classe')
             passeggeri = int(request.form.get('passeggeri', 1))
             
-            posti_disponibili = getattr(disponibilità, f'posti_{classe}_disponibili')
-            if posti_disponibili < passeggeri:
-                raise ValueError('Non ci sono abbastanza posti disponibili')
-            
-            prenotazione = Prenotazione(
-                user_id=current_user.id,
-                stato='confermata',
-                prezzo_totale=0
-            )
-            db.session.add(prenotazione)
-            db.session.flush()
-            
-            volo = Volo.query.get(volo_id)
-            prezzo_base = getattr(volo, f'prezzo_{classe}')
-            
             bagaglio_extra_checked = request.form.get('bagaglio_extra') == 'on'
             servizi_extra_checked = request.form.get('servizi_extra') == 'on'
             
-            prezzo_per_biglietto = prezzo_base
+            supplemento = 0
             servizi_extra_str = ""
             if bagaglio_extra_checked:
-                prezzo_per_biglietto += 30
+                supplemento += 30
             if servizi_extra_checked:
-                prezzo_per_biglietto += 20
+                supplemento += 20
                 servizi_extra_str = "Servizi Extra"
 
-            prezzo_totale = 0
-            for i in range(passeggeri):
-                biglietto = Biglietto(
-                    booking_id=prenotazione.id,
-                    flight_id=volo_id,
-                    passeggero_id=current_user.id,
-                    classe=classe,
-                    numero_posto=f"{classe[0].upper()}{i+1}",
-                    prezzo=prezzo_per_biglietto,
-                    bagaglio_extra=bagaglio_extra_checked,
-                    servizi_extra=servizi_extra_str
-                )
-                db.session.add(biglietto)
-                prezzo_totale += prezzo_per_biglietto
-            
-            prenotazione.prezzo_totale = prezzo_totale
-            db.session.commit()
+            # I posti vengono riservati e i biglietti creati in una transazione
+            prenota(
+                current_user.id,
+                volo_id,
+                classe,
+                passeggeri,
+                supplemento=supplemento,
+                bagaglio_extra=bagaglio_extra_checked,
+                servizi_extra=servizi_extra_str
+            )
             
             flash('Prenotazione effettuata con successo!', 'success')
             return redirect(url_for('main.le_mie_prenotazioni'))
@@ -141,11 +113,26 @@ def prenota_volo(volo_id):
             flash(f'Errore durante la prenotazione: {str(e)}', 'error')
     
     volo = Volo.query.get_or_404(volo_id)
-    disponibilità = verifica_disponibilità_posti(volo_id)
+    blocco = None
+    if request.method == 'GET':
+        # I posti richiesti dalla ricerca restano all'utente mentre compila il modulo
+        classe = request.args.get('classe', 'economy')
+        passeggeri = min(max(request.args.get('passeggeri', 1, type=int), 1), 9)
+        try:
+            blocco = blocca_posti(current_user.id, volo_id, classe, passeggeri)
+        except ValueError:
+            # Posti esauriti o classe non valida: la pagina mostra la disponibilità
+            pass
+        except SQLAlchemyError:
+            db.session.rollback()
+    else:
+        blocco = blocco_attivo(current_user.id, volo_id)
+    disponibilità = verifica_disponibilità_posti(volo_id, current_user.id)
     return render_template(
         'prenota_volo.html',
         volo=volo,
-        disponibilità=disponibilità
+        disponibilità=disponibilità,
+        blocco=blocco
     )
 
 @main.route('/le_mie_prenotazioni')
@@ -163,12 +150,14 @@ def le_mie_prenotazioni():
 @login_required
 def visualizza_statistiche(compagnia_id):
     # Verifica che l'utente sia una compagnia aerea e che stia accedendo alle proprie statistiche
-    if not current_user.is_airline or current_user.compagnia.id != compagnia_id:
+    if not current_user.is_airline or compagnia_di_utente(current_user.id).id != compagnia_id:
         flash('Non hai i permessi per accedere a questa pagina.', 'danger')
         return redirect(url_for('main.index'))
     
     # Recupera i dati della compagnia
-    compagnia = CompagniaAerea.query.get_or_404(compagnia_id)
+    compagnia = riferimenti.compagnia(compagnia_id)
+    if compagnia is None:
+        abort(404)
     
     # Recupera i voli della compagnia
     voli = Volo.query.filter_by(compagnia_id=compagnia_id).all()
@@ -179,27 +168,20 @@ def visualizza_statistiche(compagnia_id):
     voli_in_corso = sum(1 for volo in voli if volo.data_partenza <= datetime.now() <= volo.data_arrivo)
     voli_futuri = sum(1 for volo in voli if volo.data_partenza > datetime.now())
 
-    # Calcola il totale dei posti venduti e disponibili per classe
-    posti_economy_venduti = 0
-    posti_business_venduti = 0
-    posti_first_venduti = 0
-    posti_economy_disponibili = 0
-    posti_business_disponibili = 0
-    posti_first_disponibili = 0
+    # Posti liberi, venduti e bloccati sono contatori dei voli già caricati:
+    # non serve contare i biglietti
+    posti_economy_disponibili = sum(volo.posti_economy for volo in voli)
+    posti_business_disponibili = sum(volo.posti_business for volo in voli)
+    posti_first_disponibili = sum(volo.posti_first for volo in voli)
 
-    for volo in voli:
-        disponibilita = verifica_disponibilità_posti(volo.id)
-        posti_economy_disponibili += disponibilita.posti_economy_disponibili
-        posti_business_disponibili += disponibilita.posti_business_disponibili
-        posti_first_disponibili += disponibilita.posti_first_disponibili
-        posti_economy_venduti += volo.posti_economy - disponibilita.posti_economy_disponibili
-        posti_business_venduti += volo.posti_business - disponibilita.posti_business_disponibili
-        posti_first_venduti += volo.posti_first - disponibilita.posti_first_disponibili
+    posti_economy_venduti = sum(volo.venduti_economy for volo in voli)
+    posti_business_venduti = sum(volo.venduti_business for volo in voli)
+    posti_first_venduti = sum(volo.venduti_first for volo in voli)
 
-    # Calcola il totale dei posti per classe
-    posti_economy_totali = sum(volo.posti_economy for volo in voli)
-    posti_business_totali = sum(volo.posti_business for volo in voli)
-    posti_first_totali = sum(volo.posti_first for volo in voli)
+    # Calcola il totale dei posti per classe (compresi quelli bloccati)
+    posti_economy_totali = posti_economy_disponibili + posti_economy_venduti + sum(volo.bloccati_economy for volo in voli)
+    posti_business_totali = posti_business_disponibili + posti_business_venduti + sum(volo.bloccati_business for volo in voli)
+    posti_first_totali = posti_first_disponibili + posti_first_venduti + sum(volo.bloccati_first for volo in voli)
 
     # Calcola le percentuali di occupazione per classe
     occupazione_economy = (posti_economy_venduti / posti_economy_totali * 100) if posti_economy_totali > 0 else 0
@@ -257,7 +239,7 @@ def api_verifica_disponibilità(volo_id):
 @main.route('/compagnie')
 def lista_compagnie():
     """Visualizza la lista di tutte le compagnie aeree registrate."""
-    compagnie = CompagniaAerea.query.all()
+    compagnie = riferimenti.tutte_compagnie()
     return render_template('main/compagnie.html', compagnie=compagnie)
 
 @main.route('/acquista_biglietto/<int:volo_id>', methods=['GET', 'POST'])
@@ -272,21 +254,9 @@ def acquista_biglietto(volo_id):
     if request.method == 'POST':
         try:
             classe = request.form.get('classe')
-            prezzo = getattr(volo, f'prezzo_{classe}')
-            
-            # Crea il biglietto
-            biglietto = Biglietto(
-                passeggero_id=current_user.id,
-                flight_id=volo.id,
-                classe=classe,
-                prezzo=prezzo,
-                data_acquisto=datetime.utcnow()
-            )
-            
-            # La gestione dei posti disponibili è ora gestita dal trigger
             
-            db.session.add(biglietto)
-            db.session.commit()
+            # Riserva il posto e crea il biglietto
+            prenota(current_user.id, volo.id, classe, 1)
             
             flash('Biglietto acquistato con successo!', 'success')
             return redirect(url_for('main.le_mie_prenotazioni'))
@@ -355,9 +325,9 @@ def stampa_prenotazione(prenotazione_id):
         for biglietto in prenotazione.biglietti:
             # Recupera i dettagli del volo
             volo = biglietto.volo
-            aeroporto_partenza = volo.aeroporto_partenza
-            aeroporto_arrivo = volo.aeroporto_arrivo
-            compagnia = volo.compagnia
+            aeroporto_partenza = riferimenti.aeroporto(volo.aeroporto_partenza_id)
+            aeroporto_arrivo = riferimenti.aeroporto(volo.aeroporto_arrivo_id)
+            compagnia = riferimenti.compagnia(volo.compagnia_id)
             
             # Crea una tabella per ogni biglietto
             biglietto_data = [
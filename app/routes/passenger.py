@@ -1,7 +1,9 @@
 from flask import Blueprint, render_template, request, flash, redirect, url_for, jsonify
 from flask_login import login_required, current_user
-from app.models import Volo, Prenotazione, Biglietto, Aeroporto
+from app.models import Volo, Prenotazione, Aeroporto
 from app import db
+from app.booking import annulla_prenotazioni
+from app.booking_writer import prenota
 from datetime import datetime
 from sqlalchemy import and_, or_
 
@@ -28,39 +30,22 @@ def prenota_volo(flight_id):
     
     if request.method == 'POST':
         try:
-            # Crea la prenotazione
-            prenotazione = Prenotazione(
-                user_id=current_user.id,
-                prezzo_totale=0  # Verrà aggiornato dopo
-            )
-            db.session.add(prenotazione)
-            db.session.flush()  # Per ottenere l'ID della prenotazione
-            
-            # Crea il biglietto
             classe = request.form.get('classe')
-            prezzo = getattr(volo, f'prezzo_{classe}')
+            bagaglio_extra = request.form.get('bagaglio_extra') == 'on'
+            numero_posto = (request.form.get('numero_posto') or '').strip()
             
-            biglietto = Biglietto(
-                booking_id=prenotazione.id,
-                flight_id=volo.id,
-                classe=classe,
-                numero_posto=request.form.get('numero_posto'),
-                prezzo=prezzo,
-                bagaglio_extra=request.form.get('bagaglio_extra') == 'on',
-                servizi_extra=request.form.get('servizi_extra')
+            # Riserva il posto e crea prenotazione e biglietto
+            prenota(
+                current_user.id,
+                volo.id,
+                classe,
+                1,
+                supplemento=30 if bagaglio_extra else 0,  # Costo bagaglio extra
+                bagaglio_extra=bagaglio_extra,
+                servizi_extra=request.form.get('servizi_extra'),
+                numeri_posto=[numero_posto] if numero_posto else None  # Altrimenti assegnato dalla mappa
             )
             
-            # Aggiorna il prezzo totale
-            prenotazione.prezzo_totale = prezzo
-            if biglietto.bagaglio_extra:
-                prenotazione.prezzo_totale += 30  # Costo bagaglio extra
-            
-            # Aggiorna i posti disponibili
-            setattr(volo, f'posti_{classe}', getattr(volo, f'posti_{classe}') - 1)
-            
-            db.session.add(biglietto)
-            db.session.commit()
-            
             flash('Prenotazione effettuata con successo!', 'success')
             return redirect(url_for('passenger.prenotazioni'))
             
@@ -75,17 +60,19 @@ def prenota_volo(flight_id):
 def posti_disponibili(flight_id):
     volo = Volo.query.get_or_404(flight_id)
     classe = request.args.get('classe', 'economy')
+    if classe not in ('economy', 'business', 'first'):
+        return jsonify({'error': 'Classe non valida'}), 400
     
+    # Posti liberi, venduti e bloccati sono contatori della riga del volo
     posti_disponibili = getattr(volo, f'posti_{classe}')
-    posti_occupati = Biglietto.query.filter_by(
-        flight_id=flight_id,
-        classe=classe
-    ).count()
+    posti_occupati = getattr(volo, f'venduti_{classe}')
+    posti_bloccati = getattr(volo, f'bloccati_{classe}')
     
     return jsonify({
-        'totali': posti_disponibili,
+        'totali': posti_disponibili + posti_occupati + posti_bloccati,
         'occupati': posti_occupati,
-        'disponibili': posti_disponibili - posti_occupati
+        'bloccati': posti_bloccati,
+        'disponibili': posti_disponibili
     })
 
 @passenger.route('/cancella_prenotazione/<int:booking_id>', methods=['POST'])
@@ -101,18 +88,11 @@ def cancella_prenotazione(booking_id):
         return redirect(url_for('passenger.prenotazioni'))
     
     try:
-        # Ripristina i posti disponibili
-        for biglietto in prenotazione.biglietti:
-            volo = biglietto.volo
-            setattr(volo, f'posti_{biglietto.classe}',
-                   getattr(volo, f'posti_{biglietto.classe}') + 1)
-        
-        # Cancella la prenotazione (cascade cancellerà i biglietti)
-        db.session.delete(prenotazione)
-        db.session.commit()
+        # Posti, biglietti e prenotazione con poche istruzioni, qualunque sia
+        # il numero di biglietti
+        annulla_prenotazioni([booking_id], current_user.id)
         flash('Prenotazione cancellata con successo!', 'success')
     except Exception as e:
-        db.session.rollback()
         flash(f'Errore durante la cancellazione: {str(e)}', 'error')
     
     return redirect(url_for('passenger.prenotazioni')) 
\ No newline at end of file
@@ -0,0 +1,347 @@
+"""
+Cache dei risultati di ricerca voli con invalidazione guidata dalle scritture.
+
+I risultati di `cerca_voli_diretti` e della ricerca con scalo vengono tenuti in
+una cache LRU limitata, con scadenza (TTL) per voce. Le chiavi sono
+(origine, destinazione, giorno, classe, passeggeri, ordinamento, cursore,
+limite), dove origine e destinazione sono gli insiemi di aeroporti in cui il
+luogo cercato (codice IATA o città) viene espanso: ogni pagina di risultati è
+una voce a sé. Il calendario delle tariffe è tenuto in cache per
+tratta e mese, con il primo giorno del mese al posto del giorno.
+
+Le voci vengono rimosse dagli eventi di sessione SQLAlchemy:
+
+- quando un `Volo` viene inserito, modificato o cancellato, si invalidano i
+  voli diretti e il calendario della sua tratta nel suo giorno (e mese) e le
+  ricerche con scalo del suo giorno e del giorno precedente (il volo può essere
+  una tratta successiva di un itinerario partito il giorno prima);
+- quando un `Biglietto` o un `BloccoPosti` viene inserito, modificato o
+  cancellato, la disponibilità del suo volo cambia e si applica la stessa
+  regola; lo stesso per la `MappaPosti` del volo, che una prenotazione
+  modifica nel flush (i suoi biglietti si inseriscono con un INSERT a parte,
+  senza eventi di flush).
+
+L'invalidazione avviene dopo il flush e di nuovo dopo il commit o il rollback,
+così una lettura concorrente tra il flush e il commit non lascia in cache dati
+già superati, né una lettura nella stessa transazione dati poi annullati.
+"""
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+
+from .models import Volo, Biglietto, BloccoPosti, MappaPosti
+from .city_index import indice_città
+from .queries import cerca_voli_diretti, tariffe_minime_per_giorno
+from .route_graph import cerca_itinerari
+
+DIRETTI = 'diretti'
+SCALO = 'scalo'
+CALENDARIO = 'calendario'
+
+
+class CacheRicerca:
+    """Cache LRU con TTL e indici secondari per l'invalidazione."""
+
+    def __init__(self, dimensione_massima=1024, ttl=60):
+        self.dimensione_massima = dimensione_massima
+        self.ttl = ttl
+        self._voci = OrderedDict()
+        self._per_tratta = defaultdict(set)
+        self._per_giorno = defaultdict(set)
+        self._lock = threading.Lock()
+        self.hit = 0
+        self.miss = 0
+        self.scadute = 0
+        self.espulse = 0
+        self.invalidate = 0
+
+    def leggi(self, chiave):
+        """Restituisce il valore in cache o None se assente o scaduto."""
+        adesso = time.monotonic()
+        with self._lock:
+            voce = self._voci.get(chiave)
+            if voce is None:
+                self.miss += 1
+                return None
+            scadenza, valore = voce
+            if scadenza <= adesso:
+                self._rimuovi(chiave)
+                self.scadute += 1
+                self.miss += 1
+                return None
+            self._voci.move_to_end(chiave)
+            self.hit += 1
+            return valore
+
+    @staticmethod
+    def _sottochiavi(chiave):
+        """Voci degli indici secondari: ogni coppia di aeroporti e il giorno."""
+        tipo, partenze, arrivi, giorno = chiave[:4]
+        indici = [('tratta', (partenza, arrivo, giorno)) for partenza in partenze for arrivo in arrivi]
+        indici.append(('giorno', giorno))
+        return indici
+
+    def scrivi(self, chiave, valore):
+        with self._lock:
+            if chiave in self._voci:
+                self._voci.move_to_end(chiave)
+            self._voci[chiave] = (time.monotonic() + self.ttl, valore)
+            for nome, sottochiave in self._sottochiavi(chiave):
+                indice = self._per_tratta if nome == 'tratta' else self._per_giorno
+                indice[sottochiave].add(chiave)
+            while len(self._voci) > self.dimensione_massima:
+                vecchia = next(iter(self._voci))
+                self._rimuovi(vecchia)
+                self.espulse += 1
+
+    def _rimuovi(self, chiave):
+        self._voci.pop(chiave, None)
+        for nome, sottochiave in self._sottochiavi(chiave):
+            indice = self._per_tratta if nome == 'tratta' else self._per_giorno
+            chiavi = indice.get(sottochiave)
+            if chiavi is not None:
+                chiavi.discard(chiave)
+                if not chiavi:
+                    del indice[sottochiave]
+
+    def invalida_volo(self, partenza, arrivo, giorno):
+        """
+        Rimuove le ricerche che possono includere un volo della tratta e del giorno dati.
+
+        Args:
+            partenza (int): Id dell'aeroporto di partenza
+            arrivo (int): Id dell'aeroporto di arrivo
+            giorno (date): Giorno di partenza del volo
+        """
+        with self._lock:
+            da_rimuovere = {
+                c for c in self._per_tratta.get((partenza, arrivo, giorno), ())
+                if c[0] == DIRETTI
+            }
+            da_rimuovere.update(
+                c for c in self._per_tratta.get((partenza, arrivo, giorno.replace(day=1)), ())
+                if c[0] == CALENDARIO
+            )
+            for g in (giorno, giorno - timedelta(days=1)):
+                da_rimuovere.update(c for c in self._per_giorno.get(g, ()) if c[0] == SCALO)
+            for chiave in da_rimuovere:
+                self._rimuovi(chiave)
+            self.invalidate += len(da_rimuovere)
+
+    def svuota(self):
+        with self._lock:
+            self._voci.clear()
+            self._per_tratta.clear()
+            self._per_giorno.clear()
+
+    def statistiche(self):
+        with self._lock:
+            return {
+                'voci': len(self._voci),
+                'dimensione_massima': self.dimensione_massima,
+                'hit': self.hit,
+                'miss': self.miss,
+                'scadute': self.scadute,
+                'espulse': self.espulse,
+                'invalidate': self.invalidate,
+            }
+
+
+cache_ricerca = CacheRicerca()
+
+
+def _giorno(data):
+    return data.date() if isinstance(data, datetime) else data
+
+
+def cerca_diretti(aeroporto_partenza, aeroporto_arrivo, data, passeggeri=1, classe='economy', ordina_per='prezzo',
+                  cursore=None, limite=None):
+    """`cerca_voli_diretti` con la cache dei risultati davanti."""
+    chiave = (DIRETTI, indice_città.risolvi(aeroporto_partenza), indice_città.risolvi(aeroporto_arrivo),
+              _giorno(data), classe, passeggeri, ordina_per, cursore, limite)
+    risultati = cache_ricerca.leggi(chiave)
+    if risultati is None:
+        risultati = tuple(cerca_voli_diretti(
+            aeroporto_partenza, aeroporto_arrivo, data, passeggeri, classe, ordina_per, cursore, limite
+        ))
+        cache_ricerca.scrivi(chiave, risultati)
+    return list(risultati)
+
+
+def cerca_con_scalo(aeroporto_partenza, aeroporto_arrivo, data, passeggeri=1, classe='economy', ordina_per='prezzo',
+                    cursore=None, limite=None):
+    """`cerca_itinerari` con la cache dei risultati davanti."""
+    chiave = (SCALO, indice_città.risolvi(aeroporto_partenza), indice_città.risolvi(aeroporto_arrivo),
+              _giorno(data), classe, passeggeri, ordina_per, cursore, limite)
+    risultati = cache_ricerca.leggi(chiave)
+    if risultati is None:
+        risultati = tuple(cerca_itinerari(
+            aeroporto_partenza, aeroporto_arrivo, data, passeggeri, classe, ordina_per, cursore, limite
+        ))
+        cache_ricerca.scrivi(chiave, risultati)
+    return list(risultati)
+
+
+def _primo_del_mese_successivo(giorno):
+    return (giorno.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+
+def calendario_tariffe(aeroporto_partenza, aeroporto_arrivo, data_inizio, data_fine, classe='economy', passeggeri=1):
+    """
+    Tariffa minima per giorno nel periodo [data_inizio, data_fine).
+
+    I risultati sono tenuti in cache per tratta e mese: i mesi mancanti
+    vengono caricati insieme con una sola query raggruppata.
+
+    Returns:
+        list: Una coppia (giorno, (prezzo_minimo, numero_voli) o None) per ogni giorno
+    """
+    mesi = []
+    mese = data_inizio.replace(day=1)
+    while mese < data_fine:
+        mesi.append(mese)
+        mese = _primo_del_mese_successivo(mese)
+
+    partenze = indice_città.risolvi(aeroporto_partenza)
+    arrivi = indice_città.risolvi(aeroporto_arrivo)
+    tariffe = {}
+    mancanti = []
+    for mese in mesi:
+        chiave = (CALENDARIO, partenze, arrivi, mese, classe, passeggeri, None)
+        valore = cache_ricerca.leggi(chiave)
+        if valore is None:
+            mancanti.append(mese)
+        else:
+            tariffe.update(valore)
+
+    if mancanti:
+        caricate = tariffe_minime_per_giorno(
+            aeroporto_partenza,
+            aeroporto_arrivo,
+            mancanti[0],
+            _primo_del_mese_successivo(mancanti[-1]),
+            classe,
+            passeggeri
+        )
+        for mese in mancanti:
+            fine_mese = _primo_del_mese_successivo(mese)
+            valore = {g: t for g, t in caricate.items() if mese <= g < fine_mese}
+            chiave = (CALENDARIO, partenze, arrivi, mese, classe, passeggeri, None)
+            cache_ricerca.scrivi(chiave, valore)
+            tariffe.update(valore)
+
+    giorni = (data_fine - data_inizio).days
+    return [
+        (giorno, tariffe.get(giorno))
+        for giorno in (data_inizio + timedelta(days=i) for i in range(giorni))
+    ]
+
+
+def valori_attributo(oggetto, attributo):
+    """Valore attuale e valori precedenti (non ancora committati) di un attributo."""
+    stato = inspect(oggetto)
+    storia = stato.attrs[attributo].history
+    valori = set(storia.added or ()) | set(storia.unchanged or ()) | set(storia.deleted or ())
+    if not valori:
+        valori.add(stato.dict.get(attributo))
+    valori.discard(None)
+    return valori
+
+
+def _voli_toccati(session):
+    """Tratte e giorni (per id di aeroporto) dei voli toccati dal flush."""
+    voli = set()
+    voli_da_caricare = set()
+    for oggetto in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(oggetto, Volo):
+            for partenza in valori_attributo(oggetto, 'aeroporto_partenza_id'):
+                for arrivo in valori_attributo(oggetto, 'aeroporto_arrivo_id'):
+                    for data in valori_attributo(oggetto, 'data_partenza'):
+                        voli.add((int(partenza), int(arrivo), data.date()))
+        elif isinstance(oggetto, (Biglietto, BloccoPosti)):
+            voli_da_caricare.update(valori_attributo(oggetto, 'flight_id'))
+        elif isinstance(oggetto, MappaPosti):
+            voli_da_caricare.add(oggetto.volo_id)
+
+    if voli_da_caricare:
+        voli.update(_tratte(session, voli_da_caricare))
+    return voli
+
+
+def _tratte(session, volo_ids):
+    righe = session.connection().execute(
+        select(Volo.aeroporto_partenza_id, Volo.aeroporto_arrivo_id, Volo.data_partenza)
+        .where(Volo.id.in_(volo_ids))
+    )
+    return {(r[0], r[1], r[2].date()) for r in righe}
+
+
+def _invalida_tratte(session, tratte):
+    session.info.setdefault('ricerca_da_invalidare', set()).update(tratte)
+    for tratta in tratte:
+        cache_ricerca.invalida_volo(*tratta)
+
+
+def invalida_voli(session, volo_ids):
+    """
+    Invalida le ricerche dei voli modificati con un UPDATE fuori dall'ORM, che
+    non genera eventi di flush: subito e di nuovo a fine transazione.
+    """
+    _invalida_tratte(session, _tratte(session, volo_ids))
+
+
+def _dopo_flush(session, flush_context):
+    tratte = _voli_toccati(session)
+    if tratte:
+        _invalida_tratte(session, tratte)
+
+
+def _dopo_commit(session):
+    if session.in_nested_transaction():
+        # Anche il RELEASE di un SAVEPOINT arriva come after_commit
+        return
+    for tratta in session.info.pop('ricerca_da_invalidare', ()):
+        cache_ricerca.invalida_volo(*tratta)
+
+
+def _dopo_rollback(session, transazione_precedente):
+    if transazione_precedente.nested:
+        return
+    for tratta in session.info.pop('ricerca_da_invalidare', ()):
+        cache_ricerca.invalida_volo(*tratta)
+
+
+def init_app(app):
+    """Configura la cache e registra l'invalidazione sugli eventi di sessione."""
+    app.config.setdefault('RICERCA_CACHE_DIMENSIONE', 1024)
+    app.config.setdefault('RICERCA_CACHE_TTL', 60)
+    cache_ricerca.dimensione_massima = app.config['RICERCA_CACHE_DIMENSIONE']
+    cache_ricerca.ttl = app.config['RICERCA_CACHE_TTL']
+    for nome, funzione in (('after_flush', _dopo_flush),
+                           ('after_commit', _dopo_commit),
+                           ('after_soft_rollback', _dopo_rollback)):
+        if not event.contains(Session, nome, funzione):
+            event.listen(Session, nome, funzione)
+
+
+def metriche_prometheus():
+    """Contatori della cache nel formato testuale di Prometheus."""
+    statistiche = cache_ricerca.statistiche()
+    righe = []
+    for nome, descrizione, tipo in (
+        ('hit', 'Ricerche servite dalla cache', 'counter'),
+        ('miss', 'Ricerche eseguite sul database', 'counter'),
+        ('scadute', 'Voci scadute per TTL', 'counter'),
+        ('espulse', 'Voci espulse per limite di dimensione (LRU)', 'counter'),
+        ('invalidate', 'Voci invalidate da scritture su voli o biglietti', 'counter'),
+        ('voci', 'Voci attualmente in cache', 'gauge'),
+    ):
+        metrica = f'cache_ricerca_{nome}' + ('_total' if tipo == 'counter' else '')
+        righe.append(f'# HELP {metrica} {descrizione}')
+        righe.append(f'# TYPE {metrica} {tipo}')
+        righe.append(f'{metrica} {statistiche[nome]}')
+    return '\n'.join(righe) + '\n'
@@ -0,0 +1,368 @@
+"""
+Mappa dei posti di un volo: disposizione della cabina e bitset dei posti assegnati.
+
+Per ogni classe di un volo una riga di `mappa_posti` conserva la disposizione
+(prima fila, lettere di una fila, numero di posti) e i posti assegnati come
+bitset impacchettato in una colonna binaria: il bit i è il posto i, contando
+fila per fila. In memoria il bitset è un intero Python e l'assegnazione usa
+solo operazioni sui bit, senza scorrere i posti:
+
+- primo posto libero: il bit meno significativo di `liberi & -liberi`;
+- k posti adiacenti nella stessa fila (prenotazioni di gruppo): l'AND di
+  `liberi` con se stesso spostato di 1..k-1 posizioni lascia accesi gli
+  inizi di k posti liberi consecutivi; una maschera ripetuta per ogni fila
+  scarta quelli che finirebbero nella fila successiva.
+
+Le mappe si creano alla prima assegnazione, per tutte le classi del volo: le
+file si numerano dalla first alla economy con le lettere di
+`MAPPA_POSTI_LETTERE`. I biglietti già emessi prima della mappa occupano i
+primi posti della loro classe.
+
+Se i posti di una classe vengono aumentati, le file nuove si aggiungono dopo
+l'ultima fila della cabina (o in coda alla classe, se è già l'ultima): le
+etichette dei posti già assegnati non cambiano e le file delle classi non si
+sovrappongono. Una classe può quindi avere più segmenti di file consecutive,
+conservati in `segmenti`; il bitset resta contato fila per fila attraverso i
+segmenti.
+
+L'assegnazione avviene nella transazione della prenotazione, dopo
+`riserva_posti`: la riga della mappa è letta con `SELECT ... FOR UPDATE`,
+quindi due prenotazioni dello stesso volo non assegnano lo stesso posto.
+"""
+import base64
+
+from flask import current_app
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from .models import db, Volo, MappaPosti
+
+# Dalla prima fila della cabina all'ultima
+CLASSI = ('first', 'business', 'economy')
+LETTERE_PREDEFINITE = {'first': 'AD', 'business': 'ACDF', 'economy': 'ABCDEF'}
+
+
+class PostoNonDisponibile(ValueError):
+    """Il posto richiesto non esiste nella mappa o è già assegnato."""
+
+
+def _impacchetta(bitset, capacità):
+    return bitset.to_bytes((capacità + 7) // 8, 'little')
+
+
+def _spacchetta(dati):
+    return int.from_bytes(dati, 'little')
+
+
+def _ripeti_per_fila(schema, larghezza, file):
+    """Ripete lo schema di bit di una fila su `file` file consecutive."""
+    if file <= 0:
+        return 0
+    return schema * (((1 << (larghezza * file)) - 1) // ((1 << larghezza) - 1))
+
+
+def blocco_adiacente(liberi, k, larghezza, file):
+    """
+    Primo di k posti liberi consecutivi nella stessa fila.
+
+    Args:
+        liberi (int): Bitset dei posti liberi
+        k (int): Posti richiesti, al più `larghezza`
+        larghezza (int): Posti per fila
+        file (int): Numero di file
+
+    Returns:
+        int: Indice del primo posto del blocco, o None se non c'è
+    """
+    inizi = liberi
+    for i in range(1, k):
+        inizi &= liberi >> i
+    inizi &= _ripeti_per_fila((1 << (larghezza - k + 1)) - 1, larghezza, file)
+    if not inizi:
+        return None
+    return (inizi & -inizi).bit_length() - 1
+
+
+def _leggi_segmenti(testo):
+    return [[int(x) for x in segmento.split(':')] for segmento in testo.split(',')]
+
+
+class Disposizione:
+    """Una `MappaPosti` decodificata: etichette dei posti e bitset in memoria."""
+
+    __slots__ = ('segmenti', 'lettere', 'capacità', 'occupati')
+
+    def __init__(self, prima_fila, lettere, capacità, occupati=0, segmenti=None):
+        self.lettere = lettere
+        self.capacità = capacità
+        self.occupati = occupati
+        # [prima fila, numero di file] per ogni segmento, in ordine di indice
+        self.segmenti = segmenti or [[prima_fila, -(-capacità // len(lettere))]]
+
+    @classmethod
+    def da_mappa(cls, mappa):
+        segmenti = _leggi_segmenti(mappa.segmenti) if mappa.segmenti else None
+        return cls(mappa.prima_fila, mappa.lettere, mappa.capacità, _spacchetta(mappa.occupati), segmenti)
+
+    @property
+    def prima_fila(self):
+        return self.segmenti[0][0]
+
+    @property
+    def larghezza(self):
+        return len(self.lettere)
+
+    @property
+    def file(self):
+        return sum(numero for _, numero in self.segmenti)
+
+    @property
+    def fine(self):
+        """Prima fila dopo l'ultima della classe."""
+        return max(inizio + numero for inizio, numero in self.segmenti)
+
+    @property
+    def testo_segmenti(self):
+        """Valore della colonna `segmenti`: None se la classe è un solo blocco di file."""
+        if len(self.segmenti) == 1:
+            return None
+        return ','.join(f'{inizio}:{numero}' for inizio, numero in self.segmenti)
+
+    @property
+    def liberi(self):
+        return ((1 << self.capacità) - 1) & ~self.occupati
+
+    def etichetta(self, indice):
+        fila, lettera = divmod(indice, self.larghezza)
+        for inizio, numero in self.segmenti:
+            if fila < numero:
+                return f'{inizio + fila}{self.lettere[lettera]}'
+            fila -= numero
+        raise IndexError(indice)
+
+    def indice(self, etichetta):
+        """Posizione del posto nel bitset, o None se l'etichetta non è della mappa."""
+        etichetta = (etichetta or '').strip().upper()
+        if len(etichetta) < 2 or not etichetta[:-1].isdigit() or etichetta[-1] not in self.lettere:
+            return None
+        fila, precedenti = int(etichetta[:-1]), 0
+        for inizio, numero in self.segmenti:
+            if inizio <= fila < inizio + numero:
+                indice = (precedenti + fila - inizio) * self.larghezza + self.lettere.index(etichetta[-1])
+                return indice if indice < self.capacità else None
+            precedenti += numero
+        return None
+
+    def allarga(self, posti, fine_cabina):
+        """
+        Aggiunge posti alla classe. Le file in più seguono l'ultimo segmento
+        se questo chiude la cabina, altrimenti formano un segmento nuovo a
+        partire da `fine_cabina`, la prima fila dopo tutte le classi del volo.
+        """
+        self.capacità += posti
+        nuove = -(-self.capacità // self.larghezza) - self.file
+        if nuove <= 0:
+            return
+        ultimo = self.segmenti[-1]
+        if ultimo[0] + ultimo[1] == fine_cabina:
+            ultimo[1] += nuove
+        else:
+            self.segmenti = [s for s in self.segmenti if s[1]] + [[fine_cabina, nuove]]
+
+    def scegli(self, n):
+        """
+        Indici di n posti liberi: adiacenti nella stessa fila se possibile,
+        altrimenti i primi liberi.
+        """
+        liberi = self.liberi
+        if n <= self.larghezza:
+            inizio = blocco_adiacente(liberi, n, self.larghezza, self.file)
+            if inizio is not None:
+                return list(range(inizio, inizio + n))
+        indici = []
+        for _ in range(n):
+            bit = liberi & -liberi
+            indici.append(bit.bit_length() - 1)
+            liberi ^= bit
+        return indici
+
+
+def _lettere(classe):
+    return current_app.config['MAPPA_POSTI_LETTERE'].get(classe) or LETTERE_PREDEFINITE[classe]
+
+
+def _contatori(volo_id):
+    """{classe: (liberi, venduti, bloccati)} dalla riga del volo, o None se non esiste."""
+    colonne = [
+        getattr(Volo, f'{contatore}_{classe}')
+        for classe in CLASSI for contatore in ('posti', 'venduti', 'bloccati')
+    ]
+    riga = db.session.execute(select(*colonne).where(Volo.id == volo_id)).first()
+    if riga is None:
+        return None
+    return {classe: tuple(riga[i * 3:i * 3 + 3]) for i, classe in enumerate(CLASSI)}
+
+
+def _crea_mappe(volo_id, classe_in_corso=None, in_corso=0):
+    """
+    Crea le mappe mancanti del volo; se un'altra transazione le crea per
+    prima, l'inserimento viene ignorato.
+
+    La capacità di ogni classe è la somma dei contatori di posti liberi,
+    venduti e bloccati del volo. I venduti comprendono già i posti della
+    prenotazione in corso, che non ha ancora biglietti: `in_corso` posti di
+    `classe_in_corso`.
+    """
+    contatori = _contatori(volo_id)
+    if contatori is None:
+        return
+
+    righe = []
+    fila = 1
+    for classe in CLASSI:
+        lettere = _lettere(classe)
+        liberi, venduti, bloccati = contatori[classe]
+        capacità = liberi + venduti + bloccati
+        assegnati = max(venduti - (in_corso if classe == classe_in_corso else 0), 0)
+        righe.append({
+            'volo_id': volo_id,
+            'classe': classe,
+            'prima_fila': fila,
+            'lettere': lettere,
+            'capacità': capacità,
+            # I biglietti emessi prima della mappa occupano i primi posti
+            'occupati': _impacchetta((1 << min(assegnati, capacità)) - 1, capacità),
+        })
+        fila += -(-capacità // len(lettere))
+
+    inserisci = postgresql.insert if db.session.get_bind().dialect.name == 'postgresql' else sqlite.insert
+    db.session.execute(inserisci(MappaPosti).values(righe).on_conflict_do_nothing())
+
+
+def _fine_cabina(volo_id):
+    """Prima fila dopo l'ultima di tutte le classi del volo."""
+    return max(
+        Disposizione.da_mappa(m).fine
+        for m in db.session.execute(select(MappaPosti).where(MappaPosti.volo_id == volo_id)).scalars()
+    )
+
+
+def _mappa_bloccata(volo_id, classe):
+    return db.session.execute(
+        select(MappaPosti)
+        .where(MappaPosti.volo_id == volo_id, MappaPosti.classe == classe)
+        .with_for_update()
+        .execution_options(populate_existing=True)
+    ).scalar_one_or_none()
+
+
+def assegna_posti(volo_id, classe, n, richiesti=None):
+    """
+    Assegna n posti di una classe di un volo, nella transazione corrente.
+
+    Va chiamata dopo aver riservato i posti (`riserva_posti` o un blocco):
+    la mappa non controlla la disponibilità, solo quali posti sono liberi.
+
+    Args:
+        volo_id (int): ID del volo
+        classe (str): 'economy', 'business' o 'first'
+        n (int): Numero di posti
+        richiesti (list): Etichette dei posti scelti dal passeggero; se None
+            si sceglie un blocco di posti adiacenti o i primi liberi
+
+    Returns:
+        list: Etichette dei posti assegnati ('12A', ...)
+
+    Raises:
+        PostoNonDisponibile: se un posto richiesto non esiste o è già assegnato
+    """
+    mappa = _mappa_bloccata(volo_id, classe)
+    if mappa is None:
+        _crea_mappe(volo_id, classe, n)
+        mappa = _mappa_bloccata(volo_id, classe)
+    disposizione = Disposizione.da_mappa(mappa)
+
+    if richiesti:
+        indici = [disposizione.indice(etichetta) for etichetta in richiesti]
+        liberi = disposizione.liberi
+        for etichetta, indice in zip(richiesti, indici):
+            if indice is None or not liberi >> indice & 1:
+                raise PostoNonDisponibile(f'Il posto {etichetta} non è disponibile')
+            liberi &= ~(1 << indice)
+        if len(set(indici)) != len(indici):
+            raise PostoNonDisponibile('Lo stesso posto è stato richiesto più volte')
+    else:
+        mancanti = n - disposizione.liberi.bit_count()
+        if mancanti > 0:
+            # Posti del volo aumentati dopo la creazione della mappa: la riga
+            # del volo è già bloccata da `riserva_posti`, quindi nessun'altra
+            # transazione allarga le mappe del volo nel frattempo
+            disposizione.allarga(mancanti, _fine_cabina(volo_id))
+        indici = disposizione.scegli(n)
+
+    for indice in indici:
+        disposizione.occupati |= 1 << indice
+    mappa.prima_fila = disposizione.prima_fila
+    mappa.segmenti = disposizione.testo_segmenti
+    mappa.capacità = disposizione.capacità
+    mappa.occupati = _impacchetta(disposizione.occupati, disposizione.capacità)
+    return [disposizione.etichetta(indice) for indice in indici]
+
+
+def libera_posti(volo_id, classe, etichette):
+    """Rende di nuovo liberi dei posti assegnati (cancellazione di biglietti)."""
+    mappa = _mappa_bloccata(volo_id, classe)
+    if mappa is None:
+        return
+    disposizione = Disposizione.da_mappa(mappa)
+    for etichetta in etichette:
+        indice = disposizione.indice(etichetta)
+        if indice is not None:
+            disposizione.occupati &= ~(1 << indice)
+    mappa.occupati = _impacchetta(disposizione.occupati, disposizione.capacità)
+
+
+def mappa_volo(volo_id):
+    """
+    Mappa dei posti di un volo per la pagina di prenotazione, senza leggere i biglietti.
+
+    Returns:
+        dict: Per classe: prima fila, segmenti di file ([prima fila, file]),
+            lettere, file, posti, posti liberi e il bitset dei posti assegnati
+            in base64 (little-endian, bit i = posto i contando per fila
+            attraverso i segmenti); None se il volo non esiste
+    """
+    mappe = {
+        m.classe: Disposizione.da_mappa(m)
+        for m in db.session.execute(select(MappaPosti).where(MappaPosti.volo_id == volo_id)).scalars()
+    }
+    if len(mappe) < len(CLASSI):
+        # Nessuna prenotazione con mappa ancora: disposizione calcolata al volo,
+        # come la creerebbe la prima assegnazione
+        contatori = _contatori(volo_id)
+        if contatori is None:
+            return None
+        fila = 1
+        for classe in CLASSI:
+            liberi, venduti, bloccati = contatori[classe]
+            disposizione = Disposizione(fila, _lettere(classe), liberi + venduti + bloccati, (1 << venduti) - 1)
+            mappe.setdefault(classe, disposizione)
+            fila = disposizione.fine
+
+    return {
+        classe: {
+            'prima_fila': d.prima_fila,
+            'segmenti': d.segmenti,
+            'lettere': d.lettere,
+            'file': d.file,
+            'posti': d.capacità,
+            'liberi': d.liberi.bit_count(),
+            'occupati': base64.b64encode(_impacchetta(d.occupati, d.capacità)).decode('ascii'),
+        }
+        for classe, d in mappe.items()
+    }
+
+
+def init_app(app):
+    """Lettere delle file per classe."""
+    app.config.setdefault('MAPPA_POSTI_LETTERE', dict(LETTERE_PREDEFINITE))
@@ -0,0 +1,63 @@
+// Completamento dei campi aeroporto tramite /api/v1/airports/suggest.
+//
+// <input data-suggerimenti="URL"> riceve un <datalist> con i suggerimenti
+// (valore: codice IATA). Con data-campo-id="ID" il codice scelto viene
+// tradotto nell'id dell'aeroporto e scritto nel campo nascosto ID.
+document.addEventListener('DOMContentLoaded', function() {
+    document.querySelectorAll('input[data-suggerimenti]').forEach(function(campo) {
+        const elenco = document.createElement('datalist');
+        elenco.id = campo.id + '_suggerimenti';
+        campo.setAttribute('list', elenco.id);
+        campo.setAttribute('autocomplete', 'off');
+        campo.after(elenco);
+
+        const campoId = campo.dataset.campoId ? document.getElementById(campo.dataset.campoId) : null;
+        const perCodice = {};
+        let attesa = null;
+        let controllo = null;
+
+        function scegli() {
+            if (!campoId) {
+                return;
+            }
+            const aeroporto = perCodice[campo.value.trim().toUpperCase()];
+            campoId.value = aeroporto ? aeroporto.id : '';
+            campo.setCustomValidity(aeroporto ? '' : 'Seleziona un aeroporto dall\'elenco');
+        }
+
+        campo.addEventListener('input', function() {
+            scegli();
+            clearTimeout(attesa);
+            const testo = campo.value.trim();
+            if (!testo) {
+                elenco.replaceChildren();
+                return;
+            }
+            attesa = setTimeout(function() {
+                if (controllo) {
+                    controllo.abort();
+                }
+                controllo = new AbortController();
+                fetch(campo.dataset.suggerimenti + '?q=' + encodeURIComponent(testo), {signal: controllo.signal})
+                    .then(function(risposta) { return risposta.json(); })
+                    .then(function(aeroporti) {
+                        elenco.replaceChildren(...aeroporti.map(function(aeroporto) {
+                            perCodice[aeroporto.codice_iata.toUpperCase()] = aeroporto;
+                            const opzione = document.createElement('option');
+                            opzione.value = aeroporto.codice_iata;
+                            opzione.label = aeroporto.città + ' - ' + aeroporto.nome + ' (' + aeroporto.codice_iata + ')';
+                            return opzione;
+                        }));
+                        scegli();
+                    })
+                    .catch(function() {});
+            }, 150);
+        });
+        campo.addEventListener('change', scegli);
+
+        // Valore iniziale (form di modifica): il codice è già valido
+        if (campoId && campo.value) {
+            perCodice[campo.value.trim().toUpperCase()] = {id: campoId.value};
+        }
+    });
+});
@@ -35,6 +35,43 @@ class Config:
     UPLOAD_FOLDER = os.path.join(basedir, 'app/static/uploads')
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
     
+    # Configurazione Ricerca Voli
+    RIFERIMENTI_TTL = 300  # secondi, per vedere le modifiche fatte da altri processi
+    RICERCA_USA_GRAFO = True  # False per usare solo la query SQL con uno scalo
+    RICERCA_GRAFO_TTL = 300  # secondi di validità del grafo di un giorno
+    RICERCA_MAX_SCALI = 2
+    RICERCA_TEMPO_MIN_SCALO = timedelta(hours=2)
+    RICERCA_TEMPO_MAX_SCALO = timedelta(hours=24)
+    RICERCA_MAX_ITINERARI = 1000  # itinerari con scalo al più per ricerca sul grafo
+    RICERCA_CACHE_DIMENSIONE = 1024  # numero massimo di ricerche in cache
+    RICERCA_CACHE_TTL = 60  # secondi
+    RICERCA_PARALLELA = True  # voli diretti e con scalo su connessioni separate
+    RICERCA_SCADENZA = 2.0  # secondi, oltre si restituiscono solo i voli diretti
+    RICERCA_WORKER = 4
+    RICERCA_USA_COINCIDENZE = True  # ricerca con scalo SQL sulla tabella coincidenza
+    RICERCA_BATCH_MASSIMO = 50  # ricerche per richiesta a /flights/search/batch
+    FILTRO_TRATTE = True  # scarta senza query le ricerche su tratte e giorni senza voli
+    FILTRO_TRATTE_GIORNI = 365
+    FILTRO_TRATTE_TTL = 600  # secondi tra due ricostruzioni complete
+    RICERCA_PESI = {'prezzo': 0.5, 'durata': 0.35, 'scali': 0.15}  # punteggio di /flights/search/ranked
+
+    # Configurazione Prenotazioni
+    BLOCCO_POSTI_DURATA = 600  # secondi per cui la pagina di prenotazione tiene i posti
+    BLOCCO_POSTI_PULIZIA = 60  # secondi tra due rilasci dei blocchi scaduti
+    MAPPA_POSTI_LETTERE = {'first': 'AD', 'business': 'ACDF', 'economy': 'ABCDEF'}  # posti di una fila per classe
+    IDEMPOTENZA_DURATA = 86400  # secondi per cui una Idempotency-Key restituisce la stessa risposta
+    IDEMPOTENZA_ATTESA = 10  # secondi di attesa di una copia mentre l'originale è in corso
+    # IDEMPOTENZA_IN_CORSO: secondi dopo cui la chiave di una richiesta mai conclusa si può riusare;
+    # di default 2 * PRENOTAZIONI_LOTTO_TIMEOUT + IDEMPOTENZA_ATTESA (app/idempotency.py)
+    IDEMPOTENZA_PULIZIA = 300  # secondi tra due cancellazioni delle chiavi scadute
+    PRENOTAZIONI_COMMIT_DI_GRUPPO = False  # True per scrivere le prenotazioni a lotti (app/booking_writer.py)
+    PRENOTAZIONI_LOTTO_MASSIMO = 100  # prenotazioni per commit
+    PRENOTAZIONI_LOTTO_ATTESA = 0.005  # secondi di attesa di altre prenotazioni dopo la prima del lotto
+    PRENOTAZIONI_LOTTO_TIMEOUT = 30  # secondi in coda prima di rinunciare
+    DISPONIBILITA_CACHE_DIMENSIONE = 10000  # voli in cache per /availability
+    DISPONIBILITA_CACHE_TTL = 5  # secondi
+    DISPONIBILITA_MASSIMO_VOLI = 300  # voli per richiesta a /availability
+    
     # Configurazione Sessioni
     PERMANENT_SESSION_LIFETIME = 3600  # 1 ora
     
@@ -49,6 +86,10 @@ class DevelopmentConfig(Config):
     SESSION_COOKIE_SECURE = False
     REMEMBER_COOKIE_SECURE = False
 
+class TestingConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL') or 'sqlite://'
+
 class ProductionConfig(Config):
     DEBUG = False
     SESSION_COOKIE_SECURE = True
@@ -46,12 +46,23 @@ CREATE TABLE volo (
     posti_economy INTEGER NOT NULL,
     posti_business INTEGER NOT NULL,
     posti_first INTEGER NOT NULL,
+    -- Biglietti emessi e posti bloccati per classe (app/booking.py)
+    venduti_economy INTEGER NOT NULL DEFAULT 0,
+    venduti_business INTEGER NOT NULL DEFAULT 0,
+    venduti_first INTEGER NOT NULL DEFAULT 0,
+    bloccati_economy INTEGER NOT NULL DEFAULT 0,
+    bloccati_business INTEGER NOT NULL DEFAULT 0,
+    bloccati_first INTEGER NOT NULL DEFAULT 0,
     prezzo_economy DECIMAL(10,2) NOT NULL,
     prezzo_business DECIMAL(10,2) NOT NULL,
     prezzo_first DECIMAL(10,2) NOT NULL,
+    -- Lock ottimistico delle modifiche al volo (app/booking.py)
+    versione INTEGER NOT NULL DEFAULT 1,
     CONSTRAINT check_date CHECK (data_arrivo > data_partenza),
     CONSTRAINT check_posti CHECK (
         posti_totali = posti_economy + posti_business + posti_first
+            + venduti_economy + venduti_business + venduti_first
+            + bloccati_economy + bloccati_business + bloccati_first
         AND posti_economy >= 0
         AND posti_business >= 0
         AND posti_first >= 0
@@ -91,69 +102,8 @@ CREATE INDEX idx_biglietto_volo_classe ON biglietto(flight_id, classe);
 CREATE INDEX idx_prenotazione_user ON prenotazione(user_id);
 CREATE INDEX idx_biglietto_booking ON biglietto(booking_id);
 
--- Funzioni e trigger per la gestione automatica
-CREATE OR REPLACE FUNCTION verifica_disponibilita_posti()
-RETURNS TRIGGER AS $$
-BEGIN
-    -- Verifica se ci sono posti disponibili per la classe selezionata
-    IF NEW.classe = 'economy' AND 
-       (SELECT posti_economy FROM volo WHERE id = NEW.flight_id) <= 0 THEN
-        RAISE EXCEPTION 'Nessun posto economy disponibile per questo volo';
-    ELSIF NEW.classe = 'business' AND 
-          (SELECT posti_business FROM volo WHERE id = NEW.flight_id) <= 0 THEN
-        RAISE EXCEPTION 'Nessun posto business disponibile per questo volo';
-    ELSIF NEW.classe = 'first' AND 
-          (SELECT posti_first FROM volo WHERE id = NEW.flight_id) <= 0 THEN
-        RAISE EXCEPTION 'Nessun posto first class disponibile per questo volo';
-    END IF;
-    RETURN NEW;
-END;
-$$ LANGUAGE plpgsql;
-
-CREATE TRIGGER trigger_verifica_posti
-    BEFORE INSERT ON biglietto
-    FOR EACH ROW
-    EXECUTE FUNCTION verifica_disponibilita_posti();
-
-CREATE OR REPLACE FUNCTION aggiorna_posti_disponibili()
-RETURNS TRIGGER AS $$
-BEGIN
-    -- Aggiorna i posti disponibili quando viene inserito un nuovo biglietto
-    IF NEW.classe = 'economy' THEN
-        UPDATE volo SET posti_economy = posti_economy - 1 WHERE id = NEW.flight_id;
-    ELSIF NEW.classe = 'business' THEN
-        UPDATE volo SET posti_business = posti_business - 1 WHERE id = NEW.flight_id;
-    ELSIF NEW.classe = 'first' THEN
-        UPDATE volo SET posti_first = posti_first - 1 WHERE id = NEW.flight_id;
-    END IF;
-    RETURN NEW;
-END;
-$$ LANGUAGE plpgsql;
-
-CREATE TRIGGER trigger_aggiorna_posti
-    AFTER INSERT ON biglietto
-    FOR EACH ROW
-    EXECUTE FUNCTION aggiorna_posti_disponibili();
-
-CREATE OR REPLACE FUNCTION ripristina_posti_disponibili()
-RETURNS TRIGGER AS $$
-BEGIN
-    -- Ripristina i posti disponibili quando viene cancellato un biglietto
-    IF OLD.classe = 'economy' THEN
-        UPDATE volo SET posti_economy = posti_economy + 1 WHERE id = OLD.flight_id;
-    ELSIF OLD.classe = 'business' THEN
-        UPDATE volo SET posti_business = posti_business + 1 WHERE id = OLD.flight_id;
-    ELSIF OLD.classe = 'first' THEN
-        UPDATE volo SET posti_first = posti_first + 1 WHERE id = OLD.flight_id;
-    END IF;
-    RETURN OLD;
-END;
-$$ LANGUAGE plpgsql;
-
-CREATE TRIGGER trigger_ripristina_posti
-    AFTER DELETE ON biglietto
-    FOR EACH ROW
-    EXECUTE FUNCTION ripristina_posti_disponibili();
+-- I posti disponibili non sono gestiti da trigger: ogni prenotazione li
+-- decrementa con un solo UPDATE condizionale (app/booking.py)
 
 -- Viste materializzate per le statistiche
 CREATE MATERIALIZED VIEW statistiche_compagnie AS
@@ -186,12 +136,10 @@ CREATE MATERIALIZED VIEW occupazione_classi AS
 SELECT 
     v.id AS volo_id,
     v.numero_volo,
-    v.posti_economy - COUNT(CASE WHEN b.classe = 'economy' THEN 1 END) AS posti_economy_disponibili,
-    v.posti_business - COUNT(CASE WHEN b.classe = 'business' THEN 1 END) AS posti_business_disponibili,
-    v.posti_first - COUNT(CASE WHEN b.classe = 'first' THEN 1 END) AS posti_first_disponibili
-FROM volo v
-LEFT JOIN biglietto b ON v.id = b.flight_id
-GROUP BY v.id, v.numero_volo, v.posti_economy, v.posti_business, v.posti_first;
+    v.posti_economy AS posti_economy_disponibili,
+    v.posti_business AS posti_business_disponibili,
+    v.posti_first AS posti_first_disponibili
+FROM volo v;
 
 -- Funzione per aggiornare le viste materializzate
 CREATE OR REPLACE FUNCTION aggiorna_statistiche()
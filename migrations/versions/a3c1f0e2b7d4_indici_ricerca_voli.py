@@ -0,0 +1,40 @@
+"""indici per la ricerca voli
+
+Revision ID: a3c1f0e2b7d4
+Revises: 98e7955c59ab, update_password_length
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3c1f0e2b7d4'
+down_revision = ('98e7955c59ab', 'update_password_length')
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Ricerca per tratta e giorno: con le colonne incluse PostgreSQL può
+    # rispondere a cerca_voli_diretti senza leggere la tabella
+    op.create_index(
+        'idx_volo_tratta_data',
+        'volo',
+        ['aeroporto_partenza_id', 'aeroporto_arrivo_id', 'data_partenza'],
+        postgresql_include=[
+            'compagnia_id', 'numero_volo', 'data_arrivo',
+            'posti_economy', 'posti_business', 'posti_first',
+            'prezzo_economy', 'prezzo_business', 'prezzo_first'
+        ]
+    )
+    # Voli di una compagnia in un periodo
+    op.create_index('idx_volo_compagnia_data', 'volo', ['compagnia_id', 'data_partenza'])
+    # Voli di un giorno (ricerca con scalo)
+    op.create_index('idx_volo_data_partenza', 'volo', ['data_partenza'])
+
+
+def downgrade():
+    op.drop_index('idx_volo_data_partenza', table_name='volo')
+    op.drop_index('idx_volo_compagnia_data', table_name='volo')
+    op.drop_index('idx_volo_tratta_data', table_name='volo')
@@ -0,0 +1,45 @@
+"""posti totali con i contatori dei venduti e dei bloccati
+
+Revision ID: a4e6c9b2d7f3
+Revises: f8b3d1a6c2e5
+Create Date: 2026-10-19 09:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4e6c9b2d7f3'
+down_revision = 'f8b3d1a6c2e5'
+branch_labels = None
+depends_on = None
+
+# Da c3f8a1d7e5b2 `posti_*` sono i posti liberi: il trigger
+# trigger_calcola_posti_totali (app/database/triggers.sql) deve sommare anche
+# venduti e bloccati, altrimenti ogni prenotazione viola check_posti
+FUNZIONE = """
+CREATE OR REPLACE FUNCTION calcola_posti_totali()
+RETURNS TRIGGER AS $$
+BEGIN
+    NEW.posti_totali := {somma};
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql
+"""
+LIBERI = 'NEW.posti_economy + NEW.posti_business + NEW.posti_first'
+CONTATORI = (
+    'NEW.venduti_economy + NEW.venduti_business + NEW.venduti_first'
+    ' + NEW.bloccati_economy + NEW.bloccati_business + NEW.bloccati_first'
+)
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute(FUNZIONE.format(somma=f'{LIBERI} + {CONTATORI}'))
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute(FUNZIONE.format(somma=LIBERI))
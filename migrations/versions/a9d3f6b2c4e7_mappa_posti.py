@@ -0,0 +1,35 @@
+"""mappa dei posti per volo e classe
+
+Revision ID: a9d3f6b2c4e7
+Revises: f2a7c5e1b8d3
+Create Date: 2026-10-18 17:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a9d3f6b2c4e7'
+down_revision = 'f2a7c5e1b8d3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Le mappe dei voli esistenti si creano alla prima prenotazione
+    # (app/seat_map.py), con i biglietti già emessi nei primi posti
+    op.create_table('mappa_posti',
+    sa.Column('volo_id', sa.Integer(), nullable=False),
+    sa.Column('classe', sa.String(length=20), nullable=False),
+    sa.Column('prima_fila', sa.Integer(), nullable=False),
+    sa.Column('lettere', sa.String(length=10), nullable=False),
+    sa.Column('capacità', sa.Integer(), nullable=False),
+    sa.Column('occupati', sa.LargeBinary(), nullable=False),
+    sa.ForeignKeyConstraint(['volo_id'], ['volo.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('volo_id', 'classe')
+    )
+
+
+def downgrade():
+    op.drop_table('mappa_posti')
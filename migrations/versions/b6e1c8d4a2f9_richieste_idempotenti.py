@@ -0,0 +1,38 @@
+"""chiavi di idempotenza delle richieste API
+
+Revision ID: b6e1c8d4a2f9
+Revises: a9d3f6b2c4e7
+Create Date: 2026-10-18 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6e1c8d4a2f9'
+down_revision = 'a9d3f6b2c4e7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('richiesta_idempotente',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('chiave', sa.String(length=255), nullable=False),
+    sa.Column('impronta', sa.String(length=64), nullable=False),
+    sa.Column('stato_http', sa.Integer(), nullable=True),
+    sa.Column('risposta', sa.Text(), nullable=True),
+    sa.Column('tipo_risposta', sa.String(length=100), nullable=True),
+    sa.Column('scadenza', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['utente.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('user_id', 'chiave', name='uq_richiesta_idempotente_utente_chiave')
+    )
+    op.create_index('idx_richiesta_idempotente_scadenza', 'richiesta_idempotente', ['scadenza'])
+
+
+def downgrade():
+    op.drop_index('idx_richiesta_idempotente_scadenza', table_name='richiesta_idempotente')
+    op.drop_table('richiesta_idempotente')
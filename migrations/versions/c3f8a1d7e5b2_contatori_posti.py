@@ -0,0 +1,44 @@
+"""contatori dei posti venduti e bloccati per classe
+
+Revision ID: c3f8a1d7e5b2
+Revises: b6e1c8d4a2f9
+Create Date: 2026-10-18 19:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3f8a1d7e5b2'
+down_revision = 'b6e1c8d4a2f9'
+branch_labels = None
+depends_on = None
+
+CLASSI = ('economy', 'business', 'first')
+
+
+def upgrade():
+    with op.batch_alter_table('volo') as batch_op:
+        for classe in CLASSI:
+            batch_op.add_column(sa.Column(f'venduti_{classe}', sa.Integer(), nullable=False, server_default='0'))
+            batch_op.add_column(sa.Column(f'bloccati_{classe}', sa.Integer(), nullable=False, server_default='0'))
+    # Contatori iniziali dai biglietti emessi e dai blocchi attivi
+    for classe in CLASSI:
+        op.execute(
+            f'UPDATE volo SET venduti_{classe} = ('
+            f'SELECT COUNT(*) FROM biglietto b '
+            f"WHERE b.flight_id = volo.id AND b.classe = '{classe}')"
+        )
+        op.execute(
+            f'UPDATE volo SET bloccati_{classe} = COALESCE(('
+            f'SELECT SUM(b.posti) FROM blocco_posti b '
+            f"WHERE b.flight_id = volo.id AND b.classe = '{classe}'), 0)"
+        )
+
+
+def downgrade():
+    with op.batch_alter_table('volo') as batch_op:
+        for classe in CLASSI:
+            batch_op.drop_column(f'bloccati_{classe}')
+            batch_op.drop_column(f'venduti_{classe}')
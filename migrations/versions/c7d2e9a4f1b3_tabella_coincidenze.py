@@ -0,0 +1,52 @@
+"""tabella delle coincidenze
+
+Revision ID: c7d2e9a4f1b3
+Revises: a3c1f0e2b7d4
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7d2e9a4f1b3'
+down_revision = 'a3c1f0e2b7d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('coincidenza',
+    sa.Column('volo1_id', sa.Integer(), nullable=False),
+    sa.Column('volo2_id', sa.Integer(), nullable=False),
+    sa.Column('aeroporto_partenza_id', sa.Integer(), nullable=False),
+    sa.Column('aeroporto_arrivo_id', sa.Integer(), nullable=False),
+    sa.Column('data_partenza', sa.DateTime(), nullable=False),
+    sa.Column('data_arrivo', sa.DateTime(), nullable=False),
+    sa.Column('tempo_scalo', sa.Integer(), nullable=False),
+    sa.Column('prezzo_economy', sa.Float(), nullable=False),
+    sa.Column('prezzo_business', sa.Float(), nullable=False),
+    sa.Column('prezzo_first', sa.Float(), nullable=False),
+    sa.Column('posti_economy', sa.Integer(), nullable=False),
+    sa.Column('posti_business', sa.Integer(), nullable=False),
+    sa.Column('posti_first', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['volo1_id'], ['volo.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['volo2_id'], ['volo.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['aeroporto_partenza_id'], ['aeroporto.id'], ),
+    sa.ForeignKeyConstraint(['aeroporto_arrivo_id'], ['aeroporto.id'], ),
+    sa.PrimaryKeyConstraint('volo1_id', 'volo2_id')
+    )
+    op.create_index('idx_coincidenza_tratta_data', 'coincidenza',
+                    ['aeroporto_partenza_id', 'aeroporto_arrivo_id', 'data_partenza'])
+    op.create_index('idx_coincidenza_volo2', 'coincidenza', ['volo2_id'])
+    # Voli in arrivo in un aeroporto in un periodo (coincidenze di un volo)
+    op.create_index('idx_volo_arrivo_data', 'volo', ['aeroporto_arrivo_id', 'data_arrivo'])
+    # La tabella si popola con: flask coincidenze ricostruisci
+
+
+def downgrade():
+    op.drop_index('idx_volo_arrivo_data', table_name='volo')
+    op.drop_index('idx_coincidenza_volo2', table_name='coincidenza')
+    op.drop_index('idx_coincidenza_tratta_data', table_name='coincidenza')
+    op.drop_table('coincidenza')
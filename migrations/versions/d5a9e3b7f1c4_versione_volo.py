@@ -0,0 +1,26 @@
+"""versione del volo per il lock ottimistico
+
+Revision ID: d5a9e3b7f1c4
+Revises: c3f8a1d7e5b2
+Create Date: 2026-10-18 21:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5a9e3b7f1c4'
+down_revision = 'c3f8a1d7e5b2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('volo') as batch_op:
+        batch_op.add_column(sa.Column('versione', sa.Integer(), nullable=False, server_default='1'))
+
+
+def downgrade():
+    with op.batch_alter_table('volo') as batch_op:
+        batch_op.drop_column('versione')
@@ -0,0 +1,56 @@
+"""posti disponibili senza trigger per biglietto
+
+Revision ID: e4b8a2c6d9f1
+Revises: c7d2e9a4f1b3
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4b8a2c6d9f1'
+down_revision = 'c7d2e9a4f1b3'
+branch_labels = None
+depends_on = None
+
+# Trigger su biglietto che verificavano e aggiornavano i posti del volo
+# (app/database/triggers.sql e database_setup.sql): ora lo fa la prenotazione
+# con un solo UPDATE condizionale (app/booking.py)
+TRIGGER = (
+    ('trigger_aggiorna_posti_disponibili', 'aggiorna_posti_disponibili'),
+    ('trigger_verifica_posti', 'verifica_disponibilita_posti'),
+    ('trigger_aggiorna_posti', 'aggiorna_posti_disponibili'),
+    ('trigger_ripristina_posti', 'ripristina_posti_disponibili'),
+)
+CLASSI = ('economy', 'business', 'first')
+
+
+def _venduti(classe):
+    return f"(SELECT COUNT(*) FROM biglietto WHERE biglietto.flight_id = volo.id AND biglietto.classe = '{classe}')"
+
+
+def upgrade():
+    dialetto = op.get_bind().dialect.name
+    if dialetto == 'sqlite':
+        # Senza trigger `posti_*` era la capienza della classe: diventa i
+        # posti liberi togliendo i biglietti venduti
+        for classe in CLASSI:
+            op.execute(f'UPDATE volo SET posti_{classe} = MAX(posti_{classe} - {_venduti(classe)}, 0)')
+    if dialetto != 'postgresql':
+        return
+    for trigger, _ in TRIGGER:
+        op.execute(f'DROP TRIGGER IF EXISTS {trigger} ON biglietto')
+    for funzione in sorted({funzione for _, funzione in TRIGGER}):
+        op.execute(f'DROP FUNCTION IF EXISTS {funzione}()')
+
+
+def downgrade():
+    dialetto = op.get_bind().dialect.name
+    if dialetto == 'sqlite':
+        for classe in CLASSI:
+            op.execute(f'UPDATE volo SET posti_{classe} = posti_{classe} + {_venduti(classe)}')
+    if dialetto != 'postgresql':
+        return
+    # I trigger si ricreano con app/database/apply_triggers.py da una versione
+    # precedente di triggers.sql
@@ -0,0 +1,27 @@
+"""segmenti di file nella mappa dei posti
+
+Revision ID: e7c2b9f4a1d6
+Revises: d5a9e3b7f1c4
+Create Date: 2026-10-18 22:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7c2b9f4a1d6'
+down_revision = 'd5a9e3b7f1c4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Le mappe esistenti sono un solo blocco di file da prima_fila: NULL
+    with op.batch_alter_table('mappa_posti') as batch_op:
+        batch_op.add_column(sa.Column('segmenti', sa.String(length=200), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('mappa_posti') as batch_op:
+        batch_op.drop_column('segmenti')
@@ -0,0 +1,45 @@
+"""blocchi temporanei dei posti
+
+Revision ID: f2a7c5e1b8d3
+Revises: e4b8a2c6d9f1
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2a7c5e1b8d3'
+down_revision = 'e4b8a2c6d9f1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('blocco_posti',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('flight_id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('classe', sa.String(length=20), nullable=False),
+    sa.Column('posti', sa.Integer(), nullable=False),
+    sa.Column('scadenza', sa.DateTime(), nullable=False),
+    sa.Column('versione', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['flight_id'], ['volo.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['utente.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('flight_id', 'user_id', name='uq_blocco_posti_volo_utente')
+    )
+    op.create_index('idx_blocco_posti_scadenza', 'blocco_posti', ['scadenza'])
+
+
+def downgrade():
+    # I posti bloccati tornano liberi
+    for classe in ('economy', 'business', 'first'):
+        op.execute(
+            f'UPDATE volo SET posti_{classe} = posti_{classe} + COALESCE(('
+            f'SELECT SUM(b.posti) FROM blocco_posti b '
+            f"WHERE b.flight_id = volo.id AND b.classe = '{classe}'), 0)"
+        )
+    op.drop_index('idx_blocco_posti_scadenza', table_name='blocco_posti')
+    op.drop_table('blocco_posti')
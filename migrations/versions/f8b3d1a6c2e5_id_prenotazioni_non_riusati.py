@@ -0,0 +1,32 @@
+"""id delle prenotazioni non riusati su SQLite
+
+Revision ID: f8b3d1a6c2e5
+Revises: e7c2b9f4a1d6
+Create Date: 2026-10-18 23:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'f8b3d1a6c2e5'
+down_revision = 'e7c2b9f4a1d6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Senza AUTOINCREMENT SQLite riassegna l'id più alto dopo una
+    # cancellazione; su PostgreSQL la sequenza non torna indietro
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    with op.batch_alter_table('prenotazione', recreate='always',
+                              table_kwargs={'sqlite_autoincrement': True}):
+        pass
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    with op.batch_alter_table('prenotazione', recreate='always'):
+        pass
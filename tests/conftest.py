@@ -0,0 +1,172 @@
+"""
+Fixture comuni dei test: applicazione con database, dati di base e voli.
+
+`app` crea l'applicazione con `TestingConfig` più le impostazioni della
+fixture `configurazione`, che i moduli di test ridefiniscono, e tiene attivo
+il suo contesto per tutto il test. Il database è SQLite in memoria, oppure un
+file temporaneo se il modulo ridefinisce `database_su_file` (test con più
+connessioni o thread: in memoria ogni connessione avrebbe il suo database);
+con TEST_DATABASE_URL i test su file usano quel database, per esempio
+PostgreSQL. Alla fine del test le tabelle vengono eliminate.
+
+`crea_app` crea altre applicazioni nello stesso test (per confrontare due
+configurazioni), `dati` costruisce aeroporti, compagnia, passeggeri e voli
+nella sessione dell'applicazione attiva.
+"""
+import os
+from datetime import timedelta
+
+import pytest
+
+from app import create_app, db
+from app.models import Utente, CompagniaAerea, Aeroporto, Volo
+from config import TestingConfig
+
+CLASSI = ('economy', 'business', 'first')
+
+
+@pytest.fixture
+def configurazione():
+    """Impostazioni aggiunte a `TestingConfig` per l'applicazione `app`."""
+    return {}
+
+
+@pytest.fixture
+def database_su_file():
+    return False
+
+
+@pytest.fixture
+def crea_app(tmp_path):
+    """
+    Funzione `crea_app(su_file=False, **impostazioni)` che restituisce una
+    nuova applicazione con le tabelle create (e vuote).
+    """
+    create = []
+
+    def crea(su_file=False, **impostazioni):
+        attributi = dict(impostazioni)
+        if su_file:
+            url = os.environ.get('TEST_DATABASE_URL')
+            attributi.setdefault('SQLALCHEMY_DATABASE_URI', url or f'sqlite:///{tmp_path / f"test{len(create)}.db"}')
+            if not url:
+                # Su SQLite le scritture concorrenti aspettano il lock invece di fallire
+                attributi.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {'connect_args': {'timeout': 30}})
+        app = create_app(type('Config', (TestingConfig,), attributi))
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+        create.append(app)
+        return app
+
+    yield crea
+    for app in create:
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+            db.engine.dispose()
+
+
+@pytest.fixture
+def app(crea_app, configurazione, database_su_file):
+    app = crea_app(su_file=database_su_file, **configurazione)
+    with app.app_context():
+        yield app
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def intestazioni():
+    """Funzione `intestazioni(client, email, **altre)`: header con il token JWT dell'utente."""
+    def accedi(client, email='passeggero@test.com', **altre):
+        risposta = client.post('/api/v1/auth/login', json={'email': email, 'password': 'password'})
+        return {'Authorization': f"Bearer {risposta.json['access_token']}", **altre}
+    return accedi
+
+
+class Dati:
+    """Costruttori dei dati di test, nella sessione dell'applicazione attiva (password 'password')."""
+
+    def aeroporti(self, *aeroporti):
+        """
+        Args:
+            aeroporti: Tuple (codice, città) o (codice, città, nome, paese)
+
+        Returns:
+            dict: codice IATA -> id
+        """
+        righe = []
+        for codice, città, *altro in aeroporti:
+            nome, paese = altro or (codice, 'Test')
+            righe.append(Aeroporto(codice_iata=codice, nome=nome, città=città, paese=paese))
+        db.session.add_all(righe)
+        db.session.flush()
+        return {aeroporto.codice_iata: aeroporto.id for aeroporto in righe}
+
+    def compagnia(self, codice='TA', nome='Test Airlines', email='compagnia@test.com'):
+        """Compagnia aerea con il suo utente; restituisce l'id della compagnia."""
+        utente = Utente(email=email, nome='Test', cognome='Airline', is_airline=True)
+        utente.set_password('password')
+        db.session.add(utente)
+        db.session.flush()
+        compagnia = CompagniaAerea(utente_id=utente.id, nome_compagnia=nome, codice_iata=codice)
+        db.session.add(compagnia)
+        db.session.flush()
+        return compagnia.id
+
+    def passeggero(self, email='passeggero@test.com'):
+        utente = Utente(email=email, nome='Test', cognome='Passeggero', is_airline=False)
+        utente.set_password('password')
+        db.session.add(utente)
+        db.session.flush()
+        return utente.id
+
+    def passeggeri(self, n):
+        return [self.passeggero(f'passeggero{i}@test.com') for i in range(n)]
+
+    def volo(self, partenza, arrivo, data_partenza, durata=1, numero=None, posti=10, prezzo=100,
+             compagnia_id=None):
+        """
+        Volo tra due aeroporti (codici IATA); business e first costano 3 e 6 volte l'economy.
+
+        Args:
+            durata (float): Ore di volo
+            posti (int/dict): Posti economy, o posti per classe
+            compagnia_id (int): Default: la prima compagnia
+
+        Returns:
+            Volo: Il volo, già scritto con un flush
+        """
+        ids = dict(db.session.query(Aeroporto.codice_iata, Aeroporto.id)
+                   .filter(Aeroporto.codice_iata.in_((partenza, arrivo))))
+        if compagnia_id is None:
+            compagnia_id = db.session.query(db.func.min(CompagniaAerea.id)).scalar()
+        if not isinstance(posti, dict):
+            posti = {'economy': posti}
+        posti = {classe: posti.get(classe, 0) for classe in CLASSI}
+        volo = Volo(
+            numero_volo=numero or f'TA{db.session.query(Volo).count() + 1}',
+            compagnia_id=compagnia_id,
+            aeroporto_partenza_id=ids[partenza],
+            aeroporto_arrivo_id=ids[arrivo],
+            data_partenza=data_partenza,
+            data_arrivo=data_partenza + timedelta(hours=durata),
+            posti_totali=sum(posti.values()),
+            prezzo_economy=prezzo,
+            prezzo_business=prezzo * 3,
+            prezzo_first=prezzo * 6,
+            **{f'posti_{classe}': n for classe, n in posti.items()}
+        )
+        db.session.add(volo)
+        db.session.flush()
+        return volo
+
+
+@pytest.fixture
+def dati():
+    return Dati()
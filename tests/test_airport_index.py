@@ -0,0 +1,69 @@
+"""
+Verifica i suggerimenti degli aeroporti (app/airport_index.py).
+
+I prefissi si cercano su codice IATA, città, nome (anche da una parola
+interna) e paese, senza distinzione di maiuscole e accenti; a parità di
+prefisso il codice IATA precede la città e il nome. Un testo con un errore
+di battitura trova l'aeroporto con i trigrammi, e un aeroporto aggiunto
+dopo la costruzione dell'indice viene suggerito.
+"""
+import pytest
+
+from app import db
+from app.airport_index import suggerisci
+from app.models import Aeroporto
+
+
+@pytest.fixture(autouse=True)
+def aeroporti(app, dati):
+    dati.aeroporti(
+        ('FCO', 'Roma', 'Aeroporto di Roma Fiumicino', 'Italia'),
+        ('CIA', 'Roma', 'Aeroporto di Roma Ciampino', 'Italia'),
+        ('MXP', 'Milano', 'Aeroporto di Milano Malpensa', 'Italia'),
+        ('LIN', 'Milano', 'Aeroporto di Milano Linate', 'Italia'),
+        ('FRL', 'Forlì', 'Aeroporto di Forlì', 'Italia'),
+        ('CDG', 'Parigi', 'Aéroport Charles de Gaulle', 'Francia'),
+        ('MAD', 'Madrid', 'Aeropuerto Adolfo Suárez Madrid-Barajas', 'Spagna'),
+    )
+    db.session.commit()
+
+
+def codici(testo, limite=10):
+    return [a['codice_iata'] for a in suggerisci(testo, limite)]
+
+
+def test_prefissi():
+    assert codici('fco') == ['FCO']
+    assert sorted(codici('Roma')) == ['CIA', 'FCO']
+    assert codici('  MILANO  ') == codici('milano')
+    assert sorted(codici('milano')) == ['LIN', 'MXP']
+    # Parola interna del nome, accenti e maiuscole
+    assert codici('fiumi') == ['FCO']
+    assert codici('FORLI') == ['FRL']
+    assert codici('suarez') == ['MAD']
+    assert sorted(codici('fran')) == ['CDG']
+    # Il codice IATA viene prima della città con lo stesso prefisso
+    assert codici('ma')[:2] == ['MAD', 'MXP']
+    assert len(codici('aeroporto di', limite=3)) == 3
+    assert suggerisci('') == []
+    fiumicino = db.session.query(Aeroporto).filter_by(codice_iata='FCO').one()
+    assert suggerisci('FCO') == [{
+        'id': fiumicino.id, 'codice_iata': 'FCO', 'nome': 'Aeroporto di Roma Fiumicino',
+        'città': 'Roma', 'paese': 'Italia'
+    }]
+
+
+def test_errori_di_battitura_e_nuovi_aeroporti(client):
+    assert 'MXP' in codici('milno') and 'LIN' in codici('milno')
+    assert codici('fiumicno')[:1] == ['FCO']
+    assert codici('xyzxyz') == []
+
+    db.session.add(Aeroporto(codice_iata='BGY', nome='Aeroporto di Bergamo Orio al Serio',
+                             città='Bergamo', paese='Italia'))
+    db.session.commit()
+    assert codici('berg') == ['BGY']
+    assert codici('orio') == ['BGY']
+
+    risposta = client.get('/api/v1/airports/suggest?q=linate')
+    assert risposta.status_code == 200
+    assert [a['codice_iata'] for a in risposta.json] == ['LIN']
@@ -0,0 +1,84 @@
+"""
+Verifica l'endpoint di disponibilità di più voli (`/api/v1/availability`).
+
+GET e POST con gli stessi voli restituiscono lo stesso corpo e lo stesso
+ETag; con `If-None-Match` uguale rispondono 304 senza corpo. Dopo una
+prenotazione la cache del volo viene invalidata e l'ETag cambia; una
+disponibilità letta a metà di una transazione annullata non resta in cache.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import db
+from app.booking import prenota
+from app.models import Volo
+
+
+@pytest.fixture
+def configurazione():
+    return {'DISPONIBILITA_CACHE_TTL': 60}
+
+
+@pytest.fixture
+def passeggero_id(app, dati):
+    return dati.passeggero()
+
+
+@pytest.fixture
+def voli(app, dati):
+    dati.aeroporti(('FCO', 'Roma'), ('MXP', 'Milano'))
+    dati.compagnia()
+    partenza = datetime.now().replace(microsecond=0) + timedelta(days=7)
+    voli = [
+        dati.volo('FCO', 'MXP', partenza + timedelta(hours=i), posti={'economy': 10, 'business': 5}).id
+        for i in range(3)
+    ]
+    db.session.commit()
+    return voli
+
+
+def test_etag_e_304(client, passeggero_id, voli):
+    ids = voli + [9999]
+    get = client.get('/api/v1/availability?ids=' + ','.join(map(str, ids)))
+    assert get.status_code == 200
+    assert [v['volo_id'] for v in get.json['voli']] == voli
+    assert get.json['non_trovati'] == [9999]
+    assert get.json['voli'][0]['classi']['economy'] == {
+        'totali': 10, 'occupati': 0, 'bloccati': 0, 'disponibili': 10
+    }
+    etag = get.headers['ETag']
+
+    post = client.post('/api/v1/availability', json={'ids': ids})
+    assert post.status_code == 200
+    assert post.headers['ETag'] == etag
+    assert post.get_data() == get.get_data()
+
+    for risposta in (
+        client.get('/api/v1/availability', query_string={'ids': ids}, headers={'If-None-Match': etag}),
+        client.post('/api/v1/availability', json={'ids': ids}, headers={'If-None-Match': etag}),
+    ):
+        assert risposta.status_code == 304
+        assert risposta.get_data() == b''
+
+    # Una prenotazione cambia la disponibilità e quindi l'ETag
+    prenota(passeggero_id, voli[0], 'economy', 2)
+    dopo = client.post('/api/v1/availability', json={'ids': ids}, headers={'If-None-Match': etag})
+    assert dopo.status_code == 200
+    assert dopo.headers['ETag'] != etag
+    assert dopo.json['voli'][0]['classi']['economy']['disponibili'] == 8
+    assert dopo.json['voli'][0]['classi']['economy']['occupati'] == 2
+
+    assert client.get('/api/v1/availability').status_code == 400
+    assert client.post('/api/v1/availability', json={'ids': ['x']}).status_code == 400
+
+
+def test_rollback_non_resta_in_cache(client, voli):
+    prima = client.get(f'/api/v1/availability?ids={voli[0]}').json
+
+    db.session.get(Volo, voli[0]).posti_economy = 3
+    db.session.flush()
+    # Letta nella transazione, con i posti non ancora confermati
+    assert client.get(f'/api/v1/availability?ids={voli[0]}').json != prima
+    db.session.rollback()
+    assert client.get(f'/api/v1/availability?ids={voli[0]}').json == prima
@@ -0,0 +1,225 @@
+"""
+Verifica le ricerche multiple (`/api/v1/flights/search/batch`,
+`cerca_voli_diretti_multipla`, `cerca_itinerari_multipla` e `tabella_valori`).
+
+Le ricerche diventano una tabella derivata: `VALUES` su PostgreSQL, una
+`UNION ALL` di `SELECT` sugli altri database. Ogni ricerca riceve gli stessi
+risultati che avrebbe da sola, nello stesso ordine, con il proprio `limite`
+(`row_number()` per ricerca), anche quando più ricerche cercano la stessa
+tratta. Le ricerche con scalo si controllano con la query sulle coincidenze
+(senza grafo) e sul grafo, dove sono eseguite una alla volta ma con le
+stesse query al database di una ricerca sola. L'endpoint restituisce i
+risultati nell'ordine delle ricerche, con gli errori di validazione al loro
+posto.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import Integer, String, event, select
+from sqlalchemy.dialects import postgresql
+
+from app import db
+from app.queries import (
+    cerca_voli_diretti, cerca_voli_scalo, cerca_voli_diretti_multipla, tabella_valori
+)
+from app.route_graph import cerca_itinerari_multipla, motore
+
+GIORNO = (datetime.now() + timedelta(days=7)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+@pytest.fixture
+def usa_grafo():
+    return False
+
+
+@pytest.fixture
+def configurazione(usa_grafo):
+    return {'RICERCA_USA_GRAFO': usa_grafo, 'FILTRO_TRATTE': False}
+
+
+@pytest.fixture
+def database_su_file():
+    return True
+
+
+@pytest.fixture(autouse=True)
+def voli(app, dati):
+    dati.aeroporti(('FCO', 'Roma'), ('MXP', 'Milano'), ('CDG', 'Parigi'))
+    dati.compagnia()
+    dati.passeggero()
+    for numero, partenza, arrivo, ora, durata, prezzo, posti in (
+        ('TA1', 'FCO', 'CDG', 8, 2.5, 200, 10),
+        ('TA2', 'FCO', 'CDG', 12, 2, 150, 10),
+        ('TA3', 'FCO', 'CDG', 18, 3, 300, 2),
+        ('TA4', 'FCO', 'MXP', 6, 1, 50, 10),     # con TA5 o TA6: 1 scalo a Milano
+        ('TA5', 'MXP', 'CDG', 9.5, 1.5, 60, 10),
+        ('TA6', 'MXP', 'CDG', 11, 1, 90, 10),
+    ):
+        dati.volo(partenza, arrivo, GIORNO + timedelta(hours=ora), durata=durata, numero=numero, prezzo=prezzo,
+                  posti=dict.fromkeys(('economy', 'business', 'first'), posti))
+    db.session.commit()
+    motore.svuota()
+
+
+def ricerca(indice, partenza, arrivo, limite, **altri):
+    return {'indice': indice, 'aeroporto_partenza': partenza, 'aeroporto_arrivo': arrivo,
+            'data': GIORNO, 'limite': limite, **altri}
+
+
+# Stessa tratta con limiti, ordinamenti e passeggeri diversi, per città e per codice
+RICERCHE = [
+    ricerca(0, 'FCO', 'CDG', 2),
+    ricerca(1, 'FCO', 'CDG', 5, ordina_per='tempo'),
+    ricerca(2, 'Roma', 'Parigi', 5, passeggeri=3),
+    ricerca(3, 'MXP', 'CDG', 1, classe='business'),
+    ricerca(4, 'CDG', 'FCO', 5),
+    ricerca(5, 'FCO', 'CDG', 1),
+]
+
+
+def numeri(righe):
+    return [r.numero_volo for r in righe]
+
+
+def tratte(itinerari):
+    return [[t.numero_volo for t in i.tratte] for i in itinerari]
+
+
+def test_tabella_valori():
+    colonne = (('indice', Integer), ('codice', String))
+    righe = [(0, 'FCO'), (1, 'MXP'), (2, 'CDG')]
+    tabella = tabella_valori('prova', colonne, righe)
+    assert db.session.execute(select(tabella).order_by(tabella.c.indice)).all() == righe
+    # Una sola riga: un SELECT senza UNION
+    tabella = tabella_valori('prova', colonne, righe[:1])
+    assert db.session.execute(select(tabella)).all() == righe[:1]
+
+    sql = str(select(tabella_valori('prova', colonne, righe)).compile(dialect=db.engine.dialect))
+    if db.engine.dialect.name == 'postgresql':
+        assert 'VALUES' in sql
+    else:
+        assert 'UNION ALL' in sql and 'VALUES' not in sql
+
+    # Il ramo di PostgreSQL: una lista VALUES con i nomi delle colonne
+    db.engine.dialect.name = 'postgresql'
+    try:
+        tabella = tabella_valori('prova', colonne, righe)
+    finally:
+        del db.engine.dialect.name
+    sql = str(select(tabella).compile(dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True}))
+    assert "(VALUES (0, 'FCO'), (1, 'MXP'), (2, 'CDG')) AS prova (indice, codice)" in sql
+    assert 'UNION' not in sql
+
+
+def test_voli_diretti():
+    risultati = cerca_voli_diretti_multipla(RICERCHE)
+    assert {i: numeri(r) for i, r in risultati.items()} == {
+        0: ['TA2', 'TA1'],
+        1: ['TA2', 'TA1', 'TA3'],
+        2: ['TA2', 'TA1'],
+        3: ['TA5'],
+        4: [],
+        5: ['TA2'],
+    }
+    # Gli stessi voli, nello stesso ordine, della ricerca singola
+    for r in RICERCHE:
+        singola = cerca_voli_diretti(
+            r['aeroporto_partenza'], r['aeroporto_arrivo'], r['data'], r.get('passeggeri', 1),
+            r.get('classe', 'economy'), r.get('ordina_per', 'prezzo'), limite=r['limite']
+        )
+        assert numeri(risultati[r['indice']]) == numeri(singola)
+    assert [float(v.prezzo) for v in risultati[3]] == [180.0]
+    assert cerca_voli_diretti_multipla([]) == {}
+
+
+def test_voli_con_scalo_senza_grafo():
+    risultati = cerca_itinerari_multipla(RICERCHE)
+    assert {i: tratte(r) for i, r in risultati.items()} == {
+        0: [['TA4', 'TA5'], ['TA4', 'TA6']],
+        1: [['TA4', 'TA5'], ['TA4', 'TA6']],
+        2: [['TA4', 'TA5'], ['TA4', 'TA6']],
+        3: [],
+        4: [],
+        5: [['TA4', 'TA5']],
+    }
+    # Gli stessi itinerari, nello stesso ordine, della ricerca singola
+    for r in RICERCHE:
+        singola = cerca_voli_scalo(
+            r['aeroporto_partenza'], r['aeroporto_arrivo'], r['data'],
+            classe=r.get('classe', 'economy'), ordina_per=r.get('ordina_per', 'prezzo'),
+            limite=r['limite'], passeggeri=r.get('passeggeri', 1)
+        )
+        assert tratte(risultati[r['indice']]) == [[c.volo1_numero, c.volo2_numero] for c in singola]
+
+
+@pytest.mark.parametrize('usa_grafo', [True])
+def test_voli_con_scalo_sul_grafo():
+    query = []
+
+    def conta(conn, cursor, statement, parameters, context, executemany):
+        query.append(statement)
+
+    risultati = cerca_itinerari_multipla(RICERCHE)
+    assert {i: tratte(r) for i, r in risultati.items()} == {
+        0: [['TA4', 'TA5'], ['TA4', 'TA6']],
+        1: [['TA4', 'TA5'], ['TA4', 'TA6']],
+        2: [['TA4', 'TA5'], ['TA4', 'TA6']],
+        3: [],
+        4: [],
+        5: [['TA4', 'TA5']],
+    }
+
+    # Una ricerca alla volta, ma con le query di una ricerca sola
+    event.listen(db.engine, 'before_cursor_execute', conta)
+    try:
+        motore.svuota()
+        cerca_itinerari_multipla(RICERCHE[:1])
+        una = len(query)
+        motore.svuota()
+        cerca_itinerari_multipla(RICERCHE)
+        tutte = len(query) - una
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', conta)
+    assert una > 0
+    assert tutte == una
+
+
+@pytest.mark.parametrize('usa_grafo', [False, True])
+def test_endpoint(client, intestazioni):
+    intest = intestazioni(client)
+    data = GIORNO.date().isoformat()
+    risposta = client.post('/api/v1/flights/search/batch', headers=intest, json={'ricerche': [
+        {'aeroporto_partenza': 'FCO', 'aeroporto_arrivo': 'CDG', 'data': data, 'passeggeri': 1, 'limite': 1},
+        {'aeroporto_partenza': 'FCO', 'data': data, 'passeggeri': 1},
+        {'aeroporto_partenza': 'MXP', 'aeroporto_arrivo': 'CDG', 'data': data, 'passeggeri': 1,
+         'ordina_per': 'tempo'},
+        {'aeroporto_partenza': 'FCO', 'aeroporto_arrivo': 'CDG', 'data': data, 'passeggeri': 1,
+         'cursore_diretti': 'abc'},
+    ]})
+    assert risposta.status_code == 200
+    risultati = risposta.json['risultati']
+    assert [r['indice'] for r in risultati] == [0, 1, 2, 3]
+
+    assert [v['numero_volo'] for v in risultati[0]['voli_diretti']] == ['TA2']
+    assert [[t['numero'] for t in i['tratte']] for i in risultati[0]['voli_scalo']] == [['TA4', 'TA5']]
+    # Con uno scalo le tratte sono anche in volo1 e volo2, come prima di `tratte`
+    itinerario = risultati[0]['voli_scalo'][0]
+    assert [itinerario['volo1'], itinerario['volo2']] == itinerario['tratte']
+    # Il risultato in più della ricerca dà il cursore della pagina successiva
+    assert risultati[0]['paginazione']['cursore_diretti'] is not None
+    assert risultati[0]['paginazione']['cursore_scalo'] is not None
+
+    assert 'aeroporto_arrivo' in risultati[1]['error']
+    assert 'voli_diretti' not in risultati[1]
+
+    assert [v['numero_volo'] for v in risultati[2]['voli_diretti']] == ['TA6', 'TA5']
+    assert risultati[2]['voli_scalo'] == []
+    assert risultati[2]['paginazione']['cursore_diretti'] is None
+
+    assert risultati[3]['error'] == 'Le pagine successive si richiedono a /flights/search'
+
+    assert client.post('/api/v1/flights/search/batch', headers=intest, json={}).status_code == 400
+    troppe = [{'aeroporto_partenza': 'FCO', 'aeroporto_arrivo': 'CDG', 'data': data, 'passeggeri': 1}] * 51
+    assert client.post('/api/v1/flights/search/batch', headers=intest,
+                       json={'ricerche': troppe}).status_code == 400
+
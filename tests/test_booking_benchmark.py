@@ -0,0 +1,83 @@
+"""
+Confronta la latenza di una prenotazione da 1 e da 9 passeggeri.
+
+Le prenotazioni usano `app.booking.prenota`: i posti si riservano con un solo
+UPDATE per la classe e i biglietti si inseriscono con un solo INSERT, quindi
+una prenotazione da 9 passeggeri esegue le stesse istruzioni SQL di una da 1
+e costa poco di più. Il test verifica il numero di istruzioni (i tempi
+dipendono dalla macchina e vengono solo stampati con `pytest -s`).
+
+Usa SQLite in memoria; per provarlo su PostgreSQL impostare TEST_DATABASE_URL.
+"""
+import statistics
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from app import db
+from app.booking import prenota
+from app.models import Biglietto
+
+PRENOTAZIONI = 50
+PASSEGGERI = (1, 9)
+
+
+def misura(volo_id, utente_id, passeggeri):
+    """
+    Esegue PRENOTAZIONI prenotazioni da `passeggeri` posti.
+
+    Returns:
+        tuple: (latenze in secondi, istruzioni SQL per prenotazione, INSERT
+            su biglietto per prenotazione)
+    """
+    istruzioni = []
+
+    def registra(conn, cursor, statement, parameters, context, executemany):
+        istruzioni.append(statement)
+
+    latenze = []
+    event.listen(db.engine, 'before_cursor_execute', registra)
+    try:
+        for _ in range(PRENOTAZIONI):
+            inizio = time.perf_counter()
+            prenota(utente_id, volo_id, 'economy', passeggeri)
+            latenze.append(time.perf_counter() - inizio)
+            db.session.expunge_all()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', registra)
+    insert_biglietti = sum(1 for s in istruzioni if s.lstrip().upper().startswith('INSERT INTO BIGLIETTO'))
+    return latenze, len(istruzioni) / PRENOTAZIONI, insert_biglietti / PRENOTAZIONI
+
+
+def esegui_benchmark(dati):
+    dati.aeroporti(('FCO', 'Roma'), ('MXP', 'Milano'))
+    dati.compagnia()
+    utente_id = dati.passeggero()
+    posti = 1 + PRENOTAZIONI * sum(PASSEGGERI)
+    partenza = datetime.now().replace(microsecond=0) + timedelta(days=7)
+    volo_id = dati.volo('FCO', 'MXP', partenza, posti=posti).id
+    db.session.commit()
+    # La prima prenotazione crea la mappa dei posti del volo
+    prenota(utente_id, volo_id, 'economy', 1)
+    db.session.expunge_all()
+
+    risultati = {n: misura(volo_id, utente_id, n) for n in PASSEGGERI}
+    biglietti = db.session.query(Biglietto).count()
+
+    assert biglietti == 1 + PRENOTAZIONI * sum(PASSEGGERI)
+    for n, (latenze, istruzioni, insert_biglietti) in risultati.items():
+        print(
+            f'{n} passeggeri: mediana {statistics.median(latenze) * 1000:.2f} ms, '
+            f'p95 {sorted(latenze)[int(len(latenze) * 0.95) - 1] * 1000:.2f} ms, '
+            f'{istruzioni:.1f} istruzioni SQL'
+        )
+    return risultati
+
+
+def test_prenotazione_di_gruppo_stesse_istruzioni(app, dati):
+    risultati = esegui_benchmark(dati)
+    _, istruzioni_singola, insert_singola = risultati[1]
+    _, istruzioni_gruppo, insert_gruppo = risultati[9]
+    assert insert_singola == insert_gruppo == 1
+    assert istruzioni_gruppo == istruzioni_singola
@@ -0,0 +1,430 @@
+"""
+Verifica che le prenotazioni concorrenti non vendano più posti di quelli liberi.
+
+Molti thread prenotano insieme (partono tutti dalla stessa barriera) gli
+stessi posti di un volo con `app.booking.prenota`, ognuno con la propria
+connessione; alcuni prima bloccano dei posti con `blocca_posti`, anche di
+un'altra classe o in numero diverso, altri prenotano con
+`prenota_itinerario` il volo insieme a una coincidenza. Alla fine i biglietti
+emessi non superano i posti iniziali, i posti rimasti non sono negativi,
+posti rimasti + biglietti + posti ancora bloccati = posti iniziali, i
+contatori dei venduti e dei bloccati del volo corrispondono e le
+prenotazioni rifiutate non lasciano righe nel database (neanche su una sola
+tratta dell'itinerario). Una prenotazione cancellata da più thread insieme
+restituisce i suoi posti una volta sola, e le modifiche dei posti fatte
+dalla compagnia durante le prenotazioni non ne perdono nessuna: le
+prenotazioni non cambiano la versione del volo, quindi una modifica non
+ripete la scrittura per i biglietti emessi tra la sua lettura e il commit.
+Il supplemento di un itinerario si paga una volta per passeggero, non per
+tratta. Contatori alterati direttamente nel database vengono segnalati da
+`verifica_contatori` (e da `flask posti verifica`) e riallineati con
+`--correggi`.
+
+Usa un database SQLite su file (in memoria ogni connessione avrebbe il suo
+database); per provarlo su PostgreSQL impostare TEST_DATABASE_URL.
+"""
+import random
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import event, func, update
+
+from app import db
+from app.booking import (
+    prenota, prenota_itinerario, blocca_posti, annulla_prenotazioni, aggiorna_volo, verifica_contatori,
+    Disallineamento, PostiNonDisponibili
+)
+from app.models import Volo, Prenotazione, Biglietto, BloccoPosti
+
+THREAD = 32
+POSTI = {'economy': 40, 'business': 8, 'first': 3}
+# La coincidenza ha meno posti: gli itinerari falliscono spesso sulla seconda tratta
+POSTI_COINCIDENZA = {'economy': 12, 'business': 3, 'first': 1}
+
+
+@pytest.fixture
+def configurazione():
+    return {'RICERCA_USA_GRAFO': False, 'FILTRO_TRATTE': False}
+
+
+@pytest.fixture
+def database_su_file():
+    return True
+
+
+@pytest.fixture
+def voli(app, dati):
+    """
+    Volo da Roma a Milano con POSTI posti e coincidenza da Milano a Parigi
+    3 ore dopo l'arrivo, con POSTI_COINCIDENZA posti.
+
+    Returns:
+        tuple: (id del volo, id della coincidenza, id dei THREAD passeggeri)
+    """
+    dati.aeroporti(('FCO', 'Roma'), ('MXP', 'Milano'), ('CDG', 'Parigi'))
+    dati.compagnia()
+    passeggeri = dati.passeggeri(THREAD)
+    partenza = datetime.now().replace(microsecond=0) + timedelta(days=7)
+    volo = dati.volo('FCO', 'MXP', partenza, numero='TA100', posti=POSTI)
+    coincidenza = dati.volo('MXP', 'CDG', volo.data_arrivo + timedelta(hours=3), durata=2, numero='TA200',
+                            posti=POSTI_COINCIDENZA, prezzo=80)
+    db.session.commit()
+    ids = volo.id, coincidenza.id, passeggeri
+    # I thread usano le proprie connessioni: la sessione non tiene lock sul file
+    db.session.remove()
+    return ids
+
+
+def prenota_in_parallelo(app, volo_id, richieste):
+    """
+    Esegue le richieste (utente_id, classe, passeggeri[, blocco[, voli]])
+    ognuna nel suo thread; `blocco` è una coppia (classe, posti) da bloccare
+    prima, `voli` l'itinerario da prenotare al posto del solo volo.
+
+    Returns:
+        tuple: (richieste accettate, numero di rifiutate, eccezioni inattese)
+    """
+    barriera = threading.Barrier(len(richieste))
+    lock = threading.Lock()
+    accettate, rifiutate, errori = [], [], []
+
+    def esegui(utente_id, classe, passeggeri, blocco=None, voli=None):
+        with app.app_context():
+            barriera.wait()
+            try:
+                if blocco is not None:
+                    try:
+                        blocca_posti(utente_id, volo_id, *blocco)
+                    except PostiNonDisponibili:
+                        pass
+                if voli is None:
+                    prenota(utente_id, volo_id, classe, passeggeri)
+                else:
+                    prenota_itinerario(utente_id, voli, classe, passeggeri)
+                with lock:
+                    accettate.append((classe, passeggeri, voli or [volo_id]))
+            except PostiNonDisponibili:
+                with lock:
+                    rifiutate.append((classe, passeggeri))
+            except Exception as e:
+                with lock:
+                    errori.append(e)
+            finally:
+                db.session.remove()
+
+    thread = [threading.Thread(target=esegui, args=richiesta) for richiesta in richieste]
+    for t in thread:
+        t.start()
+    for t in thread:
+        t.join()
+    return accettate, len(rifiutate), errori
+
+
+def verifica_posti(volo_id, accettate):
+    volo = db.session.get(Volo, volo_id)
+    posti_iniziali = POSTI_COINCIDENZA if volo.numero_volo == 'TA200' else POSTI
+    venduti = dict(
+        db.session.query(Biglietto.classe, func.count(Biglietto.id))
+        .filter(Biglietto.flight_id == volo_id)
+        .group_by(Biglietto.classe)
+        .all()
+    )
+    bloccati = dict(
+        db.session.query(BloccoPosti.classe, func.sum(BloccoPosti.posti))
+        .filter(BloccoPosti.flight_id == volo_id)
+        .group_by(BloccoPosti.classe)
+        .all()
+    )
+    for classe, iniziali in posti_iniziali.items():
+        rimasti = getattr(volo, f'posti_{classe}')
+        emessi = venduti.get(classe, 0)
+        tenuti = bloccati.get(classe, 0)
+        assert rimasti >= 0, f'{classe}: posti negativi ({rimasti})'
+        assert emessi + tenuti <= iniziali, f'{classe}: venduti {emessi} e bloccati {tenuti} posti su {iniziali}'
+        assert rimasti + emessi + tenuti == iniziali, (
+            f'{classe}: {rimasti} liberi + {emessi} venduti + {tenuti} bloccati != {iniziali}'
+        )
+        assert emessi == sum(n for c, n, voli in accettate if c == classe and volo_id in voli)
+        # I contatori della riga del volo corrispondono a biglietti e blocchi
+        assert getattr(volo, f'venduti_{classe}') == emessi, f'{classe}: contatore dei venduti'
+        assert getattr(volo, f'bloccati_{classe}') == tenuti, f'{classe}: contatore dei bloccati'
+
+
+def verifica_prenotazioni(accettate):
+    for volo_id, in db.session.query(Volo.id):
+        verifica_posti(volo_id, accettate)
+    # Le prenotazioni rifiutate sono state annullate per intero, su tutti i voli
+    assert db.session.query(Prenotazione).count() == len(accettate)
+    assert db.session.query(Biglietto).count() == sum(n * len(voli) for _, n, voli in accettate)
+    biglietti_per_prenotazione = sorted(
+        n for n, in db.session.query(func.count(Biglietto.id)).group_by(Biglietto.booking_id)
+    )
+    assert biglietti_per_prenotazione == sorted(n * len(voli) for _, n, voli in accettate)
+
+
+def esegui_scenario(app, voli, genera_richieste):
+    volo_id, coincidenza_id, passeggeri = voli
+    richieste = genera_richieste(passeggeri, [volo_id, coincidenza_id])
+    accettate, rifiutate, errori = prenota_in_parallelo(app, volo_id, richieste)
+    assert not errori, errori
+    verifica_prenotazioni(accettate)
+    return accettate, rifiutate
+
+
+def test_ultimi_posti_contesi(app, voli):
+    # 32 richieste da 1 posto per 3 posti in first: esattamente 3 accettate
+    accettate, rifiutate = esegui_scenario(
+        app, voli, lambda passeggeri, _: [(p, 'first', 1) for p in passeggeri]
+    )
+    assert len(accettate) == POSTI['first']
+    assert rifiutate == THREAD - POSTI['first']
+
+
+def test_prenotazioni_miste_senza_overbooking(app, voli):
+    # Più posti richiesti che disponibili in ogni classe, con prenotazioni di
+    # dimensioni diverse: nessuna classe va oltre i suoi posti
+    casuale = random.Random(42)
+    accettate, rifiutate = esegui_scenario(
+        app, voli, lambda passeggeri, _: [(p, casuale.choice(list(POSTI)), casuale.randint(1, 4)) for p in passeggeri]
+    )
+    assert accettate and rifiutate
+
+
+def test_prenotazioni_con_blocchi(app, voli):
+    # Metà dei thread blocca prima dei posti, a volte di un'altra classe o in
+    # numero diverso da quelli poi prenotati: chi conferma usa il proprio
+    # blocco, chi fallisce lo lascia attivo
+    casuale = random.Random(7)
+    classi = list(POSTI)
+
+    def richieste(passeggeri, _):
+        elenco = []
+        for i, p in enumerate(passeggeri):
+            classe, n = casuale.choice(classi), casuale.randint(1, 4)
+            blocco = (casuale.choice([classe, casuale.choice(classi)]), casuale.randint(1, 4)) if i % 2 else None
+            elenco.append((p, classe, n, blocco))
+        return elenco
+
+    accettate, rifiutate = esegui_scenario(app, voli, richieste)
+    assert accettate and rifiutate
+
+
+def test_itinerari_tutto_o_niente(app, voli):
+    # Metà dei thread prenota il volo con la coincidenza, in cui i posti sono
+    # contesi anche da chi ha bloccato posti solo sul primo volo: un
+    # itinerario rifiutato non lascia biglietti su nessuna delle due tratte
+    casuale = random.Random(11)
+
+    def richieste(passeggeri, itinerario):
+        elenco = []
+        for i, p in enumerate(passeggeri):
+            classe, n = casuale.choice(list(POSTI)), casuale.randint(1, 4)
+            if i % 2:
+                elenco.append((p, classe, n, None, itinerario))
+            else:
+                elenco.append((p, classe, n, (classe, n) if i % 4 else None))
+        return elenco
+
+    accettate, rifiutate = esegui_scenario(app, voli, richieste)
+    assert rifiutate
+    assert any(len(voli) == 2 for _, _, voli in accettate)
+
+
+def test_cancellazioni_concorrenti(app, voli):
+    # Ogni prenotazione iniziale viene cancellata da due thread insieme,
+    # mentre altri prenotano i posti che si liberano: i posti di una
+    # prenotazione tornano liberi una volta sola
+    volo_id, _, passeggeri = voli
+    iniziali = [prenota(p, volo_id, 'economy', 4).id for p in passeggeri[:POSTI['economy'] // 4]]
+    db.session.remove()
+
+    barriera = threading.Barrier(THREAD)
+    lock = threading.Lock()
+    accettate, cancellate, errori = [], [], []
+
+    def esegui(i):
+        with app.app_context():
+            barriera.wait()
+            try:
+                if i < 2 * len(iniziali):
+                    n = annulla_prenotazioni([iniziali[i // 2]])
+                    with lock:
+                        cancellate.append(n)
+                else:
+                    prenota(passeggeri[i], volo_id, 'economy', 3)
+                    with lock:
+                        accettate.append(('economy', 3, [volo_id]))
+            except PostiNonDisponibili:
+                pass
+            except Exception as e:
+                with lock:
+                    errori.append(e)
+            finally:
+                db.session.remove()
+
+    thread = [threading.Thread(target=esegui, args=(i,)) for i in range(THREAD)]
+    for t in thread:
+        t.start()
+    for t in thread:
+        t.join()
+    assert not errori, errori
+    assert sorted(cancellate) == [0] * len(iniziali) + [1] * len(iniziali)
+
+    verifica_prenotazioni(accettate)
+
+
+def test_modifiche_volo_concorrenti(app, voli):
+    # La compagnia aggiunge posti economy mentre i passeggeri prenotano: con
+    # il lock ottimistico nessuna modifica sovrascrive i posti venduti e
+    # nessun posto aggiunto va perso
+    aggiunti_per_modifica = 2
+    volo_id, _, passeggeri = voli
+
+    barriera = threading.Barrier(THREAD)
+    lock = threading.Lock()
+    accettate, modifiche, errori = [], [], []
+
+    def esegui(i):
+        with app.app_context():
+            barriera.wait()
+            try:
+                if i % 4 == 0:
+                    aggiorna_volo(volo_id, {'prezzo_economy': 100 + i}, {'economy': aggiunti_per_modifica})
+                    with lock:
+                        modifiche.append(i)
+                else:
+                    prenota(passeggeri[i], volo_id, 'economy', 2)
+                    with lock:
+                        accettate.append(('economy', 2, [volo_id]))
+            except PostiNonDisponibili:
+                pass
+            except Exception as e:
+                with lock:
+                    errori.append(e)
+            finally:
+                db.session.remove()
+
+    thread = [threading.Thread(target=esegui, args=(i,)) for i in range(THREAD)]
+    for t in thread:
+        t.start()
+    for t in thread:
+        t.join()
+    assert not errori, errori
+    assert len(modifiche) == THREAD // 4
+
+    volo = db.session.get(Volo, volo_id)
+    posti = POSTI['economy'] + aggiunti_per_modifica * len(modifiche)
+    assert volo.posti_economy + volo.venduti_economy == posti
+    assert volo.posti_totali == sum(POSTI.values()) + aggiunti_per_modifica * len(modifiche)
+    assert volo.venduti_economy == sum(n for _, n, _ in accettate)
+    assert volo.prezzo_economy in {100 + i for i in modifiche}
+
+
+def test_modifica_tra_prenotazioni_senza_ripetere(app, voli):
+    # Prenotazioni tra la lettura del volo e la scrittura della modifica: con
+    # un solo tentativo la modifica riesce lo stesso, somma i posti a quelli
+    # rimasti e incrementa la versione una volta sola
+    volo_id, _, passeggeri = voli
+    versione = db.session.get(Volo, volo_id).versione
+    db.session.remove()
+
+    prenotate, avviate = [], threading.Event()
+
+    def prenota_altrove():
+        with app.app_context():
+            for passeggero in passeggeri[:5]:
+                prenotate.append(prenota(passeggero, volo_id, 'economy', 2))
+            db.session.remove()
+
+    def prima_della_scrittura(session, flush_context, instances):
+        # Solo al primo flush della modifica, non a quelli delle prenotazioni
+        if not avviate.is_set():
+            avviate.set()
+            t = threading.Thread(target=prenota_altrove)
+            t.start()
+            t.join()
+
+    event.listen(db.session, 'before_flush', prima_della_scrittura)
+    try:
+        aggiorna_volo(volo_id, {'prezzo_economy': 150}, {'economy': 3}, tentativi=1)
+    finally:
+        event.remove(db.session, 'before_flush', prima_della_scrittura)
+    assert len(prenotate) == 5
+    db.session.remove()
+
+    volo = db.session.get(Volo, volo_id)
+    assert volo.versione == versione + 1
+    assert volo.prezzo_economy == 150
+    assert volo.venduti_economy == 10
+    assert volo.posti_economy == POSTI['economy'] + 3 - 10
+    assert volo.posti_totali == sum(POSTI.values()) + 3
+
+    # Togliere più posti di quelli liberi non cambia niente, neanche il prezzo
+    with pytest.raises(ValueError, match=f'ne restano liberi {POSTI["economy"] + 3 - 10}'):
+        aggiorna_volo(volo_id, {'prezzo_economy': 200}, {'economy': -(volo.posti_economy + 1)})
+    db.session.remove()
+    volo = db.session.get(Volo, volo_id)
+    assert volo.prezzo_economy == 150
+    assert volo.posti_economy == POSTI['economy'] + 3 - 10
+    assert volo.versione == versione + 1
+
+
+def test_supplemento_di_un_itinerario(voli):
+    volo_id, coincidenza_id, passeggeri = voli
+
+    # Economy: 100 il volo, 80 la coincidenza, 30 di supplemento per passeggero
+    prenotazione = prenota_itinerario(passeggeri[0], [volo_id, coincidenza_id], 'economy', 2, supplemento=30)
+    assert prenotazione.prezzo_totale == (100 + 80 + 30) * 2
+    assert [(b.flight_id, b.prezzo) for b in prenotazione.biglietti] == [
+        (volo_id, 130), (volo_id, 130), (coincidenza_id, 80), (coincidenza_id, 80)
+    ]
+    assert sum(b.prezzo for b in prenotazione.biglietti) == prenotazione.prezzo_totale
+
+    # Un volo solo: come prima
+    prenotazione = prenota(passeggeri[1], volo_id, 'economy', 3, supplemento=30)
+    assert prenotazione.prezzo_totale == (100 + 30) * 3
+
+
+def test_contatori_disallineati(app, voli):
+    volo_id, coincidenza_id, passeggeri = voli
+    prenota(passeggeri[0], volo_id, 'economy', 3)
+    blocca_posti(passeggeri[1], volo_id, 'business', 2)
+    prenota(passeggeri[2], coincidenza_id, 'first', 1)
+    assert verifica_contatori() == []
+
+    # Contatori cambiati senza biglietti né blocchi
+    db.session.execute(update(Volo).where(Volo.id == volo_id).values(venduti_economy=5, bloccati_business=0))
+    db.session.commit()
+    attesi = [
+        Disallineamento(volo_id, 'economy', 'venduti', 5, 3),
+        Disallineamento(volo_id, 'business', 'bloccati', 0, 2),
+    ]
+    assert sorted(verifica_contatori(lotto=1)) == sorted(attesi)
+
+    def comando(*opzioni):
+        db.session.remove()
+        risultato = app.test_cli_runner().invoke(args=['posti', 'verifica', *opzioni])
+        return risultato.exit_code, risultato.output
+
+    # Senza --correggi il comando segnala ed esce con errore, senza modificare niente
+    codice, output = comando()
+    assert codice == 1, output
+    assert f'volo {volo_id} venduti_economy: 5 invece di 3' in output
+    assert f'volo {volo_id} bloccati_business: 0 invece di 2' in output
+    assert 'Contatori disallineati: 2' in output
+    volo = db.session.get(Volo, volo_id)
+    assert (volo.venduti_economy, volo.bloccati_business) == (5, 0)
+
+    codice, output = comando('--correggi', '--lotto', '1')
+    assert codice == 0, output
+    assert 'Contatori corretti: 2' in output
+    volo = db.session.get(Volo, volo_id)
+    assert (volo.venduti_economy, volo.bloccati_business) == (3, 2)
+    # I posti liberi non si toccano
+    assert (volo.posti_economy, volo.posti_business) == (POSTI['economy'] - 3, POSTI['business'] - 2)
+    assert db.session.get(Volo, coincidenza_id).venduti_first == 1
+
+    codice, output = comando()
+    assert codice == 0, output
+    assert 'Contatori allineati' in output
@@ -0,0 +1,128 @@
+"""
+Confronta throughput e latenza p99 delle prenotazioni concorrenti con e senza
+commit di gruppo (`PRENOTAZIONI_COMMIT_DI_GRUPPO`, app/booking_writer.py).
+
+THREAD client prenotano insieme PRENOTAZIONI_PER_THREAD volte ciascuno, prima
+con una transazione per prenotazione, poi attraverso lo scrittore a lotti. Il
+test verifica che le prenotazioni siano tutte scritte, che i contatori dei
+posti corrispondano ai biglietti e che lo scrittore faccia meno commit che
+prenotazioni; throughput e latenze dipendono dalla macchina e vengono solo
+stampati con `pytest -s`.
+
+Usa un database SQLite su file, dove ogni commit è un fsync; per provarlo su
+PostgreSQL impostare TEST_DATABASE_URL. Si controlla anche che il RELEASE dei
+SAVEPOINT del lotto non svuoti le cache prima del commit.
+"""
+import statistics
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from app import db
+from app.booking import verifica_contatori
+from app.availability import cache_disponibilità
+from app.booking_writer import prenota
+from app.models import Volo, Prenotazione
+
+THREAD = 16
+PRENOTAZIONI_PER_THREAD = 20
+
+
+def crea_app_prenotazioni(crea_app, commit_di_gruppo):
+    return crea_app(
+        su_file=True, RICERCA_USA_GRAFO=False, FILTRO_TRATTE=False, PRENOTAZIONI_COMMIT_DI_GRUPPO=commit_di_gruppo
+    )
+
+
+def popola_database(dati):
+    dati.aeroporti(('FCO', 'Roma'), ('MXP', 'Milano'))
+    dati.compagnia()
+    passeggeri = dati.passeggeri(THREAD)
+    partenza = datetime.now().replace(microsecond=0) + timedelta(days=7)
+    volo = dati.volo('FCO', 'MXP', partenza, numero='TA100', posti=THREAD * PRENOTAZIONI_PER_THREAD)
+    db.session.commit()
+    return volo.id, passeggeri
+
+
+def misura(crea_app, dati, commit_di_gruppo):
+    """
+    Returns:
+        tuple: (prenotazioni al secondo, latenze in secondi, commit eseguiti)
+    """
+    app = crea_app_prenotazioni(crea_app, commit_di_gruppo)
+    with app.app_context():
+        volo_id, passeggeri = popola_database(dati)
+        db.session.remove()
+
+        commit = []
+        event.listen(db.engine, 'commit', lambda conn: commit.append(1))
+
+    barriera = threading.Barrier(THREAD + 1)
+    lock = threading.Lock()
+    latenze, errori = [], []
+
+    def esegui(utente_id):
+        with app.app_context():
+            barriera.wait()
+            for _ in range(PRENOTAZIONI_PER_THREAD):
+                inizio = time.perf_counter()
+                try:
+                    prenota(utente_id, volo_id, 'economy', 1)
+                except Exception as e:
+                    with lock:
+                        errori.append(e)
+                finally:
+                    db.session.remove()
+                with lock:
+                    latenze.append(time.perf_counter() - inizio)
+
+    thread = [threading.Thread(target=esegui, args=(p,)) for p in passeggeri]
+    for t in thread:
+        t.start()
+    barriera.wait()
+    inizio = time.perf_counter()
+    for t in thread:
+        t.join()
+    durata = time.perf_counter() - inizio
+    assert not errori, errori
+
+    with app.app_context():
+        prenotazioni = db.session.query(Prenotazione).count()
+        assert prenotazioni == THREAD * PRENOTAZIONI_PER_THREAD
+        assert db.session.get(Volo, volo_id).posti_economy == 0
+        assert verifica_contatori() == []
+        db.session.remove()
+    return prenotazioni / durata, latenze, len(commit)
+
+
+def p99(latenze):
+    return sorted(latenze)[int(len(latenze) * 0.99) - 1]
+
+
+def test_commit_di_gruppo(crea_app, dati):
+    risultati = {nome: misura(crea_app, dati, gruppo) for nome, gruppo in (('singolo', False), ('di gruppo', True))}
+    for nome, (throughput, latenze, commit) in risultati.items():
+        print(
+            f'commit {nome}: {throughput:.0f} prenotazioni/s, '
+            f'mediana {statistics.median(latenze) * 1000:.2f} ms, p99 {p99(latenze) * 1000:.2f} ms, '
+            f'{commit} commit'
+        )
+    prenotazioni = THREAD * PRENOTAZIONI_PER_THREAD
+    assert risultati['singolo'][2] >= prenotazioni
+    # Più prenotazioni per commit: lo scrittore raccoglie le richieste concorrenti
+    assert risultati['di gruppo'][2] < prenotazioni
+
+
+def test_cache_invalidate_al_commit_del_lotto(crea_app, dati):
+    app = crea_app_prenotazioni(crea_app, True)
+    with app.app_context():
+        volo_id, _ = popola_database(dati)
+        with db.session.begin_nested():
+            db.session.get(Volo, volo_id).posti_economy -= 1
+        # Una lettura concorrente tra il RELEASE e il commit del lotto
+        cache_disponibilità.scrivi({volo_id: 'vecchia'})
+        db.session.commit()
+        assert cache_disponibilità.leggi([volo_id]) == ({}, [volo_id])
+        db.session.remove()
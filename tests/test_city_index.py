@@ -0,0 +1,74 @@
+"""
+Verifica l'indice città → aeroporti (app/city_index.py).
+
+Un codice IATA si espande nel solo aeroporto, il nome di una città (senza
+distinzione di maiuscole, accenti e spazi) in tutti i suoi aeroporti; la
+ricerca dei voli diretti da una città trova i voli di ognuno dei suoi
+aeroporti e un aeroporto aggiunto dopo la costruzione dell'indice viene
+incluso. Città con lo stesso nome in paesi diversi restano città distinte.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import db
+from app.city_index import indice_città
+from app.models import Aeroporto
+from app.queries import cerca_voli_diretti
+
+GIORNO = (datetime.now() + timedelta(days=7)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+@pytest.fixture
+def configurazione():
+    return {'RICERCA_USA_GRAFO': False, 'FILTRO_TRATTE': False}
+
+
+@pytest.fixture
+def ids(app, dati):
+    ids = dati.aeroporti(('FCO', 'Roma'), ('MXP', 'Milano'), ('LIN', 'Milano'), ('FRL', 'Forlì'))
+    dati.compagnia()
+    for numero, partenza, ora in (('TA1', 'MXP', 8), ('TA2', 'LIN', 9), ('TA3', 'FRL', 10)):
+        dati.volo(partenza, 'FCO', GIORNO + timedelta(hours=ora), numero=numero)
+    db.session.commit()
+    return ids
+
+
+def test_risolvi_codici_e_città(ids):
+    assert indice_città.risolvi('MXP') == {ids['MXP']}
+    assert indice_città.risolvi(' lin ') == {ids['LIN']}
+    assert indice_città.risolvi('Milano') == indice_città.risolvi('  MILANO ') == {ids['MXP'], ids['LIN']}
+    assert indice_città.risolvi('forli') == {ids['FRL']}
+    assert indice_città.risolvi('Atlantide') == frozenset()
+    assert indice_città.risolvi(None) == frozenset()
+
+    # Stessa città, stesso id di città
+    assert indice_città.città(ids['MXP']) == indice_città.città(ids['LIN'])
+    assert indice_città.stessa_città(ids['MXP']) == {ids['MXP'], ids['LIN']}
+    assert set(indice_città.città_multi_aeroporto()) == {ids['MXP'], ids['LIN']}
+
+
+def test_ricerca_per_città_e_nuovo_aeroporto(ids):
+    voli = cerca_voli_diretti('Milano', 'Roma', GIORNO)
+    assert sorted(v.numero_volo for v in voli) == ['TA1', 'TA2']
+    assert [v.numero_volo for v in cerca_voli_diretti('MXP', 'FCO', GIORNO)] == ['TA1']
+
+    # Un terzo aeroporto di Milano entra nell'indice dopo il commit
+    db.session.add(Aeroporto(codice_iata='BGX', nome='BGX', città='Milano', paese='Test'))
+    db.session.commit()
+    nuovo = db.session.query(Aeroporto.id).filter_by(codice_iata='BGX').scalar()
+    assert indice_città.risolvi('milano') == {ids['MXP'], ids['LIN'], nuovo}
+
+
+def test_città_omonime_in_paesi_diversi(app, dati):
+    ids = dati.aeroporti(('SCL', 'Santiago', 'SCL', 'Cile'), ('SCQ', 'Santiago', 'SCQ', 'Spagna'),
+                         ('VLC', 'Valencia', 'VLC', 'Spagna'))
+    db.session.commit()
+    scl, scq = ids['SCL'], ids['SCQ']
+
+    # Il nome trova entrambe, ma uno scalo non passa da un paese all'altro
+    assert indice_città.risolvi('santiago') == {scl, scq}
+    assert indice_città.città(scl) != indice_città.città(scq)
+    assert indice_città.stessa_città(scl) == {scl}
+    assert indice_città.città_multi_aeroporto() == {}
+    assert indice_città.risolvi('Valencia') == {ids['VLC']}
@@ -0,0 +1,138 @@
+"""
+Verifica la ricerca di voli diretti e con scalo in parallelo (app/concurrent_search.py).
+
+Entro la scadenza la ricerca restituisce voli diretti e itinerari con scalo,
+con `completa=True`. Se la ricerca con scalo è troppo lenta (qui una query
+che conta fino a un miliardo al posto della ricerca vera) si ricevono solo i
+voli diretti alla scadenza, e la query del worker viene interrotta poco dopo
+invece di tenere la connessione fino alla fine. Allo stesso modo si ferma
+alla scadenza la visita del grafo orario, che non esegue query.
+
+Usa un database SQLite su file: in memoria la ricerca non è parallela.
+"""
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from app import db, concurrent_search
+from app.city_index import indice_città
+from app.route_graph import RicercaScaduta, motore
+from app.search_cache import cache_ricerca
+
+GIORNO = (datetime.now() + timedelta(days=7)).replace(hour=0, minute=0, second=0, microsecond=0)
+QUERY_LENTA = text(
+    'WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 1000000000) SELECT count(*) FROM n'
+)
+
+
+@pytest.fixture
+def configurazione():
+    return {'RICERCA_PARALLELA': True, 'RICERCA_SCADENZA': 0.5, 'FILTRO_TRATTE': False}
+
+
+@pytest.fixture
+def database_su_file():
+    return True
+
+
+@pytest.fixture(autouse=True)
+def voli(app, dati):
+    dati.aeroporti(('FCO', 'Roma'), ('MXP', 'Milano'), ('CDG', 'Parigi'))
+    dati.compagnia()
+    for numero, partenza, arrivo, ora in (('TA1', 'FCO', 'CDG', 8), ('TA2', 'FCO', 'MXP', 6), ('TA3', 'MXP', 'CDG', 10)):
+        dati.volo(partenza, arrivo, GIORNO + timedelta(hours=ora), numero=numero)
+    db.session.commit()
+    cache_ricerca.svuota()
+
+
+def test_diretti_e_scalo_entro_la_scadenza():
+    risultati = concurrent_search.cerca_voli('FCO', 'CDG', GIORNO)
+    assert risultati.completa
+    assert [v.numero_volo for v in risultati.diretti] == ['TA1']
+    assert [[t.numero_volo for t in i.tratte] for i in risultati.scalo] == [['TA2', 'TA3']]
+
+
+def test_query_lenta_interrotta_alla_scadenza():
+    lente = []
+
+    def scalo_lento(*args):
+        inizio = time.monotonic()
+        try:
+            return db.session.execute(QUERY_LENTA).scalar()
+        finally:
+            lente.append(time.monotonic() - inizio)
+
+    originale = concurrent_search.cerca_con_scalo
+    concurrent_search.cerca_con_scalo = scalo_lento
+    try:
+        inizio = time.monotonic()
+        risultati = concurrent_search.cerca_voli('FCO', 'CDG', GIORNO)
+        assert time.monotonic() - inizio < 1.5
+    finally:
+        concurrent_search.cerca_con_scalo = originale
+    assert not risultati.completa
+    assert [v.numero_volo for v in risultati.diretti] == ['TA1']
+    assert risultati.scalo == []
+
+    # Il worker si libera poco dopo la scadenza
+    attesa = time.monotonic() + 5
+    while not lente and time.monotonic() < attesa:
+        time.sleep(0.05)
+    assert lente and lente[0] < 1.5
+
+
+def test_visita_del_grafo_interrotta_alla_scadenza():
+    esiti = []
+
+    def scalo_registrato(*args):
+        try:
+            esiti.append(originale(*args))
+        except Exception as e:
+            esiti.append(e)
+            raise
+
+    def stessa_città_lenta(aeroporto_id):
+        # Un passo della visita più lungo della scadenza
+        time.sleep(1)
+        return stessa_città(aeroporto_id)
+
+    motore.svuota()
+    originale = concurrent_search.cerca_con_scalo
+    stessa_città = indice_città.stessa_città
+    concurrent_search.cerca_con_scalo = scalo_registrato
+    indice_città.stessa_città = stessa_città_lenta
+    try:
+        risultati = concurrent_search.cerca_voli('FCO', 'CDG', GIORNO)
+        assert not risultati.completa
+        assert [v.numero_volo for v in risultati.diretti] == ['TA1']
+
+        # Dopo il passo lento la visita non continua
+        attesa = time.monotonic() + 5
+        while not esiti and time.monotonic() < attesa:
+            time.sleep(0.05)
+    finally:
+        concurrent_search.cerca_con_scalo = originale
+        indice_città.stessa_città = stessa_città
+    assert len(esiti) == 1 and isinstance(esiti[0], RicercaScaduta)
+
+
+def test_scadenza_non_resta_sulla_connessione(app):
+    scadenza = time.monotonic() + 0.2
+    try:
+        concurrent_search._esegui_nel_contesto(app, scadenza, lambda: db.session.execute(QUERY_LENTA).scalar())
+    except OperationalError:
+        pass
+    else:
+        raise AssertionError('la query lenta non è stata interrotta')
+    # La stessa connessione, ripresa dal pool, esegue di nuovo query lunghe
+    time.sleep(0.3)
+    conteggio = concurrent_search._esegui_nel_contesto(
+        app, time.monotonic() + 30, lambda: db.session.execute(text(
+            'WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 100000) '
+            'SELECT count(*) FROM n'
+        )).scalar()
+    )
+    assert conteggio == 100000
@@ -0,0 +1,150 @@
+"""
+Verifica l'aggiornamento incrementale della tabella delle coincidenze
+(app/connections.py).
+
+Dopo ogni modifica dei voli fatta con l'ORM (volo inserito, orari
+modificati, posti cambiati, volo cancellato) la tabella deve
+restare allineata a quella ricalcolata da `flask coincidenze verifica`, e le
+coppie presenti devono essere quelle attese. Una modifica fatta in SQL, fuori
+dall'ORM, deve invece essere segnalata dalla verifica. I posti cambiati dalla
+compagnia con `aggiorna_volo` (un UPDATE relativo, senza eventi di flush)
+arrivano comunque alle coincidenze e alle ricerche, al grafo e alla
+disponibilità già in cache.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select, update
+
+from app import db
+from app.availability import disponibilità_voli
+from app.booking import aggiorna_volo
+from app.models import Volo, Coincidenza
+from app.queries import cerca_voli_scalo
+from app.route_graph import cerca_itinerari
+from app.search_cache import cache_ricerca, cerca_diretti
+
+GIORNO = (datetime.now() + timedelta(days=7)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+@pytest.fixture
+def configurazione():
+    return {'FILTRO_TRATTE': False}
+
+
+@pytest.fixture
+def voli(app, dati):
+    dati.aeroporti(('FCO', 'Roma'), ('MXP', 'Milano'), ('CDG', 'Parigi'))
+    dati.compagnia()
+    aggiungi_volo(dati, 'FCO', 'MXP', 'TA1', 6)
+    aggiungi_volo(dati, 'MXP', 'CDG', 'TA2', 10)   # TA1 + TA2: 3 ore a Milano
+    aggiungi_volo(dati, 'MXP', 'CDG', 'TA3', 7.5)  # TA1 + TA3: scalo troppo breve
+    db.session.commit()
+
+
+def aggiungi_volo(dati, partenza, arrivo, numero, ora):
+    return dati.volo(partenza, arrivo, GIORNO + timedelta(hours=ora), numero=numero)
+
+
+def volo(numero):
+    return db.session.execute(select(Volo).where(Volo.numero_volo == numero)).scalar_one()
+
+
+def modifica(numero, **valori):
+    for campo, valore in valori.items():
+        setattr(volo(numero), campo, valore)
+    db.session.commit()
+
+
+def coincidenze():
+    """Coppie di numeri di volo nella tabella, con i posti economy."""
+    volo1, volo2 = db.aliased(Volo), db.aliased(Volo)
+    return {
+        (numero1, numero2): posti
+        for numero1, numero2, posti in db.session.execute(
+            select(volo1.numero_volo, volo2.numero_volo, Coincidenza.posti_economy)
+            .join(volo1, volo1.id == Coincidenza.volo1_id)
+            .join(volo2, volo2.id == Coincidenza.volo2_id)
+        )
+    }
+
+
+def verifica(app):
+    """Esegue `flask coincidenze verifica`; restituisce exit code e output."""
+    db.session.remove()
+    risultato = app.test_cli_runner().invoke(args=['coincidenze', 'verifica'])
+    return risultato.exit_code, risultato.output
+
+
+def allineata(app):
+    codice, output = verifica(app)
+    assert codice == 0, output
+    assert 'Tabella allineata' in output
+
+
+def test_aggiornamento_incrementale(app, dati, voli):
+    allineata(app)
+    assert coincidenze() == {('TA1', 'TA2'): 10}
+
+    # Inserimento: il nuovo volo è sia prima sia seconda tratta
+    aggiungi_volo(dati, 'MXP', 'CDG', 'TA4', 12)
+    aggiungi_volo(dati, 'FCO', 'MXP', 'TA5', 2)
+    db.session.commit()
+    allineata(app)
+    assert coincidenze() == {('TA1', 'TA2'): 10, ('TA1', 'TA4'): 10,
+                             ('TA5', 'TA2'): 10, ('TA5', 'TA3'): 10, ('TA5', 'TA4'): 10}
+
+    # Modifica degli orari: TA3 parte abbastanza tardi, TA4 troppo presto
+    modifica('TA3', data_partenza=GIORNO + timedelta(hours=9), data_arrivo=GIORNO + timedelta(hours=10))
+    modifica('TA4', data_partenza=GIORNO + timedelta(hours=7), data_arrivo=GIORNO + timedelta(hours=8))
+    allineata(app)
+    assert coincidenze() == {('TA1', 'TA2'): 10, ('TA1', 'TA3'): 10,
+                             ('TA5', 'TA2'): 10, ('TA5', 'TA3'): 10, ('TA5', 'TA4'): 10}
+
+    # Posti: cambiano solo i posti delle coincidenze
+    modifica('TA1', posti_economy=6)
+    modifica('TA3', posti_economy=3)
+    allineata(app)
+    assert coincidenze() == {('TA1', 'TA2'): 6, ('TA1', 'TA3'): 3,
+                             ('TA5', 'TA2'): 10, ('TA5', 'TA3'): 3, ('TA5', 'TA4'): 10}
+
+    # Cancellazione
+    db.session.delete(volo('TA1'))
+    db.session.commit()
+    allineata(app)
+    assert coincidenze() == {('TA5', 'TA2'): 10, ('TA5', 'TA3'): 3, ('TA5', 'TA4'): 10}
+
+    # Una modifica fuori dall'ORM non aggiorna la tabella: la verifica la trova
+    db.session.execute(update(Volo).where(Volo.numero_volo == 'TA5').values(prezzo_economy=150))
+    db.session.commit()
+    codice, output = verifica(app)
+    assert codice == 1
+    assert 'diverse: 3' in output
+
+
+def test_posti_modificati_dalla_compagnia(app, voli):
+    volo_id = volo('TA1').id
+
+    def posti():
+        return (
+            [v.posti_disponibili for v in cerca_diretti('FCO', 'MXP', GIORNO)],
+            disponibilità_voli([volo_id])[volo_id]['classi']['economy']['disponibili'],
+            [i.posti_disponibili('economy') for i in cerca_itinerari('FCO', 'CDG', GIORNO)],
+            len(cerca_voli_scalo('FCO', 'CDG', GIORNO, passeggeri=8)),
+        )
+
+    # Tutto in cache prima della modifica
+    assert posti() == ([10], 10, [10], 1)
+    invalidate = cache_ricerca.statistiche()['invalidate']
+
+    # Solo posti: nessun campo del volo cambia con l'ORM
+    aggiorna_volo(volo_id, {}, {'economy': -3})
+    assert cache_ricerca.statistiche()['invalidate'] > invalidate
+    assert posti() == ([7], 7, [7], 0)
+    assert coincidenze() == {('TA1', 'TA2'): 7}
+    allineata(app)
+
+    # Posti e prezzo insieme; l'itinerario ha i posti della tratta con meno posti
+    aggiorna_volo(volo_id, {'prezzo_economy': 120}, {'economy': 5})
+    assert posti() == ([12], 12, [10], 1)
+    allineata(app)
@@ -0,0 +1,175 @@
+"""
+Verifica il calendario delle tariffe (`tariffe_minime_per_giorno` in
+app/queries.py, `calendario_tariffe` in app/search_cache.py e l'endpoint
+`/api/v1/flights/calendar`).
+
+Per ogni giorno il calendario riporta il prezzo minimo dei voli della tratta
+con abbastanza posti liberi e il loro numero; un giorno senza voli o con i
+voli esauriti resta vuoto. Il periodo attraversa la fine di un mese: la cache
+tiene una voce per mese, i mesi mancanti si caricano con una sola query e una
+tariffa cambiata (o un volo esaurito da una prenotazione) invalida solo il
+mese del volo. L'endpoint accetta al più 29 giorni prima e dopo la data.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import app.search_cache as search_cache
+from app import db
+from app.booking import prenota
+from app.models import Volo
+from app.queries import tariffe_minime_per_giorno
+from app.search_cache import cache_ricerca, calendario_tariffe
+
+# Primo giorno di un mese tra almeno un mese: i giorni prima sono del mese precedente
+PRIMO = (datetime.now().date().replace(day=1) + timedelta(days=62)).replace(day=1)
+VIGILIA = PRIMO - timedelta(days=1)
+ANTIVIGILIA = PRIMO - timedelta(days=2)
+
+
+@pytest.fixture
+def configurazione():
+    return {'RICERCA_USA_GRAFO': False, 'FILTRO_TRATTE': False}
+
+
+@pytest.fixture
+def voli(app, dati):
+    """
+    Due voli Roma-Milano l'antivigilia, uno esaurito la vigilia, due il primo
+    del mese e uno sulla tratta inversa, più economico.
+
+    Returns:
+        tuple: (id del passeggero, id del volo più economico dell'antivigilia)
+    """
+    dati.aeroporti(('FCO', 'Roma'), ('MXP', 'Milano'))
+    dati.compagnia()
+    passeggero_id = dati.passeggero()
+    aggiungi_volo(dati, 'TA1', 'FCO', 'MXP', ANTIVIGILIA, 8, 120, 10)
+    economico = aggiungi_volo(dati, 'TA2', 'FCO', 'MXP', ANTIVIGILIA, 22, 90, 10)
+    aggiungi_volo(dati, 'TA3', 'FCO', 'MXP', VIGILIA, 8, 80, 0)
+    aggiungi_volo(dati, 'TA4', 'FCO', 'MXP', PRIMO, 7, 150, 3)
+    aggiungi_volo(dati, 'TA5', 'FCO', 'MXP', PRIMO, 18, 200, 10)
+    # Tratta inversa, più economica: non entra nel calendario
+    aggiungi_volo(dati, 'TA6', 'MXP', 'FCO', ANTIVIGILIA, 9, 10, 10)
+    db.session.commit()
+    cache_ricerca.svuota()
+    return passeggero_id, economico.id
+
+
+def aggiungi_volo(dati, numero, partenza, arrivo, giorno, ora, prezzo, posti):
+    data_partenza = datetime.combine(giorno, datetime.min.time()) + timedelta(hours=ora)
+    return dati.volo(partenza, arrivo, data_partenza, numero=numero, posti=posti, prezzo=prezzo)
+
+
+def conta_query():
+    """Sostituisce la query del calendario con una che registra i periodi caricati."""
+    originale = search_cache.tariffe_minime_per_giorno
+    periodi = []
+
+    def registra(partenza, arrivo, data_inizio, data_fine, *args):
+        periodi.append((data_inizio, data_fine))
+        return originale(partenza, arrivo, data_inizio, data_fine, *args)
+
+    search_cache.tariffe_minime_per_giorno = registra
+    return periodi, lambda: setattr(search_cache, 'tariffe_minime_per_giorno', originale)
+
+
+def test_tariffa_minima_per_giorno(voli):
+    fine = PRIMO + timedelta(days=1)
+    assert tariffe_minime_per_giorno('FCO', 'MXP', ANTIVIGILIA, fine) == {
+        ANTIVIGILIA: (90.0, 2),
+        PRIMO: (150.0, 2),
+    }
+    # Per città come per codice IATA; l'ultimo giorno è escluso
+    assert tariffe_minime_per_giorno('Roma', 'Milano', ANTIVIGILIA, PRIMO) == {ANTIVIGILIA: (90.0, 2)}
+    # Il volo da 150 ha solo 3 posti
+    assert tariffe_minime_per_giorno('FCO', 'MXP', ANTIVIGILIA, fine, passeggeri=4) == {
+        ANTIVIGILIA: (90.0, 2),
+        PRIMO: (200.0, 1),
+    }
+    assert tariffe_minime_per_giorno('FCO', 'MXP', ANTIVIGILIA, fine, classe='business') == {}
+    assert tariffe_minime_per_giorno('MXP', 'FCO', ANTIVIGILIA, fine) == {ANTIVIGILIA: (10.0, 1)}
+    assert tariffe_minime_per_giorno('FCO', 'XXX', ANTIVIGILIA, fine) == {}
+
+
+def test_calendario_a_cavallo_del_mese(voli):
+    periodi, ripristina = conta_query()
+    try:
+        calendario = calendario_tariffe('FCO', 'MXP', ANTIVIGILIA, PRIMO + timedelta(days=2))
+        assert calendario == [
+            (ANTIVIGILIA, (90.0, 2)),
+            (VIGILIA, None),
+            (PRIMO, (150.0, 2)),
+            (PRIMO + timedelta(days=1), None),
+        ]
+        # Una sola query per i due mesi, dal primo del mese precedente alla fine del successivo
+        assert periodi == [(VIGILIA.replace(day=1), search_cache._primo_del_mese_successivo(PRIMO))]
+        assert cache_ricerca.statistiche()['voci'] == 2
+
+        # Altri giorni degli stessi mesi: serviti dalla cache
+        assert calendario_tariffe('FCO', 'MXP', VIGILIA, PRIMO + timedelta(days=1)) == [
+            (VIGILIA, None),
+            (PRIMO, (150.0, 2)),
+        ]
+        assert calendario_tariffe('FCO', 'MXP', PRIMO + timedelta(days=5), PRIMO + timedelta(days=6)) == [
+            (PRIMO + timedelta(days=5), None),
+        ]
+        assert len(periodi) == 1
+
+        # Altri passeggeri: un'altra voce
+        assert calendario_tariffe('FCO', 'MXP', PRIMO, PRIMO + timedelta(days=1), passeggeri=4) == [
+            (PRIMO, (200.0, 1)),
+        ]
+        assert len(periodi) == 2
+    finally:
+        ripristina()
+
+
+def test_invalidazione_per_tariffa_e_posti(voli):
+    passeggero_id, economico_id = voli
+    inizio, fine = ANTIVIGILIA, PRIMO + timedelta(days=1)
+    periodi, ripristina = conta_query()
+    try:
+        calendario_tariffe('FCO', 'MXP', inizio, fine)
+        db.session.get(Volo, economico_id).prezzo_economy = 60
+        db.session.commit()
+        # Si ricarica solo il mese del volo modificato, non quello del primo
+        assert calendario_tariffe('FCO', 'MXP', inizio, fine)[0] == (ANTIVIGILIA, (60.0, 2))
+        assert periodi[-1] == (ANTIVIGILIA.replace(day=1), PRIMO)
+        assert calendario_tariffe('FCO', 'MXP', inizio, fine)[-1] == (PRIMO, (150.0, 2))
+        assert len(periodi) == 2
+
+        # Una prenotazione esaurisce il volo: la tariffa minima torna quella dell'altro
+        prenota(passeggero_id, economico_id, 'economy', 10)
+        assert calendario_tariffe('FCO', 'MXP', inizio, fine)[0] == (ANTIVIGILIA, (120.0, 1))
+        assert len(periodi) == 3
+    finally:
+        ripristina()
+
+
+def test_endpoint(client, intestazioni, voli):
+    intest = intestazioni(client)
+
+    def calendario(**parametri):
+        parametri = {'aeroporto_partenza': 'FCO', 'aeroporto_arrivo': 'MXP', **parametri}
+        return client.get('/api/v1/flights/calendar', query_string=parametri, headers=intest)
+
+    risposta = calendario(data=VIGILIA.isoformat(), giorni=1)
+    assert risposta.status_code == 200
+    assert risposta.json['calendario'] == [
+        {'data': ANTIVIGILIA.isoformat(), 'prezzo_minimo': 90.0, 'voli': 2},
+        {'data': VIGILIA.isoformat(), 'prezzo_minimo': None, 'voli': 0},
+        {'data': PRIMO.isoformat(), 'prezzo_minimo': 150.0, 'voli': 2},
+    ]
+    risposta = calendario(data=PRIMO.isoformat(), giorni=0, passeggeri=4)
+    assert risposta.json['calendario'] == [{'data': PRIMO.isoformat(), 'prezzo_minimo': 200.0, 'voli': 1}]
+
+    # Al più 29 giorni per parte: 59 giorni in tutto
+    giorni = calendario(data=PRIMO.isoformat(), giorni=29).json['calendario']
+    assert len(giorni) == 59
+    assert giorni[0]['data'] == (PRIMO - timedelta(days=29)).isoformat()
+    assert giorni[-1]['data'] == (PRIMO + timedelta(days=29)).isoformat()
+    assert sum(g['voli'] for g in giorni) == 4
+    assert calendario(data=PRIMO.isoformat(), giorni=30).status_code == 400
+    assert calendario(data=PRIMO.isoformat(), giorni=-1).status_code == 400
+
@@ -0,0 +1,256 @@
+"""
+Verifica le chiavi di idempotenza delle prenotazioni API (app/idempotency.py).
+
+La stessa richiesta ripetuta con la stessa `Idempotency-Key` riceve la stessa
+risposta senza una seconda prenotazione; la chiave riusata con un altro corpo
+riceve 422; copie concorrenti della stessa richiesta creano una sola
+prenotazione. La riga di una richiesta rimasta in corso (processo morto prima
+di salvare la risposta) blocca le ripetizioni con 409 solo fino alla fine del
+lease, poi la richiesta viene eseguita.
+
+Gli errori transitori (database occupato, volo modificato nel frattempo)
+ricevono 503 o 409 e non vengono salvati, i posti esauriti sì. La risposta
+si salva con il commit della prenotazione, anche con il commit di gruppo; se
+il lotto non fa il commit in tempo la richiesta riceve 202 e le ripetizioni
+la risposta del lotto.
+
+Usa un database SQLite su file, condiviso dai thread delle copie concorrenti.
+"""
+import hashlib
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import event, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm.exc import StaleDataError
+
+from app import db
+from app.booking_writer import ScrittorePrenotazioni
+from app.models import Prenotazione, RichiestaIdempotente
+from app.routes import api
+
+COPIE = 8
+PERCORSO = '/api/v1/bookings'
+CONFIGURAZIONE = {
+    'RICERCA_USA_GRAFO': False, 'FILTRO_TRATTE': False,
+    'IDEMPOTENZA_ATTESA': 1, 'IDEMPOTENZA_IN_CORSO': 3, 'PRENOTAZIONI_LOTTO_TIMEOUT': 1,
+}
+DI_GRUPPO = {**CONFIGURAZIONE, 'PRENOTAZIONI_COMMIT_DI_GRUPPO': True}
+
+
+@pytest.fixture
+def configurazione():
+    return CONFIGURAZIONE
+
+
+@pytest.fixture
+def database_su_file():
+    return True
+
+
+@pytest.fixture
+def volo(app, dati):
+    """Volo da Roma a Milano con 50 posti; restituisce (id del volo, id del passeggero)."""
+    dati.aeroporti(('FCO', 'Roma'), ('MXP', 'Milano'))
+    dati.compagnia()
+    passeggero_id = dati.passeggero()
+    partenza = datetime.now().replace(microsecond=0) + timedelta(days=7)
+    volo_id = dati.volo('FCO', 'MXP', partenza, numero='TA100', posti=50).id
+    db.session.commit()
+    db.session.remove()
+    return volo_id, passeggero_id
+
+
+def prenota(client, intestazioni, corpo):
+    return client.post(PERCORSO, data=corpo, content_type='application/json', headers=intestazioni)
+
+
+def prenotazioni(app):
+    with app.app_context():
+        totale = db.session.query(Prenotazione).count()
+        db.session.remove()
+        return totale
+
+
+def test_ripetizione_e_chiave_riusata(app, client, intestazioni, volo):
+    volo_id, _ = volo
+    intest = {**intestazioni(client), 'Idempotency-Key': 'prenotazione-1'}
+    corpo = json.dumps({'volo_id': volo_id, 'classe': 'economy', 'passeggeri': 2})
+
+    prima = prenota(client, intest, corpo)
+    assert prima.status_code == 201
+    assert 'Idempotent-Replayed' not in prima.headers
+    seconda = prenota(client, intest, corpo)
+    assert seconda.status_code == 201
+    assert seconda.headers['Idempotent-Replayed'] == 'true'
+    assert seconda.json == prima.json
+    assert prenotazioni(app) == 1
+
+    # Stessa chiave, altra richiesta
+    altro = json.dumps({'volo_id': volo_id, 'classe': 'economy', 'passeggeri': 3})
+    assert prenota(client, intest, altro).status_code == 422
+    assert prenotazioni(app) == 1
+
+
+def test_copie_concorrenti(app, client, intestazioni, volo):
+    volo_id, _ = volo
+    intest = {**intestazioni(client), 'Idempotency-Key': 'prenotazione-concorrente'}
+    corpo = json.dumps({'volo_id': volo_id, 'classe': 'economy', 'passeggeri': 1})
+    barriera = threading.Barrier(COPIE)
+    lock = threading.Lock()
+    risposte = []
+
+    def copia():
+        client = app.test_client()
+        barriera.wait()
+        risposta = prenota(client, intest, corpo)
+        with lock:
+            risposte.append((risposta.status_code, risposta.json))
+
+    thread = [threading.Thread(target=copia) for _ in range(COPIE)]
+    for t in thread:
+        t.start()
+    for t in thread:
+        t.join()
+
+    assert [stato for stato, _ in risposte] == [201] * COPIE
+    assert len({corpo['prenotazione_id'] for _, corpo in risposte}) == 1
+    assert prenotazioni(app) == 1
+
+
+def test_lease_della_richiesta_in_corso(app, client, intestazioni, volo):
+    volo_id, passeggero_id = volo
+    intest = {**intestazioni(client), 'Idempotency-Key': 'prenotazione-interrotta'}
+    corpo = json.dumps({'volo_id': volo_id, 'classe': 'economy', 'passeggeri': 1})
+
+    # Riga lasciata da un processo morto dopo il commit della vista
+    impronta = hashlib.sha256(f'POST {PERCORSO}\n'.encode() + corpo.encode()).hexdigest()
+    with app.app_context():
+        db.session.add(RichiestaIdempotente(
+            user_id=passeggero_id, chiave='prenotazione-interrotta', impronta=impronta,
+            scadenza=datetime.now() + timedelta(seconds=app.config['IDEMPOTENZA_IN_CORSO'])
+        ))
+        db.session.commit()
+        db.session.remove()
+    assert prenota(client, intest, corpo).status_code == 409
+
+    # Finito il lease la ripetizione esegue la richiesta, con un nuovo lease
+    with app.app_context():
+        db.session.query(RichiestaIdempotente).update({'scadenza': datetime.now() - timedelta(seconds=1)})
+        db.session.commit()
+        db.session.remove()
+    durante_la_vista = []
+
+    def leggi_scadenza(mapper, connessione, prenotazione):
+        durante_la_vista.append(connessione.execute(select(RichiestaIdempotente.scadenza)).scalar())
+
+    event.listen(Prenotazione, 'after_insert', leggi_scadenza)
+    try:
+        assert prenota(client, intest, corpo).status_code == 201
+    finally:
+        event.remove(Prenotazione, 'after_insert', leggi_scadenza)
+    assert prenotazioni(app) == 1
+    assert durante_la_vista[0] <= datetime.now() + timedelta(seconds=app.config['IDEMPOTENZA_IN_CORSO'])
+
+    # Con la risposta salvata la chiave vale per IDEMPOTENZA_DURATA
+    with app.app_context():
+        riga = db.session.query(RichiestaIdempotente).one()
+        assert riga.stato_http == 201
+        assert riga.scadenza > datetime.now() + timedelta(seconds=app.config['IDEMPOTENZA_DURATA'] - 60)
+        db.session.remove()
+
+
+def righe_salvate(app):
+    with app.app_context():
+        stati = [stato for stato, in db.session.query(RichiestaIdempotente.stato_http)]
+        db.session.remove()
+        return stati
+
+
+def test_lease_dalla_durata_massima_della_prenotazione(crea_app):
+    assert crea_app().config['IDEMPOTENZA_IN_CORSO'] == 2 * 30 + 10
+    app = crea_app(PRENOTAZIONI_LOTTO_TIMEOUT=5, IDEMPOTENZA_ATTESA=2)
+    assert app.config['IDEMPOTENZA_IN_CORSO'] == 12
+
+
+@pytest.mark.parametrize('errore, stato', [
+    (OperationalError('UPDATE volo', {}, Exception('database is locked')), 503),
+    (StaleDataError('volo modificato'), 409),
+])
+def test_errori_transitori_non_salvati(app, client, intestazioni, volo, monkeypatch, errore, stato):
+    volo_id, _ = volo
+    intest = {**intestazioni(client), 'Idempotency-Key': 'prenotazione-transitoria'}
+    corpo = json.dumps({'volo_id': volo_id, 'classe': 'economy', 'passeggeri': 1})
+    originale = api.prenota
+
+    def fallisce(*args, **kwargs):
+        raise errore
+
+    monkeypatch.setattr(api, 'prenota', fallisce)
+    risposta = prenota(client, intest, corpo)
+    assert risposta.status_code == stato
+    assert righe_salvate(app) == []
+
+    # La ripetizione esegue di nuovo la prenotazione
+    monkeypatch.setattr(api, 'prenota', originale)
+    assert prenota(client, intest, corpo).status_code == 201
+    assert prenotazioni(app) == 1
+
+
+def test_posti_esauriti_salvati(app, client, intestazioni, volo):
+    volo_id, _ = volo
+    intest = {**intestazioni(client), 'Idempotency-Key': 'prenotazione-first'}
+    # Il volo non ha posti in first
+    corpo = json.dumps({'volo_id': volo_id, 'classe': 'first', 'passeggeri': 1})
+    assert prenota(client, intest, corpo).status_code == 400
+    assert righe_salvate(app) == [400]
+    ripetuta = prenota(client, intest, corpo)
+    assert ripetuta.status_code == 400
+    assert ripetuta.headers['Idempotent-Replayed'] == 'true'
+
+
+@pytest.mark.parametrize('configurazione', [CONFIGURAZIONE, DI_GRUPPO])
+def test_risposta_salvata_con_la_prenotazione(app, client, intestazioni, volo, monkeypatch):
+    volo_id, _ = volo
+    intest = {**intestazioni(client), 'Idempotency-Key': 'prenotazione-atomica'}
+    corpo = json.dumps({'volo_id': volo_id, 'classe': 'economy', 'passeggeri': 2})
+    originale = api.prenota
+    dopo_il_commit = []
+
+    def prenota_e_leggi(*args, **kwargs):
+        prenotazione = originale(*args, **kwargs)
+        # Se il processo morisse qui, la risposta sarebbe già salvata
+        dopo_il_commit.append(righe_salvate(app))
+        return prenotazione
+
+    monkeypatch.setattr(api, 'prenota', prenota_e_leggi)
+    risposta = prenota(client, intest, corpo)
+    assert risposta.status_code == 201
+    assert dopo_il_commit == [[201]]
+    ripetuta = prenota(client, intest, corpo)
+    assert ripetuta.json == risposta.json
+    assert prenotazioni(app) == 1
+
+
+@pytest.mark.parametrize('configurazione', [{**DI_GRUPPO, 'PRENOTAZIONI_LOTTO_TIMEOUT': 0.2}])
+def test_lotto_lento_esito_incerto(app, client, intestazioni, volo, monkeypatch):
+    volo_id, _ = volo
+    intest = {**intestazioni(client), 'Idempotency-Key': 'prenotazione-lenta'}
+    corpo = json.dumps({'volo_id': volo_id, 'classe': 'economy', 'passeggeri': 1})
+    scrivi = ScrittorePrenotazioni._scrivi
+
+    def scrivi_lento(self, lotto):
+        time.sleep(0.6)
+        scrivi(self, lotto)
+
+    monkeypatch.setattr(ScrittorePrenotazioni, '_scrivi', scrivi_lento)
+    # Il lotto supera le due attese: l'esito non è ancora noto
+    assert prenota(client, intest, corpo).status_code == 202
+    # La ripetizione aspetta il commit del lotto e riceve la sua risposta
+    ripetuta = prenota(client, intest, corpo)
+    assert ripetuta.status_code == 201
+    assert ripetuta.headers['Idempotent-Replayed'] == 'true'
+    assert prenotazioni(app) == 1
@@ -0,0 +1,95 @@
+"""
+Verifica le risposte NDJSON in streaming dell'API (`Accept: application/x-ndjson`).
+
+La ricerca voli in NDJSON restituisce una riga JSON per risultato, prima i
+voli diretti e poi quelli con scalo, senza limite: gli stessi risultati della
+risposta JSON, e dal cursore in poi se la richiesta ne ha uno. Le
+prenotazioni dell'utente in NDJSON sono le stesse della risposta JSON. Senza
+l'header `Accept` la risposta resta JSON.
+"""
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import db
+from app.models import Prenotazione, Biglietto
+
+GIORNO = (datetime.now() + timedelta(days=7)).replace(hour=0, minute=0, second=0, microsecond=0)
+NDJSON = 'application/x-ndjson'
+
+
+@pytest.fixture
+def configurazione():
+    return {'FILTRO_TRATTE': False}
+
+
+@pytest.fixture
+def passeggero_id(app, dati):
+    dati.aeroporti(('FCO', 'Roma'), ('MXP', 'Milano'), ('CDG', 'Parigi'))
+    dati.compagnia()
+    passeggero_id = dati.passeggero()
+    voli = [('FCO', 'CDG', 6 + i, 100 + i * 10) for i in range(5)]
+    voli += [('FCO', 'MXP', 6, 50), ('MXP', 'CDG', 10, 50), ('MXP', 'CDG', 12, 70)]
+    for partenza, arrivo, ora, prezzo in voli:
+        dati.volo(partenza, arrivo, GIORNO + timedelta(hours=ora), prezzo=prezzo)
+    db.session.commit()
+    return passeggero_id
+
+
+def prenota(utente_id, volo_id, passeggeri):
+    prenotazione = Prenotazione(user_id=utente_id, stato='confermata', prezzo_totale=100 * passeggeri)
+    db.session.add(prenotazione)
+    db.session.flush()
+    db.session.add_all([
+        Biglietto(booking_id=prenotazione.id, flight_id=volo_id, passeggero_id=utente_id,
+                  classe='economy', numero_posto=f'{i + 1}A', prezzo=100)
+        for i in range(passeggeri)
+    ])
+    db.session.commit()
+
+
+def righe_ndjson(risposta):
+    assert risposta.status_code == 200
+    assert risposta.mimetype == NDJSON
+    testo = risposta.get_data(as_text=True)
+    assert testo.endswith('\n')
+    return [json.loads(riga) for riga in testo.splitlines()]
+
+
+def test_ricerca_in_ndjson(client, intestazioni, passeggero_id):
+    ricerca = {'aeroporto_partenza': 'FCO', 'aeroporto_arrivo': 'CDG',
+               'data': GIORNO.date().isoformat(), 'passeggeri': 1}
+
+    pagina = client.post('/api/v1/flights/search', json={**ricerca, 'limite': 100},
+                         headers=intestazioni(client))
+    assert pagina.mimetype == 'application/json'
+    righe = righe_ndjson(client.post('/api/v1/flights/search', json=ricerca,
+                                     headers=intestazioni(client, Accept=NDJSON)))
+
+    tipi = [riga.pop('tipo') for riga in righe]
+    assert tipi == ['diretto'] * 5 + ['scalo'] * 2
+    assert righe[:5] == pagina.json['voli_diretti']
+    assert righe[5:] == pagina.json['voli_scalo']
+
+    # Dal cursore della prima pagina in poi
+    prima = client.post('/api/v1/flights/search', json={**ricerca, 'limite': 2},
+                        headers=intestazioni(client)).json
+    seguito = righe_ndjson(client.post(
+        '/api/v1/flights/search',
+        json={**ricerca, 'cursore_diretti': prima['paginazione']['cursore_diretti']},
+        headers=intestazioni(client, Accept=NDJSON)
+    ))
+    diretti = [riga['id'] for riga in seguito if riga['tipo'] == 'diretto']
+    assert diretti == [v['id'] for v in pagina.json['voli_diretti'][2:]]
+
+
+def test_prenotazioni_in_ndjson(client, intestazioni, passeggero_id):
+    for volo_id in (1, 2, 3):
+        prenota(passeggero_id, volo_id, volo_id)
+
+    completa = client.get('/api/v1/bookings', headers=intestazioni(client)).json['prenotazioni']
+    righe = righe_ndjson(client.get('/api/v1/bookings', headers=intestazioni(client, Accept=NDJSON)))
+    assert len(righe) == 3
+    assert righe == completa
+    assert sorted(len(p['biglietti']) for p in righe) == [1, 2, 3]
@@ -0,0 +1,107 @@
+"""
+Verifica la paginazione per chiave della ricerca voli (`cursore_diretti` e
+`cursore_scalo` di /api/v1/flights/search).
+
+I cursori si codificano e decodificano senza perdere la chiave, e un cursore
+non valido o di un altro ordinamento viene rifiutato. Scorrendo i risultati
+pagina per pagina, con molti prezzi e durate uguali, si ottengono tutti i
+risultati della ricerca senza limite, nello stesso ordine, senza duplicati:
+per i voli diretti, per gli itinerari sul grafo e con la query SQL.
+"""
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import pytest
+
+from app import db
+from app.queries import cerca_voli_diretti, chiave_ordinamento, codifica_cursore, decodifica_cursore
+from app.route_graph import cerca_itinerari, motore
+
+GIORNO = (datetime.now() + timedelta(days=7)).replace(hour=0, minute=0, second=0, microsecond=0)
+# (partenza, arrivo, ora, durata in ore, prezzo): prezzi e durate ripetuti
+VOLI = [
+    ('FCO', 'MXP', 6, 1, 100), ('FCO', 'MXP', 7, 1, 100), ('FCO', 'MXP', 8, 2, 90),
+    ('FCO', 'MXP', 9, 1, 120), ('FCO', 'MXP', 10, 2, 90), ('FCO', 'MXP', 11, 1, 100),
+    ('FCO', 'MXP', 12, 1.5, 150),
+    ('MXP', 'CDG', 15, 1, 80), ('MXP', 'CDG', 16, 1, 80), ('MXP', 'CDG', 17, 2, 60),
+]
+
+
+@pytest.fixture
+def usa_grafo():
+    return True
+
+
+@pytest.fixture
+def configurazione(usa_grafo):
+    return {'RICERCA_USA_GRAFO': usa_grafo, 'FILTRO_TRATTE': False}
+
+
+@pytest.fixture
+def voli(app, dati):
+    dati.aeroporti(('FCO', 'Roma'), ('MXP', 'Milano'), ('CDG', 'Parigi'))
+    dati.compagnia()
+    for partenza, arrivo, ora, durata, prezzo in VOLI:
+        dati.volo(partenza, arrivo, GIORNO + timedelta(hours=ora), durata=durata, prezzo=prezzo)
+    db.session.commit()
+    motore.svuota()
+
+
+def sfoglia(cerca, ordina_per, limite):
+    """Tutte le pagine di una ricerca, passando il cursore codificato come fa l'API."""
+    risultati, cursore = [], None
+    while True:
+        pagina = cerca(cursore, limite)
+        assert len(pagina) <= limite
+        risultati.extend(pagina)
+        if len(pagina) < limite:
+            return risultati
+        testo = codifica_cursore(chiave_ordinamento(pagina[-1], ordina_per), ordina_per)
+        cursore = decodifica_cursore(testo, ordina_per)
+
+
+def verifica_pagine(cerca, ordina_per):
+    tutti = [chiave_ordinamento(r, ordina_per) for r in cerca(None, None)]
+    assert tutti == sorted(tutti)
+    assert len(set(tutti)) == len(tutti)
+    for limite in (1, 2, 3, 4):
+        pagine = [chiave_ordinamento(r, ordina_per) for r in sfoglia(cerca, ordina_per, limite)]
+        assert pagine == tutti, f'pagine da {limite} diverse dalla ricerca completa'
+    return tutti
+
+
+def test_cursore_andata_e_ritorno():
+    for chiave, ordina_per in (((Decimal('99.90'), (3,)), 'prezzo'), ((5400.0, (4, 9)), 'tempo')):
+        assert decodifica_cursore(codifica_cursore(chiave, ordina_per), ordina_per) == chiave
+    cursore = codifica_cursore((Decimal('100'), (1,)), 'prezzo')
+    for testo, ordina_per in ((cursore, 'tempo'), ('non-un-cursore', 'prezzo'), ('', 'prezzo')):
+        try:
+            decodifica_cursore(testo, ordina_per)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f'cursore {testo!r} accettato per {ordina_per}')
+
+
+def test_pagine_voli_diretti(voli):
+    for ordina_per in ('prezzo', 'tempo'):
+        tutti = verifica_pagine(
+            lambda cursore, limite: cerca_voli_diretti(
+                'FCO', 'MXP', GIORNO, ordina_per=ordina_per, cursore=cursore, limite=limite
+            ),
+            ordina_per
+        )
+        assert len(tutti) == 7
+
+
+@pytest.mark.parametrize('usa_grafo', [True, False])
+def test_pagine_itinerari(usa_grafo, voli):
+    for ordina_per in ('prezzo', 'tempo'):
+        tutti = verifica_pagine(
+            lambda cursore, limite: cerca_itinerari(
+                'FCO', 'CDG', GIORNO, ordina_per=ordina_per, cursore=cursore, limite=limite
+            ),
+            ordina_per
+        )
+        # Tutte le coppie tranne TA7 + TA8: 1h30 a Milano, meno delle 2 ore minime
+        assert len(tutti) == 7 * 3 - 1
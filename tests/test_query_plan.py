@@ -0,0 +1,100 @@
+"""
+Verifica che le query di ricerca voli usino gli indici su `volo` e `coincidenza`.
+
+Le query vengono catturate mentre `cerca_voli_diretti` e `cerca_voli_scalo`
+girano davvero, poi rieseguite con EXPLAIN. Il test fallisce se il piano
+torna a una scansione sequenziale della tabella `volo` o `coincidenza` (ad
+esempio se il filtro sulla data viene di nuovo avvolto in `func.date`). La
+ricerca con scalo si verifica sia sulla tabella delle coincidenze sia, con
+`RICERCA_USA_COINCIDENZE = False`, con il self-join di `volo`.
+
+Usa SQLite in memoria; per provarlo su PostgreSQL impostare TEST_DATABASE_URL.
+"""
+import re
+from datetime import datetime, timedelta
+from functools import partial
+
+import pytest
+from sqlalchemy import event
+
+from app import db
+from app.queries import cerca_voli_diretti, cerca_voli_scalo
+
+SCANSIONE_SEQUENZIALE = {
+    'sqlite': re.compile(r'\bSCAN (TABLE )?(volo|coincidenza)\b'),
+    'postgresql': re.compile(r'Seq Scan on (volo|coincidenza)\b'),
+}
+
+
+@pytest.fixture
+def giorno(app, dati):
+    dati.aeroporti(('FCO', 'Roma'), ('MXP', 'Milano'), ('CDG', 'Parigi'))
+    dati.compagnia()
+    giorno = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=7)
+    tratte = [('FCO', 'MXP'), ('MXP', 'CDG'), ('FCO', 'CDG')]
+    for i in range(60):
+        partenza, arrivo = tratte[i % len(tratte)]
+        dati.volo(partenza, arrivo, giorno + timedelta(days=i // 6, hours=6 + i % 6 * 2), durata=2,
+                  numero=f'TA{100 + i}', posti={'economy': 100, 'business': 20, 'first': 10})
+    db.session.commit()
+    return giorno
+
+
+def cattura_query(funzione, *args):
+    """Esegue `funzione` e restituisce le SELECT inviate al database."""
+    catturate = []
+
+    def registra(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            catturate.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', registra)
+    try:
+        funzione(*args)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', registra)
+    return catturate
+
+
+def piano_di_esecuzione(statement, parameters):
+    dialetto = db.engine.dialect.name
+    with db.engine.connect() as connection:
+        if dialetto == 'postgresql':
+            # Su tabelle piccole il planner preferisce comunque la scansione
+            # sequenziale: la si scoraggia per vedere se un indice è utilizzabile
+            connection.exec_driver_sql('SET enable_seqscan = off')
+            righe = connection.exec_driver_sql('EXPLAIN ' + statement, parameters).fetchall()
+            return '\n'.join(r[0] for r in righe)
+        righe = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+        return '\n'.join(r[-1] for r in righe)
+
+
+def verifica_piani(funzione, *args, tabella='volo'):
+    """Controlla i piani delle query di `funzione`, che devono leggere `tabella`."""
+    query = cattura_query(funzione, *args)
+    assert query, 'nessuna query catturata'
+    assert any(re.search(rf'\bFROM {tabella}\b', statement) for statement, _ in query), (
+        f'nessuna query su {tabella}'
+    )
+
+    scansione = SCANSIONE_SEQUENZIALE[db.engine.dialect.name]
+    for statement, parameters in query:
+        piano = piano_di_esecuzione(statement, parameters)
+        assert not scansione.search(piano), (
+            f'scansione sequenziale su volo:\n{piano}\n\nper la query:\n{statement}'
+        )
+
+
+def test_cerca_voli_diretti_usa_indice(giorno):
+    verifica_piani(cerca_voli_diretti, 'FCO', 'MXP', giorno)
+
+
+@pytest.mark.parametrize('configurazione', [{'RICERCA_USA_COINCIDENZE': False}])
+def test_cerca_voli_scalo_usa_indice(giorno):
+    # Self-join di `volo`, senza la tabella delle coincidenze
+    verifica_piani(partial(cerca_voli_scalo, usa_coincidenze=False), 'Roma', 'Parigi', giorno)
+
+
+@pytest.mark.parametrize('configurazione', [{'RICERCA_USA_COINCIDENZE': True}])
+def test_cerca_voli_scalo_su_coincidenze_usa_indice(giorno):
+    verifica_piani(cerca_voli_scalo, 'Roma', 'Parigi', giorno, tabella='coincidenza')
@@ -0,0 +1,87 @@
+"""
+Verifica il fronte di Pareto e la classifica di app/ranking.py.
+
+`fronte_pareto` è confrontato con la definizione di dominanza applicata a
+coppie, su casi costruiti a mano (criteri uguali, pareggi su un criterio) e
+su candidati casuali con molti valori ripetuti. Per `classifica` si controlla
+che il fronte venga prima degli altri candidati e che migliore, più
+economico e più veloce restino nei primi k.
+"""
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import numpy as np
+
+from app.ranking import fronte_pareto, classifica, MIGLIORE, PIÙ_ECONOMICO, PIÙ_VELOCE
+
+PARTENZA = datetime(2030, 1, 1, 8)
+
+
+def domina(a, b):
+    return all(x <= y for x, y in zip(a, b)) and any(x < y for x, y in zip(a, b))
+
+
+def fronte_a_coppie(prezzo, durata, scali):
+    punti = list(zip(prezzo, durata, scali))
+    return np.array([not any(domina(altro, punto) for altro in punti) for punto in punti], dtype=bool)
+
+
+def fronte(*criteri):
+    return fronte_pareto(*(np.array(c, dtype=np.float64) for c in zip(*criteri))).tolist()
+
+
+def test_fronte_casi():
+    assert fronte_pareto(np.zeros(0), np.zeros(0), np.zeros(0)).tolist() == []
+    # Il secondo è peggiore solo nel prezzo, il terzo solo negli scali
+    assert fronte((100, 3600, 0), (120, 3600, 0), (100, 3600, 1)) == [True, False, False]
+    # Criteri identici: nessuno dei due domina l'altro
+    assert fronte((100, 3600, 0), (100, 3600, 0)) == [True, True]
+    # Compromessi: ognuno è migliore degli altri in un criterio
+    assert fronte((100, 9000, 1), (200, 3600, 1), (300, 7200, 0)) == [True, True, True]
+    # Più economico ma più lento e con più scali: resta sul fronte
+    assert fronte((300, 3600, 0), (80, 20000, 2), (90, 20000, 2)) == [True, True, False]
+    # Dominato da un candidato con meno scali e stessa durata
+    assert fronte((100, 7200, 0), (100, 7200, 1), (90, 7200, 1)) == [True, False, True]
+
+
+def test_fronte_casuale():
+    generatore = np.random.default_rng(42)
+    for _ in range(200):
+        n = int(generatore.integers(1, 40))
+        prezzo = generatore.integers(50, 60, n).astype(np.float64)
+        durata = generatore.integers(1, 8, n).astype(np.float64) * 1800
+        scali = generatore.integers(0, 3, n).astype(np.float64)
+        assert fronte_pareto(prezzo, durata, scali).tolist() == fronte_a_coppie(prezzo, durata, scali).tolist()
+
+
+def diretto(prezzo, ore):
+    return SimpleNamespace(prezzo=prezzo, data_partenza=PARTENZA, data_arrivo=PARTENZA + timedelta(hours=ore))
+
+
+def itinerario(prezzo, ore, scali):
+    return SimpleNamespace(prezzo=lambda classe: prezzo, scali=scali,
+                           data_partenza=PARTENZA, data_arrivo=PARTENZA + timedelta(hours=ore))
+
+
+def test_classifica():
+    diretti = [diretto(300, 2), diretto(350, 2), diretto(400, 3)]
+    itinerari = [itinerario(100, 9, 1), itinerario(150, 6, 1), itinerario(160, 6, 2), itinerario(90, 20, 2)]
+    proposte = classifica(diretti, itinerari, k=10)
+
+    assert len(proposte) == 7
+    pareto = [p.pareto for p in proposte]
+    # Prima tutto il fronte, poi i dominati
+    assert pareto == sorted(pareto, reverse=True)
+    assert {(p.prezzo, p.durata) for p in proposte if p.pareto} == {
+        (300, 7200), (100, 32400), (150, 21600), (90, 72000)
+    }
+    assert proposte[0].etichette[0] == MIGLIORE
+    per_etichetta = {e: p for p in proposte for e in p.etichette}
+    assert per_etichetta[PIÙ_ECONOMICO].prezzo == 90
+    assert per_etichetta[PIÙ_VELOCE].risultato is diretti[0]
+
+    # Con k piccolo il più economico e il più veloce restano nella classifica
+    primi = classifica(diretti, itinerari, k=2, pesi={'prezzo': 0, 'durata': 0, 'scali': 1})
+    etichette = {e for p in primi for e in p.etichette}
+    assert etichette == {MIGLIORE, PIÙ_ECONOMICO, PIÙ_VELOCE}
+    assert len(primi) == len({id(p.risultato) for p in primi}) <= 3
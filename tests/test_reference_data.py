@@ -0,0 +1,85 @@
+"""
+Verifica la cache dei dati di riferimento (app/reference_data.py).
+
+Aeroporti e compagnie letti dalla cache non fanno query; una modifica fatta
+con l'ORM si vede dopo il commit, una annullata con il rollback non resta in
+cache, e una modifica fatta fuori dall'ORM si vede solo dopo
+`RIFERIMENTI_TTL` secondi.
+"""
+import pytest
+from sqlalchemy import event, update
+
+from app import db
+from app.models import Utente, CompagniaAerea, Aeroporto
+from app.reference_data import riferimenti, aeroporto, compagnia_di_utente
+
+
+@pytest.fixture
+def configurazione():
+    return {'RIFERIMENTI_TTL': 300}
+
+
+@pytest.fixture
+def ids(app, dati):
+    """Restituisce (id di Fiumicino, id dell'utente della compagnia)."""
+    aeroporti = dati.aeroporti(('FCO', 'Roma', 'Fiumicino', 'Italia'), ('MXP', 'Milano', 'Malpensa', 'Italia'))
+    utente_id = db.session.get(CompagniaAerea, dati.compagnia()).utente_id
+    db.session.commit()
+    return aeroporti['FCO'], utente_id
+
+
+def conta_query():
+    query = []
+    event.listen(db.engine, 'before_cursor_execute', lambda *args: query.append(args[2]))
+    return query
+
+
+def test_letture_dalla_cache(ids):
+    roma_id, utente_id = ids
+    riferimenti.generazione()
+    query = conta_query()
+    assert aeroporto(roma_id).città == 'Roma'
+    assert riferimenti.aeroporto_per_codice(' fco ').id == roma_id
+    assert compagnia_di_utente(str(utente_id)).codice_iata == 'TA'
+    assert riferimenti.compagnia_per_codice('ta').nome_compagnia == 'Test Airlines'
+    assert [a.codice_iata for a in riferimenti.tutti_aeroporti()] == ['FCO', 'MXP']
+    assert aeroporto(-1) is None
+    assert query == []
+
+
+def test_invalidazione_al_commit_e_al_rollback(ids):
+    roma_id, utente_id = ids
+    generazione = riferimenti.generazione()
+
+    # Letta a metà transazione, la modifica annullata non resta in cache
+    db.session.get(Aeroporto, roma_id).nome = 'Leonardo da Vinci'
+    db.session.flush()
+    assert aeroporto(roma_id).nome == 'Leonardo da Vinci'
+    db.session.rollback()
+    assert aeroporto(roma_id).nome == 'Fiumicino'
+
+    db.session.add(Aeroporto(codice_iata='CIA', nome='Ciampino', città='Roma', paese='Italia'))
+    db.session.get(CompagniaAerea, compagnia_di_utente(utente_id).id).nome_compagnia = 'Nuova Airlines'
+    db.session.commit()
+    assert riferimenti.aeroporto_per_codice('CIA').città == 'Roma'
+    assert riferimenti.compagnia_per_codice('TA').nome_compagnia == 'Nuova Airlines'
+    assert riferimenti.generazione() > generazione
+
+    # Le altre tabelle non invalidano la cache
+    generazione = riferimenti.generazione()
+    utente = db.session.get(Utente, utente_id)
+    utente.nome = 'Altro'
+    db.session.commit()
+    assert riferimenti.generazione() == generazione
+
+
+@pytest.mark.parametrize('configurazione, nome', [
+    ({'RIFERIMENTI_TTL': 300}, 'Fiumicino'),
+    ({'RIFERIMENTI_TTL': 0}, 'Leonardo da Vinci'),
+])
+def test_modifiche_fuori_dall_orm(ids, nome):
+    roma_id, _ = ids
+    aeroporto(roma_id)
+    db.session.execute(update(Aeroporto).where(Aeroporto.id == roma_id).values(nome='Leonardo da Vinci'))
+    db.session.commit()
+    assert aeroporto(roma_id).nome == nome
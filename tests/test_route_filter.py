@@ -0,0 +1,85 @@
+"""
+Verifica che il filtro delle tratte (app/route_filter.py) non scarti mai una
+ricerca che ha risultati.
+
+Il filtro viene costruito con pochi voli e poi si inseriscono voli a più
+riprese, con commit, e se ne sposta uno in un altro giorno: dopo ogni passo
+le ricerche dirette e con scalo di ogni coppia di città e di ogni giorno
+devono dare gli stessi risultati con e senza filtro, e il filtro deve aver
+evitato almeno una query.
+"""
+import random
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select
+
+from app import db
+from app.models import Volo
+from app.queries import cerca_voli_diretti, cerca_voli_scalo
+from app.route_filter import filtro_tratte
+
+OGGI = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+CITTÀ = (('FCO', 'Roma'), ('MXP', 'Milano'), ('CDG', 'Parigi'), ('MAD', 'Madrid'))
+GIORNI = 6
+
+
+@pytest.fixture
+def configurazione():
+    return {'FILTRO_TRATTE': True, 'RICERCA_USA_GRAFO': False}
+
+
+def aggiungi_voli(dati, generatore, n):
+    for _ in range(n):
+        partenza, arrivo = generatore.sample([codice for codice, _ in CITTÀ], 2)
+        data_partenza = OGGI + timedelta(days=generatore.randrange(1, GIORNI), hours=generatore.randrange(5, 22))
+        numero = f'TA{generatore.randrange(10000)}'
+        dati.volo(partenza, arrivo, data_partenza, durata=generatore.randrange(1, 4), numero=numero)
+    db.session.commit()
+
+
+def risultati(app, filtro):
+    app.config['FILTRO_TRATTE'] = filtro
+    trovati = {}
+    for partenza, _ in CITTÀ:
+        for arrivo, _ in CITTÀ:
+            if partenza == arrivo:
+                continue
+            for giorno in range(GIORNI + 1):
+                data = OGGI + timedelta(days=giorno)
+                trovati[(partenza, arrivo, giorno)] = (
+                    [v.id for v in cerca_voli_diretti(partenza, arrivo, data)],
+                    [(s.volo1_id, s.volo2_id) for s in cerca_voli_scalo(partenza, arrivo, data)],
+                )
+    app.config['FILTRO_TRATTE'] = True
+    return trovati
+
+
+def confronta(app):
+    evitate = filtro_tratte.evitate
+    con_filtro = risultati(app, True)
+    assert filtro_tratte.evitate > evitate
+    assert con_filtro == risultati(app, False)
+    return con_filtro
+
+
+def test_nessun_falso_negativo(app, dati):
+    generatore = random.Random(7)
+    dati.aeroporti(*CITTÀ)
+    dati.compagnia()
+    aggiungi_voli(dati, generatore, 3)
+    filtro_tratte.ricostruisci(app.config['FILTRO_TRATTE_GIORNI'])
+    prima = confronta(app)
+
+    # Voli inseriti dopo la costruzione del filtro
+    for _ in range(3):
+        aggiungi_voli(dati, generatore, 4)
+        dopo = confronta(app)
+    assert sum(bool(d or s) for d, s in dopo.values()) > sum(bool(d or s) for d, s in prima.values())
+
+    # Un volo spostato in un giorno in cui la tratta non aveva voli
+    volo = db.session.scalars(select(Volo).order_by(Volo.id)).first()
+    volo.data_partenza += timedelta(days=3)
+    volo.data_arrivo += timedelta(days=3)
+    db.session.commit()
+    confronta(app)
@@ -0,0 +1,135 @@
+"""
+Verifica la ricerca di itinerari sul grafo orario (app/route_graph.py).
+
+Tra Roma e Parigi ci sono un volo diretto, un itinerario con uno scalo a
+Milano, uno con due scali (Francoforte e Londra) e una coincidenza a Milano
+troppo stretta per il tempo minimo di scalo. Si controllano i voli diretti
+(0 scali), il numero minimo e massimo di scali, il tempo minimo di
+coincidenza e che i grafi in memoria vengano invalidati dopo il commit e dopo
+il rollback di una transazione che inserisce un volo. Un volo di una compagnia
+assente dai dati di riferimento resta fuori dal grafo. Gli itinerari escono
+in ordine di prezzo o durata e al più `max_itinerari`; limite e cursore si
+applicano durante la visita del grafo.
+
+Usa un database SQLite su file: la sessione che ricostruisce il grafo durante
+la transazione di un'altra deve vedere solo i dati committati.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import db
+from app.queries import chiave_ordinamento
+from app.route_graph import motore
+
+GIORNO = (datetime.now() + timedelta(days=7)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+@pytest.fixture
+def configurazione():
+    return {'FILTRO_TRATTE': False}
+
+
+@pytest.fixture
+def database_su_file():
+    return True
+
+
+@pytest.fixture(autouse=True)
+def voli(app, dati):
+    dati.aeroporti(('FCO', 'Roma'), ('MXP', 'Milano'), ('CDG', 'Parigi'), ('FRA', 'Francoforte'), ('LHR', 'Londra'))
+    dati.compagnia()
+    for numero, partenza, arrivo, ora, durata in (
+        ('TA1', 'FCO', 'CDG', 8, 2),      # diretto
+        ('TA2', 'FCO', 'MXP', 6, 1),      # 1 scalo: TA2 + TA3, 2h30 a Milano
+        ('TA3', 'MXP', 'CDG', 9.5, 1.5),
+        ('TA4', 'MXP', 'CDG', 7.5, 1.5),  # TA2 + TA4: solo 30 minuti a Milano
+        ('TA5', 'FCO', 'FRA', 6, 2),      # 2 scali: TA5 + TA6 + TA7
+        ('TA6', 'FRA', 'LHR', 10.5, 1),
+        ('TA7', 'LHR', 'CDG', 14, 1),
+    ):
+        aggiungi_volo(dati, partenza, arrivo, numero, ora, durata)
+    db.session.commit()
+    motore.svuota()
+
+
+def aggiungi_volo(dati, partenza, arrivo, numero, ora, durata, **altro):
+    return dati.volo(partenza, arrivo, GIORNO + timedelta(hours=ora), durata=durata, numero=numero, **altro)
+
+
+def numeri(itinerari):
+    return {tuple(t.numero_volo for t in i.tratte) for i in itinerari}
+
+
+def test_scali_e_tempo_di_coincidenza():
+    tutti = numeri(motore.cerca('FCO', 'CDG', GIORNO, min_scali=0, max_scali=2))
+    assert tutti == {('TA1',), ('TA2', 'TA3'), ('TA5', 'TA6', 'TA7')}
+    assert numeri(motore.cerca('FCO', 'CDG', GIORNO, min_scali=0, max_scali=0)) == {('TA1',)}
+    assert numeri(motore.cerca('FCO', 'CDG', GIORNO, max_scali=1)) == {('TA2', 'TA3')}
+    assert numeri(motore.cerca('FCO', 'CDG', GIORNO, min_scali=2)) == {('TA5', 'TA6', 'TA7')}
+    # Con 20 minuti di coincidenza anche TA2 + TA4 è valido
+    assert ('TA2', 'TA4') in numeri(
+        motore.cerca('FCO', 'CDG', GIORNO, max_scali=1, tempo_min_scalo=timedelta(minutes=20))
+    )
+    # Per città: Parigi è la stessa destinazione di CDG
+    assert numeri(motore.cerca('Roma', 'Parigi', GIORNO, max_scali=1)) == {('TA2', 'TA3')}
+
+
+def test_grafo_invalidato_al_commit_e_al_rollback(app, dati):
+    assert numeri(motore.cerca('FCO', 'CDG', GIORNO, max_scali=1)) == {('TA2', 'TA3')}
+
+    # Rollback: un volo inserito e visto dal grafo nella stessa
+    # transazione sparisce dal grafo
+    aggiungi_volo(dati, 'MXP', 'CDG', 'TA8', 12, 1)
+    db.session.flush()
+    assert ('TA2', 'TA8') in numeri(motore.cerca('FCO', 'CDG', GIORNO, max_scali=1))
+    db.session.rollback()
+    assert numeri(motore.cerca('FCO', 'CDG', GIORNO, max_scali=1)) == {('TA2', 'TA3')}
+
+    # Commit: un'altra sessione ricostruisce il grafo tra il flush e il
+    # commit, senza il volo non ancora committato
+    aggiungi_volo(dati, 'FCO', 'MXP', 'TA9', 5, 1)
+    db.session.flush()
+    with app.app_context():
+        assert ('TA9', 'TA3') not in numeri(motore.cerca('FCO', 'CDG', GIORNO, max_scali=1))
+        db.session.remove()
+    db.session.commit()
+    assert ('TA9', 'TA3') in numeri(motore.cerca('FCO', 'CDG', GIORNO, max_scali=1))
+
+
+def test_volo_senza_compagnia_escluso(dati):
+    # Compagnia inesistente: SQLite non controlla le chiavi esterne
+    aggiungi_volo(dati, 'MXP', 'CDG', 'XX1', 12, 1, compagnia_id=9999)
+    db.session.commit()
+    assert numeri(motore.cerca('FCO', 'CDG', GIORNO, max_scali=1)) == {('TA2', 'TA3')}
+
+
+def test_ordine_e_numero_massimo():
+    ordine = [('TA1',), ('TA2', 'TA3'), ('TA5', 'TA6', 'TA7')]
+    for ordina_per in ('prezzo', 'tempo'):
+        itinerari = motore.cerca('FCO', 'CDG', GIORNO, min_scali=0, max_scali=2, ordina_per=ordina_per)
+        assert [tuple(t.numero_volo for t in i.tratte) for i in itinerari] == ordine
+    massimo = motore.max_itinerari
+    motore.max_itinerari = 2
+    try:
+        itinerari = motore.cerca('FCO', 'CDG', GIORNO, min_scali=0, max_scali=2)
+    finally:
+        motore.max_itinerari = massimo
+    assert [tuple(t.numero_volo for t in i.tratte) for i in itinerari] == ordine[:2]
+
+
+def test_limite_e_cursore():
+    pagine = []
+    cursore = None
+    while True:
+        pagina = motore.cerca('FCO', 'CDG', GIORNO, min_scali=0, max_scali=2, cursore=cursore, limite=1)
+        if not pagina:
+            break
+        pagine.append(tuple(t.numero_volo for t in pagina[0].tratte))
+        cursore = chiave_ordinamento(pagina[0])
+    assert pagine == [('TA1',), ('TA2', 'TA3'), ('TA5', 'TA6', 'TA7')]
+
+    # La visita procede solo quando si leggono gli itinerari
+    itinerari = motore.scorri('FCO', 'CDG', GIORNO, min_scali=0, max_scali=2)
+    assert tuple(t.numero_volo for t in next(itinerari).tratte) == ('TA1',)
+    itinerari.close()
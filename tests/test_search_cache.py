@@ -0,0 +1,90 @@
+"""
+Verifica la cache dei risultati di ricerca (app/search_cache.py).
+
+La seconda ricerca uguale è servita dalla cache, una ricerca diversa no; un
+volo inserito sulla tratta toglie dalla cache le ricerche che lo
+includerebbero dopo il flush, di nuovo dopo il commit (se un'altra sessione
+ha letto i dati vecchi nel frattempo) e dopo il rollback (se la stessa
+sessione ha letto il volo poi annullato).
+
+Usa un database SQLite su file: la sessione che legge durante la transazione
+di un'altra deve vedere solo i dati committati.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import db
+from app.search_cache import cache_ricerca, cerca_diretti
+
+GIORNO = (datetime.now() + timedelta(days=7)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+@pytest.fixture
+def configurazione():
+    return {'RICERCA_USA_GRAFO': False, 'FILTRO_TRATTE': False}
+
+
+@pytest.fixture
+def database_su_file():
+    return True
+
+
+@pytest.fixture(autouse=True)
+def volo(app, dati):
+    dati.aeroporti(('FCO', 'Roma'), ('MXP', 'Milano'))
+    dati.compagnia()
+    aggiungi_volo(dati, 'TA1', 8)
+    db.session.commit()
+    cache_ricerca.svuota()
+
+
+def aggiungi_volo(dati, numero, ora):
+    return dati.volo('FCO', 'MXP', GIORNO + timedelta(hours=ora), numero=numero)
+
+
+def numeri(passeggeri=1):
+    return sorted(v.numero_volo for v in cerca_diretti('FCO', 'MXP', GIORNO, passeggeri=passeggeri))
+
+
+def test_hit_e_miss():
+    prima = cache_ricerca.statistiche()
+    assert numeri() == ['TA1']
+    assert numeri() == ['TA1']
+    # Altri passeggeri: un'altra chiave
+    assert numeri(passeggeri=2) == ['TA1']
+    dopo = cache_ricerca.statistiche()
+    assert dopo['miss'] - prima['miss'] == 2
+    assert dopo['hit'] - prima['hit'] == 1
+    assert dopo['voci'] == 2
+
+
+def test_invalidazione_al_flush(dati):
+    assert numeri() == ['TA1']
+    aggiungi_volo(dati, 'TA2', 10)
+    db.session.flush()
+    assert cache_ricerca.statistiche()['voci'] == 0
+    assert numeri() == ['TA1', 'TA2']
+    db.session.commit()
+
+
+def test_invalidazione_al_commit(app, dati):
+    assert numeri() == ['TA1']
+    aggiungi_volo(dati, 'TA2', 10)
+    db.session.flush()
+    # Un'altra sessione rimette in cache il risultato senza il volo non committato
+    with app.app_context():
+        assert numeri() == ['TA1']
+        db.session.remove()
+    db.session.commit()
+    assert numeri() == ['TA1', 'TA2']
+
+
+def test_invalidazione_al_rollback(dati):
+    assert numeri() == ['TA1']
+    aggiungi_volo(dati, 'TA2', 10)
+    db.session.flush()
+    # La stessa sessione mette in cache il volo, poi lo annulla
+    assert numeri() == ['TA1', 'TA2']
+    db.session.rollback()
+    assert numeri() == ['TA1']
@@ -0,0 +1,87 @@
+"""
+Verifica le etichette dei posti della mappa (app/seat_map.py) quando la
+compagnia aumenta i posti di un volo già prenotato.
+
+Le classi sono piccole (una fila ciascuna) e vengono allargate a turno dopo
+la creazione della mappa, anche una classe che non è l'ultima della cabina:
+le file aggiunte non devono riusare i numeri di fila di un'altra classe, i
+posti già assegnati mantengono la loro etichetta e, prenotati tutti i posti
+del volo, nessuna etichetta compare due volte.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import db
+from app.booking import prenota, aggiorna_volo
+from app.models import Volo, Biglietto
+from app.seat_map import Disposizione, mappa_volo
+
+POSTI = {'first': 2, 'business': 4, 'economy': 6}
+
+
+@pytest.fixture
+def configurazione():
+    return {'RICERCA_USA_GRAFO': False, 'FILTRO_TRATTE': False}
+
+
+@pytest.fixture
+def volo(app, dati):
+    """Volo con POSTI posti; restituisce (id del volo, id del passeggero)."""
+    dati.aeroporti(('FCO', 'Roma'), ('MXP', 'Milano'))
+    dati.compagnia()
+    passeggero_id = dati.passeggero()
+    partenza = datetime.now().replace(microsecond=0) + timedelta(days=7)
+    volo_id = dati.volo('FCO', 'MXP', partenza, numero='TA100', posti=POSTI).id
+    db.session.commit()
+    return volo_id, passeggero_id
+
+
+def etichette_volo(volo_id):
+    return [numero for numero, in db.session.query(Biglietto.numero_posto).filter_by(flight_id=volo_id)]
+
+
+def test_disposizione_con_segmenti():
+    # 'first' su due segmenti: fila 1 e, aggiunte dopo la cabina, file 4-5
+    disposizione = Disposizione(1, 'AD', 6, segmenti=[[1, 1], [4, 2]])
+    etichette = [disposizione.etichetta(i) for i in range(disposizione.capacità)]
+    assert etichette == ['1A', '1D', '4A', '4D', '5A', '5D']
+    assert [disposizione.indice(e) for e in etichette] == list(range(6))
+    assert disposizione.indice('2A') is None
+    assert disposizione.indice('6A') is None
+    assert disposizione.fine == 6
+
+
+def test_posti_aggiunti_senza_etichette_duplicate(volo):
+    volo_id, passeggero_id = volo
+
+    # Crea la mappa: first fila 1, business fila 2, economy fila 3
+    prenota(passeggero_id, volo_id, 'first', 1)
+    prenota(passeggero_id, volo_id, 'economy', 2)
+    emesse = set(etichette_volo(volo_id))
+    assert emesse == {'1A', '3A', '3B'}
+
+    # Allarga una classe a metà cabina, poi l'ultima, poi di nuovo la prima
+    for classe, posti in (('first', 4), ('economy', 6), ('first', 2), ('business', 3)):
+        aggiorna_volo(volo_id, {}, {classe: posti})
+        prenota(passeggero_id, volo_id, classe, 1)
+
+    volo = db.session.get(Volo, volo_id)
+    for classe in POSTI:
+        liberi = getattr(volo, f'posti_{classe}')
+        if liberi:
+            prenota(passeggero_id, volo_id, classe, liberi)
+
+    etichette = etichette_volo(volo_id)
+    assert len(etichette) == sum(POSTI.values()) + 4 + 6 + 2 + 3
+    assert len(set(etichette)) == len(etichette)
+    assert emesse <= set(etichette)
+
+    # Le file delle classi non si sovrappongono
+    mappa = mappa_volo(volo_id)
+    file = [
+        inizio + i
+        for classe in mappa.values() for inizio, numero in classe['segmenti'] for i in range(numero)
+    ]
+    assert len(set(file)) == len(file)
+    assert mappa['first']['liberi'] == mappa['business']['liberi'] == mappa['economy']['liberi'] == 0